@@ -1,9 +1,10 @@
-from telegram import Update, BotCommand, ReplyKeyboardMarkup
+from telegram import Update, BotCommand, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
 import asyncio
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
 import os
 from dotenv import load_dotenv
 from app.database import SessionLocal
+from sqlalchemy.orm.exc import StaleDataError
 import logging
 from app.utils.bot_commands import set_bot_commands_async, get_token_from_env
 
@@ -14,9 +15,11 @@ logging.basicConfig(
 )
 logger = logging.getLogger("app.bot")
 
-from app.models.models import Work, Technician, WorkEvent, ONT, Modem, ONTModemSync
+from app.models.models import Work, Technician, ONT, Modem, ONTModemSync
 from datetime import datetime
 from app.utils.help_text import HELP_TEXT
+from app.utils import changes, inventory, journal, work_pages  # noqa: F401 - changes and inventory register their hooks for bot writes
+from app.utils.uow import UnitOfWork
 
 load_dotenv()
 
@@ -41,9 +44,38 @@ async def miei_lavori(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not tech:
             await update.message.reply_text("Tecnico non trovato. Contatta l'admin.")
             return
-        works = db.query(Work).filter(Work.tecnico_assegnato_id == tech.id).all()
-        text = "\n".join([f"WR {w.numero_wr} - {w.stato} - {w.indirizzo}" for w in works])
-    await update.message.reply_text(text or "Nessun lavoro assegnato")
+        include_closed = bool(context.args) and context.args[0].lower() in ("tutti", "all", "chiusi")
+        text, markup = work_pages.get_works_page(db, tech.id, 1, include_closed)
+    await update.message.reply_text(text, reply_markup=_inline_markup(markup))
+
+
+def _inline_markup(markup: dict | None):
+    """Convert a Bot API inline_keyboard dict into a python-telegram-bot markup."""
+    if not markup:
+        return None
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(b["text"], callback_data=b["callback_data"]) for b in row]
+        for row in markup.get("inline_keyboard", [])
+    ])
+
+
+async def miei_lavori_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle next/prev presses on the /miei_lavori inline keyboard"""
+    query = update.callback_query
+    parsed = work_pages.parse_callback_data(query.data)
+    if not parsed:
+        await query.answer()
+        return
+    page, include_closed = parsed
+    telegram_id = str(update.effective_user.id)
+    with SessionLocal() as db:
+        tech = db.query(Technician).filter(Technician.telegram_id == telegram_id).first()
+        if not tech:
+            await query.answer("Tecnico non trovato")
+            return
+        text, markup = work_pages.get_works_page(db, tech.id, page, include_closed)
+    await query.answer()
+    await query.edit_message_text(text, reply_markup=_inline_markup(markup))
 
 async def accetta(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
@@ -59,12 +91,13 @@ async def accetta(update: Update, context: ContextTypes.DEFAULT_TYPE):
         work = db.query(Work).filter(Work.numero_wr == wr, Work.tecnico_assegnato_id == tech.id).first()
         if work:
             work.stato = "in_corso"
-            event = WorkEvent(work_id=work.id, timestamp=datetime.now(), event_type="accepted", description="Accepted by tech", user_id=tech.id)
-            db.add(event)
             try:
-                db.commit()
+                with UnitOfWork(db) as uow:
+                    uow.event(work, journal.EventKind.ACCEPTED, journal.diff(work, ["stato"]), actor_id=tech.id, note="bot")
+            except StaleDataError:
+                await update.message.reply_text("Il lavoro è stato modificato nel frattempo, riprova")
+                return
             except Exception as e:
-                db.rollback()
                 await update.message.reply_text(f"Errore aggiornamento: {e}")
                 return
             
@@ -106,12 +139,13 @@ async def rifiuta(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if work:
             work.stato = "aperto"
             work.tecnico_assegnato_id = None
-            event = WorkEvent(work_id=work.id, timestamp=datetime.now(), event_type="rejected", description="Rejected by tech", user_id=tech.id)
-            db.add(event)
             try:
-                db.commit()
+                with UnitOfWork(db) as uow:
+                    uow.event(work, journal.EventKind.REJECTED, journal.diff(work, ["tecnico_assegnato_id", "stato"]), actor_id=tech.id, note="bot")
+            except StaleDataError:
+                await update.message.reply_text("Il lavoro è stato modificato nel frattempo, riprova")
+                return
             except Exception as e:
-                db.rollback()
                 await update.message.reply_text(f"Errore aggiornamento: {e}")
                 return
             await update.message.reply_text("Lavoro rifiutato")
@@ -142,12 +176,14 @@ async def chiudi(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         work.stato = "chiuso"
         work.data_chiusura = datetime.now()
-        event = WorkEvent(work_id=work.id, timestamp=datetime.now(), event_type="closed", description="Closed by tech", user_id=tech.id)
-        db.add(event)
         try:
-            db.commit()
+            with UnitOfWork(db) as uow:
+                uow.event(work, journal.EventKind.CLOSED, journal.diff(work, ["stato", "data_chiusura"]), actor_id=tech.id, note="bot")
+        except StaleDataError:
+            # reassigned or changed from the back office after it was read: nothing was written
+            await update.message.reply_text("Il lavoro è stato modificato nel frattempo, riprova")
+            return
         except Exception as e:
-            db.rollback()
             await update.message.reply_text(f"Errore aggiornamento: {e}")
             return
         await update.message.reply_text("Lavoro chiuso")
@@ -396,6 +432,7 @@ def main():
     logger.info("📝 Registrazione handlers comandi...")
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("miei_lavori", miei_lavori))
+    application.add_handler(CallbackQueryHandler(miei_lavori_page, pattern=f"^{work_pages.CALLBACK_PREFIX}:"))
     application.add_handler(CommandHandler("accetta", accetta))
     application.add_handler(CommandHandler("rifiuta", rifiuta))
     application.add_handler(CommandHandler("help", help_command))
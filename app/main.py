@@ -9,11 +9,13 @@ from dotenv import load_dotenv
 from telegram import Bot, BotCommand
 from app.utils.bot_commands import set_bot_commands_async, get_token_from_env, BOT_COMMANDS
 from app.database import engine
-from app.models import models
+from app.utils import concurrency, replication  # noqa: F401  (replication records deleted rows for the peer)
+from app.utils.schema import init_schema
 from pythonjsonlogger import jsonlogger
+from sqlalchemy.orm.exc import StaleDataError
 
 try:
-	models.Base.metadata.create_all(bind=engine)
+	init_schema(engine)
 except Exception as e:
 	# If DB isn't available (for example during local development without Postgres), warn and continue
 	import logging
@@ -50,7 +52,11 @@ except Exception:
 	pass
 
 # Include routers
-from app.routes import works, technicians, teams, stats, auth, telegram, documents, health, manual, debug, onts, modems, sync
+from app.routes import works, technicians, teams, stats, auth, telegram, documents, health, manual, debug, onts, modems, sync, live
+from app.routes import areas
+from app.routes import dispatch as dispatch_routes
+from app.routes import inventory as inventory_routes
+from app.routes import search as search_routes
 from telegram_endpoints import router as telegram_router
 app.include_router(works.router)
 app.include_router(technicians.router)
@@ -65,7 +71,18 @@ app.include_router(manual.router)
 app.include_router(debug.router)
 app.include_router(onts.router)
 app.include_router(modems.router)
+app.include_router(inventory_routes.router)
+app.include_router(dispatch_routes.router)
+app.include_router(areas.router)
 app.include_router(sync.router)
+app.include_router(live.router)
+app.include_router(search_routes.router)
+
+
+@app.exception_handler(StaleDataError)
+async def stale_data_handler(request: Request, exc: StaleDataError):
+	# A versioned row (work, ONT, modem) changed between read and write
+	return concurrency.conflict_response(request, exc)
 
 
 @app.exception_handler(Exception)
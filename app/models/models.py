@@ -1,10 +1,12 @@
-from sqlalchemy import Column, Integer, String, DateTime, JSON, ForeignKey, LargeBinary, Boolean, UniqueConstraint, Float, Text
+from sqlalchemy import Column, Integer, SmallInteger, String, DateTime, JSON, ForeignKey, LargeBinary, Boolean, UniqueConstraint, Float, Text, Index
 from sqlalchemy.orm import relationship
 from app.database import Base
 from datetime import datetime
 
 class Work(Base):
     __tablename__ = "works"
+    # Serves the per-technician work lists (/miei_lavori) filtered by state
+    __table_args__ = (Index("ix_works_tecnico_stato", "tecnico_assegnato_id", "stato"),)
 
     id = Column(Integer, primary_key=True, index=True)
     numero_wr = Column(String, unique=True, index=True)
@@ -41,6 +43,10 @@ class Work(Base):
     ont_cost = Column(Float, default=0.0)
     modem_cost = Column(Float, default=0.0)
 
+    # Optimistic concurrency: every ORM UPDATE checks and bumps it (app.utils.concurrency)
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    __mapper_args__ = {"version_id_col": version}
+
 class Technician(Base):
     __tablename__ = "technicians"
 
@@ -50,6 +56,8 @@ class Technician(Base):
     telefono = Column(String)
     squadra_id = Column(Integer, ForeignKey("teams.id"))
     telegram_id = Column(String, nullable=True)
+    # tipo_lavoro values the technician can be dispatched (null: all of them)
+    competenze = Column(JSON, nullable=True)
 
     squadra = relationship("Team")
 
@@ -60,6 +68,7 @@ class Team(Base):
     nome = Column(String)
 
 class WorkEvent(Base):
+    """Legacy free-text work events; no longer written, moved into ``work_journal`` at startup."""
     __tablename__ = "work_events"
 
     id = Column(Integer, primary_key=True)
@@ -70,6 +79,21 @@ class WorkEvent(Base):
     user_id = Column(Integer, ForeignKey("technicians.id"))
 
 
+class WorkJournalEntry(Base):
+    """One entry of a work's event journal (see app.utils.journal); replaces the free-text ``work_events``."""
+    __tablename__ = "work_journal"
+    # A work's timeline is one range scan of this index
+    __table_args__ = (Index("ix_work_journal_work_ts", "work_id", "ts"),)
+
+    id = Column(Integer, primary_key=True)
+    work_id = Column(Integer, ForeignKey("works.id"), nullable=False)
+    ts = Column(DateTime, nullable=False)
+    kind = Column(SmallInteger, nullable=False)  # journal.EventKind
+    actor_id = Column(Integer, nullable=True)  # technician (or user) behind the event
+    diff = Column(JSON, nullable=True)  # {field: [old, new]}
+    note = Column(String, nullable=True)  # short context: "csv", "document:12", ...
+
+
 class Document(Base):
     __tablename__ = "documents"
 
@@ -87,6 +111,33 @@ class Document(Base):
     applied_works = relationship("Work", secondary="document_applied_works", back_populates="documents")
 
 
+class DocumentPage(Base):
+    """Fingerprint and parsed entries of one page of a document (see app.utils.doc_pages)."""
+    __tablename__ = "document_pages"
+
+    id = Column(Integer, primary_key=True)
+    document_id = Column(Integer, ForeignKey("documents.id"), nullable=False, index=True)
+    page_no = Column(Integer, nullable=False)
+    fingerprint = Column(String, nullable=True, index=True)  # None for pages without text
+    entries = Column(JSON, nullable=True)
+
+
+class ProcessedFile(Base):
+    """Ledger of files ingested from disk, keyed by content hash (see app.utils.pdf_ingest)."""
+    __tablename__ = "processed_files"
+
+    id = Column(Integer, primary_key=True)
+    sha256 = Column(String, index=True, nullable=False)
+    path = Column(String, index=True)
+    size = Column(Integer)
+    mtime = Column(Float)
+    status = Column(String, default="parsed")  # parsed, duplicate (same content as document_id), failed
+    error = Column(String, nullable=True)
+    entries = Column(Integer, default=0)
+    document_id = Column(Integer, ForeignKey("documents.id"), nullable=True)
+    processed_at = Column(DateTime)
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -110,13 +161,16 @@ class DocumentAppliedWork(Base):
 
 class ONT(Base):
     __tablename__ = "onts"
+    # Stock lookups of the inventory engine (first available device of a model/location)
+    __table_args__ = (Index("ix_onts_status_location_model", "status", "location", "model"),)
 
     id = Column(Integer, primary_key=True, index=True)
     serial_number = Column(String, unique=True, index=True, nullable=False)
     model = Column(String, nullable=False)
     manufacturer = Column(String)
-    status = Column(String, default="available")  # available, assigned, installed, faulty
+    status = Column(String, default="available")  # available, reserved, assigned, installed, faulty
     work_id = Column(Integer, ForeignKey("works.id"), nullable=True)
+    reserved_until = Column(DateTime, nullable=True)  # status "reserved": released by the inventory engine after this
     assigned_date = Column(DateTime, nullable=True)
     installed_at = Column(DateTime, nullable=True)
     returned_date = Column(DateTime, nullable=True)
@@ -137,17 +191,22 @@ class ONT(Base):
     # Relationships
     work = relationship("Work", back_populates="ont")
 
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    __mapper_args__ = {"version_id_col": version}
+
 
 class Modem(Base):
     __tablename__ = "modems"
+    __table_args__ = (Index("ix_modems_status_location_model", "status", "location", "model"),)
 
     id = Column(Integer, primary_key=True, index=True)
     serial_number = Column(String, unique=True, index=True, nullable=False)
     model = Column(String, nullable=False)
     type = Column(String, nullable=False)  # adsl, vdsl, fiber, etc.
     manufacturer = Column(String)
-    status = Column(String, default="available")  # available, assigned, installed, faulty
+    status = Column(String, default="available")  # available, reserved, assigned, configured, installed, faulty
     work_id = Column(Integer, ForeignKey("works.id"), nullable=True)
+    reserved_until = Column(DateTime, nullable=True)
     
     # Configuration details
     wifi_ssid = Column(String)
@@ -174,6 +233,9 @@ class Modem(Base):
     # Relationships
     work = relationship("Work", back_populates="modem")
 
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    __mapper_args__ = {"version_id_col": version}
+
 
 class ONTModemSync(Base):
     __tablename__ = "ont_modem_sync"
@@ -197,3 +259,190 @@ class ONTModemSync(Base):
     modem = relationship("Modem")
     work = relationship("Work")
 
+
+
+class IngestIdempotencyKey(Base):
+    """Sender-provided Idempotency-Key of an ingest request and the response it produced."""
+    __tablename__ = "ingest_idempotency_keys"
+    __table_args__ = (UniqueConstraint("scope", "idempotency_key", name="uq_ingest_idempotency_scope_key"),)
+
+    id = Column(Integer, primary_key=True)
+    scope = Column(String, nullable=False)  # endpoint the key belongs to, e.g. works.ingest.bulk
+    idempotency_key = Column(String, nullable=False)
+    payload_hash = Column(String, nullable=True)  # sha256 of the payload, set once the request completed
+    status = Column(String, nullable=False, default="pending")  # pending, completed
+    response = Column(JSON, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+class ChangeLog(Base):
+    """One row per write to a synced entity; ``seq`` is the cursor of ``GET /works/changes``."""
+    __tablename__ = "change_log"
+    # AUTOINCREMENT keeps SQLite from reusing sequence numbers after pruning
+    __table_args__ = (
+        Index("ix_change_log_entity_seq", "entity", "seq"),
+        Index("ix_change_log_entity_row_seq", "entity", "entity_id", "seq"),
+        {"sqlite_autoincrement": True},
+    )
+
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    entity = Column(String, nullable=False)  # work, ont, modem, sync, technician, team
+    entity_id = Column(Integer, nullable=False)
+    op = Column(String, nullable=False, default="upsert")  # upsert, delete
+    changed_at = Column(DateTime, default=datetime.utcnow)
+
+
+class DatabaseEpoch(Base):
+    """Identity of this database's ``change_log`` sequence (one row); a restore replaces it (see app.utils.changes)."""
+    __tablename__ = "db_epoch"
+
+    id = Column(Integer, primary_key=True)
+    epoch = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class WorkMatchKey(Base):
+    """Blocking key of a work for fuzzy duplicate detection (see app.utils.fuzzy)."""
+    __tablename__ = "work_match_keys"
+
+    id = Column(Integer, primary_key=True)
+    work_id = Column(Integer, ForeignKey("works.id"), nullable=False, index=True)
+    key = Column(String, nullable=False, index=True)  # w:<wr digits or one-deletion variant>, n:<name token>, a:<address token>
+
+
+class Job(Base):
+    """Background job queue (see app.utils.jobs); workers lease rows instead of keeping jobs in memory."""
+    __tablename__ = "jobs"
+    # Next job to lease: pending, highest priority, oldest first; one job per scheduled slot
+    __table_args__ = (Index("ix_jobs_status_priority", "status", "priority", "id"),
+                      Index("ux_jobs_schedule_key", "schedule_key", unique=True))
+
+    id = Column(Integer, primary_key=True)
+    job_type = Column(String, nullable=False)  # sync, reindex, backup, archive, cleanup
+    params = Column(JSON, nullable=True)
+    schedule_key = Column(String, nullable=True)  # "<job_type>@<minute>" for jobs queued by the scheduler
+    status = Column(String, nullable=False, default="pending")  # pending, running, completed, failed
+    priority = Column(Integer, nullable=False, default=0)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    progress = Column(Integer, nullable=False, default=0)
+    message = Column(String, nullable=True)
+    result = Column(JSON, nullable=True)
+    error = Column(Text, nullable=True)
+    run_after = Column(DateTime, nullable=False, default=datetime.utcnow)  # retry backoff
+    lease_owner = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    completed_at = Column(DateTime, nullable=True)
+
+
+class SyncPeer(Base):
+    """Replication cursors towards one remote node (see app.utils.replication)."""
+    __tablename__ = "sync_peers"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True, nullable=False)  # peer URL or configured name
+    pull_cursor = Column(Integer, nullable=False, default=0)  # last remote change_log seq applied here
+    push_cursor = Column(Integer, nullable=False, default=0)  # last local change_log seq sent to the peer
+    last_sync_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+
+
+class SyncRow(Base):
+    """Last state of a row both nodes agreed on: the base of the three-way field merge."""
+    __tablename__ = "sync_rows"
+    __table_args__ = (UniqueConstraint("peer", "entity", "key", name="uq_sync_rows_peer_entity_key"),)
+
+    id = Column(Integer, primary_key=True)
+    peer = Column(String, nullable=False)
+    entity = Column(String, nullable=False)  # work, ont, modem
+    key = Column(String, nullable=False)  # numero_wr / serial_number
+    base = Column(JSON, nullable=True)  # None once deleted on both sides
+    base_hash = Column(String, nullable=False)
+    pending = Column(Boolean, nullable=False, default=False, index=True)  # local state still to be pushed
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class SyncTombstone(Base):
+    """Natural key of a deleted synced row, so the delete can be replicated by key."""
+    __tablename__ = "sync_tombstones"
+    __table_args__ = (Index("ix_sync_tombstones_entity_row", "entity", "entity_id"),)
+
+    id = Column(Integer, primary_key=True)
+    entity = Column(String, nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    key = Column(String, nullable=False)
+    deleted_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ArchivedWork(Base):
+    """A closed work moved out of ``works`` with everything that referenced it (see app.utils.archive)."""
+    __tablename__ = "archived_works"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)  # the id the work had in ``works``
+    numero_wr = Column(String, index=True)
+    operatore = Column(String)
+    stato = Column(String)
+    data_chiusura = Column(DateTime, index=True)
+    tecnico_assegnato_id = Column(Integer, nullable=True)
+    data = Column(JSON, nullable=False)  # the ``works`` row
+    events = Column(JSON, nullable=True)  # work_journal rows
+    documents = Column(JSON, nullable=True)  # {"applied": [document ids], "created": [document ids]}
+    equipment = Column(JSON, nullable=True)  # {"onts": [...], "modems": [...], "syncs": [ont_modem_sync rows]}
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ArchiveStat(Base):
+    """Closed-work counters of the archived works, so /stats does not scan the archive."""
+    __tablename__ = "archive_stats"
+    __table_args__ = (UniqueConstraint("dimension", "key", name="uq_archive_stats_dimension_key"),)
+
+    id = Column(Integer, primary_key=True)
+    dimension = Column(String, nullable=False)  # operator, technician, day
+    key = Column(String, nullable=False)  # operatore / technician id / YYYY-MM-DD
+    closed = Column(Integer, nullable=False, default=0)
+
+
+class InventoryStock(Base):
+    """Devices per kind, location, model and status (app.utils.inventory keeps it in step with onts/modems)."""
+    __tablename__ = "inventory_stock"
+    __table_args__ = (UniqueConstraint("kind", "location", "model", "status", name="uq_inventory_stock_key"),)
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)  # ont, modem
+    location = Column(String, nullable=False, default="")  # "" when the device has none
+    model = Column(String, nullable=False, default="")
+    status = Column(String, nullable=False)
+    quantity = Column(Integer, nullable=False, default=0)
+
+
+class AddressCache(Base):
+    """Parsed form of every distinct address text seen in works (app.utils.geocode); never needs the network."""
+    __tablename__ = "address_cache"
+
+    id = Column(Integer, primary_key=True)
+    key = Column(String, nullable=False, unique=True)  # accent-free, lower-case words of the raw address
+    canonical = Column(String)  # "Via Roma 12, 20121 Milano (MI)"
+    street_type = Column(String)  # via, viale, piazza, corso, ...
+    street = Column(String)
+    civico = Column(String)
+    cap = Column(String, index=True)
+    comune = Column(String)
+    provincia = Column(String)
+    area = Column(String)  # cluster key: CAP, else the normalized comune
+    lat = Column(Float, nullable=True)  # from the local gazetteer (GEOCODE_GAZETTEER), when it knows the area
+    lon = Column(Float, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class WorkLocation(Base):
+    """Area of each work, for clustering and per-area queries (kept in step with works.indirizzo)."""
+    __tablename__ = "work_locations"
+
+    work_id = Column(Integer, ForeignKey("works.id"), primary_key=True)
+    address_id = Column(Integer, ForeignKey("address_cache.id"), nullable=False)
+    area = Column(String, index=True)
+    cap = Column(String, index=True)
+    comune = Column(String, index=True)
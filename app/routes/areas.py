@@ -0,0 +1,52 @@
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.orm import Session
+
+from app.database import SessionLocal
+from app.utils import geocode
+from app.utils.security import verify_api_key
+
+router = APIRouter(prefix="/areas", tags=["areas"])
+
+
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+@router.get("")
+def list_areas(
+    by: str = Query("area", pattern="^(area|cap|comune)$", description="Group by area (CAP, else comune), CAP or comune"),
+    open_only: bool = Query(True, description="Count only works not closed yet"),
+    comune: Optional[str] = Query(None, description="Only the areas of this comune"),
+    db: Session = Depends(get_db),
+    api_key: str = Depends(verify_api_key),
+):
+    """Works clustered by area, largest cluster first, with the area's coordinates when the gazetteer knows them."""
+    return geocode.clusters(db, by=by, open_only=open_only, comune=comune)
+
+
+@router.get("/normalize")
+def normalize_address(address: str = Query(..., min_length=1), api_key: str = Depends(verify_api_key)):
+    """Canonical components of an address (street type, street, civico, CAP, comune, provincia), offline."""
+    return geocode.normalize(address)
+
+
+@router.get("/works")
+def works_in_area(
+    area: Optional[str] = None,
+    cap: Optional[str] = Query(None, pattern=r"^\d{5}$"),
+    comune: Optional[str] = None,
+    open_only: bool = True,
+    limit: int = Query(500, ge=1, le=5000),
+    db: Session = Depends(get_db),
+    api_key: str = Depends(verify_api_key),
+):
+    """Works of one area, CAP or comune, oldest appointment first."""
+    if not (area or cap or comune):
+        raise HTTPException(status_code=400, detail="Give area, cap or comune")
+    return geocode.works_in(db, area_key=area, cap=cap, comune=comune, open_only=open_only, limit=limit)
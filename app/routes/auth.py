@@ -1,12 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
 from jose import JWTError, jwt
-import os
 from sqlalchemy.orm import Session
 from app.database import SessionLocal
 from app.models.models import User
 from app.schemas import LoginRequest, RegisterRequest, Token
-from app.utils.auth import get_password_hash, verify_password, create_access_token, create_refresh_token, get_user_by_username, get_db, require_role, get_current_user, get_current_user_optional
+from app.utils.auth import SECRET_KEY, ALGORITHM, get_password_hash, verify_password, create_access_token, create_refresh_token, get_user_by_username, get_db, require_role, get_current_user, get_current_user_optional
 from fastapi import Body
+from app.utils import login as login_guard
 from datetime import timedelta
 
 router = APIRouter(prefix="/auth", tags=["auth"])
@@ -36,12 +36,27 @@ def register(payload: RegisterRequest, db: Session = Depends(get_db_dep), curren
 
 
 @router.post("/login", response_model=Token)
-def login(payload: LoginRequest, db: Session = Depends(get_db_dep)):
+def login(payload: LoginRequest, request: Request, db: Session = Depends(get_db_dep)):
+    ip = request.client.host if request.client else None
+    retry_after = login_guard.check_throttle(payload.username, ip)
+    if retry_after:
+        raise HTTPException(status_code=429, detail="Too many failed login attempts", headers={"Retry-After": str(retry_after)})
     user = db.query(User).filter(User.username == payload.username).first()
     if not user:
+        login_guard.record_failure(payload.username, ip)
         raise HTTPException(status_code=401, detail="Incorrect username or password")
-    if not verify_password(payload.password, user.hashed_password):
+    try:
+        valid, new_hash = login_guard.verifier.verify(payload.password, user.hashed_password)
+    except login_guard.Busy:
+        raise HTTPException(status_code=503, detail="Login temporarily unavailable, retry shortly", headers={"Retry-After": "1"})
+    if not valid:
+        login_guard.record_failure(payload.username, ip)
         raise HTTPException(status_code=401, detail="Incorrect username or password")
+    login_guard.record_success(payload.username)
+    if new_hash:
+        # stored with outdated parameters: upgrade it now that we have the password
+        user.hashed_password = new_hash
+        db.commit()
     access_token = create_access_token({"sub": user.username, "role": user.role})
     refresh_token = create_refresh_token({"sub": user.username, "role": user.role})
     return {"access_token": access_token, "token_type": "bearer", "expires_in": 60 * 60, "refresh_token": refresh_token}
@@ -50,7 +65,7 @@ def login(payload: LoginRequest, db: Session = Depends(get_db_dep)):
 @router.post("/refresh", response_model=Token)
 def refresh_token(refresh_token: str = Body(...), db: Session = Depends(get_db_dep)):
     try:
-        payload = jwt.decode(refresh_token, os.getenv("SECRET_KEY") or "unsafe-secret", algorithms=["HS256"])
+        payload = jwt.decode(refresh_token, SECRET_KEY, algorithms=[ALGORITHM])
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid refresh token")
     username = payload.get("sub")
@@ -1,7 +1,7 @@
 from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.orm import Session
 from app.database import SessionLocal
-from app.models.models import Work, Technician, Team, Document, WorkEvent, DocumentAppliedWork, User
+from app.models.models import Work, Technician, Team, Document, WorkEvent, WorkJournalEntry, DocumentAppliedWork, User
 from app.utils.auth import auth_required
 from typing import List
 import base64
@@ -28,6 +28,7 @@ def debug_db(table: str = Query('works'), limit: int = Query(100), db: Session =
         'teams': Team,
         'documents': Document,
         'work_events': WorkEvent,
+        'work_journal': WorkJournalEntry,
         'document_applied_works': DocumentAppliedWork,
         'users': User
     }
@@ -0,0 +1,50 @@
+from datetime import date
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Query, Response
+from sqlalchemy.orm import Session
+
+from app.database import SessionLocal
+from app.utils import dispatch, jobs
+from app.utils.auth import auth_required
+from app.utils.uow import UnitOfWork
+
+router = APIRouter(prefix="/dispatch", tags=["dispatch"])
+
+
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+@router.post("")
+def dispatch_works(
+    response: Response,
+    preview: bool = Query(False, description="Return the plan without assigning anything"),
+    background: bool = Query(False, description="Run as a 'dispatch' job and return its id"),
+    day: Optional[date] = Query(None, description="Only works with the appointment on this day (default: all open works)"),
+    team_id: Optional[int] = Query(None, description="Only technicians of this team"),
+    max_open_works: Optional[int] = Query(None, ge=1, le=100, description="Open works per technician (default DISPATCH_MAX_OPEN_WORKS)"),
+    notify: bool = Query(True, description="Send each technician the list of works dispatched to them"),
+    db: Session = Depends(get_db),
+    current_user = Depends(auth_required(['admin', 'backoffice'])),
+):
+    """Assign the open, unassigned works to technicians balancing load, teams, skills and locality."""
+    if background:
+        params = {"day": day.isoformat() if day else None, "team_id": team_id, "max_open_works": max_open_works,
+                  "preview": preview, "notify": notify}
+        job = jobs.enqueue(db, "dispatch", {k: v for k, v in params.items() if v is not None})
+        response.status_code = 202
+        return {"job_id": job.id, "status": job.status}
+    planned = dispatch.plan(db, day=day, team_id=team_id, capacity=max_open_works)
+    if preview:
+        return {**planned, "preview": True}
+    with UnitOfWork(db) as uow:
+        done = dispatch.apply(db, planned)
+        if notify:
+            uow.notify(dispatch.notify_technicians, db, done)
+    skipped = len(planned["assigned"]) - len(done)
+    return {**planned, "assigned": done, "preview": False, "skipped": skipped}
@@ -1,22 +1,18 @@
 from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Response, Body, Query
 from sqlalchemy.orm import Session
 from app.database import SessionLocal
-from app.models.models import Document, Work, WorkEvent, Technician, DocumentAppliedWork
+from app.models.models import Document, Work, Technician, DocumentAppliedWork
 import app.utils.telegram as telegram_utils
 from app.schemas import DocumentOut
 from typing import List
 from datetime import datetime
 from app.utils.auth import auth_required
 from app.utils.ocr import extract_wr_fields, normalize_numero_wr, extract_wr_entries
-try:
-    import pytesseract
-    from PIL import Image
-except Exception:
-    pytesseract = None
-    Image = None
-import pdfplumber
-from io import BytesIO
+from app.utils import doc_pages, fuzzy, journal
+from app.utils.uow import UnitOfWork
+from app.utils.pdf_ingest import extract_pages
 from sqlalchemy.exc import IntegrityError
+import copy
 import json
 
 router = APIRouter(prefix="/documents", tags=["documents"])
@@ -66,44 +62,23 @@ def parse_document(doc_id: int, db: Session = Depends(get_db)):
     if not doc:
         raise HTTPException(status_code=404, detail="Document not found")
     text = None
+    pages_text = None
     ocr_used = False
     try:
         # Ensure this is a PDF (file extension or mime) — images and text are not supported here
         if not (doc.filename and doc.filename.lower().endswith('.pdf')) and not (doc.mime and 'pdf' in (doc.mime or '').lower()):
             raise HTTPException(status_code=400, detail='Only PDF parsing is supported')
-        # Try pdf extraction
-        text = None
-        try:
-            with pdfplumber.open(BytesIO(doc.content)) as pdf:
-                # Gather full text and per-page texts
-                pages_text = [p.extract_text() or '' for p in pdf.pages]
-                text = '\n'.join(pages_text)
-                # If nothing found and OCR available, fallback to OCR for each page
-                if (not text or len(text.strip()) == 0) and pytesseract:
-                    ocr_pages = []
-                    for p in pdf.pages:
-                        try:
-                            # Render page to image and OCR via pytesseract
-                            pil_image = p.to_image(resolution=200).original
-                            page_text = pytesseract.image_to_string(pil_image)
-                            ocr_pages.append(page_text)
-                        except Exception:
-                            # best effort; if rendering or OCR fails skip page
-                            continue
-                    if ocr_pages:
-                        text = '\n'.join(ocr_pages)
-                        ocr_used = True
-        except Exception:
-            # If pdfplumber fails to parse the file (e.g., for test stubs that are not a real PDF), try to decode the content as UTF-8 and parse JSON as a fallback
-            try:
-                text = doc.content.decode('utf-8')
-            except Exception:
-                text = None
+        # Extract page texts (OCR fallback for scanned pages). Content that is not a real PDF
+        # (e.g. test stubs) comes back decoded as UTF-8 and is parsed as JSON below
+        text, pages_text, ocr_used = extract_pages(doc.content)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
     # Attempt to parse JSON content first (and accept JSON lists)
     parsed = None
+    previous = None
+    page_records = []
+    unchanged_pages = []
     try:
         parsed_json = json.loads(text)
         if isinstance(parsed_json, dict):
@@ -120,9 +95,23 @@ def parse_document(doc_id: int, db: Session = Depends(get_db)):
         parsed_entries = []
         try:
             # Use pages_text if available
-            if 'pages_text' in locals():
-                for ptext in pages_text:
-                    parsed_entries.extend([e for e in extract_wr_entries(ptext) if e])
+            if pages_text is not None:
+                # A revision of an earlier document only needs its changed pages parsed
+                page_prints = [doc_pages.fingerprint(ptext) for ptext in pages_text]
+                previous = doc_pages.find_previous_revision(db, doc, page_prints)
+                previous_entries = doc_pages.entries_by_fingerprint(db, previous.id) if previous else {}
+                for page_no, ptext in enumerate(pages_text):
+                    fp = page_prints[page_no]
+                    if fp in previous_entries:
+                        page_entries = copy.deepcopy(previous_entries[fp])
+                        unchanged_pages.append(page_no)
+                    else:
+                        page_entries = [e for e in extract_wr_entries(ptext) if e]
+                    page_records.append((page_no, fp, copy.deepcopy(page_entries)))
+                    if fp in previous_entries:
+                        for e in page_entries:
+                            e[doc_pages.UNCHANGED_KEY] = previous.id
+                    parsed_entries.extend(page_entries)
             else:
                 parsed_entries = extract_wr_entries(text)
         except Exception:
@@ -181,16 +170,61 @@ def parse_document(doc_id: int, db: Session = Depends(get_db)):
         if ocr_used and 'ocr' not in methods_list:
             methods_list.append('ocr')
         parsed['parse_debug'] = {'methods': methods_list, 'candidates': list(candidates)}
+        if previous is not None:
+            parsed['parse_debug']['revision'] = {
+                'of': previous.id,
+                'unchanged_pages': unchanged_pages,
+                'changed_pages': [page_no for page_no, _fp, _entries in page_records if page_no not in unchanged_pages],
+            }
     except Exception:
         # don't fail parsing for debug aggregation
         pass
+    # Propose existing works for entries whose WR is not known verbatim (OCR misreads, typos)
+    try:
+        if isinstance(parsed.get('entries'), list):
+            indexed = [(i, e) for i, e in enumerate(parsed['entries']) if isinstance(e, dict)]
+            known = set()
+            wrs = [e.get('numero_wr') for _, e in indexed if e.get('numero_wr')]
+            if wrs:
+                known = {n for (n,) in db.query(Work.numero_wr).filter(Work.numero_wr.in_(wrs))}
+            pending = [(i, e) for i, e in indexed if not e.get('numero_wr') or e.get('numero_wr') not in known]
+            found = fuzzy.find_matches_many(db, [(e.get('numero_wr'), e.get('nome_cliente'), e.get('indirizzo')) for _, e in pending])
+            match_candidates = {}
+            for (i, e), cands in zip(pending, found):
+                if cands:
+                    e['match_candidates'] = cands
+                    match_candidates[str(i)] = cands
+            parsed.setdefault('parse_debug', {})['match_candidates'] = match_candidates
+    except Exception:
+        pass
     doc.parsed_data = parsed
     doc.parsed = True
+    if page_records:
+        doc_pages.store(db, doc.id, page_records)
     db.commit()
     db.refresh(doc)
     return doc
 
 
+def _notify_document_work(db: Session, doc: Document, work: Work):
+    """Notify the assigned technician (or every linked one) about a work applied from ``doc``."""
+    try:
+        msg = f"Nuovo lavoro WR {work.numero_wr} creato dal documento {doc.filename} (id:{doc.id})"
+        if work.tecnico_assegnato_id:
+            tech = db.query(Technician).filter(Technician.id == work.tecnico_assegnato_id).first()
+            if tech and tech.telegram_id:
+                telegram_utils.send_message_to_telegram(tech.telegram_id, msg)
+        else:
+            # Fallback: notify all technicians with a linked telegram_id (helpful for review/notification)
+            techs = db.query(Technician).filter(Technician.telegram_id != None).all()
+            for t in techs:
+                if t.telegram_id:
+                    telegram_utils.send_message_to_telegram(t.telegram_id, msg)
+    except Exception:
+        # Don't fail the endpoint on notification errors; just log and continue
+        pass
+
+
 @router.post("/{doc_id}/apply", response_model=DocumentOut)
 def apply_document(doc_id: int, db: Session = Depends(get_db), override: dict | None = Body(None), selected_indices: List[int] | None = Query(None)):
     doc = db.query(Document).filter(Document.id == doc_id).first()
@@ -237,14 +271,41 @@ def apply_document(doc_id: int, db: Session = Depends(get_db), override: dict |
             raise HTTPException(status_code=400, detail='Invalid override payload')
 
     applied_ids = []
+    matched = []
+    possible_duplicates = []
+    skipped = []
+    applied_revisions = {}
+    # the whole document is applied in one transaction; entries are flushed so later ones can match them
+    uow = UnitOfWork(db)
     for idx, entry in enumerate(entries):
         data_entry = dict(entry or {})
         if overrides:
             data_entry.update(overrides[idx])
         numero_wr = normalize_numero_wr(data_entry.get('numero_wr') or None)
+        unchanged_from = data_entry.get(doc_pages.UNCHANGED_KEY)
+        if unchanged_from and numero_wr and not selected_indices:
+            # entry of an unchanged page that the earlier revision already applied: nothing new to write
+            if unchanged_from not in applied_revisions:
+                applied_revisions[unchanged_from] = doc_pages.applied_numeri_wr(db, unchanged_from)
+            if numero_wr in applied_revisions[unchanged_from]:
+                skipped.append({'entry': idx, 'numero_wr': data_entry.get('numero_wr'), 'unchanged_from': unchanged_from})
+                continue
         work = None
-        if numero_wr:
+        candidates = []
+        if data_entry.get('match_work_id'):
+            # operator picked one of the proposed match_candidates
+            work = db.query(Work).filter(Work.id == data_entry['match_work_id']).first()
+            if not work:
+                raise HTTPException(status_code=400, detail=f"match_work_id {data_entry['match_work_id']} not found")
+            matched.append({'entry': idx, 'numero_wr': numero_wr, 'work_id': work.id, 'reason': 'override'})
+        elif numero_wr:
             work = db.query(Work).filter(Work.numero_wr == numero_wr).first()
+        if not work:
+            candidates = fuzzy.find_matches(db, numero_wr, data_entry.get('nome_cliente'), data_entry.get('indirizzo'))
+            if candidates and fuzzy.is_confident(candidates[0]):
+                work = db.query(Work).filter(Work.id == candidates[0]['work_id']).first()
+                if work:
+                    matched.append({'entry': idx, 'numero_wr': numero_wr, 'work_id': work.id, 'reason': 'fuzzy', 'score': candidates[0]['score']})
         if not work:
             work = Work(
                 numero_wr=numero_wr or ('WR-' + str(int(datetime.now().timestamp()))),
@@ -255,17 +316,16 @@ def apply_document(doc_id: int, db: Session = Depends(get_db), override: dict |
                 data_apertura=datetime.now(),
                 extra_fields=data_entry.get('extra_fields') or {}
             )
-            db.add(work)
+            uow.add(work)
+            uow.event(work, journal.EventKind.CREATED, note=f'document:{doc.id}')
             try:
-                db.commit()
+                db.flush()
             except IntegrityError as e:
-                db.rollback()
+                uow.rollback()
                 # Skip or rethrow - better to rethrow so caller knows
                 raise HTTPException(status_code=409, detail=str(e))
-            db.refresh(work)
-            ev = WorkEvent(work_id=work.id, timestamp=datetime.now(), event_type='created', description=f'Created from document {doc.id}', user_id=None)
-            db.add(ev)
-            db.commit()
+            if candidates:
+                possible_duplicates.append({'entry': idx, 'work_id': work.id, 'candidates': candidates})
         else:
             # update
             work.operatore = data_entry.get('operatore', work.operatore)
@@ -274,22 +334,24 @@ def apply_document(doc_id: int, db: Session = Depends(get_db), override: dict |
             work.tipo_lavoro = data_entry.get('tipo_lavoro', work.tipo_lavoro)
             work.extra_fields = work.extra_fields or {}
             work.extra_fields.update(data_entry.get('extra_fields') or {})
-            db.commit()
-            ev = WorkEvent(work_id=work.id, timestamp=datetime.now(), event_type='updated', description=f'Updated from document {doc.id}', user_id=None)
-            db.add(ev)
-            db.commit()
+            uow.event(work, journal.EventKind.UPDATED, journal.diff(work, ['operatore', 'indirizzo', 'nome_cliente', 'tipo_lavoro']), note=f'document:{doc.id}')
         # Create a DocumentAppliedWork row if not already present
         existing_assoc = db.query(DocumentAppliedWork).filter(DocumentAppliedWork.document_id == doc.id, DocumentAppliedWork.work_id == work.id).first()
         if not existing_assoc:
             assoc = DocumentAppliedWork(document_id=doc.id, work_id=work.id, applied_at=datetime.now())
-            db.add(assoc)
-            db.commit()
+            uow.add(assoc)
+            db.flush()
         applied_ids.append(work.id)
     # attach list of applied ids into parsed_data for traceability, keeping raw_text if present
     parsed = doc.parsed_data or {}
     if isinstance(parsed, dict):
         new_parsed = dict(parsed)
         new_parsed['applied_work_ids'] = applied_ids
+        parse_debug = dict(new_parsed.get('parse_debug') or {})
+        parse_debug['applied_matches'] = matched
+        parse_debug['possible_duplicates'] = possible_duplicates
+        parse_debug['skipped_entries'] = skipped
+        new_parsed['parse_debug'] = parse_debug
         doc.parsed_data = new_parsed
     else:
         # defensive copy
@@ -298,26 +360,10 @@ def apply_document(doc_id: int, db: Session = Depends(get_db), override: dict |
     if applied_ids:
         doc.applied_work_id = applied_ids[0]
         # Add a summary event showing document was applied to multiple works
-        ev_summary = WorkEvent(work_id=applied_ids[0], timestamp=datetime.now(), event_type='applied_from_document', description=f'Applied document {doc.id} to {len(applied_ids)} works', user_id=None)
-        db.add(ev_summary)
-    db.commit()
+        uow.event(applied_ids[0], journal.EventKind.APPLIED_FROM_DOCUMENT, note=f'document:{doc.id} works:{len(applied_ids)}')
+        uow.notify(_notify_document_work, db, doc, work)
+    uow.commit()
     db.refresh(doc)
-    # Notify assigned technician via Telegram if available
-    try:
-        msg = f"Nuovo lavoro WR {work.numero_wr} creato dal documento {doc.filename} (id:{doc.id})"
-        if work.tecnico_assegnato_id:
-            tech = db.query(Technician).filter(Technician.id == work.tecnico_assegnato_id).first()
-            if tech and tech.telegram_id:
-                telegram_utils.send_message_to_telegram(tech.telegram_id, msg)
-        else:
-            # Fallback: notify all technicians with a linked telegram_id (helpful for review/notification)
-            techs = db.query(Technician).filter(Technician.telegram_id != None).all()
-            for t in techs:
-                if t.telegram_id:
-                    telegram_utils.send_message_to_telegram(t.telegram_id, msg)
-    except Exception:
-        # Don't fail the endpoint on notification errors; just log and continue
-        pass
     return doc
 
 
@@ -334,6 +380,7 @@ def delete_document(doc_id: int, db: Session = Depends(get_db)):
     doc = db.query(Document).filter(Document.id == doc_id).first()
     if not doc:
         raise HTTPException(status_code=404, detail='Document not found')
+    doc_pages.delete_pages(db, doc.id)
     db.delete(doc)
     db.commit()
     return {"message": "Document deleted"}
@@ -0,0 +1,94 @@
+from datetime import date, timedelta
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Path, Query
+from pydantic import BaseModel, Field
+from sqlalchemy.orm import Session
+
+from app.database import SessionLocal
+from app.models.models import Work
+from app.utils import inventory
+from app.utils.security import verify_api_key
+from app.utils.uow import UnitOfWork
+
+router = APIRouter(prefix="/inventory", tags=["inventory"])
+
+KIND_PATTERN = "^(ont|modem)$"
+
+
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+class ReserveRequest(BaseModel):
+    kind: str = Field(..., pattern=KIND_PATTERN)
+    work_id: int
+    model: Optional[str] = None
+    location: Optional[str] = None
+    ttl_hours: Optional[float] = Field(None, gt=0, le=24 * 30)
+
+
+@router.get("/stock")
+def get_stock(
+    kind: Optional[str] = Query(None, pattern=KIND_PATTERN),
+    location: Optional[str] = None,
+    model: Optional[str] = None,
+    db: Session = Depends(get_db),
+    api_key: str = Depends(verify_api_key),
+):
+    """Devices per kind, location and model, with a count per status (available, reserved, assigned, ...)."""
+    return inventory.stock(db, kind=kind, location=location, model=model)
+
+
+@router.post("/reserve")
+def reserve_device(payload: ReserveRequest, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
+    """Reserve the first available device of the given model/location for a work, until the TTL expires."""
+    if db.query(Work.id).filter(Work.id == payload.work_id).first() is None:
+        raise HTTPException(status_code=404, detail="Work not found")
+    ttl = timedelta(hours=payload.ttl_hours) if payload.ttl_hours else None
+    with UnitOfWork(db):
+        reserved = inventory.reserve(db, payload.kind, payload.work_id, model=payload.model,
+                                     location=payload.location, ttl=ttl)
+    if reserved is None:
+        raise HTTPException(status_code=409, detail="No device of this kind in stock")
+    return reserved
+
+
+@router.post("/{kind}/{device_id}/release")
+def release_device(device_id: int, kind: str = Path(..., pattern=KIND_PATTERN), work_id: Optional[int] = None,
+                   db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
+    """Put a reserved device back in stock (only if reserved for ``work_id``, when given)."""
+    with UnitOfWork(db):
+        released = inventory.release(db, kind, device_id, work_id)
+    if not released:
+        raise HTTPException(status_code=409, detail="Device is not reserved")
+    return {"message": "Reservation released"}
+
+
+@router.post("/{kind}/{device_id}/consume/{work_id}")
+def consume_device(device_id: int, work_id: int, kind: str = Path(..., pattern=KIND_PATTERN),
+                   db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
+    """Assign the device to the work, from its reservation or straight from stock."""
+    if db.query(Work.id).filter(Work.id == work_id).first() is None:
+        raise HTTPException(status_code=404, detail="Work not found")
+    with UnitOfWork(db):
+        consumed = inventory.consume(db, kind, device_id, work_id)
+    if not consumed:
+        raise HTTPException(status_code=409, detail="Device is neither available nor reserved for this work")
+    return {"message": "Device assigned"}
+
+
+@router.post("/auto-assign")
+def auto_assign_devices(
+    day: Optional[date] = Query(None, description="Appointment day of the works (default: tomorrow)"),
+    location: Optional[str] = Query(None, description="Take devices from this location only"),
+    db: Session = Depends(get_db),
+    api_key: str = Depends(verify_api_key),
+):
+    """Reserve an ONT and a modem for every open work of the day that still needs them, in one transaction."""
+    with UnitOfWork(db):
+        return inventory.auto_assign(db, day=day, location=location)
@@ -0,0 +1,103 @@
+import asyncio
+import json
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+
+from app.database import SessionLocal
+from app.utils import changes, live, security
+from app.utils.live import hub, HEARTBEAT_SECONDS
+
+router = APIRouter(prefix="/live", tags=["live"])
+
+# Entities readable without the API key, same as the public GET /works/
+PUBLIC_ENTITIES = {"work"}
+
+
+def _format(item: dict) -> str:
+    lines = []
+    if item.get("seq") is not None:
+        lines.append(f"id: {item['seq']}")
+    lines.append(f"event: {item.get('type', 'change')}")
+    lines.append("data: " + json.dumps(item, separators=(",", ":"), default=str))
+    return "\n".join(lines) + "\n\n"
+
+
+def _backlog(since: int, entities):
+    db = SessionLocal()
+    try:
+        return changes.fetch_changes(db, since=since, limit=changes.MAX_LIMIT, entities=sorted(entities))
+    finally:
+        db.close()
+
+
+@router.post("/token")
+def live_token(api_key: str = Depends(security.verify_api_key)):
+    """Short-lived signed token for ``GET /live/events?token=`` (EventSource cannot send X-API-Key)."""
+    return {"token": live.stream_token(), "expires_in": live.STREAM_TOKEN_SECONDS}
+
+
+@router.get("/events")
+async def live_events(
+    request: Request,
+    entities: Optional[str] = Query(None, description="Comma separated subset of work,ont,modem,sync,technician,team"),
+    token: Optional[str] = Query(None, description="Stream token from POST /live/token"),
+    since: Optional[int] = Query(None, description="Replay the changes after this seq (a reopened stream)"),
+    x_api_key: Optional[str] = Header(None),
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID"),
+):
+    """Server-Sent Events stream of committed changes.
+
+    Every ``change`` event carries the same entry as ``GET /works/changes``
+    (``seq``, ``entity``, ``id``, ``op``, ``data``); ``data`` is null for
+    deletes and bulk ingest writes, in which case the client should refetch
+    the row. On reconnect the browser sends ``Last-Event-ID`` and the missed
+    entries are replayed first; a ``reset`` event means the client has to
+    reload everything. A stream reopened by the client (e.g. with a fresh
+    token once the browser gave up reconnecting) passes the last seq as
+    ``since``. Without ``X-API-Key`` or a valid ``token`` only works are
+    streamed; an expired token is refused, so the client fetches a new one.
+    """
+    if token and not live.valid_stream_token(token):
+        raise HTTPException(status_code=403, detail="Invalid or expired stream token")
+    full = bool(token) or bool(x_api_key and x_api_key == security.api_key())
+    allowed = set(changes.ENTITIES) if full else set(PUBLIC_ENTITIES)
+    if since is not None and not (last_event_id and last_event_id.isdigit()):
+        last_event_id = str(since)
+    wanted = allowed
+    if entities:
+        wanted = {e.strip() for e in entities.split(",") if e.strip()}
+        unknown = wanted - set(changes.ENTITIES)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown entities: {', '.join(sorted(unknown))}")
+        if not wanted <= allowed:
+            raise HTTPException(status_code=403, detail="Invalid API Key")
+
+    async def stream():
+        # Subscribe before reading the backlog so nothing committed in between is lost (clients dedupe on seq)
+        subscriber = hub.subscribe(wanted)
+        try:
+            yield "retry: 5000\n: subscribed\n\n"
+            if last_event_id and last_event_id.isdigit():
+                backlog = await asyncio.to_thread(_backlog, int(last_event_id), wanted)
+                if backlog["reset"] or backlog["has_more"]:
+                    yield _format({"type": "reset", "seq": backlog["cursor"]})
+                else:
+                    for entry in backlog["changes"]:
+                        yield _format({"type": "change", **entry})
+            while not await request.is_disconnected():
+                try:
+                    item = await asyncio.wait_for(subscriber.queue.get(), timeout=HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    # Comment line keeps proxies from closing an idle connection
+                    yield ": ping\n\n"
+                    continue
+                yield _format(item)
+        finally:
+            hub.unsubscribe(subscriber)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",  # disable nginx response buffering
+    })
@@ -1,8 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException, Body
 from sqlalchemy.orm import Session
 from app.database import SessionLocal
-from app.models.models import Work, Technician, WorkEvent
+from app.models.models import Work, Technician
 from app.utils.auth import auth_required
+from app.utils import journal
+from app.utils.uow import UnitOfWork
 from datetime import datetime
 import logging
 from typing import Optional
@@ -105,15 +107,11 @@ def manual_create_work(payload: dict = Body(...), db: Session = Depends(get_db),
         work.extra_fields = extra
 
     try:
-        db.add(work)
-        db.commit()
+        with UnitOfWork(db) as uow:
+            uow.add(work)
+            uow.event(work, journal.EventKind.CREATED, note='manual')
         db.refresh(work)
-        # Add event to track manual creation
-        ev = WorkEvent(work_id=work.id, timestamp=datetime.now(), event_type='created_manual', description='Created via manual entry', user_id=None)
-        db.add(ev)
-        db.commit()
     except Exception as e:
-        db.rollback()
         logger.exception('Failed to insert manual work: %s', e)
         raise HTTPException(status_code=500, detail='DB error')
     return { 'ok': True, 'id': work.id, 'numero_wr': work.numero_wr }
@@ -1,11 +1,14 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from sqlalchemy.orm import Session
 from sqlalchemy import func
 from app.database import SessionLocal
 from app.models.models import Modem, Work
 from typing import List, Optional
 from app.utils.security import verify_api_key
-from pydantic import BaseModel
+from app.utils import fastjson
+from app.utils import concurrency, device_ingest, etag, inventory
+from app.utils.ingest import DEFAULT_CHUNK_SIZE
+from pydantic import BaseModel, ValidationError
 from datetime import datetime
 
 router = APIRouter(prefix="/modems", tags=["modems"])
@@ -65,12 +68,17 @@ class ModemOut(BaseModel):
     location: Optional[str]
     created_at: datetime
     updated_at: datetime
+    version: Optional[int] = None
 
     class Config:
         from_attributes = True
 
+MODEM_OUT_COLUMNS = fastjson.model_columns(Modem, ModemOut)
+
 @router.get("/", response_model=List[ModemOut])
 def get_modems(
+    request: Request,
+    response: Response,
     status: Optional[str] = None,
     type: Optional[str] = None,
     assigned: Optional[bool] = None,
@@ -78,25 +86,34 @@ def get_modems(
     api_key: str = Depends(verify_api_key)
 ):
     """Get all modems with optional filtering"""
-    query = db.query(Modem)
+    not_modified = etag.check(request, response, db, ["modem"])
+    if not_modified is not None:
+        return not_modified
+    criteria = []
 
     if status:
-        query = query.filter(Modem.status == status)
+        criteria.append(Modem.status == status)
 
     if type:
-        query = query.filter(Modem.type == type)
+        criteria.append(Modem.type == type)
 
     if assigned is not None:
         if assigned:
-            query = query.filter(Modem.work_id.isnot(None))
+            criteria.append(Modem.work_id.isnot(None))
         else:
-            query = query.filter(Modem.work_id.is_(None))
+            criteria.append(Modem.work_id.is_(None))
 
-    return query.all()
+    if fastjson.enabled():
+        return fastjson.response(fastjson.select_dicts(db, MODEM_OUT_COLUMNS, criteria), response)
+    return db.query(Modem).filter(*criteria).all()
 
 @router.get("/{modem_id}", response_model=ModemOut)
-def get_modem(modem_id: int, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
+def get_modem(modem_id: int, request: Request, response: Response, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
     """Get modem by ID"""
+    current = db.query(Modem.version).filter(Modem.id == modem_id).scalar()
+    not_modified = etag.check(request, response, db, [("modem", modem_id)], resource_version=current, exists=current is not None)
+    if not_modified is not None:
+        return not_modified
     modem = db.query(Modem).filter(Modem.id == modem_id).first()
     if not modem:
         raise HTTPException(status_code=404, detail="Modem not found")
@@ -116,33 +133,75 @@ def create_modem(modem: ModemCreate, db: Session = Depends(get_db), api_key: str
     db.refresh(db_modem)
     return db_modem
 
+def _feed_devices(registrar: device_ingest.DeviceRegistrar, batch, defaults: dict) -> None:
+    for index, item in batch:
+        record = {"serial_number": item} if isinstance(item, str) else item
+        if not isinstance(record, dict):
+            registrar.add_error(index, None, "expected an object or a serial number")
+            continue
+        record = {**defaults, **{k: v for k, v in record.items() if v not in (None, "")}}
+        try:
+            registrar.add(index, ModemCreate.model_validate(record).model_dump())
+        except ValidationError as e:
+            registrar.add_error(index, record.get("serial_number"), "; ".join(err["msg"] for err in e.errors()))
+
+@router.post("/bulk", openapi_extra={
+    "requestBody": {
+        "content": {
+            "text/csv": {"schema": {"type": "string", "description": "Header row (serial_number/seriale/sn, model, ...) or one serial per line"}},
+            "application/x-ndjson": {"schema": {"type": "string", "description": "One ModemCreate object or serial string per line"}},
+            "application/json": {"schema": {"type": "object", "properties": {"devices": {"type": "array", "items": {"type": "object"}}}}},
+        },
+        "required": True,
+    }
+})
+async def register_modems_bulk(
+    request: Request,
+    chunk_size: int = Query(DEFAULT_CHUNK_SIZE, ge=1, le=5000),
+    model: Optional[str] = Query(None, description="Default model for rows without one"),
+    manufacturer: Optional[str] = None,
+    location: Optional[str] = Query(None, description="Default location (warehouse)"),
+    type: Optional[str] = Query(None, description="Default modem type (adsl, vdsl, fiber)"),
+    db: Session = Depends(get_db),
+    api_key: str = Depends(verify_api_key),
+):
+    """Register many Modems at once (barcode scanner exports, pallet deliveries).
+
+    Accepts CSV, NDJSON or JSON; rows without model/location take the query
+    defaults. Returns one report entry per row: created, exists, duplicate
+    or error.
+    """
+    defaults = {k: v for k, v in {"model": model, "manufacturer": manufacturer, "location": location, "type": type}.items() if v}
+    registrar = device_ingest.DeviceRegistrar(db, "modem", chunk_size=chunk_size)
+    summary = await device_ingest.run_registration(request, registrar, lambda r, batch: _feed_devices(r, batch, defaults))
+    return {"message": f"Processed {summary['received']} serials", **summary}
+
 @router.put("/{modem_id}/assign/{work_id}")
-def assign_modem_to_work(modem_id: int, work_id: int, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
+def assign_modem_to_work(modem_id: int, work_id: int, request: Request, response: Response, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
     """Assign modem to a work order"""
     modem = db.query(Modem).filter(Modem.id == modem_id).first()
     if not modem:
         raise HTTPException(status_code=404, detail="Modem not found")
+    concurrency.check_if_match(request, modem)
 
     work = db.query(Work).filter(Work.id == work_id).first()
     if not work:
         raise HTTPException(status_code=404, detail="Work not found")
 
-    if modem.status != "available":
+    if not inventory.consume(db, "modem", modem_id, work_id, expected_version=modem.version):
         raise HTTPException(status_code=400, detail="Modem is not available for assignment")
 
-    modem.work_id = work_id
-    modem.status = "assigned"
-    modem.updated_at = datetime.utcnow()
-
     db.commit()
+    concurrency.set_tag(response, modem)
     return {"message": "Modem assigned successfully"}
 
 @router.put("/{modem_id}/install")
-def mark_modem_installed(modem_id: int, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
+def mark_modem_installed(modem_id: int, request: Request, response: Response, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
     """Mark modem as installed"""
     modem = db.query(Modem).filter(Modem.id == modem_id).first()
     if not modem:
         raise HTTPException(status_code=404, detail="Modem not found")
+    concurrency.check_if_match(request, modem)
 
     if modem.status != "assigned":
         raise HTTPException(status_code=400, detail="Modem must be assigned to a work before installation")
@@ -152,18 +211,20 @@ def mark_modem_installed(modem_id: int, db: Session = Depends(get_db), api_key:
     modem.updated_at = datetime.utcnow()
 
     db.commit()
+    concurrency.set_tag(response, modem)
     return {"message": "Modem marked as installed"}
 
 @router.put("/{modem_id}/configure")
-def configure_modem(modem_id: int, config: dict, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
+def configure_modem(modem_id: int, config: dict, request: Request, response: Response, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
     """Update modem configuration"""
     modem = db.query(Modem).filter(Modem.id == modem_id).first()
     if not modem:
         raise HTTPException(status_code=404, detail="Modem not found")
+    concurrency.check_if_match(request, modem)
 
     # Update configuration fields
     for key, value in config.items():
-        if hasattr(modem, key):
+        if hasattr(modem, key) and key not in ("id", "version"):
             setattr(modem, key, value)
 
     modem.status = "configured"
@@ -171,28 +232,32 @@ def configure_modem(modem_id: int, config: dict, db: Session = Depends(get_db),
     modem.updated_at = datetime.utcnow()
 
     db.commit()
+    concurrency.set_tag(response, modem)
     return {"message": "Modem configured successfully"}
 
 @router.put("/{modem_id}/return")
-def return_modem(modem_id: int, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
+def return_modem(modem_id: int, request: Request, response: Response, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
     """Mark modem as returned"""
     modem = db.query(Modem).filter(Modem.id == modem_id).first()
     if not modem:
         raise HTTPException(status_code=404, detail="Modem not found")
+    concurrency.check_if_match(request, modem)
 
     modem.status = "available"
     modem.work_id = None
     modem.updated_at = datetime.utcnow()
 
     db.commit()
+    concurrency.set_tag(response, modem)
     return {"message": "Modem returned successfully"}
 
 @router.put("/{modem_id}", response_model=ModemOut)
-def update_modem(modem_id: int, modem_update: ModemUpdate, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
+def update_modem(modem_id: int, modem_update: ModemUpdate, request: Request, response: Response, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
     """Update modem information"""
     modem = db.query(Modem).filter(Modem.id == modem_id).first()
     if not modem:
         raise HTTPException(status_code=404, detail="Modem not found")
+    concurrency.check_if_match(request, modem)
 
     update_data = modem_update.dict(exclude_unset=True)
     for field, value in update_data.items():
@@ -201,14 +266,16 @@ def update_modem(modem_id: int, modem_update: ModemUpdate, db: Session = Depends
     modem.updated_at = datetime.utcnow()
     db.commit()
     db.refresh(modem)
+    concurrency.set_tag(response, modem)
     return modem
 
 @router.delete("/{modem_id}")
-def delete_modem(modem_id: int, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
+def delete_modem(modem_id: int, request: Request, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
     """Delete modem (only if not assigned or installed)"""
     modem = db.query(Modem).filter(Modem.id == modem_id).first()
     if not modem:
         raise HTTPException(status_code=404, detail="Modem not found")
+    concurrency.check_if_match(request, modem)
 
     if modem.status in ["assigned", "installed"]:
         raise HTTPException(status_code=400, detail="Cannot delete assigned or installed modem")
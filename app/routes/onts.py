@@ -1,11 +1,14 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from sqlalchemy.orm import Session
 from sqlalchemy import func
 from app.database import SessionLocal
 from app.models.models import ONT, Work
 from typing import List, Optional
 from app.utils.security import verify_api_key
-from pydantic import BaseModel
+from app.utils import fastjson
+from app.utils import concurrency, device_ingest, etag, inventory
+from app.utils.ingest import DEFAULT_CHUNK_SIZE
+from pydantic import BaseModel, ValidationError
 from datetime import datetime
 
 router = APIRouter(prefix="/onts", tags=["onts"])
@@ -55,34 +58,48 @@ class ONTOut(BaseModel):
     location: Optional[str]
     created_at: datetime
     updated_at: datetime
+    version: Optional[int] = None
 
     class Config:
         from_attributes = True
 
+ONT_OUT_COLUMNS = fastjson.model_columns(ONT, ONTOut)
+
 @router.get("/", response_model=List[ONTOut])
 def get_onts(
+    request: Request,
+    response: Response,
     status: Optional[str] = None,
     assigned: Optional[bool] = None,
     db: Session = Depends(get_db),
     api_key: str = Depends(verify_api_key)
 ):
     """Get all ONTs with optional filtering"""
-    query = db.query(ONT)
+    not_modified = etag.check(request, response, db, ["ont"])
+    if not_modified is not None:
+        return not_modified
+    criteria = []
 
     if status:
-        query = query.filter(ONT.status == status)
+        criteria.append(ONT.status == status)
 
     if assigned is not None:
         if assigned:
-            query = query.filter(ONT.work_id.isnot(None))
+            criteria.append(ONT.work_id.isnot(None))
         else:
-            query = query.filter(ONT.work_id.is_(None))
+            criteria.append(ONT.work_id.is_(None))
 
-    return query.all()
+    if fastjson.enabled():
+        return fastjson.response(fastjson.select_dicts(db, ONT_OUT_COLUMNS, criteria), response)
+    return db.query(ONT).filter(*criteria).all()
 
 @router.get("/{ont_id}", response_model=ONTOut)
-def get_ont(ont_id: int, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
+def get_ont(ont_id: int, request: Request, response: Response, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
     """Get ONT by ID"""
+    current = db.query(ONT.version).filter(ONT.id == ont_id).scalar()
+    not_modified = etag.check(request, response, db, [("ont", ont_id)], resource_version=current, exists=current is not None)
+    if not_modified is not None:
+        return not_modified
     ont = db.query(ONT).filter(ONT.id == ont_id).first()
     if not ont:
         raise HTTPException(status_code=404, detail="ONT not found")
@@ -102,34 +119,75 @@ def create_ont(ont: ONTCreate, db: Session = Depends(get_db), api_key: str = Dep
     db.refresh(db_ont)
     return db_ont
 
+def _feed_devices(registrar: device_ingest.DeviceRegistrar, batch, defaults: dict) -> None:
+    for index, item in batch:
+        record = {"serial_number": item} if isinstance(item, str) else item
+        if not isinstance(record, dict):
+            registrar.add_error(index, None, "expected an object or a serial number")
+            continue
+        record = {**defaults, **{k: v for k, v in record.items() if v not in (None, "")}}
+        try:
+            registrar.add(index, ONTCreate.model_validate(record).model_dump())
+        except ValidationError as e:
+            registrar.add_error(index, record.get("serial_number"), "; ".join(err["msg"] for err in e.errors()))
+
+@router.post("/bulk", openapi_extra={
+    "requestBody": {
+        "content": {
+            "text/csv": {"schema": {"type": "string", "description": "Header row (serial_number/seriale/sn, model, ...) or one serial per line"}},
+            "application/x-ndjson": {"schema": {"type": "string", "description": "One ONTCreate object or serial string per line"}},
+            "application/json": {"schema": {"type": "object", "properties": {"devices": {"type": "array", "items": {"type": "object"}}}}},
+        },
+        "required": True,
+    }
+})
+async def register_onts_bulk(
+    request: Request,
+    chunk_size: int = Query(DEFAULT_CHUNK_SIZE, ge=1, le=5000),
+    model: Optional[str] = Query(None, description="Default model for rows without one"),
+    manufacturer: Optional[str] = None,
+    location: Optional[str] = Query(None, description="Default location (warehouse)"),
+    db: Session = Depends(get_db),
+    api_key: str = Depends(verify_api_key),
+):
+    """Register many ONTs at once (barcode scanner exports, pallet deliveries).
+
+    Accepts CSV, NDJSON or JSON; rows without model/location take the query
+    defaults. Returns one report entry per row: created, exists, duplicate
+    or error.
+    """
+    defaults = {k: v for k, v in {"model": model, "manufacturer": manufacturer, "location": location}.items() if v}
+    registrar = device_ingest.DeviceRegistrar(db, "ont", chunk_size=chunk_size)
+    summary = await device_ingest.run_registration(request, registrar, lambda r, batch: _feed_devices(r, batch, defaults))
+    return {"message": f"Processed {summary['received']} serials", **summary}
+
 @router.put("/{ont_id}/assign/{work_id}")
-def assign_ont_to_work(ont_id: int, work_id: int, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
+def assign_ont_to_work(ont_id: int, work_id: int, request: Request, response: Response, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
     """Assign ONT to a work order"""
     ont = db.query(ONT).filter(ONT.id == ont_id).first()
     if not ont:
         raise HTTPException(status_code=404, detail="ONT not found")
+    concurrency.check_if_match(request, ont)
 
     work = db.query(Work).filter(Work.id == work_id).first()
     if not work:
         raise HTTPException(status_code=404, detail="Work not found")
 
-    if ont.status != "available":
+    # from stock or from a reservation for this work; never a device another request just took
+    if not inventory.consume(db, "ont", ont_id, work_id, expected_version=ont.version):
         raise HTTPException(status_code=400, detail="ONT is not available for assignment")
 
-    ont.work_id = work_id
-    ont.status = "assigned"
-    ont.assigned_date = datetime.utcnow()
-    ont.updated_at = datetime.utcnow()
-
     db.commit()
+    concurrency.set_tag(response, ont)
     return {"message": "ONT assigned successfully"}
 
 @router.put("/{ont_id}/install")
-def mark_ont_installed(ont_id: int, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
+def mark_ont_installed(ont_id: int, request: Request, response: Response, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
     """Mark ONT as installed"""
     ont = db.query(ONT).filter(ONT.id == ont_id).first()
     if not ont:
         raise HTTPException(status_code=404, detail="ONT not found")
+    concurrency.check_if_match(request, ont)
 
     if ont.status != "assigned":
         raise HTTPException(status_code=400, detail="ONT must be assigned to a work before installation")
@@ -139,14 +197,16 @@ def mark_ont_installed(ont_id: int, db: Session = Depends(get_db), api_key: str
     ont.updated_at = datetime.utcnow()
 
     db.commit()
+    concurrency.set_tag(response, ont)
     return {"message": "ONT marked as installed"}
 
 @router.put("/{ont_id}/return")
-def return_ont(ont_id: int, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
+def return_ont(ont_id: int, request: Request, response: Response, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
     """Mark ONT as returned"""
     ont = db.query(ONT).filter(ONT.id == ont_id).first()
     if not ont:
         raise HTTPException(status_code=404, detail="ONT not found")
+    concurrency.check_if_match(request, ont)
 
     ont.status = "available"
     ont.returned_date = datetime.utcnow()
@@ -154,14 +214,16 @@ def return_ont(ont_id: int, db: Session = Depends(get_db), api_key: str = Depend
     ont.updated_at = datetime.utcnow()
 
     db.commit()
+    concurrency.set_tag(response, ont)
     return {"message": "ONT returned successfully"}
 
 @router.put("/{ont_id}", response_model=ONTOut)
-def update_ont(ont_id: int, ont_update: ONTUpdate, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
+def update_ont(ont_id: int, ont_update: ONTUpdate, request: Request, response: Response, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
     """Update ONT information"""
     ont = db.query(ONT).filter(ONT.id == ont_id).first()
     if not ont:
         raise HTTPException(status_code=404, detail="ONT not found")
+    concurrency.check_if_match(request, ont)
 
     update_data = ont_update.dict(exclude_unset=True)
     for field, value in update_data.items():
@@ -170,14 +232,16 @@ def update_ont(ont_id: int, ont_update: ONTUpdate, db: Session = Depends(get_db)
     ont.updated_at = datetime.utcnow()
     db.commit()
     db.refresh(ont)
+    concurrency.set_tag(response, ont)
     return ont
 
 @router.delete("/{ont_id}")
-def delete_ont(ont_id: int, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
+def delete_ont(ont_id: int, request: Request, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
     """Delete ONT (only if not assigned)"""
     ont = db.query(ONT).filter(ONT.id == ont_id).first()
     if not ont:
         raise HTTPException(status_code=404, detail="ONT not found")
+    concurrency.check_if_match(request, ont)
 
     if ont.work_id is not None:
         raise HTTPException(status_code=400, detail="Cannot delete assigned ONT")
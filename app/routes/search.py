@@ -0,0 +1,42 @@
+import time
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy.orm import Session
+
+from app.database import SessionLocal
+from app.utils import search
+from app.utils.security import verify_api_key
+
+router = APIRouter(prefix="/search", tags=["search"])
+
+
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+@router.get("/")
+def search_all(
+    q: str = Query(..., min_length=1, max_length=200, description="Words to look for; every word must match, as a prefix"),
+    kind: Optional[str] = Query(None, pattern="^(work|document)$"),
+    limit: int = Query(search.DEFAULT_LIMIT, ge=1, le=search.MAX_LIMIT),
+    db: Session = Depends(get_db),
+    api_key: str = Depends(verify_api_key),
+):
+    """Ranked full-text search over works (WR, cliente, indirizzo, note, extra_fields) and parsed documents.
+
+    ``snippet`` holds the matching text with the hits wrapped in ``<mark>``
+    (the rest is HTML-escaped).
+    """
+    start = time.perf_counter()
+    found = search.search(db, q, kind=kind, limit=limit)
+    return {
+        "query": q,
+        "backend": found["backend"],
+        "took_ms": round((time.perf_counter() - start) * 1000, 2),
+        "results": found["results"],
+    }
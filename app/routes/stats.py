@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Request, Response
 from sqlalchemy.orm import Session
 from app.database import SessionLocal
 from sqlalchemy import func
@@ -7,9 +7,13 @@ from app.schemas import StatsWeeklyOut, OperatorStatOut, TechnicianStatOut, Dail
 from datetime import datetime, timedelta
 from calendar import monthrange
 from app.database import engine
+from app.utils import archive, etag
 
 router = APIRouter(prefix="/stats", tags=["stats"])
 
+# Stats relative to "now" are revalidated at least this often even without writes (seconds)
+RELATIVE_WINDOW_BUCKET = 300
+
 def get_db():
     db = SessionLocal()
     try:
@@ -18,7 +22,10 @@ def get_db():
         db.close()
 
 @router.get("/weekly", response_model=StatsWeeklyOut)
-def get_weekly_stats(db: Session = Depends(get_db)):
+def get_weekly_stats(request: Request, response: Response, db: Session = Depends(get_db)):
+    not_modified = etag.check(request, response, db, ["work"], time_bucket=RELATIVE_WINDOW_BUCKET)
+    if not_modified is not None:
+        return not_modified
     week_ago = datetime.now() - timedelta(days=7)
     closed = db.query(func.count(Work.id)).filter(Work.stato == "chiuso", Work.data_chiusura >= week_ago).scalar()
     suspended = db.query(func.count(Work.id)).filter(Work.stato == "sospeso").scalar()
@@ -26,26 +33,49 @@ def get_weekly_stats(db: Session = Depends(get_db)):
 
 
 @router.get("/closed_by_operator", response_model=list[OperatorStatOut])
-def closed_by_operator(db: Session = Depends(get_db)):
+def closed_by_operator(request: Request, response: Response, db: Session = Depends(get_db)):
+    not_modified = etag.check(request, response, db, ["work"])
+    if not_modified is not None:
+        return not_modified
     results = db.query(Work.operatore, func.count(Work.id).label("closed")).filter(Work.stato == "chiuso").group_by(Work.operatore).all()
-    return [{"operatore": r[0] or "Unknown", "closed": r[1]} for r in results]
+    totals = {}
+    for operatore, closed in list(results) + list(archive.closed_counts(db, "operator").items()):
+        totals[operatore or "Unknown"] = totals.get(operatore or "Unknown", 0) + closed
+    return [{"operatore": k, "closed": v} for k, v in totals.items()]
 
 
 @router.get("/closed_by_technician", response_model=list[TechnicianStatOut])
-def closed_by_technician(db: Session = Depends(get_db)):
-    results = db.query(Technician.nome, Technician.cognome, func.count(Work.id).label("closed")).join(Work, Work.tecnico_assegnato_id == Technician.id).filter(Work.stato == "chiuso").group_by(Technician.id).all()
-    return [{"tecnico": f"{r[0]} {r[1]}", "closed": r[2]} for r in results]
+def closed_by_technician(request: Request, response: Response, db: Session = Depends(get_db)):
+    not_modified = etag.check(request, response, db, ["work", "technician"])
+    if not_modified is not None:
+        return not_modified
+    results = db.query(Technician.id, func.count(Work.id).label("closed")).join(Work, Work.tecnico_assegnato_id == Technician.id).filter(Work.stato == "chiuso").group_by(Technician.id).all()
+    totals = {r[0]: r[1] for r in results}
+    for tech_id, closed in archive.closed_counts(db, "technician").items():
+        totals[int(tech_id)] = totals.get(int(tech_id), 0) + closed
+    names = {t.id: t for t in db.query(Technician).filter(Technician.id.in_(list(totals)))}
+    return [{"tecnico": f"{names[k].nome} {names[k].cognome}", "closed": v} for k, v in totals.items() if k in names]
 
 
 @router.get("/daily_closed", response_model=list[DailyClosedOut])
-def daily_closed(db: Session = Depends(get_db)):
+def daily_closed(request: Request, response: Response, db: Session = Depends(get_db)):
+    not_modified = etag.check(request, response, db, ["work"])
+    if not_modified is not None:
+        return not_modified
     results = db.query(func.date(Work.data_chiusura), func.count(Work.id).label("closed")).filter(Work.stato == "chiuso").group_by(func.date(Work.data_chiusura)).all()
-    return [{"date": r[0] or "", "closed": r[1]} for r in results]
+    totals = archive.closed_counts(db, "day")
+    for day, closed in results:
+        day = str(day) if day else ""
+        totals[day] = totals.get(day, 0) + closed
+    return [{"date": k, "closed": v} for k, v in sorted(totals.items())]
 
 
 @router.get('/yearly', response_model=list[DailyClosedOut])
-def yearly_closed(db: Session = Depends(get_db)):
+def yearly_closed(request: Request, response: Response, db: Session = Depends(get_db)):
     """Return closed counts grouped by month for the last 12 months."""
+    not_modified = etag.check(request, response, db, ["work"], time_bucket=RELATIVE_WINDOW_BUCKET)
+    if not_modified is not None:
+        return not_modified
     now = datetime.now()
     start = (now.replace(day=1) - timedelta(days=365)).replace(day=1)
     # SQLite vs Postgres formatting
@@ -58,6 +88,10 @@ def yearly_closed(db: Session = Depends(get_db)):
     results = db.query(month_format.label('month'), func.count(Work.id).label('closed')).filter(Work.stato == 'chiuso', Work.data_chiusura != None, Work.data_chiusura >= start).group_by('month').all()
     # Convert list of tuples to dict for quick lookup
     data_map = { r[0]: r[1] for r in results }
+    # archived works are counted from their per-day aggregates
+    for day, closed in archive.closed_counts(db, "day").items():
+        if day >= start.strftime('%Y-%m-%d'):
+            data_map[day[:7]] = data_map.get(day[:7], 0) + closed
     # Generate last 12 months labels
     months = []
     cursor = start
@@ -73,8 +107,11 @@ def yearly_closed(db: Session = Depends(get_db)):
     return out
 
 @router.get("/equipment")
-def get_equipment_stats(db: Session = Depends(get_db)):
+def get_equipment_stats(request: Request, response: Response, db: Session = Depends(get_db)):
     """Get ONT and Modem statistics"""
+    not_modified = etag.check(request, response, db, ["ont", "modem"], time_bucket=RELATIVE_WINDOW_BUCKET)
+    if not_modified is not None:
+        return not_modified
     from app.models.models import ONT, Modem
     
     ont_stats = {
@@ -122,8 +159,11 @@ def get_equipment_stats(db: Session = Depends(get_db)):
     }
 
 @router.get("/installations")
-def get_installation_stats(db: Session = Depends(get_db)):
+def get_installation_stats(request: Request, response: Response, db: Session = Depends(get_db)):
     """Get installation statistics with sync information"""
+    not_modified = etag.check(request, response, db, ["sync"])
+    if not_modified is not None:
+        return not_modified
     from app.models.models import ONTModemSync
     
     total_syncs = db.query(func.count(ONTModemSync.id)).scalar()
@@ -5,6 +5,7 @@ from app.database import SessionLocal
 from app.models.models import ONTModemSync, ONT, Modem, Work
 from typing import List, Optional
 from app.utils.security import verify_api_key
+from app.utils import fastjson
 from pydantic import BaseModel
 from datetime import datetime
 
@@ -53,6 +54,8 @@ class SyncOut(BaseModel):
     class Config:
         from_attributes = True
 
+SYNC_OUT_COLUMNS = fastjson.model_columns(ONTModemSync, SyncOut)
+
 @router.get("/work/{work_id}", response_model=List[SyncOut])
 def get_sync_by_work(work_id: int, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
     """Get synchronization records for a specific work"""
@@ -168,12 +171,14 @@ def get_all_syncs(
     api_key: str = Depends(verify_api_key)
 ):
     """Get all synchronization records with optional filtering"""
-    query = db.query(ONTModemSync)
+    criteria = []
 
     if status:
-        query = query.filter(ONTModemSync.sync_status == status)
+        criteria.append(ONTModemSync.sync_status == status)
 
     if work_id:
-        query = query.filter(ONTModemSync.work_id == work_id)
+        criteria.append(ONTModemSync.work_id == work_id)
 
-    return query.all()
\ No newline at end of file
+    if fastjson.enabled():
+        return fastjson.response(fastjson.select_dicts(db, SYNC_OUT_COLUMNS, criteria))
+    return db.query(ONTModemSync).filter(*criteria).all()
\ No newline at end of file
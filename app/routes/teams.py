@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Request, Response
 from sqlalchemy.orm import Session
 from app.database import SessionLocal
 from app.models.models import Team
@@ -6,6 +6,7 @@ from typing import List
 from app.utils.security import verify_api_key
 from app.schemas import TeamCreate, TeamOut
 from app.utils.auth import auth_required
+from app.utils import etag
 
 router = APIRouter(prefix="/teams", tags=["teams"])
 
@@ -17,7 +18,10 @@ def get_db():
         db.close()
 
 @router.get("/", response_model=List[TeamOut])
-def get_teams(db: Session = Depends(get_db)):
+def get_teams(request: Request, response: Response, db: Session = Depends(get_db)):
+    not_modified = etag.check(request, response, db, ["team"])
+    if not_modified is not None:
+        return not_modified
     teams = db.query(Team).all()
     return teams
 
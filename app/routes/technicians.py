@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
 from sqlalchemy.orm import Session
 from app.database import SessionLocal
 from app.models.models import Technician, Team
@@ -6,6 +6,7 @@ from typing import List
 from app.utils.security import verify_api_key
 from app.schemas import TechnicianCreate, TechnicianOut, TechnicianUpdate
 from app.utils.auth import auth_required
+from app.utils import etag
 
 router = APIRouter(prefix="/technicians", tags=["technicians"])
 
@@ -17,7 +18,10 @@ def get_db():
         db.close()
 
 @router.get("/", response_model=List[TechnicianOut])
-def get_technicians(db: Session = Depends(get_db)):
+def get_technicians(request: Request, response: Response, db: Session = Depends(get_db)):
+    not_modified = etag.check(request, response, db, ["technician", "team"])
+    if not_modified is not None:
+        return not_modified
     techs = db.query(Technician).all()
     return techs
 
@@ -28,7 +32,8 @@ def create_technician(payload: TechnicianCreate, db: Session = Depends(get_db),
         cognome=payload.cognome, 
         telefono=payload.telefono, 
         squadra_id=payload.squadra_id,
-        telegram_id=payload.telegram_id
+        telegram_id=payload.telegram_id,
+        competenze=payload.competenze
     )
     db.add(tech)
     db.commit()
@@ -58,6 +63,8 @@ def update_technician(
         tech.squadra_id = payload.squadra_id
     if payload.telegram_id is not None:
         tech.telegram_id = payload.telegram_id
+    if payload.competenze is not None:
+        tech.competenze = payload.competenze or None
     
     db.commit()
     db.refresh(tech)
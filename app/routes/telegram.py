@@ -1,7 +1,8 @@
 from fastapi import APIRouter, Depends, HTTPException, Request, Body
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.exc import StaleDataError
 from app.database import SessionLocal
-from app.models.models import Work, Technician, WorkEvent
+from app.models.models import Work, Technician
 from app.utils.auth import auth_required
 from datetime import datetime
 import logging
@@ -14,6 +15,8 @@ except Exception:
     httpx = None
 import json
 from app.utils.help_text import HELP_TEXT
+from app.utils import journal, work_pages
+from app.utils.uow import UnitOfWork
 
 router = APIRouter(prefix="/telegram", tags=["telegram"])
 logger = logging.getLogger("app.routes.telegram")
@@ -46,9 +49,39 @@ def _safe_send(chat_id, text, reply_markup=None):
         return False
 
 
+def _handle_callback_query(callback: dict, db: Session):
+    """Handle inline keyboard presses (currently only /miei_lavori pagination)."""
+    callback_id = callback.get("id")
+    from_user = callback.get("from", {})
+    message = callback.get("message") or {}
+    chat_id = (message.get("chat") or {}).get("id") or from_user.get("id")
+    parsed = work_pages.parse_callback_data(callback.get("data"))
+    if not parsed:
+        if callback_id:
+            telegram_utils.answer_callback_query(callback_id)
+        return {"ok": True}
+    page, include_closed = parsed
+    tech = db.query(Technician).filter(Technician.telegram_id == str(from_user.get("id"))).first()
+    if not tech:
+        if callback_id:
+            telegram_utils.answer_callback_query(callback_id, "Tecnico non trovato")
+        return {"ok": False, "message": "Technician not linked"}
+    text, reply_markup = work_pages.get_works_page(db, tech.id, page, include_closed)
+    message_id = message.get("message_id")
+    if message_id and chat_id:
+        telegram_utils.edit_message_text(chat_id, message_id, text, reply_markup=reply_markup)
+    else:
+        _safe_send(chat_id, text, reply_markup=reply_markup)
+    if callback_id:
+        telegram_utils.answer_callback_query(callback_id)
+    return {"ok": True, "page": page}
+
+
 @router.post("/webhook")
 async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
     body = await request.json()
+    if body.get("callback_query"):
+        return _handle_callback_query(body["callback_query"], db)
     # Support message updates only for now
     message = body.get("message") or body.get("edited_message")
     if not message:
@@ -100,12 +133,10 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
         if not tech:
             _safe_send(chat.get("id") or from_user.get("id"), "Tecnico non trovato. Contatta l'admin.")
             return {"ok": True}
-        works = db.query(Work).filter(Work.tecnico_assegnato_id == tech.id).all()
-        if not works:
-            _safe_send(chat.get("id") or from_user.get("id"), "Nessun lavoro assegnato")
-            return {"ok": True}
-        lines = [f"WR {w.numero_wr} - {w.stato} - {w.indirizzo}" for w in works]
-        _safe_send(chat.get("id") or from_user.get("id"), "\n".join(lines))
+        # Open works only by default; "/miei_lavori tutti" includes closed ones
+        include_closed = args.strip().lower() in ("tutti", "all", "chiusi")
+        text, reply_markup = work_pages.get_works_page(db, tech.id, 1, include_closed)
+        _safe_send(chat.get("id") or from_user.get("id"), text, reply_markup=reply_markup)
         return {"ok": True}
 
     if cmd == "accetta":
@@ -119,9 +150,11 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                 return {"ok": False, "message": "Technician not linked"}
             work.tecnico_assegnato_id = tech.id
             work.stato = "in_corso"
-            event = WorkEvent(work_id=work.id, timestamp=datetime.now(), event_type="accepted", description="Accepted by tech via webhook", user_id=tech.id)
-            db.add(event)
-            db.commit()
+            try:
+                with UnitOfWork(db) as uow:
+                    uow.event(work, journal.EventKind.ACCEPTED, journal.diff(work, ["tecnico_assegnato_id", "stato"]), actor_id=tech.id, note="webhook")
+            except StaleDataError:
+                return {"ok": False, "message": "Work changed meanwhile, retry"}
             return {"ok": True, "message": "Accepted"}
     if cmd == "rifiuta":
         parts = args.split() if args else []
@@ -136,9 +169,11 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                 return {"ok": False, "message": "Work not assigned to you"}
             work.stato = "aperto"
             work.tecnico_assegnato_id = None
-            event = WorkEvent(work_id=work.id, timestamp=datetime.now(), event_type="rejected", description="Rejected by tech via webhook", user_id=tech.id)
-            db.add(event)
-            db.commit()
+            try:
+                with UnitOfWork(db) as uow:
+                    uow.event(work, journal.EventKind.REJECTED, journal.diff(work, ["tecnico_assegnato_id", "stato"]), actor_id=tech.id, note="webhook")
+            except StaleDataError:
+                return {"ok": False, "message": "Work changed meanwhile, retry"}
             return {"ok": True, "message": "Rejected"}
     if cmd == "chiudi":
         parts = args.split() if args else []
@@ -153,9 +188,12 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                 return {"ok": False, "message": "Work not assigned to you"}
             work.stato = "chiuso"
             work.data_chiusura = datetime.now()
-            event = WorkEvent(work_id=work.id, timestamp=datetime.now(), event_type="closed", description="Closed by tech via webhook", user_id=tech.id)
-            db.add(event)
-            db.commit()
+            try:
+                with UnitOfWork(db) as uow:
+                    uow.event(work, journal.EventKind.CLOSED, journal.diff(work, ["stato", "data_chiusura"]), actor_id=tech.id, note="webhook")
+            except StaleDataError:
+                # changed meanwhile (e.g. reassigned from the back office): nothing was written
+                return {"ok": False, "message": "Work changed meanwhile, retry"}
             return {"ok": True, "message": "Closed"}
     # Default response
     return {"ok": True}
@@ -392,15 +430,9 @@ def send_gpt_message(payload: dict = Body(...), db: Session = Depends(get_db), c
     if work_id:
         work = db.query(Work).filter(Work.id == work_id).first()
         if work:
-            event = WorkEvent(
-                work_id=work.id,
-                timestamp=datetime.now(),
-                event_type="gpt_message",
-                description=f"GPT sent message to {len(recipients)} recipients",
-                user_id=current_user.get('id') if current_user else None
-            )
-            db.add(event)
-            db.commit()
+            with UnitOfWork(db) as uow:
+                uow.event(work, journal.EventKind.MESSAGE, actor_id=current_user.get('id') if current_user else None,
+                          note=f"gpt:{len(recipients)}")
 
     return {
         "ok": True,
@@ -1,15 +1,19 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Query, Request, Response, Header
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import func, select
 import logging
 from app.database import SessionLocal
-from app.models.models import Work, Technician, WorkEvent, Document, DocumentAppliedWork
+from app.models.models import ArchivedWork, Work, Technician, Team, WorkEvent, WorkJournalEntry, Document, DocumentAppliedWork
 from typing import List
 from app.utils.security import verify_api_key
 from app.schemas import WorkCreate, WorkOut, WorkStatusUpdate
 from app.schemas import WorkUpdate
 from app.utils.ocr import extract_wr_fields, normalize_numero_wr
 from app.utils.auth import auth_required
+from app.utils.ingest import WorkIngestor, DEFAULT_CHUNK_SIZE, parse_iso_datetime, run_bulk_ingest
+from app.utils import archive, changes, concurrency, etag, fastjson, idempotency, inventory, journal
+from app.utils.uow import UnitOfWork
 from io import BytesIO, StringIO
 import csv
 # We only accept PDFs here; image OCR is handled by documents routes
@@ -20,8 +24,9 @@ except Exception:
 import json
 from datetime import datetime
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 import app.utils.telegram as telegram_utils
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 from typing import Optional, List
 
 router = APIRouter(prefix="/works", tags=["works"])
@@ -46,61 +51,56 @@ async def upload_work(file: UploadFile = File(...), db: Session = Depends(get_db
         text = content.decode('utf-8')
         reader = csv.DictReader(StringIO(text))
         works_created = []
-        for row in reader:
-            data = {k.lower().strip(): v.strip() for k, v in row.items() if v.strip()}
-            # Map common column names
-            field_map = {
-                'numero wr': 'numero_wr',
-                'numero_wr': 'numero_wr',
-                'wr': 'numero_wr',
-                'operatore': 'operatore',
-                'fornitore': 'operatore',
-                'indirizzo': 'indirizzo',
-                'cliente': 'nome_cliente',
-                'nome cliente': 'nome_cliente',
-                'tipo lavoro': 'tipo_lavoro',
-                'tipo_lavoro': 'tipo_lavoro',
-                'lavoro': 'tipo_lavoro'
-            }
-            mapped_data = {}
-            for k, v in data.items():
-                mapped_key = field_map.get(k.lower(), k)
-                mapped_data[mapped_key] = v
-            # Set defaults
-            mapped_data.setdefault("numero_wr", f"WR-{int(datetime.now().timestamp())}")
-            # Normalize numero_wr to canonical format
-            if mapped_data.get("numero_wr"):
-                mapped_data["numero_wr"] = normalize_numero_wr(mapped_data["numero_wr"])
-            mapped_data.setdefault("operatore", "unknown")
-            mapped_data.setdefault("indirizzo", "unknown")
-            mapped_data.setdefault("nome_cliente", "unknown")
-            mapped_data.setdefault("tipo_lavoro", "attivazione")
-            # Create or update work (upsert)
-            existing = db.query(Work).filter(Work.numero_wr == mapped_data["numero_wr"]).first()
-            if existing:
-                # Update existing
-                existing.operatore = mapped_data.get("operatore", existing.operatore)
-                existing.indirizzo = mapped_data.get("indirizzo", existing.indirizzo)
-                existing.nome_cliente = mapped_data.get("nome_cliente", existing.nome_cliente)
-                existing.tipo_lavoro = mapped_data.get("tipo_lavoro", existing.tipo_lavoro)
-                if mapped_data.get('note'):
-                    existing.note = mapped_data.get('note')
-                db.commit()
-                # add event
-                event = WorkEvent(work_id=existing.id, timestamp=datetime.now(), event_type="updated", description="Work updated from CSV", user_id=None)
-                db.add(event)
-                db.commit()
-                works_created.append(existing)
-            else:
-                work = Work(**{k: v for k, v in mapped_data.items() if k in ["numero_wr", "operatore", "indirizzo", "nome_cliente", "tipo_lavoro", "note"]}, data_apertura=datetime.now())
-                db.add(work)
-                db.commit()
-                db.refresh(work)
-                event = WorkEvent(work_id=work.id, timestamp=datetime.now(), event_type="created", description="Work uploaded from CSV", user_id=None)
-                db.add(event)
-                db.commit()
-                works_created.append(work)
-                notify_new_work(work, db)
+        # the whole file is one transaction: a bad row leaves nothing half-imported
+        with UnitOfWork(db) as uow:
+            for row in reader:
+                data = {k.lower().strip(): v.strip() for k, v in row.items() if v.strip()}
+                # Map common column names
+                field_map = {
+                    'numero wr': 'numero_wr',
+                    'numero_wr': 'numero_wr',
+                    'wr': 'numero_wr',
+                    'operatore': 'operatore',
+                    'fornitore': 'operatore',
+                    'indirizzo': 'indirizzo',
+                    'cliente': 'nome_cliente',
+                    'nome cliente': 'nome_cliente',
+                    'tipo lavoro': 'tipo_lavoro',
+                    'tipo_lavoro': 'tipo_lavoro',
+                    'lavoro': 'tipo_lavoro'
+                }
+                mapped_data = {}
+                for k, v in data.items():
+                    mapped_key = field_map.get(k.lower(), k)
+                    mapped_data[mapped_key] = v
+                # Set defaults
+                mapped_data.setdefault("numero_wr", f"WR-{int(datetime.now().timestamp())}")
+                # Normalize numero_wr to canonical format
+                if mapped_data.get("numero_wr"):
+                    mapped_data["numero_wr"] = normalize_numero_wr(mapped_data["numero_wr"])
+                mapped_data.setdefault("operatore", "unknown")
+                mapped_data.setdefault("indirizzo", "unknown")
+                mapped_data.setdefault("nome_cliente", "unknown")
+                mapped_data.setdefault("tipo_lavoro", "attivazione")
+                # Create or update work (upsert)
+                existing = db.query(Work).filter(Work.numero_wr == mapped_data["numero_wr"]).first()
+                if existing:
+                    # Update existing
+                    existing.operatore = mapped_data.get("operatore", existing.operatore)
+                    existing.indirizzo = mapped_data.get("indirizzo", existing.indirizzo)
+                    existing.nome_cliente = mapped_data.get("nome_cliente", existing.nome_cliente)
+                    existing.tipo_lavoro = mapped_data.get("tipo_lavoro", existing.tipo_lavoro)
+                    if mapped_data.get('note'):
+                        existing.note = mapped_data.get('note')
+                    uow.event(existing, journal.EventKind.UPDATED, journal.diff(existing), note="csv")
+                    works_created.append(existing)
+                else:
+                    work = Work(**{k: v for k, v in mapped_data.items() if k in ["numero_wr", "operatore", "indirizzo", "nome_cliente", "tipo_lavoro", "note"]}, data_apertura=datetime.now())
+                    uow.add(work)
+                    db.flush()  # later rows of the file with the same WR update this work
+                    uow.event(work, journal.EventKind.CREATED, note="csv")
+                    works_created.append(work)
+                    uow.notify(notify_new_work, work, db)
         return {"message": f"Elaborati {len(works_created)} lavori dal CSV"}
     else:
         # Single file parsing as before
@@ -173,27 +173,20 @@ async def upload_work(file: UploadFile = File(...), db: Session = Depends(get_db
             if work_kwargs.get('extra_fields'):
                 existing.extra_fields = existing.extra_fields or {}
                 existing.extra_fields.update(work_kwargs.get('extra_fields'))
-            db.commit()
+            with UnitOfWork(db) as uow:
+                uow.event(existing, journal.EventKind.UPDATED, journal.diff(existing), note="upload")
             db.refresh(existing)
-            # Add event to indicate update
-            event = WorkEvent(work_id=existing.id, timestamp=datetime.now(), event_type="updated", description="Work uploaded and merged", user_id=None)
-            db.add(event)
-            db.commit()
             return existing
         else:
             work = Work(**work_kwargs, data_apertura=datetime.now())
-            db.add(work)
             try:
-                db.commit()
+                with UnitOfWork(db) as uow:
+                    uow.add(work)
+                    uow.event(work, journal.EventKind.CREATED, note="upload")
+                    uow.notify(notify_new_work, work, db)
             except IntegrityError as e:
-                db.rollback()
                 raise HTTPException(status_code=409, detail=str(e))
             db.refresh(work)
-            # Add event
-            event = WorkEvent(work_id=work.id, timestamp=datetime.now(), event_type="created", description="Work uploaded", user_id=None)
-            db.add(event)
-            db.commit()
-            notify_new_work(work, db)
             return work
 
 
@@ -203,66 +196,135 @@ def create_work(payload: WorkCreate, db: Session = Depends(get_db), current_user
     if work_kwargs.get('numero_wr'):
         work_kwargs['numero_wr'] = normalize_numero_wr(work_kwargs.get('numero_wr'))
     work = Work(**work_kwargs, data_apertura=datetime.now())
-    db.add(work)
     try:
-        db.commit()
+        with UnitOfWork(db) as uow:
+            uow.add(work)
+            uow.event(work, journal.EventKind.CREATED, note="api")
+            uow.notify(notify_new_work, work, db)
     except IntegrityError as e:
-        db.rollback()
         raise HTTPException(status_code=409, detail=str(e))
     db.refresh(work)
-    # Add event
-    event = WorkEvent(work_id=work.id, timestamp=datetime.now(), event_type="created", description="Work created via API", user_id=None)
-    db.add(event)
-    db.commit()
-    notify_new_work(work, db)
     return work
 
 @router.get("/", response_model=List[WorkOut])
-def get_works(db: Session = Depends(get_db)):
+def get_works(request: Request, response: Response, db: Session = Depends(get_db)):
+    not_modified = etag.check(request, response, db, ["work", "technician", "team"])
+    if not_modified is not None:
+        return not_modified
+    if fastjson.enabled():
+        return fastjson.response(_work_rows(db), response)
     works = db.query(Work).all()
     return works
 
 
+# WorkOut columns for the fast list path; tecnico_assegnato is rebuilt from the joined technician/team
+WORK_OUT_COLUMNS = [getattr(Work, name) for name in WorkOut.model_fields if name != "tecnico_assegnato"]
+_WORK_LIST_STMT = (
+    select(*WORK_OUT_COLUMNS, Technician.id, Technician.nome, Technician.cognome, Technician.telefono,
+           Technician.telegram_id, Technician.competenze, Team.id, Team.nome)
+    .outerjoin(Technician, Work.tecnico_assegnato_id == Technician.id)
+    .outerjoin(Team, Technician.squadra_id == Team.id)
+)
+
+
+def _work_rows(db: Session) -> List[dict]:
+    """GET /works/ as plain dicts shaped like WorkOut, straight from one joined SELECT."""
+    keys = [column.key for column in WORK_OUT_COLUMNS]
+    width = len(keys)
+    works = []
+    for row in db.execute(_WORK_LIST_STMT):
+        item = dict(zip(keys, row[:width]))
+        tech_id, nome, cognome, telefono, telegram_id, competenze, team_id, team_nome = row[width:]
+        item["tecnico_assegnato"] = None if tech_id is None else {
+            "id": tech_id,
+            "nome": nome,
+            "cognome": cognome,
+            "telefono": telefono,
+            "squadra": None if team_id is None else {"id": team_id, "nome": team_nome},
+            "telegram_id": telegram_id,
+            "competenze": competenze,
+        }
+        works.append(item)
+    return works
+
+
+@router.get("/changes")
+def get_changes(since: int = Query(0, ge=0), limit: int = Query(changes.DEFAULT_LIMIT, ge=1, le=changes.MAX_LIMIT), entities: Optional[str] = Query(None, description="Comma separated subset of work,ont,modem,sync,technician,team"), db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
+    """Incremental change feed over works, ONTs, modems, ONT/modem syncs, technicians and teams.
+
+    Send the ``cursor`` of the previous response as ``since`` to get only
+    what changed in between; keep polling while ``has_more`` is true. A
+    client starting from scratch (or receiving ``reset: true``) should do a
+    full download and then continue from the returned ``cursor``.
+    """
+    wanted = None
+    if entities:
+        wanted = [e.strip() for e in entities.split(",") if e.strip()]
+        unknown = [e for e in wanted if e not in changes.ENTITIES]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown entities: {', '.join(unknown)}")
+    return changes.fetch_changes(db, since=since, limit=limit, entities=wanted)
+
+
 @router.get("/{work_id}", response_model=WorkOut)
-def get_work(work_id: int, db: Session = Depends(get_db)):
+def get_work(work_id: int, request: Request, response: Response, db: Session = Depends(get_db)):
+    current = db.query(Work.version).filter(Work.id == work_id).scalar()
+    not_modified = etag.check(request, response, db, [("work", work_id), "technician", "team"], resource_version=current, exists=current is not None)
+    if not_modified is not None:
+        return not_modified
     work = db.query(Work).filter(Work.id == work_id).first()
     if not work:
-        raise HTTPException(status_code=404, detail="Work not found")
+        # closed works older than ARCHIVE_AFTER_MONTHS live in the archive tier
+        work = archive.lookup(db, work_id)
+        if work is None:
+            raise HTTPException(status_code=404, detail="Work not found")
+        response.headers["X-Archived"] = "true"
     return work
 
+
+@router.get("/{work_id}/history")
+def get_work_history(work_id: int, db: Session = Depends(get_db)):
+    """Timeline of the work as NDJSON, one journal entry per line, oldest first."""
+    if db.query(Work.id).filter(Work.id == work_id).first() is None:
+        archived = db.get(ArchivedWork, work_id)
+        if archived is None:
+            raise HTTPException(status_code=404, detail="Work not found")
+        entries = list(journal.archived_history(archived.events))
+        return StreamingResponse((json.dumps(e) + "\n" for e in entries), media_type="application/x-ndjson",
+                                 headers={"X-Archived": "true"})
+
+    def stream():
+        # own session: the response body is produced after the route (and its dependencies) returned
+        session = SessionLocal()
+        try:
+            for entry in journal.history(session, work_id):
+                yield json.dumps(entry) + "\n"
+        finally:
+            session.close()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
 @router.put("/{work_id}/assign/{tech_id}")
-def assign_work(work_id: int, tech_id: int, db: Session = Depends(get_db), current_user = Depends(auth_required(['admin', 'backoffice']))):
+def assign_work(work_id: int, tech_id: int, request: Request, response: Response, db: Session = Depends(get_db), current_user = Depends(auth_required(['admin', 'backoffice']))):
     work = db.query(Work).filter(Work.id == work_id).first()
     if not work:
         raise HTTPException(status_code=404, detail="Work not found")
+    concurrency.check_if_match(request, work)
     tech = db.query(Technician).filter(Technician.id == tech_id).first()
     if not tech:
         raise HTTPException(status_code=404, detail="Technician not found")
     work.tecnico_assegnato_id = tech_id
     work.stato = "in_corso"
     try:
-        db.commit()
+        with UnitOfWork(db) as uow:
+            uow.event(work_id, journal.EventKind.ASSIGNED, journal.diff(work, ["tecnico_assegnato_id", "stato"]), actor_id=tech_id)
+            if tech.telegram_id:
+                uow.notify(notify_reassigned_work, work, tech)
+    except StaleDataError:
+        raise
     except Exception as e:
-        db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    event = WorkEvent(work_id=work_id, timestamp=datetime.now(), event_type="assigned", description=f"Assigned to tech {tech_id}", user_id=tech_id)
-    db.add(event)
-    db.commit()
-    # Notify technician via telegram if they have a telegram_id
-    try:
-        if tech and tech.telegram_id:
-            msg = f"""🔄 <b>Lavoro riassegnato!</b>
-
-📋 <b>WR:</b> {work.numero_wr}
-👤 <b>Cliente:</b> {work.nome_cliente or 'N/D'}
-📍 <b>Indirizzo:</b> {work.indirizzo or 'N/D'}
-🔧 <b>Tipo:</b> {work.tipo_lavoro or 'N/D'}
-📞 <b>Telefono:</b> {work.telefono_cliente or 'N/D'}
-
-💡 <i>Il lavoro è ora in corso</i>"""
-            telegram_utils.send_message_to_telegram(tech.telegram_id, msg)
-    except Exception as e:
-        logging.getLogger('app.routes.works').exception('Failed to notify technician: %s', e)
+    concurrency.set_tag(response, work)
     return {"message": "Assigned"}
 
 
@@ -285,10 +347,11 @@ def notify_work(work_id: int, payload: dict | None = None, db: Session = Depends
     return { 'ok': ok }
 
 @router.put("/{work_id}/status")
-def update_status(work_id: int, payload: WorkStatusUpdate | None = None, db: Session = Depends(get_db), current_user = Depends(auth_required(['admin','backoffice','tecnico']))):
+def update_status(work_id: int, request: Request, response: Response, payload: WorkStatusUpdate | None = None, db: Session = Depends(get_db), current_user = Depends(auth_required(['admin','backoffice','tecnico']))):
     work = db.query(Work).filter(Work.id == work_id).first()
     if not work:
         raise HTTPException(status_code=404, detail="Work not found")
+    concurrency.check_if_match(request, work)
     # Accept a JSON payload with 'stato' property
     if not payload or not payload.stato:
         raise HTTPException(status_code=400, detail="Missing or invalid status payload")
@@ -306,30 +369,29 @@ def update_status(work_id: int, payload: WorkStatusUpdate | None = None, db: Ses
             # Ensure they can only update works assigned to them
             if work.tecnico_assegnato_id != current_user.technician_id:
                 raise HTTPException(status_code=403, detail="Not allowed to update this work")
-    db.commit()
-    event = WorkEvent(work_id=work_id, timestamp=datetime.now(), event_type="status_change", description=f"Status to {new_status}", user_id=work.tecnico_assegnato_id)
-    db.add(event)
-    db.commit()
+    with UnitOfWork(db) as uow:
+        uow.event(work_id, journal.status_kind(new_status), journal.diff(work, ["stato", "data_chiusura"]), actor_id=work.tecnico_assegnato_id)
+    concurrency.set_tag(response, work)
     return {"message": "Status updated"}
 
 @router.delete("/{work_id}")
-def delete_work(work_id: int, db: Session = Depends(get_db)):
+def delete_work(work_id: int, request: Request, db: Session = Depends(get_db)):
     work = db.query(Work).filter(Work.id == work_id).first()
     if not work:
         raise HTTPException(status_code=404, detail="Work not found")
-    db.delete(work)
-    db.commit()
+    concurrency.check_if_match(request, work)
+    with UnitOfWork(db):
+        db.delete(work)
     return {"message": "Work deleted"}
 
 
 @router.put("/{work_id}", response_model=WorkOut)
-def update_work(work_id: int, payload: WorkUpdate, db: Session = Depends(get_db)):
+def update_work(work_id: int, payload: WorkUpdate, request: Request, response: Response, db: Session = Depends(get_db)):
     work = db.query(Work).filter(Work.id == work_id).first()
     if not work:
         raise HTTPException(status_code=404, detail="Work not found")
+    concurrency.check_if_match(request, work)
     update_data = payload.dict(exclude_unset=True)
-    old_status = work.stato
-    old_tech = work.tecnico_assegnato_id
     if 'numero_wr' in update_data:
         new_num = normalize_numero_wr(update_data['numero_wr'])
         # check if another work has this numero
@@ -363,38 +425,39 @@ def update_work(work_id: int, payload: WorkUpdate, db: Session = Depends(get_db)
         work.modem_delivered = update_data['modem_delivered']
     if 'ont_delivered' in update_data:
         work.ont_delivered = update_data['ont_delivered']
-    
-    db.commit()
-    # Create events for meaningful changes
-    if 'stato' in update_data and update_data['stato'] != old_status:
-        new_status = update_data['stato']
-        if new_status == 'chiuso':
-            ev_type = 'closed'
-        elif new_status == 'sospeso':
-            ev_type = 'suspended'
-        else:
-            ev_type = 'status_change'
-        ev = WorkEvent(work_id=work.id, timestamp=datetime.now(), event_type=ev_type, description=f'Status to {new_status}', user_id=work.tecnico_assegnato_id)
-        db.add(ev)
-        db.commit()
-    if 'tecnico_assegnato_id' in update_data and update_data['tecnico_assegnato_id'] != old_tech:
-        new_tech = update_data['tecnico_assegnato_id']
-        if new_tech:
-            ev_type = 'assigned'
-            desc = f'Assigned to tech {new_tech}'
-        else:
-            ev_type = 'unassigned'
-            desc = 'Unassigned'
-        ev = WorkEvent(work_id=work.id, timestamp=datetime.now(), event_type=ev_type, description=desc, user_id=new_tech)
-        db.add(ev)
-        db.commit()
-    # Fallback update event for other changes
-    event = WorkEvent(work_id=work.id, timestamp=datetime.now(), event_type='updated', description=f'Work updated via API', user_id=None)
-    db.add(event)
-    db.commit()
+
+    # One journal entry per kind of change, written with the update in a single commit
+    with UnitOfWork(db) as uow:
+        changed = journal.diff(work)
+        if 'stato' in changed:
+            status_diff = {k: changed.pop(k) for k in ('stato', 'data_chiusura') if k in changed}
+            uow.event(work, journal.status_kind(work.stato), status_diff, actor_id=work.tecnico_assegnato_id)
+        if 'tecnico_assegnato_id' in changed:
+            new_tech = work.tecnico_assegnato_id
+            kind = journal.EventKind.ASSIGNED if new_tech else journal.EventKind.UNASSIGNED
+            uow.event(work, kind, {'tecnico_assegnato_id': changed.pop('tecnico_assegnato_id')}, actor_id=new_tech)
+        if changed:
+            uow.event(work, journal.EventKind.UPDATED, changed, note="api")
     db.refresh(work)
+    concurrency.set_tag(response, work)
     return work
 
+def notify_reassigned_work(work: Work, tech: Technician):
+    try:
+        msg = f"""🔄 <b>Lavoro riassegnato!</b>
+
+📋 <b>WR:</b> {work.numero_wr}
+👤 <b>Cliente:</b> {work.nome_cliente or 'N/D'}
+📍 <b>Indirizzo:</b> {work.indirizzo or 'N/D'}
+🔧 <b>Tipo:</b> {work.tipo_lavoro or 'N/D'}
+📞 <b>Telefono:</b> {work.telefono_cliente or 'N/D'}
+
+💡 <i>Il lavoro è ora in corso</i>"""
+        telegram_utils.send_message_to_telegram(tech.telegram_id, msg)
+    except Exception as e:
+        logging.getLogger('app.routes.works').exception('Failed to notify technician: %s', e)
+
+
 def notify_new_work(work: Work, db: Session):
     try:
         # Only notify assigned technician if present
@@ -435,127 +498,120 @@ def merge_duplicate_works(db: Session = Depends(get_db)):
     for norm, group in groups.items():
         if len(group) <= 1:
             continue
-        # sort by id to keep the earliest
-        group_sorted = sorted(group, key=lambda x: x.id)
-        keeper = group_sorted[0]
-        to_merge = group_sorted[1:]
-        for dup in to_merge:
-            # move documents referencing dup
-            docs = db.query(Document).filter(Document.applied_work_id == dup.id).all()
-            for d in docs:
-                d.applied_work_id = keeper.id
-                db.add(d)
-            # move association rows in document_applied_works table (bulk update to avoid session stale errors)
-            # First, delete any duplicate associations where the document already has an association to the keeper.
-            keeper_doc_ids = [d[0] for d in db.query(DocumentAppliedWork.document_id).filter(DocumentAppliedWork.work_id == keeper.id).all()]
-            if keeper_doc_ids:
-                db.query(DocumentAppliedWork).filter(DocumentAppliedWork.work_id == dup.id, DocumentAppliedWork.document_id.in_(keeper_doc_ids)).delete(synchronize_session=False)
-            # Then update remaining associations from dup to keeper
-            db.query(DocumentAppliedWork).filter(DocumentAppliedWork.work_id == dup.id).update({DocumentAppliedWork.work_id: keeper.id}, synchronize_session=False)
-            # Also update parsed_data.applied_work_ids on related Documents if present
-            affected_docs = db.query(Document).filter(Document.parsed_data != None).all()
-            for doc in affected_docs:
-                try:
-                    if doc.parsed_data and isinstance(doc.parsed_data, dict):
-                        parsed = dict(doc.parsed_data)
-                        if 'applied_work_ids' in parsed and isinstance(parsed['applied_work_ids'], list):
-                            parsed['applied_work_ids'] = [keeper.id if x == dup.id else x for x in parsed['applied_work_ids']]
-                            # dedupe keeping order
-                            parsed['applied_work_ids'] = list(dict.fromkeys(parsed['applied_work_ids']))
-                            doc.parsed_data = parsed
-                            db.add(doc)
-                except Exception:
-                    # be defensive; skip doc on error
-                    pass
-            # move events referencing dup
-            events = db.query(WorkEvent).filter(WorkEvent.work_id == dup.id).all()
-            for ev in events:
-                ev.work_id = keeper.id
-                db.add(ev)
-            # merge fields: fill missing basic fields
-            if not keeper.operatore and dup.operatore:
-                keeper.operatore = dup.operatore
-            if not keeper.indirizzo and dup.indirizzo:
-                keeper.indirizzo = dup.indirizzo
-            if not keeper.nome_cliente and dup.nome_cliente:
-                keeper.nome_cliente = dup.nome_cliente
-            if not keeper.tipo_lavoro and dup.tipo_lavoro:
-                keeper.tipo_lavoro = dup.tipo_lavoro
-            # merge extra_fields
-            keeper.extra_fields = keeper.extra_fields or {}
-            if dup.extra_fields:
-                keeper.extra_fields.update(dup.extra_fields)
-            # prefer closed status if any
-            if dup.stato == 'chiuso' and keeper.stato != 'chiuso':
-                keeper.stato = 'chiuso'
-                keeper.data_chiusura = dup.data_chiusura or datetime.now()
-            # delete duplicate work row
-            db.delete(dup)
-        # add event describing merge
-        event = WorkEvent(work_id=keeper.id, timestamp=datetime.now(), event_type='merged', description=f'Merged {len(to_merge)} duplicate works', user_id=None)
-        db.add(event)
-        db.commit()
-        merged.append({'keeper_id': keeper.id, 'merged_count': len(to_merge)})
-        # After commits, dedupe any DocumentAppliedWork rows for this document/keeper
-        # For each document that references keeper.id multiple times, remove duplicates
-        dup_assocs = db.query(DocumentAppliedWork.document_id, DocumentAppliedWork.work_id).filter(DocumentAppliedWork.work_id == keeper.id).group_by(DocumentAppliedWork.document_id, DocumentAppliedWork.work_id).having(func.count(DocumentAppliedWork.id) > 1).all()
-        for (doc_id, work_id) in dup_assocs:
-            assocs = db.query(DocumentAppliedWork).filter(DocumentAppliedWork.document_id == doc_id, DocumentAppliedWork.work_id == work_id).order_by(DocumentAppliedWork.id.asc()).all()
-            # Keep first, delete the rest
-            for extra in assocs[1:]:
-                db.delete(extra)
-        db.commit()
+        # each group is merged in its own transaction
+        with UnitOfWork(db) as uow:
+            # sort by id to keep the earliest
+            group_sorted = sorted(group, key=lambda x: x.id)
+            keeper = group_sorted[0]
+            to_merge = group_sorted[1:]
+            for dup in to_merge:
+                # move documents referencing dup
+                docs = db.query(Document).filter(Document.applied_work_id == dup.id).all()
+                for d in docs:
+                    d.applied_work_id = keeper.id
+                    db.add(d)
+                # move association rows in document_applied_works table (bulk update to avoid session stale errors)
+                # First, delete any duplicate associations where the document already has an association to the keeper.
+                keeper_doc_ids = [d[0] for d in db.query(DocumentAppliedWork.document_id).filter(DocumentAppliedWork.work_id == keeper.id).all()]
+                if keeper_doc_ids:
+                    db.query(DocumentAppliedWork).filter(DocumentAppliedWork.work_id == dup.id, DocumentAppliedWork.document_id.in_(keeper_doc_ids)).delete(synchronize_session=False)
+                # Then update remaining associations from dup to keeper
+                db.query(DocumentAppliedWork).filter(DocumentAppliedWork.work_id == dup.id).update({DocumentAppliedWork.work_id: keeper.id}, synchronize_session=False)
+                # Also update parsed_data.applied_work_ids on related Documents if present
+                affected_docs = db.query(Document).filter(Document.parsed_data != None).all()
+                for doc in affected_docs:
+                    try:
+                        if doc.parsed_data and isinstance(doc.parsed_data, dict):
+                            parsed = dict(doc.parsed_data)
+                            if 'applied_work_ids' in parsed and isinstance(parsed['applied_work_ids'], list):
+                                parsed['applied_work_ids'] = [keeper.id if x == dup.id else x for x in parsed['applied_work_ids']]
+                                # dedupe keeping order
+                                parsed['applied_work_ids'] = list(dict.fromkeys(parsed['applied_work_ids']))
+                                doc.parsed_data = parsed
+                                db.add(doc)
+                    except Exception:
+                        # be defensive; skip doc on error
+                        pass
+                # move the dup's history to the keeper
+                db.query(WorkJournalEntry).filter(WorkJournalEntry.work_id == dup.id).update({WorkJournalEntry.work_id: keeper.id}, synchronize_session=False)
+                db.query(WorkEvent).filter(WorkEvent.work_id == dup.id).update({WorkEvent.work_id: keeper.id}, synchronize_session=False)
+                # merge fields: fill missing basic fields
+                if not keeper.operatore and dup.operatore:
+                    keeper.operatore = dup.operatore
+                if not keeper.indirizzo and dup.indirizzo:
+                    keeper.indirizzo = dup.indirizzo
+                if not keeper.nome_cliente and dup.nome_cliente:
+                    keeper.nome_cliente = dup.nome_cliente
+                if not keeper.tipo_lavoro and dup.tipo_lavoro:
+                    keeper.tipo_lavoro = dup.tipo_lavoro
+                # merge extra_fields
+                keeper.extra_fields = keeper.extra_fields or {}
+                if dup.extra_fields:
+                    keeper.extra_fields.update(dup.extra_fields)
+                # prefer closed status if any
+                if dup.stato == 'chiuso' and keeper.stato != 'chiuso':
+                    keeper.stato = 'chiuso'
+                    keeper.data_chiusura = dup.data_chiusura or datetime.now()
+                # delete duplicate work row
+                db.delete(dup)
+            uow.event(keeper.id, journal.EventKind.MERGED, note="merged:" + ",".join(str(d.id) for d in to_merge))
+            merged.append({'keeper_id': keeper.id, 'merged_count': len(to_merge)})
+            # Dedupe any DocumentAppliedWork rows for this document/keeper (same transaction as the merge)
+            # For each document that references keeper.id multiple times, remove duplicates
+            dup_assocs = db.query(DocumentAppliedWork.document_id, DocumentAppliedWork.work_id).filter(DocumentAppliedWork.work_id == keeper.id).group_by(DocumentAppliedWork.document_id, DocumentAppliedWork.work_id).having(func.count(DocumentAppliedWork.id) > 1).all()
+            for (doc_id, work_id) in dup_assocs:
+                assocs = db.query(DocumentAppliedWork).filter(DocumentAppliedWork.document_id == doc_id, DocumentAppliedWork.work_id == work_id).order_by(DocumentAppliedWork.id.asc()).all()
+                # Keep first, delete the rest
+                for extra in assocs[1:]:
+                    db.delete(extra)
     return {'merged': merged}
 
 # ONT/Modem management endpoints for works
 
 @router.put("/{work_id}/ont/{ont_id}")
-def assign_ont_to_work(work_id: int, ont_id: int, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
+def assign_ont_to_work(work_id: int, ont_id: int, request: Request, response: Response, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
     """Assign ONT to work and update work flags"""
     from app.models.models import ONT
     
     work = db.query(Work).filter(Work.id == work_id).first()
     if not work:
         raise HTTPException(status_code=404, detail="Work not found")
+    concurrency.check_if_match(request, work)
 
     ont = db.query(ONT).filter(ONT.id == ont_id).first()
     if not ont:
         raise HTTPException(status_code=404, detail="ONT not found")
 
-    if ont.status != "available":
+    if not inventory.consume(db, "ont", ont_id, work_id, expected_version=ont.version):
         raise HTTPException(status_code=400, detail="ONT is not available")
-
-    # Assign ONT to work
-    work.ont = ont
     work.requires_ont = True
-    ont.status = "assigned"
-    ont.assigned_date = datetime.utcnow()
 
-    db.commit()
+    with UnitOfWork(db) as uow:
+        uow.event(work, journal.EventKind.UPDATED, journal.diff(work, ["requires_ont"]), note=f"ont:{ont.serial_number}")
+    concurrency.set_tag(response, work)
     return {"message": "ONT assigned to work successfully"}
 
 @router.put("/{work_id}/modem/{modem_id}")
-def assign_modem_to_work(work_id: int, modem_id: int, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
+def assign_modem_to_work(work_id: int, modem_id: int, request: Request, response: Response, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
     """Assign modem to work and update work flags"""
     from app.models.models import Modem
     
     work = db.query(Work).filter(Work.id == work_id).first()
     if not work:
         raise HTTPException(status_code=404, detail="Work not found")
+    concurrency.check_if_match(request, work)
 
     modem = db.query(Modem).filter(Modem.id == modem_id).first()
     if not modem:
         raise HTTPException(status_code=404, detail="Modem not found")
 
-    if modem.status != "available":
+    if not inventory.consume(db, "modem", modem_id, work_id, expected_version=modem.version):
         raise HTTPException(status_code=400, detail="Modem is not available")
-
-    # Assign modem to work
-    work.modem = modem
     work.requires_modem = True
-    modem.status = "assigned"
 
-    db.commit()
+    with UnitOfWork(db) as uow:
+        uow.event(work, journal.EventKind.UPDATED, journal.diff(work, ["requires_modem"]), note=f"modem:{modem.serial_number}")
+    concurrency.set_tag(response, work)
     return {"message": "Modem assigned to work successfully"}
 
 @router.get("/{work_id}/equipment")
@@ -603,18 +659,21 @@ def get_work_equipment(work_id: int, db: Session = Depends(get_db), api_key: str
     return equipment
 
 @router.put("/{work_id}/equipment/delivered")
-def mark_equipment_delivered(work_id: int, ont_delivered: bool = False, modem_delivered: bool = False, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
+def mark_equipment_delivered(work_id: int, request: Request, response: Response, ont_delivered: bool = False, modem_delivered: bool = False, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
     """Mark equipment as delivered"""
     work = db.query(Work).filter(Work.id == work_id).first()
     if not work:
         raise HTTPException(status_code=404, detail="Work not found")
+    concurrency.check_if_match(request, work)
 
     if ont_delivered:
         work.ont_delivered = True
     if modem_delivered:
         work.modem_delivered = True
 
-    db.commit()
+    with UnitOfWork(db) as uow:
+        uow.event(work, journal.EventKind.UPDATED, journal.diff(work, ["ont_delivered", "modem_delivered"]), note="delivered")
+    concurrency.set_tag(response, work)
     return {"message": "Equipment delivery status updated"}
 
 class WorkIngest(BaseModel):
@@ -635,200 +694,114 @@ class WorkIngest(BaseModel):
 class BulkIngestRequest(BaseModel):
     works: List[WorkIngest]
 
+def _ingest_record(work_data: WorkIngest) -> dict:
+    """Map the external WorkIngest payload onto an ingest engine record."""
+    extra = {k: getattr(work_data, k) for k in ("ont_sn", "modem_sn", "telefono", "email") if getattr(work_data, k)}
+    return {
+        "numero_wr": work_data.numero_wr,
+        "values": {
+            "stato": work_data.stato,
+            "note": work_data.note or work_data.descrizione,
+            "indirizzo": work_data.indirizzo,
+            "nome_cliente": work_data.cliente,
+            "data_apertura": parse_iso_datetime(work_data.data_creazione),
+            "data_chiusura": parse_iso_datetime(work_data.data_chiusura),
+        },
+        # Only used when the work does not exist yet
+        "defaults": {"operatore": "Imported", "data_apertura": datetime.utcnow()},
+        "extra": extra,
+        "tecnico": work_data.tecnico,
+    }
+
+
+def _feed_ingest_item(ingestor: WorkIngestor, index: int, item) -> None:
+    """Validate one raw payload item and hand it to the ingestor, recording per-item errors."""
+    numero_wr = item.get("numero_wr") if isinstance(item, dict) else None
+    try:
+        work_data = item if isinstance(item, WorkIngest) else WorkIngest.model_validate(item)
+        ingestor.add(index, _ingest_record(work_data))
+    except (ValidationError, ValueError) as e:
+        ingestor.add_error(index, numero_wr, str(e))
+
+
 @router.post("/ingest/work")
-def ingest_work(work_data: WorkIngest, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
-    """Ingest a single work from external system"""
+def ingest_work(work_data: WorkIngest, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key), idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    """Ingest a single work from external system.
+
+    Retries carrying the same ``Idempotency-Key`` and payload return the
+    original response without touching the works table.
+    """
+    digest = None
+    if idempotency_key:
+        digest = idempotency.payload_hash(work_data.model_dump(mode="json"))
+        cached = idempotency.claim(db, "works.ingest.work", idempotency_key, digest)
+        if cached is not None:
+            return cached
+    ingestor = WorkIngestor(db, extra_mode="merge", event_note="ingest")
+    _feed_ingest_item(ingestor, 0, work_data)
+    summary = ingestor.finish()
+    if summary["errors"]:
+        if idempotency_key:
+            idempotency.release(db, "works.ingest.work", idempotency_key)
+        error = summary["errors"][0]["error"]
+        logging.error(f"Error ingesting work: {error}")
+        raise HTTPException(status_code=400, detail=f"Error ingesting work: {error}")
+    result = summary["results"][0]
+    response = {"message": f"Work {result['numero_wr']} {result['status']} successfully", "work_id": result["work_id"]}
+    if idempotency_key:
+        idempotency.complete(db, "works.ingest.work", idempotency_key, digest, response)
+    return response
+
+
+@router.post("/ingest/bulk", openapi_extra={
+    "requestBody": {
+        "content": {
+            "application/json": {"schema": {"type": "object", "properties": {"works": {"type": "array", "items": {"type": "object"}}}}},
+            "application/x-ndjson": {"schema": {"type": "string", "description": "One WorkIngest JSON object per line"}},
+        },
+        "required": True,
+    }
+})
+async def ingest_bulk_works(request: Request, chunk_size: int = Query(DEFAULT_CHUNK_SIZE, ge=1, le=5000), db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
+    """Ingest multiple works from external system.
+
+    Accepts either ``{"works": [...]}`` JSON or an NDJSON stream
+    (``Content-Type: application/x-ndjson``, one work per line) which is
+    processed while it is being received. Works are upserted in chunks of
+    ``chunk_size`` with one commit per chunk; extra_fields are merged field
+    by field. An ``Idempotency-Key`` header makes retries safe.
+    """
+    ingestor = WorkIngestor(db, extra_mode="merge", chunk_size=chunk_size, event_note="bulk-ingest")
+    return await run_bulk_ingest(
+        request, db, ingestor,
+        scope="works.ingest.bulk",
+        parse_json=_parse_bulk_json,
+        feed_batch=_feed_batch,
+        build_response=_bulk_response,
+    )
+
+
+def _parse_bulk_json(body) -> list:
     try:
-        # Normalize numero_wr
-        numero_wr = normalize_numero_wr(work_data.numero_wr)
-
-        # Check if work already exists
-        existing_work = db.query(Work).filter(Work.numero_wr == numero_wr).first()
-        if existing_work:
-            # Update existing work
-            existing_work.stato = work_data.stato
-            if work_data.descrizione:
-                existing_work.note = work_data.descrizione
-            if work_data.tecnico:
-                # Find technician by name
-                technician = db.query(Technician).filter(
-                    (Technician.nome + ' ' + Technician.cognome) == work_data.tecnico
-                ).first()
-                if technician:
-                    existing_work.tecnico_assegnato_id = technician.id
-            if work_data.data_creazione:
-                existing_work.data_apertura = datetime.fromisoformat(work_data.data_creazione.replace('Z', '+00:00'))
-            if work_data.data_chiusura:
-                existing_work.data_chiusura = datetime.fromisoformat(work_data.data_chiusura.replace('Z', '+00:00'))
-            if work_data.note:
-                existing_work.note = work_data.note
-            if work_data.indirizzo:
-                existing_work.indirizzo = work_data.indirizzo
-            if work_data.cliente:
-                existing_work.nome_cliente = work_data.cliente
-
-            # Store additional fields in extra_fields
-            extra_data = {}
-            if work_data.ont_sn:
-                extra_data['ont_sn'] = work_data.ont_sn
-            if work_data.modem_sn:
-                extra_data['modem_sn'] = work_data.modem_sn
-            if work_data.telefono:
-                extra_data['telefono'] = work_data.telefono
-            if work_data.email:
-                extra_data['email'] = work_data.email
-            if extra_data:
-                existing_work.extra_fields = extra_data
-
-            db.commit()
-            return {"message": f"Work {numero_wr} updated successfully", "work_id": existing_work.id}
-        else:
-            # Create new work
-            new_work = Work(
-                numero_wr=numero_wr,
-                stato=work_data.stato,
-                operatore="Imported",  # Default operator for imported works
-                indirizzo=work_data.indirizzo,
-                nome_cliente=work_data.cliente,
-                note=work_data.descrizione or work_data.note,
-                data_apertura=datetime.fromisoformat(work_data.data_creazione.replace('Z', '+00:00')) if work_data.data_creazione else datetime.utcnow(),
-                data_chiusura=datetime.fromisoformat(work_data.data_chiusura.replace('Z', '+00:00')) if work_data.data_chiusura else None
-            )
-
-            # Set technician if provided
-            if work_data.tecnico:
-                technician = db.query(Technician).filter(
-                    (Technician.nome + ' ' + Technician.cognome) == work_data.tecnico
-                ).first()
-                if technician:
-                    new_work.tecnico_assegnato_id = technician.id
-
-            # Store additional fields in extra_fields
-            extra_data = {}
-            if work_data.ont_sn:
-                extra_data['ont_sn'] = work_data.ont_sn
-            if work_data.modem_sn:
-                extra_data['modem_sn'] = work_data.modem_sn
-            if work_data.telefono:
-                extra_data['telefono'] = work_data.telefono
-            if work_data.email:
-                extra_data['email'] = work_data.email
-            if extra_data:
-                new_work.extra_fields = extra_data
-
-            db.add(new_work)
-            db.commit()
-            db.refresh(new_work)
-
-            # Log the creation event
-            event = WorkEvent(
-                work_id=new_work.id,
-                event_type="created",
-                description=f"Work {numero_wr} created via API ingest",
-                timestamp=datetime.utcnow()
-            )
-            db.add(event)
-            db.commit()
-
-            return {"message": f"Work {numero_wr} created successfully", "work_id": new_work.id}
-
-    except IntegrityError:
-        db.rollback()
-        raise HTTPException(status_code=400, detail="Duplicate work number or constraint violation")
-    except Exception as e:
-        db.rollback()
-        logging.error(f"Error ingesting work: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error ingesting work: {str(e)}")
+        payload = BulkIngestRequest.model_validate(body)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
+    return list(enumerate(payload.works))
 
-@router.post("/ingest/bulk")
-def ingest_bulk_works(request: BulkIngestRequest, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
-    """Ingest multiple works from external system"""
-    results = []
-    errors = []
 
-    for i, work_data in enumerate(request.works):
-        try:
-            # Normalize numero_wr
-            numero_wr = normalize_numero_wr(work_data.numero_wr)
-
-            # Check if work already exists
-            existing_work = db.query(Work).filter(Work.numero_wr == numero_wr).first()
-            if existing_work:
-                # Update existing work
-                existing_work.stato = work_data.stato
-                if work_data.descrizione:
-                    existing_work.note = work_data.descrizione
-                if work_data.tecnico:
-                    # Find technician by name
-                    technician = db.query(Technician).filter(
-                        (Technician.nome + ' ' + Technician.cognome) == work_data.tecnico
-                    ).first()
-                    if technician:
-                        existing_work.tecnico_assegnato_id = technician.id
-                if work_data.data_creazione:
-                    existing_work.data_apertura = datetime.fromisoformat(work_data.data_creazione.replace('Z', '+00:00'))
-                if work_data.data_chiusura:
-                    existing_work.data_chiusura = datetime.fromisoformat(work_data.data_chiusura.replace('Z', '+00:00'))
-                if work_data.note:
-                    existing_work.note = work_data.note
-                if work_data.indirizzo:
-                    existing_work.indirizzo = work_data.indirizzo
-                if work_data.cliente:
-                    existing_work.nome_cliente = work_data.cliente
-
-                # Store additional fields in extra_fields
-                extra_data = {}
-                if work_data.ont_sn:
-                    extra_data['ont_sn'] = work_data.ont_sn
-                if work_data.modem_sn:
-                    extra_data['modem_sn'] = work_data.modem_sn
-                if work_data.telefono:
-                    extra_data['telefono'] = work_data.telefono
-                if work_data.email:
-                    extra_data['email'] = work_data.email
-                if extra_data:
-                    existing_work.extra_fields = extra_data
-
-                db.commit()
-                results.append({"index": i, "numero_wr": numero_wr, "status": "updated", "work_id": existing_work.id})
-            else:
-                # Create new work
-                new_work = Work(
-                    numero_wr=numero_wr,
-                    stato=work_data.stato,
-                    operatore="Imported",  # Default operator for imported works
-                    indirizzo=work_data.indirizzo,
-                    nome_cliente=work_data.cliente,
-                    note=work_data.descrizione or work_data.note,
-                    data_apertura=datetime.fromisoformat(work_data.data_creazione.replace('Z', '+00:00')) if work_data.data_creazione else datetime.utcnow(),
-                    data_chiusura=datetime.fromisoformat(work_data.data_chiusura.replace('Z', '+00:00')) if work_data.data_chiusura else None
-                )
-                db.add(new_work)
-                db.commit()
-                db.refresh(new_work)
-
-                # Log the creation event
-                event = WorkEvent(
-                    work_id=new_work.id,
-                    event_type="created",
-                    description=f"Work {numero_wr} created via bulk API ingest",
-                    timestamp=datetime.utcnow()
-                )
-                db.add(event)
-                db.commit()
-
-                results.append({"index": i, "numero_wr": numero_wr, "status": "created", "work_id": new_work.id})
-
-        except Exception as e:
-            db.rollback()
-            error_msg = f"Error processing work at index {i} ({work_data.numero_wr}): {str(e)}"
-            errors.append(error_msg)
-            logging.error(error_msg)
+def _feed_batch(ingestor: WorkIngestor, batch) -> None:
+    for index, item in batch:
+        _feed_ingest_item(ingestor, index, item)
 
+
+def _bulk_response(summary: dict) -> dict:
+    errors = [f"Error processing work at index {e['index']} ({e['numero_wr']}): {e['error']}" for e in summary["errors"]]
+    for error_msg in errors:
+        logging.error(error_msg)
     return {
-        "message": f"Processed {len(request.works)} works",
-        "results": results,
+        "message": f"Processed {summary['received']} works",
+        "results": summary["results"],
         "errors": errors,
-        "success_count": len(results),
-        "error_count": len(errors)
-    }
\ No newline at end of file
+        "success_count": summary["success_count"],
+        "error_count": summary["error_count"]
+    }
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, field_validator, ConfigDict
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 from datetime import datetime
 
 class TeamCreate(BaseModel):
@@ -16,6 +16,7 @@ class TechnicianCreate(BaseModel):
     telefono: str
     squadra_id: int
     telegram_id: Optional[str] = None
+    competenze: Optional[List[str]] = None  # tipo_lavoro values for the dispatcher (null: all)
 
     @field_validator('telefono')
     @classmethod
@@ -32,6 +33,7 @@ class TechnicianOut(BaseModel):
     telefono: str
     squadra: Optional[TeamOut]
     telegram_id: Optional[str] = None
+    competenze: Optional[List[str]] = None
     model_config = ConfigDict(from_attributes=True)
 
 class TechnicianUpdate(BaseModel):
@@ -40,6 +42,7 @@ class TechnicianUpdate(BaseModel):
     telefono: Optional[str] = None
     squadra_id: Optional[int] = None
     telegram_id: Optional[str] = None
+    competenze: Optional[List[str]] = None
 
     @field_validator('telefono')
     @classmethod
@@ -91,6 +94,7 @@ class WorkOut(BaseModel):
     data_chiusura: Optional[datetime]
     tecnico_assegnato: Optional[TechnicianOut]
     extra_fields: Optional[Dict] = None
+    version: Optional[int] = None  # send back as If-Match: "<version>" on updates
 
     model_config = ConfigDict(from_attributes=True)
 
@@ -1,13 +1,56 @@
-import mysql.connector
+"""Replication with a remote FTTH node (see app/utils/replication.py).
 
-db = mysql.connector.connect(
-    host="localhost",
-    user="admin",
-    password="*******",
-    database="servicess_ftth"
+Pulls the peer's changes, pushes ours, resolves conflicts, and stores the
+cursors so an interrupted run resumes where it stopped:
+
+    python -m app.sync                      # once, against SYNC_PEER_URL
+    python -m app.sync --every 300          # keep syncing every 5 minutes
+    python -m app.sync --policy lww
+
+Scheduled runs can also go through the job queue (job type "sync").
+"""
+import argparse
+import logging
+import time
+
+from dotenv import load_dotenv
+
+from app.database import SessionLocal, engine
+from app.models import models
+from app.utils import replication
+
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
+logger = logging.getLogger("app.sync")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync works, ONTs and modems with a remote node")
+    parser.add_argument("--peer", default=None, help="peer URL (default: SYNC_PEER_URL)")
+    parser.add_argument("--key", default=None, help="peer X-KEY (default: SYNC_PEER_KEY)")
+    parser.add_argument("--policy", choices=["merge", "lww"], default=replication.CONFLICT_POLICY)
+    parser.add_argument("--every", type=float, default=None, metavar="SECONDS", help="repeat every SECONDS")
+    args = parser.parse_args()
+
+    models.Base.metadata.create_all(bind=engine)
+    peer = replication.HttpPeer(args.peer, args.key or "") if args.peer else replication.peer_from_env()
+    sync = replication.SyncEngine(SessionLocal, peer, policy=args.policy)
+    while True:
+        try:
+            stats = sync.run()
+            print(" ".join(f"{k}={v}" for k, v in sorted(stats.items())) or "Already in sync", flush=True)
+        except Exception:
+            if args.every is None:
+                raise
+            logger.exception("Sync with %s failed; retrying in %ss", peer.name, args.every)
+        if args.every is None:
+            break
+        time.sleep(args.every)
+
 
-cursor = db.cursor()
-cursor.execute("CALL sync_ftth_table();")
-db.commit()
-print("✅ Vista aggiornata correttamente.")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
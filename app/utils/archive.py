@@ -0,0 +1,173 @@
+"""Archive tier for closed works (``archive`` job).
+
+Works closed (``stato == 'chiuso'``) more than ``ARCHIVE_AFTER_MONTHS``
+months ago are moved out of the hot tables into ``archived_works``, one row
+per work holding the work itself, its journal, the documents that touched it
+and its equipment (ONT/modem serials and ``ont_modem_sync`` rows). Inventory
+rows stay in ``onts``/``modems``, detached from the work.
+
+The move is done with bulk Core statements, batch by batch, each batch in
+its own transaction: the change feed gets a ``delete`` entry per work, but
+no replication tombstone is written, so peers keep their copy until they
+archive it themselves.
+
+Every archived work also bumps the counters in ``archive_stats`` (by
+operator, technician and closing day), which /stats adds to its queries on
+the hot table; ``lookup()`` is the fallback of single-work reads.
+"""
+import logging
+import os
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import delete, select, update
+from sqlalchemy.orm import Session
+
+from app.models.models import (ArchivedWork, ArchiveStat, Document, DocumentAppliedWork, Modem, ONT, ONTModemSync,
+                               Technician, Work, WorkEvent, WorkJournalEntry, WorkLocation, WorkMatchKey)
+from app.utils import changes, search, work_pages
+
+logger = logging.getLogger("app.utils.archive")
+
+AFTER_MONTHS = int(os.getenv("ARCHIVE_AFTER_MONTHS") or 12)
+BATCH_SIZE = 500
+
+
+def cutoff(months: int, now: Optional[datetime] = None) -> datetime:
+    """``now`` moved back ``months`` calendar months (day clamped to the month's length)."""
+    now = now or datetime.now()
+    year, month = divmod(now.year * 12 + now.month - 1 - months, 12)
+    month += 1
+    day = now.day
+    while True:
+        try:
+            return now.replace(year=year, month=month, day=day)
+        except ValueError:
+            day -= 1
+
+
+def archive_closed(db: Session, months: Optional[int] = None, batch_size: int = BATCH_SIZE,
+                   progress=None) -> Dict[str, Any]:
+    """Move the works closed more than ``months`` months ago to the archive; returns counts."""
+    months = AFTER_MONTHS if months is None else months
+    if months < 1:
+        raise ValueError("Works can only be archived at least one month after closing")
+    before = cutoff(months)
+    candidates = select(Work.id).where(Work.stato == "chiuso", Work.data_chiusura.is_not(None), Work.data_chiusura < before)
+    total = db.query(Work.id).filter(Work.id.in_(candidates)).count()
+    archived = events = 0
+    while True:
+        ids = list(db.execute(candidates.order_by(Work.id).limit(batch_size)).scalars())
+        if not ids:
+            break
+        events += _archive_batch(db, ids)
+        db.commit()
+        archived += len(ids)
+        if progress:
+            progress(int(100 * archived / max(total, 1)), f"Archived {archived}/{total} works")
+    if archived:
+        work_pages.clear_cache()
+        logger.info("Archived %d works closed before %s (%d events)", archived, before.date(), events)
+    return {"archived": archived, "events": events, "before": before.isoformat()}
+
+
+def _rows(db: Session, model, column, ids: List[int]) -> Dict[int, List[Dict[str, Any]]]:
+    grouped: Dict[int, List[Dict[str, Any]]] = {}
+    for row in db.execute(select(model.__table__).where(column.in_(ids)).order_by(model.__table__.c.id)).mappings():
+        grouped.setdefault(row[column.key], []).append(jsonable_encoder(dict(row)))
+    return grouped
+
+
+def _archive_batch(db: Session, ids: List[int]) -> int:
+    works = _rows(db, Work, Work.id, ids)
+    events = _rows(db, WorkJournalEntry, WorkJournalEntry.work_id, ids)
+    syncs = _rows(db, ONTModemSync, ONTModemSync.work_id, ids)
+    applied: Dict[int, List[int]] = {}
+    for work_id, document_id in db.execute(select(DocumentAppliedWork.work_id, DocumentAppliedWork.document_id)
+                                           .where(DocumentAppliedWork.work_id.in_(ids))):
+        applied.setdefault(work_id, []).append(document_id)
+    created: Dict[int, List[int]] = {}
+    for work_id, document_id in db.execute(select(Document.applied_work_id, Document.id).where(Document.applied_work_id.in_(ids))):
+        created.setdefault(work_id, []).append(document_id)
+    equipment: Dict[int, Dict[str, list]] = {}
+    detached: Dict[str, List[int]] = {"ont": [], "modem": []}
+    for entity, model in (("ont", ONT), ("modem", Modem)):
+        for row_id, work_id, serial in db.execute(select(model.id, model.work_id, model.serial_number).where(model.work_id.in_(ids))):
+            equipment.setdefault(work_id, {}).setdefault(f"{entity}s", []).append({"id": row_id, "serial_number": serial})
+            detached[entity].append(row_id)
+
+    archive_rows = []
+    for work_id in ids:
+        data = works[work_id][0]
+        kit = dict(equipment.get(work_id, {}))
+        if syncs.get(work_id):
+            kit["syncs"] = syncs[work_id]
+        archive_rows.append({
+            "id": work_id, "numero_wr": data["numero_wr"], "operatore": data["operatore"], "stato": data["stato"],
+            "data_chiusura": datetime.fromisoformat(data["data_chiusura"]),
+            "tecnico_assegnato_id": data["tecnico_assegnato_id"], "data": data, "events": events.get(work_id) or None,
+            "documents": {"applied": applied.get(work_id, []), "created": created.get(work_id, [])}
+            if work_id in applied or work_id in created else None,
+            "equipment": kit or None, "archived_at": datetime.utcnow(),
+        })
+    db.execute(ArchivedWork.__table__.insert(), archive_rows)
+    _count(db, archive_rows)
+
+    # children first: nothing may keep pointing at the removed works
+    db.execute(delete(WorkJournalEntry.__table__).where(WorkJournalEntry.work_id.in_(ids)))
+    db.execute(delete(WorkEvent.__table__).where(WorkEvent.work_id.in_(ids)))  # legacy rows, already in the journal
+    db.execute(delete(DocumentAppliedWork.__table__).where(DocumentAppliedWork.work_id.in_(ids)))
+    db.execute(delete(ONTModemSync.__table__).where(ONTModemSync.work_id.in_(ids)))
+    db.execute(delete(WorkMatchKey.__table__).where(WorkMatchKey.work_id.in_(ids)))
+    db.execute(delete(WorkLocation.__table__).where(WorkLocation.work_id.in_(ids)))
+    db.execute(update(Document.__table__).where(Document.applied_work_id.in_(ids)).values(applied_work_id=None))
+    for entity, model in (("ont", ONT), ("modem", Modem)):
+        if detached[entity]:
+            db.execute(update(model.__table__).where(model.id.in_(detached[entity])).values(work_id=None, version=model.version + 1))
+            changes.record(db, entity, detached[entity])
+    sync_ids = [row["id"] for rows in syncs.values() for row in rows]
+    changes.record(db, "sync", sync_ids, op="delete")
+    db.execute(delete(Work.__table__).where(Work.id.in_(ids)))
+    changes.record(db, "work", ids, op="delete")
+    search.reindex(db, "work", ids)
+    return sum(len(rows) for rows in events.values())
+
+
+def _count(db: Session, rows: List[Dict[str, Any]]) -> None:
+    counts: Counter = Counter()
+    for row in rows:
+        counts[("operator", row["operatore"] or "")] += 1
+        if row["tecnico_assegnato_id"] is not None:
+            counts[("technician", str(row["tecnico_assegnato_id"]))] += 1
+        counts[("day", row["data_chiusura"].date().isoformat())] += 1
+    existing = {
+        (stat.dimension, stat.key): stat
+        for stat in db.query(ArchiveStat).filter(ArchiveStat.key.in_(sorted({key for _, key in counts})))
+        if (stat.dimension, stat.key) in counts
+    }
+    for (dimension, key), closed in counts.items():
+        stat = existing.get((dimension, key))
+        if stat is None:
+            db.add(ArchiveStat(dimension=dimension, key=key, closed=closed))
+        else:
+            stat.closed += closed
+    db.flush()
+
+
+def closed_counts(db: Session, dimension: str) -> Dict[str, int]:
+    """Archived closed works by ``dimension`` key (operator, technician, day)."""
+    return dict(db.query(ArchiveStat.key, ArchiveStat.closed).filter(ArchiveStat.dimension == dimension).all())
+
+
+def lookup(db: Session, work_id: int) -> Optional[Dict[str, Any]]:
+    """The archived work ``work_id`` shaped like a ``works`` row (with its technician), or None."""
+    archived = db.get(ArchivedWork, work_id)
+    if archived is None:
+        return None
+    work = dict(archived.data)
+    tech_id = work.get("tecnico_assegnato_id")
+    work["tecnico_assegnato"] = db.get(Technician, tech_id) if tech_id is not None else None
+    return work
+
@@ -1,20 +1,33 @@
 import os
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status, Header
 from fastapi.security import OAuth2PasswordBearer
 from app.database import SessionLocal
+from sqlalchemy import event
 from sqlalchemy.orm import Session
 from app.models.models import User
+from app.utils.security import api_key
 
 # Load env vars
 SECRET_KEY = os.getenv("SECRET_KEY") or "unsafe-secret"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES") or 60)
 REFRESH_TOKEN_EXPIRE_MINUTES = int(os.getenv("REFRESH_TOKEN_EXPIRE_MINUTES") or (60 * 24 * 7))
+# How long a verified token maps to its user without a DB lookup (never past the token expiry)
+PRINCIPAL_CACHE_TTL_SECONDS = int(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS") or 60)
+PRINCIPAL_CACHE_SIZE = 10000
 
-pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
+# Raising PASSWORD_HASH_ROUNDS upgrades existing hashes as their users log in (see app.utils.login)
+PASSWORD_HASH_ROUNDS = int(os.getenv("PASSWORD_HASH_ROUNDS") or 29000)
+
+pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto",
+                           pbkdf2_sha256__default_rounds=PASSWORD_HASH_ROUNDS,
+                           pbkdf2_sha256__min_rounds=PASSWORD_HASH_ROUNDS)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
 
@@ -58,6 +71,90 @@ def get_user(db, user_id: int):
     return db.query(User).filter(User.id == user_id).first()
 
 
+class Principal:
+    """The authenticated user as route handlers see it: a snapshot, not bound to any session."""
+    __slots__ = ("id", "username", "role", "technician_id")
+
+    def __init__(self, user: User):
+        self.id = user.id
+        self.username = user.username
+        self.role = user.role
+        self.technician_id = user.technician_id
+
+
+class PrincipalCache:
+    """Bearer token -> Principal, so authenticated requests skip JWT decoding and the user query.
+
+    Entries live ``PRINCIPAL_CACHE_TTL_SECONDS`` at most and never past the
+    token's ``exp``; every entry is dropped as soon as a user row is updated
+    or deleted in this process (role changes). Other processes see such a
+    change within the TTL.
+    """
+
+    def __init__(self, ttl: float = PRINCIPAL_CACHE_TTL_SECONDS, max_size: int = PRINCIPAL_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> Principal | None:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            principal, expires = entry
+            if expires <= time.monotonic():
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return principal
+
+    def put(self, token: str, principal: Principal, exp: int | None) -> None:
+        ttl = self.ttl
+        if exp is not None:
+            ttl = min(ttl, exp - time.time())
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[token] = (principal, time.monotonic() + ttl)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+principal_cache = PrincipalCache()
+
+
+@event.listens_for(Session, "after_flush")
+def _drop_cached_principals(session, flush_context):
+    if any(isinstance(obj, User) for obj in list(session.dirty) + list(session.deleted)):
+        principal_cache.clear()
+
+
+def resolve_principal(token: str, db: Session) -> Principal | None:
+    """User behind a bearer token, from the cache when possible; None if the user does not exist.
+
+    Raises JWTError for invalid or expired tokens and tokens without ``sub``.
+    """
+    principal = principal_cache.get(token)
+    if principal is not None:
+        return principal
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    username: str = payload.get("sub")
+    if username is None:
+        raise JWTError("Token without subject")
+    user = get_user_by_username(db, username)
+    if user is None:
+        return None
+    principal = Principal(user)
+    principal_cache.put(token, principal, payload.get("exp"))
+    return principal
+
+
 def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -65,13 +162,9 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
+        user = resolve_principal(token, db)
     except JWTError:
         raise credentials_exception
-    user = get_user_by_username(db, username)
     if user is None:
         raise credentials_exception
     return user
@@ -86,14 +179,9 @@ def get_current_user_optional(authorization: str | None = Header(None), db: Sess
     except Exception:
         return None
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            return None
+        return resolve_principal(token, db)
     except JWTError:
         return None
-    user = get_user_by_username(db, username)
-    return user
 
 
 def require_role(role: str):
@@ -109,7 +197,7 @@ def auth_required(roles: list[str] | None = None):
     from fastapi import Header
 
     def _auth(x_api_key: str | None = Header(None), authorization: str | None = Header(None), db: Session = Depends(get_db)):
-        API_KEY = os.getenv("API_KEY")
+        API_KEY = api_key()
         # If API key is provided and correct, allow
         if x_api_key and API_KEY and x_api_key == API_KEY:
             return True
@@ -118,14 +206,9 @@ def auth_required(roles: list[str] | None = None):
             raise HTTPException(status_code=401, detail="Missing credentials")
         try:
             token = authorization.split(" ")[1]
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            username: str = payload.get("sub")
-            role: str = payload.get("role")
-            if username is None:
-                raise HTTPException(status_code=401, detail="Invalid token")
-        except JWTError:
+            user = resolve_principal(token, db)
+        except (IndexError, JWTError):
             raise HTTPException(status_code=401, detail="Invalid token")
-        user = get_user_by_username(db, username)
         if not user:
             raise HTTPException(status_code=401, detail="User not found")
         if roles and user.role not in roles:
@@ -0,0 +1,279 @@
+"""Database backups (``backup`` job, scripts/backup_db.py).
+
+SQLite databases are copied with SQLite's online backup API in a single
+step under a read lock: writers wait for the copy, but a busy database can
+never make it restart over and over as a stepped copy does each time
+another connection writes. The copy is checked with
+``PRAGMA integrity_check`` and then compressed in a streaming pass (zstd
+when the ``zstandard`` package is installed, gzip otherwise). Postgres
+databases are dumped with ``pg_dump --format=custom``, which is compressed
+already.
+
+Backups are named ``ftth_<YYYYmmdd_HHMMSS>.<ext>`` so ``rotate()`` and
+``list_backups()`` can recognise them; ``verify()`` and ``restore()`` work
+on any of them.
+"""
+import gzip
+import hashlib
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+from datetime import datetime, timedelta
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy.engine import URL, Engine
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional; gzip is always available
+    zstandard = None
+
+logger = logging.getLogger("app.utils.backup")
+
+BACKUP_DIR = os.getenv("BACKUP_DIR") or "backups"
+RETENTION_DAYS = int(os.getenv("BACKUP_RETENTION_DAYS") or 30)
+# Rotation never removes the newest backups, however old they are
+KEEP_MIN = 3
+# Pages copied per step when a backup is restored; the backup itself is copied in one step
+PAGES_PER_STEP = 1024
+CHUNK_SIZE = 1024 * 1024
+
+_NAME = re.compile(r"^ftth_(\d{8}_\d{6})\.(db\.gz|db\.zst|db|dump)$")
+
+Progress = Optional[Callable[[int, str], None]]
+
+
+def create_backup(engine: Engine, directory: Optional[str] = None, progress: Progress = None,
+                  compression: Optional[str] = None) -> Dict[str, Any]:
+    """Back up the database behind ``engine`` into ``directory``.
+
+    ``compression`` is "zstd", "gzip" or "none" (SQLite only; default zstd
+    when available). Returns path, size, sha256 and backend.
+    """
+    directory = directory or BACKUP_DIR
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    dialect = engine.dialect.name
+    if dialect == "sqlite":
+        compression = compression or ("zstd" if zstandard else "gzip")
+        path = os.path.join(directory, f"ftth_{stamp}.{_sqlite_extension(compression)}")
+        _sqlite_backup(engine, path, compression, progress)
+    elif dialect == "postgresql":
+        path = os.path.join(directory, f"ftth_{stamp}.dump")
+        _pg_dump(engine, path)
+    else:
+        raise ValueError(f"Backups are not supported for {dialect} databases")
+    size = os.path.getsize(path)
+    checksum = _sha256(path)
+    logger.info("Backup written to %s (%d bytes)", path, size)
+    return {"path": path, "size": size, "sha256": checksum, "backend": dialect}
+
+
+def list_backups(directory: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Backups found in ``directory``, newest first."""
+    directory = directory or BACKUP_DIR
+    if not os.path.isdir(directory):
+        return []
+    found = []
+    for name in os.listdir(directory):
+        match = _NAME.match(name)
+        if match:
+            path = os.path.join(directory, name)
+            found.append({"path": path, "size": os.path.getsize(path),
+                          "created_at": datetime.strptime(match.group(1), "%Y%m%d_%H%M%S")})
+    return sorted(found, key=lambda b: b["created_at"], reverse=True)
+
+
+def rotate(directory: Optional[str] = None, retention_days: Optional[int] = None, keep_min: int = KEEP_MIN) -> List[str]:
+    """Delete backups older than ``retention_days`` (the newest ``keep_min`` are always kept); returns removed paths."""
+    days = RETENTION_DAYS if retention_days is None else retention_days
+    cutoff = datetime.now() - timedelta(days=days)
+    removed = []
+    for backup in list_backups(directory)[keep_min:]:
+        if backup["created_at"] < cutoff:
+            os.remove(backup["path"])
+            removed.append(backup["path"])
+    if removed:
+        logger.info("Removed %d backup(s) older than %d days", len(removed), days)
+    return removed
+
+
+def verify(path: str) -> Dict[str, Any]:
+    """Check a backup can be read back: SQLite copies are decompressed and integrity-checked."""
+    if path.endswith(".dump"):
+        if not shutil.which("pg_restore"):
+            raise RuntimeError("pg_restore not found in PATH")
+        listing = subprocess.run(["pg_restore", "--list", path], check=True, capture_output=True, text=True).stdout
+        return {"path": path, "ok": True, "entries": sum(1 for line in listing.splitlines() if line and not line.startswith(";"))}
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = _decompress_to(path, tmp)
+        conn = sqlite3.connect(db_path)
+        try:
+            result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+            tables = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table'").fetchone()[0]
+        finally:
+            conn.close()
+    return {"path": path, "ok": result == "ok", "integrity": result, "tables": tables, "sha256": _sha256(path)}
+
+
+def restore(path: str, engine: Engine, progress: Progress = None) -> Dict[str, Any]:
+    """Restore a backup into the database behind ``engine``.
+
+    SQLite backups are verified first, then copied in with the online backup
+    API, so the target file is never left half-written (connections see the
+    old or the new content). Stop the services that write to the database
+    before restoring, or their next commits land on top of the restored data.
+    """
+    dialect = engine.dialect.name
+    if dialect == "postgresql":
+        if not shutil.which("pg_restore"):
+            raise RuntimeError("pg_restore not found in PATH")
+        dbname, env = _pg_connection(engine)
+        subprocess.run(
+            ["pg_restore", "--clean", "--if-exists", "--no-owner", f"--dbname={dbname}", path],
+            check=True, capture_output=True, env=env,
+        )
+        _new_epoch(engine)
+        return {"path": path, "backend": dialect}
+    if dialect != "sqlite":
+        raise ValueError(f"Restore is not supported for {dialect} databases")
+    check = verify(path)
+    if not check["ok"]:
+        raise ValueError(f"Backup {path} failed the integrity check: {check['integrity']}")
+    with tempfile.TemporaryDirectory() as tmp:
+        source = sqlite3.connect(_decompress_to(path, tmp))
+        raw = engine.raw_connection()
+        try:
+            source.backup(raw.driver_connection, pages=PAGES_PER_STEP, progress=_step_reporter(progress, "Restored"))
+        finally:
+            raw.close()
+            source.close()
+    _new_epoch(engine)
+    logger.info("Database restored from %s", path)
+    return {"path": path, "backend": dialect, "tables": check["tables"]}
+
+
+# ---- internals ----
+
+def _new_epoch(engine: Engine) -> None:
+    # the restored change_log sequence restarts below numbers already handed out: tags built on it must change
+    from app.utils import changes
+    with engine.begin() as conn:
+        changes.new_epoch(conn)
+
+
+def _sqlite_extension(compression: str) -> str:
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd compression needs the zstandard package")
+        return "db.zst"
+    if compression == "gzip":
+        return "db.gz"
+    if compression == "none":
+        return "db"
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+def _step_reporter(progress: Progress, verb: str):
+    def step(status, remaining, total):
+        if progress and total:
+            progress(int(100 * (total - remaining) / total), f"{verb} {total - remaining}/{total} pages")
+    return step
+
+
+def _sqlite_backup(engine: Engine, path: str, compression: str, progress: Progress) -> None:
+    # The online copy goes to a temporary file next to the target, then is compressed in one streaming pass
+    fd, tmp_path = tempfile.mkstemp(prefix=".ftth_", suffix=".db", dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        raw = engine.raw_connection()
+        try:
+            target = sqlite3.connect(tmp_path)
+            try:
+                # one step (pages=-1): a stepped copy starts over whenever another connection writes
+                raw.driver_connection.backup(target, pages=-1, progress=_step_reporter(progress, "Copied"))
+                result = target.execute("PRAGMA integrity_check").fetchone()[0]
+            finally:
+                target.close()
+        finally:
+            raw.close()
+        if result != "ok":
+            raise RuntimeError(f"Backup copy failed the integrity check: {result}")
+        partial = path + ".part"
+        with open(tmp_path, "rb") as src, open(partial, "wb") as dst:
+            _copy_compressed(src, dst, compression)
+        os.replace(partial, path)  # a crash never leaves a truncated file under a backup name
+    finally:
+        for leftover in (tmp_path, path + ".part"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+def _copy_compressed(src: BinaryIO, dst: BinaryIO, compression: str) -> None:
+    if compression == "zstd":
+        with zstandard.ZstdCompressor(level=3).stream_writer(dst, closefd=False) as out:
+            shutil.copyfileobj(src, out, CHUNK_SIZE)
+    elif compression == "gzip":
+        with gzip.GzipFile(fileobj=dst, mode="wb", compresslevel=6) as out:
+            shutil.copyfileobj(src, out, CHUNK_SIZE)
+    else:
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+
+def _decompress_to(path: str, directory: str) -> str:
+    target = os.path.join(directory, "restore.db")
+    with open(path, "rb") as src, open(target, "wb") as dst:
+        if path.endswith(".zst"):
+            if zstandard is None:
+                raise RuntimeError("Reading .zst backups needs the zstandard package")
+            with zstandard.ZstdDecompressor().stream_reader(src) as reader:
+                shutil.copyfileobj(reader, dst, CHUNK_SIZE)
+        elif path.endswith(".gz"):
+            with gzip.GzipFile(fileobj=src, mode="rb") as reader:
+                shutil.copyfileobj(reader, dst, CHUNK_SIZE)
+        else:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    return target
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _pg_connection(engine: Engine) -> Tuple[str, Dict[str, str]]:
+    """Connection URL without the password, and the environment passing it as PGPASSWORD.
+
+    Command lines are readable by every user of the host (``ps``, ``/proc/*/cmdline``),
+    the environment of a process only by its owner.
+    """
+    url = engine.url.set(drivername="postgresql")
+    env = dict(os.environ)
+    if url.password is not None:
+        env["PGPASSWORD"] = str(url.password)
+    bare = URL.create(url.drivername, url.username, None, url.host, url.port, url.database, url.query)
+    return bare.render_as_string(hide_password=False), env
+
+
+def _pg_dump(engine: Engine, path: str) -> None:
+    if not shutil.which("pg_dump"):
+        raise RuntimeError("pg_dump not found in PATH")
+    dbname, env = _pg_connection(engine)
+    partial = path + ".part"
+    try:
+        # pg_dump runs in a single REPEATABLE READ snapshot: writers are not blocked
+        subprocess.run(
+            ["pg_dump", "--format=custom", f"--file={partial}", dbname],
+            check=True, capture_output=True, env=env,
+        )
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
@@ -0,0 +1,274 @@
+"""Change-data feed for incremental sync.
+
+Every insert, update or delete of a work, ONT, modem, ONT/modem sync,
+technician or team appends a row to ``change_log`` in the same transaction. ``seq`` grows
+monotonically, so clients keep the last cursor they saw and ask
+``GET /works/changes?since=<cursor>`` for the deltas instead of downloading
+whole tables.
+
+ORM writes are captured by a Session ``after_flush`` hook; Core bulk
+statements (the ingest engine) bypass it and call ``record`` explicitly.
+
+A cursor is only safe if no entry below it can still show up, i.e. if
+sequence numbers become visible in order. On SQLite writers are serialized,
+so they do. On PostgreSQL a transaction may draw a lower ``seq`` and commit
+after a reader has already seen a higher one, so the entries of a
+transaction are renumbered right before its commit, under a transaction
+advisory lock: numbers are then handed out in commit order and the lock is
+held until the commit is visible.
+The entries written by a transaction are also kept in ``session.info``
+and handed to the ``on_commit`` callbacks once it commits, which is how
+``app.utils.live`` pushes them to open dashboards.
+
+Restoring a backup rewinds ``seq``, so the same number can later stand for
+different data. ``db_epoch`` holds a random identity that ``new_epoch()``
+replaces after every restore; tags derived from ``seq`` (``app.utils.etag``)
+include it.
+
+The log does not grow forever: the ``cleanup`` job calls ``prune()``, which
+drops entries older than ``CHANGE_LOG_RETENTION_DAYS`` that no replication
+peer still has to receive. A cursor below the oldest entry left gets a
+``reset`` from ``fetch_changes``.
+"""
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import bindparam, delete, event, func, insert, inspect, select, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+
+from app.models.models import ChangeLog, DatabaseEpoch, ONT, ONTModemSync, Modem, SyncPeer, Team, Technician, Work
+
+logger = logging.getLogger("app.utils.changes")
+
+ENTITIES = {
+    "work": Work,
+    "ont": ONT,
+    "modem": Modem,
+    "sync": ONTModemSync,
+    "technician": Technician,
+    "team": Team,
+}
+_ENTITY_NAMES = {model: name for name, model in ENTITIES.items()}
+DEFAULT_LIMIT = 500
+MAX_LIMIT = 5000
+# Entries older than this are removed by the cleanup job (see prune)
+RETENTION_DAYS = int(os.getenv("CHANGE_LOG_RETENTION_DAYS") or 90)
+# session.info key holding the entries of the current transaction
+PENDING_KEY = "pending_changes"
+# pg_advisory_xact_lock key serializing the commit of change entries (PostgreSQL)
+COMMIT_LOCK_KEY = 0x0C4A4E6E
+
+_RENUMBER = text(
+    "UPDATE change_log SET seq = n.new_seq "
+    "FROM (SELECT t.old_seq, nextval(pg_get_serial_sequence('change_log', 'seq')) AS new_seq "
+    "      FROM unnest(CAST(:seqs AS bigint[])) WITH ORDINALITY AS t(old_seq, ord) ORDER BY t.ord) AS n "
+    "WHERE change_log.seq = n.old_seq RETURNING n.old_seq, change_log.seq"
+).bindparams(bindparam("seqs"))
+
+_commit_callbacks: List[Callable[[List[Dict[str, Any]]], None]] = []
+
+
+def on_commit(callback: Callable[[List[Dict[str, Any]]], None]):
+    """Register ``callback(entries)`` to run after every commit that recorded changes."""
+    _commit_callbacks.append(callback)
+    return callback
+
+
+def _append(session: Session, rows: List[Dict[str, Any]], data: List[Optional[Dict[str, Any]]]) -> None:
+    table = ChangeLog.__table__
+    stmt = insert(table).returning(table.c.seq, sort_by_parameter_order=True)
+    seqs = session.connection().execute(stmt, rows).scalars().all()
+    pending = session.info.setdefault(PENDING_KEY, [])
+    for seq, row, row_data in zip(seqs, rows, data):
+        pending.append({
+            "seq": seq,
+            "entity": row["entity"],
+            "id": row["entity_id"],
+            "op": row["op"],
+            "changed_at": jsonable_encoder(row["changed_at"]),
+            "data": row_data,
+        })
+
+
+def record(db: Session, entity: str, ids: Iterable[int], op: str = "upsert") -> None:
+    """Append change entries for rows written outside the ORM unit of work (bulk Core statements)."""
+    now = datetime.utcnow()
+    rows = [{"entity": entity, "entity_id": i, "op": op, "changed_at": now} for i in ids if i is not None]
+    if rows:
+        _append(db, rows, [None] * len(rows))
+
+
+@event.listens_for(Session, "after_flush")
+def _record_flushed_changes(session, flush_context):
+    now = datetime.utcnow()
+    rows = []
+    data = []
+    seen = set()
+    for objects, op, dirty in ((session.new, "upsert", False), (session.dirty, "upsert", True), (session.deleted, "delete", False)):
+        for obj in objects:
+            entity = _ENTITY_NAMES.get(type(obj))
+            if entity is None or (dirty and not session.is_modified(obj, include_collections=False)):
+                continue
+            entity_id = getattr(obj, "id", None)
+            if entity_id is None or (entity, entity_id) in seen:
+                continue
+            seen.add((entity, entity_id))
+            rows.append({"entity": entity, "entity_id": entity_id, "op": op, "changed_at": now})
+            data.append(_loaded_state(obj, new=not dirty) if op == "upsert" else None)
+    if rows:
+        _append(session, rows, data)
+
+
+def _loaded_state(obj, new: bool = False) -> Dict[str, Any]:
+    """Column values already loaded on ``obj``; never emits SQL (we are inside a flush).
+
+    Columns never set on a freshly inserted row are NULL, so they are filled
+    in; on updated rows an unloaded column is simply left out.
+    """
+    state = inspect(obj)
+    values = {}
+    for attr in state.mapper.column_attrs:
+        if attr.key in state.dict:
+            values[attr.key] = state.dict[attr.key]
+        elif new:
+            values[attr.key] = None
+    return jsonable_encoder(values)
+
+
+@event.listens_for(Session, "before_commit")
+def _renumber_in_commit_order(session):
+    """PostgreSQL: give this transaction's entries sequence numbers in commit order (see module doc)."""
+    if session.get_bind().dialect.name != "postgresql":
+        return
+    session.flush()  # entries of still pending ORM changes get their rows first
+    pending = session.info.get(PENDING_KEY)
+    if not pending:
+        return
+    conn = session.connection()
+    conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": COMMIT_LOCK_KEY})
+    renumbered = dict(conn.execute(_RENUMBER, {"seqs": [entry["seq"] for entry in pending]}).all())
+    for entry in pending:
+        entry["seq"] = renumbered.get(entry["seq"], entry["seq"])
+
+
+@event.listens_for(Session, "after_commit")
+def _dispatch_committed(session):
+    pending = session.info.pop(PENDING_KEY, None)
+    if not pending:
+        return
+    for callback in _commit_callbacks:
+        try:
+            callback(pending)
+        except Exception:
+            logger.exception("change commit callback failed")
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_rolled_back(session):
+    session.info.pop(PENDING_KEY, None)
+
+
+def new_epoch(conn: Connection) -> str:
+    """Give the change sequence a new identity (after a restore); returns it."""
+    value = uuid.uuid4().hex[:12]
+    conn.execute(delete(DatabaseEpoch.__table__))
+    conn.execute(insert(DatabaseEpoch.__table__).values(epoch=value, created_at=datetime.utcnow()))
+    return value
+
+
+def ensure_epoch(engine: Engine) -> None:
+    """Create the epoch of a database that has none yet (startup)."""
+    with engine.begin() as conn:
+        if conn.execute(select(DatabaseEpoch.id).limit(1)).first() is None:
+            new_epoch(conn)
+
+
+def head(db: Session) -> int:
+    """Current (highest) change sequence, 0 when nothing was recorded yet."""
+    return db.query(func.max(ChangeLog.seq)).scalar() or 0
+
+
+def prune(db: Session, retention_days: int = RETENTION_DAYS) -> int:
+    """Delete the entries older than ``retention_days``; returns how many went.
+
+    Entries at or above the lowest ``push_cursor`` of a replication peer are
+    kept (the peer has not received them yet), and so is the newest entry,
+    which ``head()`` reads. The caller commits.
+    """
+    current_head = head(db)
+    bound = current_head
+    lowest_cursor = db.query(func.min(SyncPeer.push_cursor)).scalar()
+    if lowest_cursor is not None:
+        bound = min(bound, lowest_cursor)
+    return db.query(ChangeLog).filter(
+        ChangeLog.seq < bound, ChangeLog.changed_at < datetime.utcnow() - timedelta(days=retention_days)
+    ).delete(synchronize_session=False)
+
+
+def _serialize(obj) -> Dict[str, Any]:
+    return jsonable_encoder({attr.key: getattr(obj, attr.key) for attr in inspect(obj).mapper.column_attrs})
+
+
+def fetch_changes(db: Session, since: int = 0, limit: int = DEFAULT_LIMIT, entities: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Return the changes recorded after ``since``.
+
+    Entries are folded per entity row (only the latest state is sent) and
+    carry the current row so clients can apply them directly. ``cursor`` is
+    the value to send as ``since`` next time; ``has_more`` means another
+    page is already available. ``reset`` asks the client for a full refresh,
+    e.g. when its cursor is ahead of this database (restored backup) or
+    older than the entries ``prune()`` left; in the latter case the page of
+    what is left comes along, so a client can resume from it after the
+    refresh.
+    """
+    current_head = head(db)
+    if since > current_head:
+        return {"since": since, "cursor": current_head, "has_more": False, "reset": True, "changes": []}
+    oldest = db.query(func.min(ChangeLog.seq)).scalar()
+    # entries between the cursor and the oldest one left may have been pruned
+    reset = oldest is not None and since < oldest - 1
+
+    query = db.query(ChangeLog).filter(ChangeLog.seq > since)
+    if entities:
+        query = query.filter(ChangeLog.entity.in_(entities))
+    entries = query.order_by(ChangeLog.seq).limit(limit + 1).all()
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    if has_more:
+        cursor = entries[-1].seq
+    else:
+        # Entries hidden by the entity filter are consumed as well
+        cursor = max(current_head, entries[-1].seq if entries else since)
+
+    latest: Dict[Tuple[str, int], ChangeLog] = {}
+    for entry in entries:
+        latest[(entry.entity, entry.entity_id)] = entry
+
+    by_entity: Dict[str, List[int]] = {}
+    for entity, entity_id in latest:
+        by_entity.setdefault(entity, []).append(entity_id)
+    rows: Dict[Tuple[str, int], Any] = {}
+    for entity, ids in by_entity.items():
+        model = ENTITIES[entity]
+        for obj in db.query(model).filter(model.id.in_(ids)):
+            rows[(entity, obj.id)] = obj
+
+    changes = []
+    for key, entry in sorted(latest.items(), key=lambda item: item[1].seq):
+        obj = rows.get(key)
+        # A row deleted after this entry was written shows up as a delete right away
+        op = "delete" if entry.op == "delete" or obj is None else "upsert"
+        changes.append({
+            "seq": entry.seq,
+            "entity": entry.entity,
+            "id": entry.entity_id,
+            "op": op,
+            "changed_at": jsonable_encoder(entry.changed_at),
+            "data": _serialize(obj) if op == "upsert" else None,
+        })
+    return {"since": since, "cursor": cursor, "has_more": has_more, "reset": reset, "changes": changes}
@@ -0,0 +1,79 @@
+"""Optimistic concurrency for works, ONTs and modems.
+
+Each of these rows carries a ``version`` counter, declared as the mapper's
+``version_id_col``: every ORM UPDATE/DELETE is issued as
+``... WHERE id = :id AND version = :read`` and bumps it, so a write based
+on a row that another request changed in the meantime matches nothing and
+raises ``StaleDataError`` instead of silently overwriting it. The API
+answers that with 409 (``conflict_response``); the Telegram commands tell
+the technician to retry. No lock is held between read and write.
+
+Clients can also make the check explicit: the PUT routes return the new
+version as a strong ``ETag`` (``"<version>"``, also in the ``version`` field
+of the GET bodies) and accept it back in ``If-Match``, as well as the ETag of
+the single-resource GET (``"<version>.<digest>"``, see ``app.utils.etag``);
+a stale value is refused with 412 before anything is written.
+
+Core bulk writes bypass the mapper, so they bump the column themselves
+(``version = version + 1``).
+"""
+import logging
+import re
+from typing import Optional
+
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import JSONResponse
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm.exc import StaleDataError
+
+from app.models.models import Modem, ONT, Work
+
+logger = logging.getLogger("app.utils.concurrency")
+
+VERSIONED = (Work, ONT, Modem)
+
+CONFLICT_DETAIL = "The resource was modified by another request; reload it and retry"
+# "<version>" from the PUTs, "<version>.<digest>" from the GETs
+_TAG_VERSION = re.compile(r'^"(\d+)(?:\.[0-9a-f]+)?"$')
+
+
+def ensure_columns(engine: Engine) -> None:
+    """Add the ``version`` column to tables created before it existed (startup)."""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for model in VERSIONED:
+            table = model.__tablename__
+            if not inspector.has_table(table):
+                continue
+            if "version" in {c["name"] for c in inspector.get_columns(table)}:
+                continue
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+            logger.info("Added version column to %s", table)
+
+
+def tag(obj) -> str:
+    return f'"{obj.version}"'
+
+
+def check_if_match(request: Request, obj) -> None:
+    """412 unless the request's ``If-Match`` (when sent) names the current version of ``obj``."""
+    header = request.headers.get("if-match")
+    if not header or header.strip() == "*":
+        return
+    current = tag(obj)
+    # Strong comparison on the version: a weak tag (W/...) never matches
+    versions = {m.group(1) for m in (_TAG_VERSION.match(c.strip()) for c in header.split(",")) if m}
+    if str(obj.version) not in versions:
+        raise HTTPException(status_code=412, detail=f"Precondition failed: current version is {obj.version}",
+                            headers={"ETag": current})
+
+
+def set_tag(response: Response, obj) -> None:
+    """ETag of ``obj`` after the write (reloads the version the commit produced)."""
+    response.headers["ETag"] = tag(obj)
+
+
+def conflict_response(request: Optional[Request], exc: StaleDataError) -> JSONResponse:
+    logger.info("Concurrent update rejected on %s: %s", request.url.path if request else "-", exc)
+    return JSONResponse(status_code=409, content={"detail": CONFLICT_DETAIL})
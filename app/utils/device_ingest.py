@@ -0,0 +1,225 @@
+"""Bulk ONT/modem registration (``POST /onts/bulk``, ``POST /modems/bulk``).
+
+A pallet delivery arrives as a list of serials, usually read with a barcode
+scanner: CSV (with a header row, or just one serial per line) or NDJSON
+(objects or bare strings), processed in chunks while the body is received.
+For every chunk the serials already registered are found with one
+``serial_number IN (...)`` query and the new devices are written with one
+``INSERT ... ON CONFLICT DO NOTHING`` executemany, committing once per
+chunk. A device registered concurrently by someone else shows up as
+``exists``, so sending the same file twice is harmless.
+
+The report has one entry per input row: ``created`` (with the new id),
+``exists`` (id of the registered device), ``duplicate`` (already earlier in
+the same upload) or ``error``.
+"""
+import csv
+import logging
+from datetime import datetime
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+
+from app.utils import changes, inventory
+from app.utils.ingest import DEFAULT_CHUNK_SIZE, is_ndjson, iter_ndjson
+
+logger = logging.getLogger("app.utils.device_ingest")
+
+CSV_CONTENT_TYPES = ("text/csv", "application/csv", "text/plain")
+# Header names accepted for the serial column (scanner exports, Italian spreadsheets)
+SERIAL_ALIASES = {"serial_number", "serial", "sn", "seriale", "matricola", "barcode"}
+
+
+def normalize_serial(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    serial = str(value).strip()
+    return serial or None
+
+
+def is_csv(content_type: Optional[str]) -> bool:
+    return bool(content_type) and content_type.split(";")[0].strip().lower() in CSV_CONTENT_TYPES
+
+
+async def iter_csv(stream: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, Any, Optional[str]]]:
+    """Yield ``(row_index, record, error)`` for every non-empty CSV line of a body stream.
+
+    The delimiter (``,``, ``;`` or tab) is taken from the first line; if that
+    line names a serial column it is the header, otherwise every line is a
+    bare serial (first cell).
+    """
+    buffer = b""
+    header: Optional[List[str]] = None
+    delimiter: Optional[str] = None
+    index = 0
+
+    def rows(lines: List[bytes]):
+        nonlocal header, delimiter, index
+        for line in lines:
+            text = line.decode("utf-8-sig", errors="replace").strip("\r\n")
+            if not text.strip():
+                continue
+            if delimiter is None:
+                delimiter = max((",", ";", "\t"), key=text.count) if any(d in text for d in ",;\t") else ","
+                cells = next(csv.reader([text], delimiter=delimiter))
+                names = [c.strip().lower() for c in cells]
+                if SERIAL_ALIASES & set(names):
+                    header = ["serial_number" if n in SERIAL_ALIASES else n for n in names]
+                    continue
+            cells = next(csv.reader([text], delimiter=delimiter))
+            if header is None:
+                record = {"serial_number": cells[0] if cells else None}
+            else:
+                record = {name: cell.strip() or None for name, cell in zip(header, cells) if name}
+            yield index, record, None
+            index += 1
+
+    async for chunk in stream:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for item in rows(lines):
+            yield item
+    for item in rows([buffer]):
+        yield item
+
+
+class DeviceRegistrar:
+    """Accumulates device records of one kind (``ont``/``modem``) and inserts them chunk by chunk."""
+
+    def __init__(self, db: Session, kind: str, *, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.db = db
+        self.kind = kind
+        self.table = inventory.KINDS[kind].__table__
+        self.chunk_size = max(1, chunk_size)
+        self.results: List[Dict[str, Any]] = []
+        self.received = 0
+        self._pending: List[Tuple[int, Dict[str, Any]]] = []
+        self._seen: set = set()
+        # Column defaults of the device table: executemany needs the same keys on every row
+        self._defaults = {c.name: c.default.arg for c in self.table.c
+                          if c.default is not None and c.default.is_scalar}
+
+    def add(self, index: int, record: Dict[str, Any]) -> None:
+        self.received += 1
+        serial = normalize_serial(record.get("serial_number"))
+        if not serial:
+            self.results.append({"index": index, "serial_number": None, "status": "error", "error": "serial_number is required"})
+            return
+        if serial in self._seen:
+            self.results.append({"index": index, "serial_number": serial, "status": "duplicate"})
+            return
+        self._seen.add(serial)
+        self._pending.append((index, {**record, "serial_number": serial}))
+        if len(self._pending) >= self.chunk_size:
+            self.flush()
+
+    def add_error(self, index: int, serial: Optional[str], error: str) -> None:
+        self.received += 1
+        self.results.append({"index": index, "serial_number": normalize_serial(serial), "status": "error", "error": error})
+
+    def flush(self) -> None:
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        try:
+            self._write_chunk(pending)
+        except Exception as e:
+            # Isolate the offending record(s): retry one by one in their own transaction
+            self.db.rollback()
+            logger.warning("Device chunk of %d failed (%s); retrying records individually", len(pending), e)
+            for item in pending:
+                try:
+                    self._write_chunk([item])
+                except Exception as row_error:
+                    self.db.rollback()
+                    self.results.append({"index": item[0], "serial_number": item[1]["serial_number"],
+                                         "status": "error", "error": str(row_error)})
+
+    def finish(self) -> Dict[str, Any]:
+        self.flush()
+        self.results.sort(key=lambda r: r["index"])
+        counts = {status: 0 for status in ("created", "exists", "duplicate", "error")}
+        for result in self.results:
+            counts[result["status"]] += 1
+        return {"received": self.received, "results": self.results, **counts}
+
+    def _insert_statement(self):
+        dialect = self.db.get_bind().dialect.name
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        elif dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            return None
+        return dialect_insert(self.table).on_conflict_do_nothing(index_elements=[self.table.c.serial_number])
+
+    def _write_chunk(self, pending: List[Tuple[int, Dict[str, Any]]]) -> None:
+        t = self.table
+        serials = [record["serial_number"] for _, record in pending]
+        existing = dict(self.db.execute(select(t.c.serial_number, t.c.id).where(t.c.serial_number.in_(serials))).all())
+        now = datetime.utcnow()
+        rows = []
+        for _, record in pending:
+            if record["serial_number"] in existing:
+                continue
+            row = dict(self._defaults)
+            row.update({k: v for k, v in record.items() if k in t.c and v is not None})
+            row.update(status="available", created_at=now, updated_at=now)
+            rows.append(row)
+        created: Dict[str, int] = {}
+        if rows:
+            columns = sorted({k for row in rows for k in row})
+            rows = [{c: row.get(c) for c in columns} for row in rows]
+            stmt = self._insert_statement()
+            if stmt is None:
+                self.db.execute(insert(t), rows)
+                created = dict(self.db.execute(select(t.c.serial_number, t.c.id)
+                                               .where(t.c.serial_number.in_([row["serial_number"] for row in rows]))).all())
+            else:
+                # only the rows actually inserted come back: a concurrent upload may have won some serials
+                created = {serial: row_id for row_id, serial in
+                           self.db.execute(stmt.returning(t.c.id, t.c.serial_number), rows)}
+            inventory.count_inserted(self.db, self.kind, [row for row in rows if row["serial_number"] in created])
+            changes.record(self.db, self.kind, created.values())
+            missing = [row["serial_number"] for row in rows if row["serial_number"] not in created]
+            if missing:
+                existing.update(self.db.execute(select(t.c.serial_number, t.c.id).where(t.c.serial_number.in_(missing))).all())
+        self.db.commit()
+        for index, record in pending:
+            serial = record["serial_number"]
+            if serial in created:
+                self.results.append({"index": index, "serial_number": serial, "status": "created", "id": created[serial]})
+            else:
+                self.results.append({"index": index, "serial_number": serial, "status": "exists", "id": existing.get(serial)})
+
+
+async def run_registration(request: Request, registrar: DeviceRegistrar,
+                           feed_batch: Callable[[DeviceRegistrar, List[Tuple[int, Any]]], None]) -> Dict[str, Any]:
+    """Run a CSV, NDJSON or JSON (``{"devices": [...]}`` or a list) body through ``registrar``."""
+    content_type = request.headers.get("content-type")
+    if is_ndjson(content_type) or is_csv(content_type):
+        rows = iter_ndjson(request.stream()) if is_ndjson(content_type) else iter_csv(request.stream())
+        batch = []
+        async for index, item, error in rows:
+            if error:
+                registrar.add_error(index, None, error)
+                continue
+            batch.append((index, item))
+            if len(batch) >= registrar.chunk_size:
+                await run_in_threadpool(feed_batch, registrar, batch)
+                batch = []
+        if batch:
+            await run_in_threadpool(feed_batch, registrar, batch)
+    else:
+        try:
+            body = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid JSON body")
+        items = body.get("devices") if isinstance(body, dict) else body
+        if not isinstance(items, list):
+            raise HTTPException(status_code=422, detail='Expected a list of devices or {"devices": [...]}')
+        await run_in_threadpool(feed_batch, registrar, list(enumerate(items)))
+    return await run_in_threadpool(registrar.finish)
@@ -0,0 +1,77 @@
+"""Page fingerprints for incremental re-parse of revised documents.
+
+Operators re-export the same schedule PDF with a few appointments added.
+Each parsed page is stored with a hash of its normalized text and the
+entries extracted from it. When a new upload shares enough pages with an
+earlier document it is treated as a revision: unchanged pages reuse the
+stored entries (marked ``_unchanged_from``) instead of being parsed again,
+and ``apply_document`` skips those whose work the earlier document already
+applied (``applied_numeri_wr``), so entries left out of a partial apply are
+still written.
+"""
+import hashlib
+import re
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.models.models import Document, DocumentAppliedWork, DocumentPage, Work
+
+UNCHANGED_KEY = "_unchanged_from"
+
+
+def fingerprint(text: Optional[str]) -> Optional[str]:
+    """Hash of the page text with case and whitespace normalized; None for empty pages."""
+    normalized = re.sub(r"\s+", " ", (text or "")).strip().casefold()
+    if not normalized:
+        return None
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def find_previous_revision(db: Session, doc: Document, prints: Sequence[Optional[str]]) -> Optional[Document]:
+    """Earlier document sharing at least half of its (or this document's) pages, most shared pages first."""
+    prints = [p for p in prints if p]
+    if not prints:
+        return None
+    shared = func.count(func.distinct(DocumentPage.fingerprint))
+    rows = (
+        db.query(DocumentPage.document_id, shared)
+        .filter(DocumentPage.fingerprint.in_(set(prints)), DocumentPage.document_id != doc.id)
+        .group_by(DocumentPage.document_id)
+        .order_by(shared.desc(), DocumentPage.document_id.desc())
+        .limit(5)
+        .all()
+    )
+    for document_id, count in rows:
+        pages = db.query(func.count(DocumentPage.id)).filter(
+            DocumentPage.document_id == document_id, DocumentPage.fingerprint.isnot(None)
+        ).scalar() or 0
+        if count * 2 >= min(pages, len(prints)):
+            return db.query(Document).filter(Document.id == document_id).first()
+    return None
+
+
+def entries_by_fingerprint(db: Session, document_id: int) -> Dict[str, List[Dict[str, Any]]]:
+    rows = db.query(DocumentPage.fingerprint, DocumentPage.entries).filter(
+        DocumentPage.document_id == document_id, DocumentPage.fingerprint.isnot(None)
+    )
+    return {fp: entries or [] for fp, entries in rows}
+
+
+def store(db: Session, document_id: int, pages: Sequence[Tuple[int, Optional[str], List[Dict[str, Any]]]]) -> None:
+    """Replace the stored pages of a document (re-parsing the same document starts over)."""
+    delete_pages(db, document_id)
+    db.add_all(DocumentPage(document_id=document_id, page_no=page_no, fingerprint=fp, entries=entries) for page_no, fp, entries in pages)
+
+
+def delete_pages(db: Session, document_id: int) -> None:
+    db.query(DocumentPage).filter(DocumentPage.document_id == document_id).delete(synchronize_session=False)
+
+
+def applied_numeri_wr(db: Session, document_id: int) -> Set[str]:
+    """WR numbers of the works a document was applied to."""
+    rows = (db.query(Work.numero_wr)
+            .join(DocumentAppliedWork, DocumentAppliedWork.work_id == Work.id)
+            .filter(DocumentAppliedWork.document_id == document_id, Work.numero_wr.isnot(None)))
+    return {numero_wr for (numero_wr,) in rows}
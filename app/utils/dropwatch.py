@@ -0,0 +1,229 @@
+"""Drop-folder watcher: ingest PDFs as soon as they land in a directory.
+
+New files are noticed through inotify (Linux; a directory rescan is used
+where it is not available) and handled without any HTTP round-trip:
+
+1. debounce: a file is picked up only once its size and mtime have not
+   changed for ``debounce`` seconds, so half-copied files are not parsed;
+2. files already in the ``processed_files`` ledger (same path, size and
+   mtime) are skipped; content duplicates are caught by hash when written;
+3. parsing runs in a process pool (``pdf_ingest.parse_file``);
+4. results are written by ``pdf_ingest.DocumentBatchWriter`` with
+   ``min_confidence``: confident entries are applied to works right away,
+   the others wait on the document for review.
+
+``python -m app.watcher`` runs it as a service (see deploy/watcher.service).
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from app.utils import pdf_ingest
+
+logger = logging.getLogger("app.utils.dropwatch")
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class Inotify:
+    """Minimal inotify binding over libc (no third-party dependency)."""
+
+    def __init__(self, directory: str, mask: int = WATCH_MASK):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+        self.directory = directory
+
+    def read(self, timeout: float) -> Optional[Set[str]]:
+        """Names of the files touched within ``timeout`` seconds; None when the kernel queue overflowed."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+        names, offset = set(), 0
+        while offset + _EVENT.size <= len(data):
+            _wd, mask, _cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if name:
+                names.add(os.fsdecode(name))
+        return names
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class PollingSource:
+    """Fallback for systems without inotify: rescans the directory every ``timeout`` seconds."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._seen: Dict[str, Tuple[int, float]] = {}
+
+    def read(self, timeout: float) -> Optional[Set[str]]:
+        time.sleep(timeout)
+        changed = set()
+        current = {}
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.is_file():
+                    stat = entry.stat()
+                    current[entry.name] = (stat.st_size, stat.st_mtime)
+                    if self._seen.get(entry.name) != current[entry.name]:
+                        changed.add(entry.name)
+        self._seen = current
+        return changed
+
+    def close(self) -> None:
+        pass
+
+
+def open_source(directory: str):
+    try:
+        return Inotify(directory)
+    except (OSError, AttributeError) as e:
+        logger.warning("inotify not available (%s); falling back to rescanning %s", e, directory)
+        return PollingSource(directory)
+
+
+def _is_candidate(name: str) -> bool:
+    # editors and copy tools write to hidden/temporary names first
+    return name.lower().endswith(".pdf") and not name.startswith((".", "~"))
+
+
+class DropFolderWatcher:
+    def __init__(self, directory: str, session_factory: Callable, *, debounce: float = 2.0, min_confidence: float = 0.8,
+                 workers: int = 1, source=None):
+        self.directory = os.path.abspath(directory)
+        self.session_factory = session_factory
+        self.debounce = debounce
+        self.min_confidence = min_confidence
+        # workers=0 parses in the watcher process itself (tests, tiny installs)
+        self.pool = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+        self.source = source or open_source(self.directory)
+        self.stats = {"documents": 0, "duplicates": 0, "failed": 0, "works": 0}
+        self._pending: Dict[str, Tuple[float, int, float]] = {}  # path -> (due, size, mtime)
+        self._running: List[Future] = []
+        # catch up with files dropped while the service was down
+        self._rescan()
+
+    def run(self, should_stop: Callable[[], bool] = lambda: False) -> None:
+        logger.info("Watching %s (debounce %.1fs, auto-apply confidence >= %.2f)", self.directory, self.debounce, self.min_confidence)
+        try:
+            while not should_stop():
+                self.poll()
+        finally:
+            self.close()
+
+    def poll(self, timeout: float = 0.5) -> int:
+        """One iteration: collect events, start parsing files that settled, write finished ones. Returns files written."""
+        wait = min(timeout, self.debounce) if self._pending or self._running else timeout
+        names = self.source.read(wait)
+        if names is None:
+            self._rescan()
+        else:
+            for name in names:
+                if _is_candidate(name):
+                    self._touch(os.path.join(self.directory, name))
+        self._start_ready()
+        return self._write_finished()
+
+    def close(self) -> None:
+        """Stop watching, let the files in flight finish parsing and write them."""
+        self.source.close()
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+        self._write_finished()
+
+    # ---- internals ----
+
+    def _rescan(self) -> None:
+        for path in pdf_ingest.iter_pdfs([self.directory], recursive=False):
+            if _is_candidate(os.path.basename(path)):
+                self._touch(path)
+
+    def _touch(self, path: str) -> None:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._pending.pop(path, None)
+            return
+        self._pending[path] = (time.monotonic() + self.debounce, stat.st_size, stat.st_mtime)
+
+    def _start_ready(self) -> None:
+        now = time.monotonic()
+        ready = []
+        for path, (due, size, mtime) in list(self._pending.items()):
+            if due > now:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self._pending[path]
+                continue
+            if (stat.st_size, stat.st_mtime) != (size, mtime) or not stat.st_size:
+                # still being written: wait another debounce period
+                self._pending[path] = (now + self.debounce, stat.st_size, stat.st_mtime)
+                continue
+            del self._pending[path]
+            ready.append(path)
+        if not ready:
+            return
+        db = self.session_factory()
+        try:
+            ready = pdf_ingest.pending_files(db, ready)
+        finally:
+            db.close()
+        for path in ready:
+            if self.pool is not None:
+                self._running.append(self.pool.submit(pdf_ingest.parse_file, path))
+            else:
+                future = Future()
+                future.set_result(pdf_ingest.parse_file(path))
+                self._running.append(future)
+
+    def _write_finished(self) -> int:
+        done = [f for f in self._running if f.done()]
+        if not done:
+            return 0
+        # filter on the same snapshot: a future finishing right now is picked up next time
+        self._running = [f for f in self._running if f not in done]
+        db = self.session_factory()
+        try:
+            writer = pdf_ingest.DocumentBatchWriter(db, batch_size=len(done), min_confidence=self.min_confidence,
+                                                    event_note="drop-folder")
+            for future in done:
+                try:
+                    writer.add(future.result())
+                except Exception:
+                    # a crashed worker loses the file for this run; it is picked up again on restart
+                    logger.exception("Parsing a dropped file failed")
+            stats = writer.finish()
+        finally:
+            db.close()
+        for key in self.stats:
+            self.stats[key] += stats[key]
+        logger.info("Ingested %d file(s): %s", len(done), stats)
+        return len(done)
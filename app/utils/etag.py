@@ -0,0 +1,101 @@
+"""Conditional GET support for read endpoints.
+
+ETags are derived from the ``change_log`` sequence (see ``app.utils.changes``)
+instead of from the response body: one indexed ``MAX(seq)`` lookup tells
+whether anything the endpoint reads has changed, so a matching
+``If-None-Match`` is answered with 304 before the rows are loaded or
+serialized. Usage inside a route::
+
+    not_modified = etag.check(request, response, db, ["technician", "team"])
+    if not_modified is not None:
+        return not_modified
+
+Single works, ONTs and modems pass their ``version`` too: their tag is then
+strong, ``"<version>.<digest>"``, and is accepted back as ``If-Match`` by the
+PUT routes (``app.utils.concurrency``). They also pass ``exists``, so
+``If-None-Match: *`` only matches a resource that is there.
+
+The digest includes the database epoch (``db_epoch``, read in the same
+query): a restore rewinds ``seq``, and without it a tag issued before the
+restore could match different data afterwards.
+"""
+import hashlib
+import time
+from typing import Iterable, Optional, Sequence, Tuple, Union
+
+from fastapi import Request, Response
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.orm import Session
+
+from app.models.models import ChangeLog, DatabaseEpoch
+
+# Clients may keep the body but must revalidate before every use
+DEFAULT_CACHE_CONTROL = "private, no-cache"
+
+# An entity name covers the whole table, (entity, id) a single row
+VersionKey = Union[str, Tuple[str, int]]
+
+
+def version(db: Session, keys: Iterable[VersionKey]) -> Tuple[int, str]:
+    """Highest change sequence touching any of ``keys`` (0 when none was recorded) and the database epoch."""
+    criteria = []
+    for key in keys:
+        if isinstance(key, tuple):
+            criteria.append(and_(ChangeLog.entity == key[0], ChangeLog.entity_id == key[1]))
+        else:
+            criteria.append(ChangeLog.entity == key)
+    epoch = select(DatabaseEpoch.epoch).limit(1).scalar_subquery()
+    if not criteria:
+        return 0, db.execute(select(epoch)).scalar() or ""
+    seq = select(func.max(ChangeLog.seq)).where(or_(*criteria)).scalar_subquery()
+    current, current_epoch = db.execute(select(seq, epoch)).one()
+    return current or 0, current_epoch or ""
+
+
+def make_etag(request: Request, current: int, time_bucket: Optional[int] = None,
+              resource_version: Optional[int] = None, epoch: str = "") -> str:
+    parts = [request.url.path, str(sorted(request.query_params.multi_items())), str(current), epoch]
+    if time_bucket:
+        # Endpoints relative to "now" (e.g. last 7 days) change even without writes
+        parts.append(str(int(time.time() // time_bucket)))
+    digest = hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()[:20]
+    if resource_version is not None:
+        return f'"{resource_version}.{digest}"'
+    return f'W/"{digest}"'
+
+
+def _matches(header: Optional[str], tag: str, exists: bool = True) -> bool:
+    if not header:
+        return False
+    if header.strip() == "*":
+        return exists
+    # Weak comparison: W/ prefixes are ignored on both sides
+    wanted = tag[2:] if tag.startswith("W/") else tag
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == wanted:
+            return True
+    return False
+
+
+def check(
+    request: Request,
+    response: Response,
+    db: Session,
+    keys: Sequence[VersionKey],
+    *,
+    time_bucket: Optional[int] = None,
+    cache_control: str = DEFAULT_CACHE_CONTROL,
+    resource_version: Optional[int] = None,
+    exists: bool = True,
+) -> Optional[Response]:
+    """Return a 304 response when the client's copy is current, otherwise set ETag/Cache-Control and return None."""
+    current, epoch = version(db, keys)
+    tag = make_etag(request, current, time_bucket, resource_version, epoch)
+    headers = {"ETag": tag, "Cache-Control": cache_control}
+    if _matches(request.headers.get("if-none-match"), tag, exists):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
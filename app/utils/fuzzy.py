@@ -0,0 +1,260 @@
+"""Fuzzy matching of incoming WR entries against existing works.
+
+OCR regularly mis-reads WR numbers (``WR-17649O2551``) and every variant used
+to become a new work that later needed ``merge_duplicates``. Each work gets
+a few blocking keys in ``work_match_keys``:
+
+* ``w:<digits>``: the WR number with OCR look-alikes folded to digits
+  (O/Q/D -> 0, I/L -> 1, Z -> 2, S -> 5, G -> 6, B -> 8), plus every
+  variant with one digit deleted. Two numbers one substitution, insertion or
+  deletion apart always share one of these keys;
+* ``n:<token>`` / ``a:<token>``: normalized customer-name and address words.
+
+A lookup is an indexed ``key IN (...)`` query for the keys of the incoming
+entry, so its cost depends on the matching postings, not on the number of
+works. Only the candidates found this way are scored (WR edit distance and
+trigram similarity of name and address).
+
+Keys are kept up to date like the search index: an ``after_flush`` hook for
+ORM writes, ``reindex`` for the ingest engine's bulk upserts. The keys of a
+deleted work go in ``before_flush``, ahead of the work's DELETE, which their
+foreign key would otherwise reject.
+"""
+import logging
+import re
+import unicodedata
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from sqlalchemy import delete, event, func, insert, inspect as sa_inspect, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from app.models.models import Work, WorkMatchKey
+
+logger = logging.getLogger("app.utils.fuzzy")
+
+_OCR_DIGITS = str.maketrans({"O": "0", "Q": "0", "D": "0", "I": "1", "L": "1", "|": "1",
+                             "Z": "2", "S": "5", "G": "6", "B": "8"})
+MIN_WR_DIGITS = 6
+ADDRESS_STOPWORDS = {
+    "via", "viale", "piazza", "piazzale", "corso", "largo", "vicolo", "strada", "localita", "loc",
+    "frazione", "fraz", "scala", "interno", "int", "piano", "civico", "snc",
+}
+# Candidates scoring below this are not reported
+MIN_SCORE = 0.5
+MAX_CANDIDATES = 5
+# Postings per key, newest works first; very common words (a frequent surname, "roma") are capped
+# here by the database, so a lookup never loads more than MAX_BLOCK rows per key
+MAX_BLOCK = 200
+WEIGHTS = {"wr": 0.6, "name": 0.25, "address": 0.15}
+
+
+def wr_digits(numero_wr: Optional[str]) -> Optional[str]:
+    """Digits of a WR number with OCR look-alike letters folded, or None when it is not WR-like."""
+    if not numero_wr:
+        return None
+    s = re.sub(r"[^A-Z0-9|]", "", numero_wr.upper())
+    if s.startswith("WR"):
+        s = s[2:]
+    s = s.translate(_OCR_DIGITS)
+    if len(s) < MIN_WR_DIGITS or not s.isdigit():
+        return None
+    return s
+
+
+def normalize_text(value: Optional[str]) -> str:
+    if not value:
+        return ""
+    value = unicodedata.normalize("NFKD", value)
+    value = "".join(c for c in value if not unicodedata.combining(c)).casefold()
+    return " ".join(re.findall(r"[a-z0-9]+", value))
+
+
+def _tokens(value: Optional[str], stopwords: Set[str] = frozenset()) -> Set[str]:
+    return {t for t in normalize_text(value).split() if len(t) >= 3 and not t.isdigit() and t not in stopwords}
+
+
+def keys_for(numero_wr: Optional[str], nome_cliente: Optional[str], indirizzo: Optional[str]) -> Set[str]:
+    keys = set()
+    digits = wr_digits(numero_wr)
+    if digits:
+        keys.add("w:" + digits)
+        keys.update("w:" + digits[:i] + digits[i + 1:] for i in range(len(digits)))
+    keys.update("n:" + t for t in _tokens(nome_cliente))
+    keys.update("a:" + t for t in _tokens(indirizzo, ADDRESS_STOPWORDS))
+    return keys
+
+
+def _within_one_edit(a: str, b: str) -> bool:
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) == len(b):
+        return sum(x != y for x, y in zip(a, b)) <= 1
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    return a[i:] == b[i + 1:]
+
+
+def _trigrams(value: str) -> Set[str]:
+    padded = f"  {value} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def similarity(a: Optional[str], b: Optional[str]) -> Optional[float]:
+    """Trigram Jaccard similarity of two normalized strings, None when either side is empty."""
+    a, b = normalize_text(a), normalize_text(b)
+    if not a or not b:
+        return None
+    ta, tb = _trigrams(a), _trigrams(b)
+    return len(ta & tb) / len(ta | tb)
+
+
+def score(entry: Tuple[Optional[str], Optional[str], Optional[str]], work) -> Dict[str, Any]:
+    """Score an incoming (numero_wr, nome_cliente, indirizzo) against a work row."""
+    numero_wr, nome_cliente, indirizzo = entry
+    parts: Dict[str, float] = {}
+    incoming, existing = wr_digits(numero_wr), wr_digits(work.numero_wr)
+    if incoming and existing:
+        parts["wr"] = 1.0 if incoming == existing else 0.8 if _within_one_edit(incoming, existing) else 0.0
+    name = similarity(nome_cliente, work.nome_cliente)
+    if name is not None:
+        parts["name"] = name
+    address = similarity(indirizzo, work.indirizzo)
+    if address is not None:
+        parts["address"] = address
+    total = sum(WEIGHTS[k] for k in parts)
+    value = sum(WEIGHTS[k] * v for k, v in parts.items()) / total if total else 0.0
+    return {
+        "work_id": work.id,
+        "numero_wr": work.numero_wr,
+        "score": round(value, 3),
+        "signals": {k: round(v, 3) for k, v in parts.items()},
+    }
+
+
+def is_confident(candidate: Dict[str, Any]) -> bool:
+    """Same WR once OCR look-alikes are folded, and name/address (when known) do not contradict it."""
+    signals = candidate["signals"]
+    if signals.get("wr") != 1.0:
+        return False
+    others = [v for k, v in signals.items() if k != "wr"]
+    return not others or max(others) >= 0.4
+
+
+def find_matches_many(db: Session, entries: Sequence[Tuple[Optional[str], Optional[str], Optional[str]]],
+                      exclude_ids: Sequence[Optional[Iterable[int]]] = ()) -> List[List[Dict[str, Any]]]:
+    """Candidate works for several (numero_wr, nome_cliente, indirizzo) entries with one key lookup."""
+    entry_keys = [keys_for(*entry) for entry in entries]
+    all_keys = set().union(*entry_keys) if entry_keys else set()
+    if not all_keys:
+        return [[] for _ in entries]
+    ranked = (select(WorkMatchKey.key, WorkMatchKey.work_id,
+                     func.row_number().over(partition_by=WorkMatchKey.key, order_by=WorkMatchKey.work_id.desc()).label("rank"))
+              .where(WorkMatchKey.key.in_(sorted(all_keys)))
+              .subquery())
+    postings: Dict[str, List[int]] = {}
+    for key, work_id in db.execute(select(ranked.c.key, ranked.c.work_id).where(ranked.c.rank <= MAX_BLOCK)):
+        postings.setdefault(key, []).append(work_id)
+
+    blocks = []
+    for index, keys in enumerate(entry_keys):
+        excluded = set(exclude_ids[index] or ()) if index < len(exclude_ids) else set()
+        hits: Dict[int, int] = {}
+        for key in keys:
+            for work_id in postings.get(key, ()):
+                if work_id not in excluded:
+                    hits[work_id] = hits.get(work_id, 0) + 1
+        # Works sharing the most keys first
+        blocks.append(sorted(hits, key=lambda w: -hits[w])[:MAX_BLOCK])
+
+    ids = set().union(*blocks) if blocks else set()
+    works = {}
+    if ids:
+        works = {w.id: w for w in db.execute(select(Work.id, Work.numero_wr, Work.nome_cliente, Work.indirizzo).where(Work.id.in_(ids)))}
+    results = []
+    for entry, block in zip(entries, blocks):
+        scored = [score(entry, works[w]) for w in block if w in works]
+        scored = [c for c in scored if c["score"] >= MIN_SCORE]
+        scored.sort(key=lambda c: -c["score"])
+        results.append(scored[:MAX_CANDIDATES])
+    return results
+
+
+def find_matches(db: Session, numero_wr: Optional[str], nome_cliente: Optional[str], indirizzo: Optional[str],
+                 exclude_ids: Optional[Iterable[int]] = None) -> List[Dict[str, Any]]:
+    return find_matches_many(db, [(numero_wr, nome_cliente, indirizzo)], [exclude_ids])[0]
+
+
+def _write_keys(conn, rows: Iterable[Tuple[int, Optional[str], Optional[str], Optional[str]]]) -> None:
+    values = [{"work_id": work_id, "key": key} for work_id, wr, nome, addr in rows for key in keys_for(wr, nome, addr)]
+    if values:
+        conn.execute(insert(WorkMatchKey.__table__), values)
+
+
+def reindex(db: Session, ids: Iterable[int]) -> None:
+    """Recompute the keys of works written outside the ORM unit of work (bulk Core statements)."""
+    ids = sorted({i for i in ids if i is not None})
+    if not ids:
+        return
+    db.execute(delete(WorkMatchKey.__table__).where(WorkMatchKey.work_id.in_(ids)))
+    _write_keys(db.connection(), db.execute(select(Work.id, Work.numero_wr, Work.nome_cliente, Work.indirizzo).where(Work.id.in_(ids))))
+
+
+def _fill(conn, batch_size: int) -> None:
+    result = conn.execute(select(Work.id, Work.numero_wr, Work.nome_cliente, Work.indirizzo))
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        _write_keys(conn, rows)
+
+
+def ensure_keys(engine: Engine, batch_size: int = 5000) -> None:
+    """Backfill the keys of existing works when the table is empty (startup)."""
+    with engine.begin() as conn:
+        if conn.execute(select(WorkMatchKey.id).limit(1)).first() is not None:
+            return
+        if not conn.execute(select(func.count(Work.id))).scalar():
+            return
+        _fill(conn, batch_size)
+
+
+def rebuild(db: Session, batch_size: int = 5000) -> None:
+    """Recompute the keys of every work (``sync`` job)."""
+    conn = db.connection()
+    conn.execute(delete(WorkMatchKey.__table__))
+    _fill(conn, batch_size)
+
+
+_KEY_FIELDS = ("numero_wr", "nome_cliente", "indirizzo")
+
+
+@event.listens_for(Session, "before_flush")
+def _drop_deleted(session, flush_context, instances):
+    ids = sorted(obj.id for obj in session.deleted if isinstance(obj, Work) and obj.id is not None)
+    if ids:
+        session.connection().execute(delete(WorkMatchKey.__table__).where(WorkMatchKey.work_id.in_(ids)))
+
+
+@event.listens_for(Session, "after_flush")
+def _index_flushed(session, flush_context):
+    stale, fresh = set(), []
+    for objects, dirty in ((session.new, False), (session.dirty, True)):
+        for obj in objects:
+            if not isinstance(obj, Work) or obj.id is None:
+                continue
+            if dirty:
+                attrs = sa_inspect(obj).attrs
+                if not any(attrs[name].history.has_changes() for name in _KEY_FIELDS):
+                    continue
+                stale.add(obj.id)
+            fresh.append((obj.id, obj.numero_wr, obj.nome_cliente, obj.indirizzo))
+    if not stale and not fresh:
+        return
+    conn = session.connection()
+    if stale:
+        conn.execute(delete(WorkMatchKey.__table__).where(WorkMatchKey.work_id.in_(sorted(stale))))
+    _write_keys(conn, fresh)
@@ -0,0 +1,384 @@
+"""Offline address normalization, geocoding cache and work areas.
+
+``works.indirizzo`` is free text ("v.le della Repubblica 12 - 20121 milano
+MI", "Via Roma, 3, Torino (TO)"). ``normalize()`` splits it into canonical
+components without any network call:
+
+* ``street_type``: the leading odonym (Via, Viale, Piazza, Corso, Strada,
+  Largo, ...), abbreviations such as ``P.zza``, ``C.so``, ``V.le`` expanded;
+* ``street`` and ``civico`` (``12``, ``12/B``, ``SNC``);
+* ``cap``, ``comune`` and ``provincia`` (``(MI)`` or a trailing ``MI``);
+* ``area``: the cluster key, the CAP when known, else the normalized comune.
+
+When ``GEOCODE_GAZETTEER`` points to a local CSV (columns ``cap``,
+``comune``, ``provincia``, ``lat``, ``lon``: e.g. an ISTAT/GeoNames export)
+it fills in the missing CAP/comune/provincia and the coordinates of the area.
+
+Each distinct address text is parsed once: ``address_cache`` keeps the result
+under its normalized words, and ``work_locations`` maps every work to its
+area, CAP and comune with an index on each, so grouping works by area or
+listing the works of a CAP is one indexed query. Both are kept up to date
+like the fuzzy keys: an ``after_flush`` hook for ORM writes (``before_flush``
+for deleted works), ``reindex`` for bulk Core upserts, ``rebuild`` from the
+``reindex`` job.
+"""
+import csv
+import logging
+import os
+import re
+import threading
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import case, delete, event, func, insert, inspect as sa_inspect, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from app.models.models import AddressCache, Work, WorkLocation
+from app.utils.fuzzy import normalize_text
+
+logger = logging.getLogger("app.utils.geocode")
+
+GAZETTEER_PATH = os.getenv("GEOCODE_GAZETTEER") or ""
+# States counted as open in the area summaries
+OPEN_STATES = ("aperto", "in_corso", "sospeso")
+
+# Canonical odonym -> accepted spellings (lower case, dots optional)
+STREET_TYPES = {
+    "Viale": r"viale|v\.?\s?le|vle",
+    "Piazzale": r"piazzale|p\.?\s?le|ple",
+    "Piazza": r"piazza|p\.?\s?zza|p\.?\s?za|pza",
+    "Corso": r"corso|c\.?\s?so|cso",
+    "Largo": r"largo|l\.?\s?go|lgo",
+    "Vicolo": r"vicolo|vic|v\.?\s?lo",
+    "Strada": r"strada|str",
+    "Località": r"localit[aà]|loc",
+    "Frazione": r"frazione|fraz|fr",
+    "Contrada": r"contrada|c\.?\s?da",
+    "Lungomare": r"lungomare|l\.?\s?mare",
+    "Borgo": r"borgo|b\.?\s?go",
+    "Salita": r"salita",
+    "Traversa": r"traversa|trav",
+    "Via": r"via|v",  # last: "v" also starts the abbreviations above
+}
+_STREET_TYPE = [(name, re.compile(rf"^(?:{pattern})(?=[\s.,]|$)\.?\s*", re.IGNORECASE))
+                for name, pattern in STREET_TYPES.items()]
+_CAP = re.compile(r"(?<!\d)(\d{5})(?!\d)")
+_PROVINCE = re.compile(r"\(\s*([A-Za-z]{2})\s*\)")
+_TRAILING_PROVINCE = re.compile(r"\s+([A-Z]{2})$")
+_CIVICO = re.compile(r"(?:^|\s+)(?:n\.?|nr\.?|n°|civ\.?)?\s*(\d+\s*[a-zA-Z]?(?:\s*/\s*\d*[a-zA-Z]?)?|snc)$", re.IGNORECASE)
+_SMALL_WORDS = {"di", "da", "del", "della", "dello", "dei", "degli", "delle", "de", "d", "e", "in", "al", "alla",
+                "allo", "ai", "agli", "alle", "sul", "sulla", "sotto", "per", "con", "la", "le", "il", "lo", "gli"}
+_ROMAN = re.compile(r"^[ivxlcdm]{2,}$", re.IGNORECASE)
+
+
+def _title(value: str, inner: bool = False) -> str:
+    """Title case Italian style ("Via della Repubblica"); ``inner``: the value does not start the name."""
+    words = []
+    for i, word in enumerate(value.split()):
+        if (i or inner) and word.lower() in _SMALL_WORDS:
+            words.append(word.lower())
+        elif _ROMAN.match(word) and word.lower() not in _SMALL_WORDS:
+            words.append(word.upper())
+        else:
+            words.append(word.capitalize() if "'" not in word else word.title())
+    return " ".join(words)
+
+
+def cache_key(address: Optional[str]) -> Optional[str]:
+    key = normalize_text(address)
+    return key[:500] or None
+
+
+def parse(address: Optional[str]) -> Dict[str, Optional[str]]:
+    """Components of an Italian street address, as written (no gazetteer lookup)."""
+    parsed: Dict[str, Optional[str]] = dict.fromkeys(("street_type", "street", "civico", "cap", "comune", "provincia"))
+    text = " ".join((address or "").replace(" - ", ", ").split())
+    if not text:
+        return parsed
+    province = _PROVINCE.search(text)
+    if province:
+        parsed["provincia"] = province.group(1).upper()
+        text = (text[:province.start()] + text[province.end():]).strip()
+    segments = [s.strip(" .;-") for s in text.split(",")]
+    segments = [s for s in segments if s]
+    if not segments:
+        return parsed
+    street, rest = segments[0], segments[1:]
+    comune = None
+    for index, segment in enumerate(segments):
+        cap = _CAP.search(segment)
+        if not cap:
+            continue
+        parsed["cap"] = cap.group(1)
+        before, after = segment[:cap.start()].strip(" .-"), segment[cap.end():].strip(" .-")
+        if index == 0:
+            # "Via Roma 12 20121 Milano": street, CAP and comune in one run
+            street, comune = before, after or None
+        else:
+            rest.remove(segment)
+            comune = after or before or None
+        break
+    # a civico on its own ("Via Roma, 12, Milano")
+    for segment in list(rest):
+        if _CIVICO.fullmatch(" " + segment):
+            parsed["civico"] = segment.upper().replace(" ", "")
+            rest.remove(segment)
+            break
+    if comune is None and rest:
+        comune = rest[-1]
+    if comune and not parsed["provincia"]:
+        trailing = _TRAILING_PROVINCE.search(comune)
+        if trailing:
+            parsed["provincia"] = trailing.group(1)
+            comune = comune[:trailing.start()]
+    if comune:
+        comune = _title(" ".join(re.sub(r"\d+", " ", comune).split())) or None
+    parsed["comune"] = comune
+
+    for name, pattern in _STREET_TYPE:
+        match = pattern.match(street)
+        if match and street[match.end():].strip():
+            parsed["street_type"] = name
+            street = street[match.end():]
+            break
+    if not parsed["civico"]:
+        civico = _CIVICO.search(street)
+        if civico and civico.start() > 0:
+            parsed["civico"] = civico.group(1).upper().replace(" ", "")
+            street = street[:civico.start()]
+    parsed["street"] = _title(street.strip(" .-"), inner=bool(parsed["street_type"])) or None
+    return parsed
+
+
+_gazetteer_lock = threading.Lock()
+_gazetteer: Optional[Tuple[Dict[str, dict], Dict[str, List[dict]]]] = None
+
+
+def _load_gazetteer() -> Tuple[Dict[str, dict], Dict[str, List[dict]]]:
+    """(by CAP, by normalized comune) from GEOCODE_GAZETTEER, loaded once; empty without it."""
+    global _gazetteer
+    with _gazetteer_lock:
+        if _gazetteer is not None:
+            return _gazetteer
+        by_cap: Dict[str, dict] = {}
+        by_comune: Dict[str, List[dict]] = {}
+        if GAZETTEER_PATH:
+            try:
+                with open(GAZETTEER_PATH, newline="", encoding="utf-8-sig") as f:
+                    sample = f.readline()
+                    f.seek(0)
+                    delimiter = ";" if sample.count(";") > sample.count(",") else ","
+                    for row in csv.DictReader(f, delimiter=delimiter):
+                        row = {(k or "").strip().lower(): (v or "").strip() for k, v in row.items()}
+                        entry = {"cap": row.get("cap") or None, "comune": _title(row.get("comune") or "") or None,
+                                 "provincia": (row.get("provincia") or row.get("sigla") or "").upper() or None,
+                                 "lat": _float(row.get("lat") or row.get("latitude")),
+                                 "lon": _float(row.get("lon") or row.get("lng") or row.get("longitude"))}
+                        if entry["cap"]:
+                            by_cap.setdefault(entry["cap"], entry)
+                        if entry["comune"]:
+                            by_comune.setdefault(normalize_text(entry["comune"]), []).append(entry)
+                logger.info("Loaded gazetteer %s: %d CAP, %d comuni", GAZETTEER_PATH, len(by_cap), len(by_comune))
+            except OSError as e:
+                logger.warning("Cannot read gazetteer %s: %s", GAZETTEER_PATH, e)
+        _gazetteer = (by_cap, by_comune)
+        return _gazetteer
+
+
+def _float(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value.replace(",", ".")) if value else None
+    except ValueError:
+        return None
+
+
+def normalize(address: Optional[str]) -> Dict[str, Any]:
+    """Parsed components completed from the gazetteer, with ``canonical``, ``area`` and coordinates."""
+    result: Dict[str, Any] = {**parse(address), "lat": None, "lon": None}
+    by_cap, by_comune = _load_gazetteer()
+    known = by_cap.get(result["cap"]) if result["cap"] else None
+    if known is None and result["comune"]:
+        candidates = by_comune.get(normalize_text(result["comune"])) or []
+        if result["provincia"]:
+            candidates = [c for c in candidates if c["provincia"] in (None, result["provincia"])] or candidates
+        if len({c["cap"] for c in candidates}) == 1:
+            known = candidates[0]
+            result["cap"] = result["cap"] or known["cap"]
+        elif candidates:
+            # a comune with several CAPs: take its name and coordinates, not a CAP
+            known = {**candidates[0], "cap": None}
+    if known:
+        for field in ("comune", "provincia"):
+            result[field] = result[field] or known[field]
+        result["lat"], result["lon"] = known["lat"], known["lon"]
+    street = " ".join(p for p in (result["street_type"], result["street"], result["civico"]) if p)
+    town = " ".join(p for p in (result["cap"], result["comune"]) if p)
+    if result["provincia"]:
+        town = f"{town} ({result['provincia']})".strip()
+    result["canonical"] = ", ".join(p for p in (street, town) if p) or None
+    result["area"] = result["cap"] or normalize_text(result["comune"]) or None
+    return result
+
+
+def area(address: Optional[str]) -> Optional[str]:
+    """Cluster key of an address: its CAP, else the normalized comune."""
+    return normalize(address)["area"] if address else None
+
+
+def _insert_ignore(conn):
+    table = AddressCache.__table__
+    if conn.dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    elif conn.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        return insert(table)
+    return dialect_insert(table).on_conflict_do_nothing(index_elements=[table.c.key])
+
+
+def resolve(conn, addresses: Iterable[Optional[str]]) -> Dict[str, Any]:
+    """Cache rows by cache key for ``addresses``; the ones never seen are parsed and stored (one insert)."""
+    raw_by_key: Dict[str, str] = {}
+    for address in addresses:
+        key = cache_key(address)
+        if key:
+            raw_by_key.setdefault(key, address)
+    if not raw_by_key:
+        return {}
+    t = AddressCache.__table__
+    found = {row.key: row for row in conn.execute(select(t).where(t.c.key.in_(sorted(raw_by_key))))}
+    missing = [key for key in raw_by_key if key not in found]
+    if missing:
+        now = datetime.utcnow()
+        fields = ("canonical", "street_type", "street", "civico", "cap", "comune", "provincia", "area", "lat", "lon")
+        rows = []
+        for key in missing:
+            parsed = normalize(raw_by_key[key])
+            rows.append({"key": key, "created_at": now, **{f: parsed[f] for f in fields}})
+        conn.execute(_insert_ignore(conn), rows)
+        found.update({row.key: row for row in conn.execute(select(t).where(t.c.key.in_(missing)))})
+    return found
+
+
+def _write_locations(conn, rows: Iterable[Tuple[int, Optional[str]]]) -> None:
+    rows = [(work_id, address) for work_id, address in rows if cache_key(address)]
+    if not rows:
+        return
+    cached = resolve(conn, (address for _, address in rows))
+    values = []
+    for work_id, address in rows:
+        entry = cached.get(cache_key(address))
+        if entry is not None:
+            values.append({"work_id": work_id, "address_id": entry.id, "area": entry.area,
+                           "cap": entry.cap, "comune": entry.comune})
+    if values:
+        conn.execute(insert(WorkLocation.__table__), values)
+
+
+def reindex(db: Session, ids: Iterable[int]) -> None:
+    """Recompute the area of works written outside the ORM unit of work (bulk Core statements)."""
+    ids = sorted({i for i in ids if i is not None})
+    if not ids:
+        return
+    conn = db.connection()
+    conn.execute(delete(WorkLocation.__table__).where(WorkLocation.work_id.in_(ids)))
+    _write_locations(conn, conn.execute(select(Work.id, Work.indirizzo).where(Work.id.in_(ids))).all())
+
+
+def _fill(conn, batch_size: int) -> int:
+    result = conn.execute(select(Work.id, Work.indirizzo).where(Work.indirizzo.isnot(None)))
+    total = 0
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        _write_locations(conn, rows)
+        total += len(rows)
+    return total
+
+
+def ensure_index(engine: Engine, batch_size: int = 5000) -> None:
+    """Backfill the areas of existing works when the index is empty (startup)."""
+    with engine.begin() as conn:
+        if conn.execute(select(WorkLocation.work_id).limit(1)).first() is not None:
+            return
+        if not conn.execute(select(func.count(Work.id)).where(Work.indirizzo.isnot(None))).scalar():
+            return
+        logger.info("Indexed the areas of %d works", _fill(conn, batch_size))
+
+
+def rebuild(db: Session, batch_size: int = 5000) -> int:
+    """Parse every address again (after a parser or gazetteer change) and recompute all areas (``reindex`` job)."""
+    conn = db.connection()
+    conn.execute(delete(WorkLocation.__table__))
+    conn.execute(delete(AddressCache.__table__))
+    return _fill(conn, batch_size)
+
+
+def clusters(db: Session, by: str = "area", open_only: bool = True, comune: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Works per area (or per CAP / comune), largest first, with the open ones and the area's coordinates."""
+    column = {"area": WorkLocation.area, "cap": WorkLocation.cap, "comune": WorkLocation.comune}[by]
+    is_open = func.coalesce(Work.stato, "aperto").in_(OPEN_STATES)
+    query = (select(column.label("key"), func.count().label("works"),
+                    func.sum(case((is_open, 1), else_=0)).label("open"),
+                    func.min(AddressCache.comune).label("comune"), func.min(AddressCache.provincia).label("provincia"),
+                    func.avg(AddressCache.lat).label("lat"), func.avg(AddressCache.lon).label("lon"))
+             .join(Work, Work.id == WorkLocation.work_id)
+             .join(AddressCache, AddressCache.id == WorkLocation.address_id)
+             .where(column.isnot(None))
+             .group_by(column))
+    if open_only:
+        query = query.where(is_open)
+    if comune:
+        query = query.where(WorkLocation.comune == _title(comune))
+    rows = db.execute(query.order_by(func.count().desc(), column)).all()
+    return [{by: row.key, "comune": row.comune, "provincia": row.provincia, "works": row.works, "open": row.open or 0,
+             "lat": row.lat, "lon": row.lon} for row in rows]
+
+
+def works_in(db: Session, area_key: Optional[str] = None, cap: Optional[str] = None, comune: Optional[str] = None,
+             open_only: bool = True, limit: int = 500) -> List[Dict[str, Any]]:
+    """Works of one area, CAP or comune (indexed lookup), oldest appointment first."""
+    query = (select(Work.id, Work.numero_wr, Work.indirizzo, Work.stato, Work.tipo_lavoro, Work.data_apertura,
+                    Work.tecnico_assegnato_id, AddressCache.canonical, WorkLocation.area)
+             .join(WorkLocation, WorkLocation.work_id == Work.id)
+             .join(AddressCache, AddressCache.id == WorkLocation.address_id))
+    if area_key:
+        query = query.where(WorkLocation.area == area_key)
+    if cap:
+        query = query.where(WorkLocation.cap == cap)
+    if comune:
+        query = query.where(WorkLocation.comune == _title(comune))
+    if open_only:
+        query = query.where(func.coalesce(Work.stato, "aperto").in_(OPEN_STATES))
+    rows = db.execute(query.order_by(Work.data_apertura.is_(None), Work.data_apertura, Work.id).limit(limit))
+    return [dict(row._mapping) for row in rows]
+
+
+@event.listens_for(Session, "before_flush")
+def _drop_deleted(session, flush_context, instances):
+    # ahead of the works' DELETE, which the locations' foreign key would reject
+    ids = sorted(obj.id for obj in session.deleted if isinstance(obj, Work) and obj.id is not None)
+    if ids:
+        session.connection().execute(delete(WorkLocation.__table__).where(WorkLocation.work_id.in_(ids)))
+
+
+@event.listens_for(Session, "after_flush")
+def _index_flushed(session, flush_context):
+    stale, fresh = set(), []
+    for objects, dirty in ((session.new, False), (session.dirty, True)):
+        for obj in objects:
+            if not isinstance(obj, Work) or obj.id is None:
+                continue
+            if dirty:
+                if not sa_inspect(obj).attrs.indirizzo.history.has_changes():
+                    continue
+                stale.add(obj.id)
+            fresh.append((obj.id, obj.indirizzo))
+    if not stale and not fresh:
+        return
+    conn = session.connection()
+    if stale:
+        conn.execute(delete(WorkLocation.__table__).where(WorkLocation.work_id.in_(sorted(stale))))
+    _write_locations(conn, fresh)
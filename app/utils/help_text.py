@@ -1,7 +1,7 @@
 HELP_TEXT = (
     "/start - Benvenuto e informazioni iniziali\n"
     "/help - Mostra questo messaggio di aiuto\n"
-    "/miei_lavori - Visualizza i lavori assegnati a te\n"
+    "/miei_lavori [tutti] - Visualizza i lavori aperti assegnati a te (a pagine)\n"
     "/accetta <WR> - Accetta un lavoro\n"
     "/rifiuta <WR> - Rifiuta un lavoro\n"
     "/chiudi <WR> - Chiudi un lavoro\n"
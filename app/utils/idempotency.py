@@ -0,0 +1,122 @@
+"""Idempotency-Key store for the ingest endpoints.
+
+External senders retry ``/works/ingest/*`` and the Yggdrasil ``/ingest/*``
+pushes on timeouts. When a request carries an ``Idempotency-Key`` header the
+first execution claims the key, and its response is stored together with a
+hash of the payload. Replays of the same key and payload within the TTL get
+the stored response back without touching the works table; reusing a key
+with a different payload is rejected with 409.
+"""
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+from typing import Any, Optional
+
+from fastapi import HTTPException
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.models.models import IngestIdempotencyKey
+
+IDEMPOTENCY_TTL = timedelta(hours=int(os.getenv("INGEST_IDEMPOTENCY_TTL_HOURS") or 24))
+# A pending claim older than this is considered abandoned (e.g. the worker crashed) and can be taken over
+STALE_PENDING_AFTER = timedelta(minutes=10)
+MAX_KEY_LENGTH = 255
+
+
+def payload_hash(payload: Any) -> str:
+    """Stable sha256 of a JSON-compatible payload (key order and whitespace do not matter)."""
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _get(db: Session, scope: str, key: str) -> Optional[IngestIdempotencyKey]:
+    return db.query(IngestIdempotencyKey).filter(
+        IngestIdempotencyKey.scope == scope,
+        IngestIdempotencyKey.idempotency_key == key,
+    ).first()
+
+
+def _validate_key(key: str) -> None:
+    if len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key longer than {MAX_KEY_LENGTH} characters")
+
+
+def completed_record(db: Session, scope: str, key: str) -> Optional[IngestIdempotencyKey]:
+    """Return the live completed record for ``key`` if there is one."""
+    _validate_key(key)
+    record = _get(db, scope, key)
+    if record and record.status == "completed" and record.expires_at > datetime.utcnow():
+        return record
+    return None
+
+
+def replay(record: IngestIdempotencyKey, digest: str) -> Any:
+    """Return the stored response for a replayed request, or 409 if the key was used for another payload."""
+    if record.payload_hash != digest:
+        raise HTTPException(status_code=409, detail="Idempotency-Key already used with a different payload")
+    return record.response
+
+
+def claim(db: Session, scope: str, key: str, digest: Optional[str] = None) -> Optional[Any]:
+    """Claim ``key`` for a new execution.
+
+    Returns the stored response when the request is a replay, otherwise None
+    once the key is claimed. ``digest`` may be None when the payload hash is
+    only known after processing (streamed bodies); callers must then check
+    ``completed_record`` themselves before claiming.
+    """
+    _validate_key(key)
+    now = datetime.utcnow()
+    db.query(IngestIdempotencyKey).filter(IngestIdempotencyKey.expires_at < now).delete(synchronize_session=False)
+    db.commit()
+    record = _get(db, scope, key)
+    if record is not None:
+        if record.status == "completed":
+            if digest is None:
+                raise HTTPException(status_code=409, detail="Idempotency-Key already used")
+            return replay(record, digest)
+        if record.created_at and now - record.created_at < STALE_PENDING_AFTER:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+        db.delete(record)
+        db.commit()
+    db.add(IngestIdempotencyKey(scope=scope, idempotency_key=key, payload_hash=digest, status="pending",
+                                created_at=now, expires_at=now + IDEMPOTENCY_TTL))
+    try:
+        db.commit()
+    except IntegrityError:
+        # Another worker claimed the same key between our lookup and insert
+        db.rollback()
+        raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+    return None
+
+
+def complete(db: Session, scope: str, key: str, digest: str, response: Any) -> None:
+    record = _get(db, scope, key)
+    if record is None:
+        return
+    now = datetime.utcnow()
+    record.payload_hash = digest
+    record.status = "completed"
+    record.response = response
+    record.expires_at = now + IDEMPOTENCY_TTL
+    db.commit()
+
+
+def release(db: Session, scope: str, key: str) -> None:
+    """Drop a pending claim after a failed execution so the sender can retry."""
+    db.rollback()
+    db.query(IngestIdempotencyKey).filter(
+        IngestIdempotencyKey.scope == scope,
+        IngestIdempotencyKey.idempotency_key == key,
+        IngestIdempotencyKey.status == "pending",
+    ).delete(synchronize_session=False)
+    db.commit()
+
+
+def purge_expired(db: Session) -> int:
+    """Delete keys past their TTL (run by the ``cleanup`` job)."""
+    deleted = db.query(IngestIdempotencyKey).filter(IngestIdempotencyKey.expires_at < datetime.utcnow()).delete(synchronize_session=False)
+    db.commit()
+    return deleted
@@ -0,0 +1,389 @@
+"""Bulk work ingest engine shared by ``/works/ingest/*`` and the Yggdrasil ``/ingest`` API.
+
+Records are processed in chunks: for every chunk the existing works are
+prefetched with a single ``numero_wr IN (...)`` query, technicians are
+resolved through a name map loaded once per batch and the rows are written
+with one dialect-specific ``INSERT ... ON CONFLICT (numero_wr) DO UPDATE``
+statement, committing once per chunk.
+
+Each API converts its own payload into a plain record dict::
+
+    {
+        "numero_wr": "WR-123",           # normalized by the engine
+        "values": {"stato": "chiuso"},   # Work columns; None means "leave unchanged"
+        "defaults": {"stato": "aperto"}, # only used when the work is created
+        "extra": {"telefono": "..."},    # extra_fields to apply
+        "defaults_extra": {},            # extra_fields only used on creation
+        "tecnico": "Mario Rossi",        # optional technician full name
+    }
+"""
+import hashlib
+import json
+import logging
+from datetime import datetime
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import func, insert, select
+from sqlalchemy.orm import Session
+
+from app.models.models import Technician, Work, WorkJournalEntry
+from app.utils import changes, fuzzy, geocode, idempotency, journal, search, work_pages
+from app.utils.ocr import normalize_numero_wr
+
+logger = logging.getLogger("app.utils.ingest")
+
+DEFAULT_CHUNK_SIZE = 500
+# Work columns an ingest record is allowed to write
+UPSERT_COLUMNS = (
+    "operatore", "indirizzo", "nome_cliente", "tipo_lavoro", "stato",
+    "data_apertura", "data_chiusura", "tecnico_assegnato_id", "note",
+)
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonlines", "application/x-jsonlines")
+
+
+def parse_iso_datetime(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def technician_key(name: Optional[str]) -> Optional[str]:
+    """Normalize a technician full name for lookups ("  Mario  ROSSI " -> "mario rossi")."""
+    if not name:
+        return None
+    key = " ".join(str(name).split()).casefold()
+    return key or None
+
+
+def merge_extra_fields(stored: Optional[Dict[str, Any]], incoming: Dict[str, Any]) -> Dict[str, Any]:
+    """Field-level merge of extra_fields following JSON merge-patch (RFC 7396) rules.
+
+    Keys in ``incoming`` override stored ones, nested dicts are merged
+    recursively and a ``None`` value removes the key.
+    """
+    merged = dict(stored or {})
+    for key, value in incoming.items():
+        if value is None:
+            merged.pop(key, None)
+        elif isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_extra_fields(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def is_ndjson(content_type: Optional[str]) -> bool:
+    return bool(content_type) and content_type.split(";")[0].strip().lower() in NDJSON_CONTENT_TYPES
+
+
+async def iter_ndjson(stream: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, Any, Optional[str]]]:
+    """Yield ``(line_index, parsed_object, error)`` for every non-empty line of an NDJSON body stream."""
+    buffer = b""
+    index = 0
+    async for chunk in stream:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if not line.strip():
+                continue
+            yield _decode_line(index, line)
+            index += 1
+    if buffer.strip():
+        yield _decode_line(index, buffer)
+
+
+def _decode_line(index: int, line: bytes) -> Tuple[int, Any, Optional[str]]:
+    try:
+        return index, json.loads(line), None
+    except Exception as e:
+        return index, None, f"invalid JSON: {e}"
+
+
+class WorkIngestor:
+    """Accumulates ingest records and writes them chunk by chunk.
+
+    ``extra_mode`` is ``"merge"`` to merge incoming extra_fields into the
+    stored ones field by field (see ``merge_extra_fields``) or ``"replace"``
+    to overwrite them when the record carries any.
+    """
+
+    def __init__(self, db: Session, *, extra_mode: str = "merge", chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 event_note: str = "ingest"):
+        self.db = db
+        self.extra_mode = extra_mode
+        self.chunk_size = max(1, chunk_size)
+        self.event_note = event_note
+        self.results: List[Dict[str, Any]] = []
+        self.errors: List[Dict[str, Any]] = []
+        self.received = 0
+        self._pending: List[Tuple[int, Dict[str, Any]]] = []
+        self._tech_map: Optional[Dict[str, int]] = None
+
+    # ---- public API ----
+
+    def add(self, index: int, record: Dict[str, Any]) -> None:
+        self.received += 1
+        if not normalize_numero_wr(record.get("numero_wr")):
+            self.errors.append({"index": index, "numero_wr": record.get("numero_wr"), "error": "numero_wr is required"})
+            return
+        self._pending.append((index, record))
+        if len(self._pending) >= self.chunk_size:
+            self.flush()
+
+    def add_error(self, index: int, numero_wr: Optional[str], error: str) -> None:
+        self.received += 1
+        self.errors.append({"index": index, "numero_wr": numero_wr, "error": error})
+
+    def feed(self, items: Iterable[Tuple[int, Dict[str, Any]]]) -> None:
+        for index, record in items:
+            self.add(index, record)
+
+    def flush(self) -> None:
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        try:
+            self._write_chunk(pending)
+        except Exception as e:
+            # Isolate the offending record(s): retry one by one in their own transaction
+            self.db.rollback()
+            logger.warning("Ingest chunk of %d failed (%s); retrying records individually", len(pending), e)
+            for item in pending:
+                try:
+                    self._write_chunk([item])
+                except Exception as row_error:
+                    self.db.rollback()
+                    self.errors.append({"index": item[0], "numero_wr": item[1].get("numero_wr"), "error": str(row_error)})
+
+    def finish(self) -> Dict[str, Any]:
+        self.flush()
+        self.results.sort(key=lambda r: r["index"])
+        self.errors.sort(key=lambda r: r["index"])
+        return {
+            "received": self.received,
+            "results": self.results,
+            "errors": self.errors,
+            "success_count": len(self.results),
+            "error_count": len(self.errors),
+        }
+
+    # ---- internals ----
+
+    def _technician_map(self) -> Dict[str, int]:
+        if self._tech_map is None:
+            rows = self.db.execute(select(Technician.id, Technician.nome, Technician.cognome)).all()
+            tech_map: Dict[str, int] = {}
+            for tech_id, nome, cognome in rows:
+                key = technician_key(f"{nome or ''} {cognome or ''}")
+                if key:
+                    # keep the first technician for ambiguous names, like the old .first() lookup
+                    tech_map.setdefault(key, tech_id)
+            self._tech_map = tech_map
+        return self._tech_map
+
+    def _prepare(self, pending: List[Tuple[int, Dict[str, Any]]]) -> Dict[str, Tuple[List[int], Dict[str, Any]]]:
+        """Normalize WR numbers and fold duplicates inside the chunk (later values win)."""
+        prepared: Dict[str, Tuple[List[int], Dict[str, Any]]] = {}
+        for index, record in pending:
+            numero_wr = normalize_numero_wr(record.get("numero_wr"))
+            if numero_wr in prepared:
+                indexes, merged = prepared[numero_wr]
+                indexes.append(index)
+                merged["values"] = {**merged.get("values", {}), **{k: v for k, v in (record.get("values") or {}).items() if v is not None}}
+                merged["extra"] = {**(merged.get("extra") or {}), **(record.get("extra") or {})}  # later record wins per key
+                merged["tecnico"] = record.get("tecnico") or merged.get("tecnico")
+            else:
+                prepared[numero_wr] = ([index], dict(record))
+        return prepared
+
+    def _upsert_statement(self):
+        dialect = self.db.get_bind().dialect.name
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        elif dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            return None
+        stmt = dialect_insert(Work.__table__)
+        excluded = stmt.excluded
+        table = Work.__table__.c
+        set_ = {col: func.coalesce(getattr(excluded, col), getattr(table, col)) for col in UPSERT_COLUMNS}
+        set_["extra_fields"] = excluded.extra_fields
+        set_["version"] = table.version + 1  # Core write: bump the optimistic-concurrency version by hand
+        return stmt.on_conflict_do_update(index_elements=[table.numero_wr], set_=set_)
+
+    def _write_chunk(self, pending: List[Tuple[int, Dict[str, Any]]]) -> None:
+        prepared = self._prepare(pending)
+        if not prepared:
+            return
+        existing = {
+            row.numero_wr: row
+            for row in self.db.execute(
+                select(Work.id, Work.numero_wr, Work.extra_fields, Work.tecnico_assegnato_id)
+                .where(Work.numero_wr.in_(list(prepared)))
+            )
+        }
+        tech_map = self._technician_map()
+        rows = []
+        touched_techs = set()
+        for numero_wr, (indexes, record) in prepared.items():
+            current = existing.get(numero_wr)
+            row = {col: None for col in UPSERT_COLUMNS}
+            if current is None:
+                row.update(record.get("defaults") or {})
+            row.update({k: v for k, v in (record.get("values") or {}).items() if k in UPSERT_COLUMNS and v is not None})
+            tech_id = tech_map.get(technician_key(record.get("tecnico"))) if record.get("tecnico") else None
+            if tech_id:
+                row["tecnico_assegnato_id"] = tech_id
+                touched_techs.add(tech_id)
+            if current is not None:
+                touched_techs.add(current.tecnico_assegnato_id)
+            row["extra_fields"] = self._extra_fields(current, record)
+            row["numero_wr"] = numero_wr
+            rows.append(row)
+
+        stmt = self._upsert_statement()
+        if stmt is not None:
+            self.db.execute(stmt, rows)
+        else:
+            self._write_generic(rows, existing)
+
+        created = [n for n in prepared if n not in existing]
+        ids = {n: existing[n].id for n in prepared if n in existing}
+        if created:
+            ids.update({n: i for i, n in self.db.execute(select(Work.id, Work.numero_wr).where(Work.numero_wr.in_(created)))})
+            now = datetime.utcnow()
+            self.db.execute(insert(WorkJournalEntry), [
+                {"work_id": ids[n], "kind": int(journal.EventKind.CREATED), "note": self.event_note, "ts": now}
+                for n in created if n in ids
+            ])
+        changes.record(self.db, "work", ids.values())
+        search.reindex(self.db, "work", ids.values())
+        fuzzy.reindex(self.db, ids.values())
+        geocode.reindex(self.db, ids.values())
+        # Created works that look like an existing one (OCR-misread WR, same customer/address)
+        created_wrs = [n for n in created if n in ids]
+        lookups = []
+        for n in created_wrs:
+            values = prepared[n][1].get("values") or {}
+            lookups.append((n, values.get("nome_cliente"), values.get("indirizzo")))
+        duplicates = dict(zip(created_wrs, fuzzy.find_matches_many(self.db, lookups, [[ids[n]] for n in created_wrs])))
+        self.db.commit()
+        for tech_id in touched_techs:
+            work_pages.invalidate_technician(tech_id)
+        for numero_wr, (indexes, _record) in prepared.items():
+            status = "updated" if numero_wr in existing else "created"
+            for position, index in enumerate(indexes):
+                self.results.append({
+                    "index": index,
+                    "numero_wr": numero_wr,
+                    "status": status if position == 0 else "updated",
+                    "work_id": ids.get(numero_wr),
+                })
+                if position == 0 and duplicates.get(numero_wr):
+                    self.results[-1]["possible_duplicates"] = duplicates[numero_wr]
+
+    def _extra_fields(self, current, record: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        incoming = record.get("extra") or {}
+        if current is None:
+            merged = merge_extra_fields(record.get("defaults_extra"), incoming)
+            return merged or None
+        stored = current.extra_fields if isinstance(current.extra_fields, dict) else None
+        if not incoming:
+            return stored
+        if self.extra_mode == "replace":
+            return dict(incoming)
+        return merge_extra_fields(stored, incoming)
+
+    def _write_generic(self, rows: List[Dict[str, Any]], existing: Dict[str, Any]) -> None:
+        """Fallback for dialects without ON CONFLICT support: bulk insert new rows, bulk update the others."""
+        new_rows = [r for r in rows if r["numero_wr"] not in existing]
+        if new_rows:
+            self.db.execute(insert(Work.__table__), new_rows)
+        updates = []
+        for r in rows:
+            current = existing.get(r["numero_wr"])
+            if current is None:
+                continue
+            values = {k: v for k, v in r.items() if v is not None and k != "numero_wr"}
+            values["id"] = current.id
+            updates.append(values)
+        for values in updates:
+            values["version"] = Work.version + 1
+            self.db.query(Work).filter(Work.id == values.pop("id")).update(values, synchronize_session=False)
+
+
+async def _hashing(stream: AsyncIterator[bytes], hasher) -> AsyncIterator[bytes]:
+    async for chunk in stream:
+        hasher.update(chunk)
+        yield chunk
+
+
+async def run_bulk_ingest(
+    request: Request,
+    db: Session,
+    ingestor: WorkIngestor,
+    *,
+    scope: str,
+    parse_json: Callable[[Any], List[Tuple[int, Any]]],
+    feed_batch: Callable[[WorkIngestor, List[Tuple[int, Any]]], None],
+    build_response: Callable[[Dict[str, Any]], Any],
+) -> Any:
+    """Run a bulk ingest request body (JSON or NDJSON) through ``ingestor``.
+
+    ``parse_json`` turns a JSON body into ``(index, item)`` pairs,
+    ``feed_batch`` validates and adds items to the ingestor and
+    ``build_response`` shapes the final summary. When the request carries an
+    ``Idempotency-Key`` header the response is stored under ``scope`` and
+    replayed for retries of the same payload.
+    """
+    key = request.headers.get("idempotency-key")
+    if is_ndjson(request.headers.get("content-type")):
+        if key:
+            record = idempotency.completed_record(db, scope, key)
+            if record is not None:
+                return idempotency.replay(record, hashlib.sha256(await request.body()).hexdigest())
+            idempotency.claim(db, scope, key)
+        hasher = hashlib.sha256()
+        try:
+            batch = []
+            async for index, item, error in iter_ndjson(_hashing(request.stream(), hasher)):
+                if error:
+                    ingestor.add_error(index, None, error)
+                    continue
+                batch.append((index, item))
+                if len(batch) >= ingestor.chunk_size:
+                    await run_in_threadpool(feed_batch, ingestor, batch)
+                    batch = []
+            if batch:
+                await run_in_threadpool(feed_batch, ingestor, batch)
+            summary = await run_in_threadpool(ingestor.finish)
+        except Exception:
+            if key:
+                idempotency.release(db, scope, key)
+            raise
+        digest = hasher.hexdigest()
+    else:
+        try:
+            body = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid JSON body")
+        items = parse_json(body)
+        digest = idempotency.payload_hash(body)
+        if key:
+            cached = idempotency.claim(db, scope, key, digest)
+            if cached is not None:
+                return cached
+        try:
+            await run_in_threadpool(feed_batch, ingestor, items)
+            summary = await run_in_threadpool(ingestor.finish)
+        except Exception:
+            if key:
+                idempotency.release(db, scope, key)
+            raise
+    response = build_response(summary)
+    if key:
+        idempotency.complete(db, scope, key, digest, response)
+    return response
@@ -0,0 +1,357 @@
+"""Inventory engine for ONT and modem stock.
+
+``inventory_stock`` counts the devices per kind, location, model and status.
+ORM writes to ``onts``/``modems`` adjust it from an ``after_flush`` hook;
+the operations below write with single Core statements and adjust it
+themselves, so a stock read is one indexed lookup instead of a scan.
+
+- ``reserve()`` takes the first available device of a model/location for a
+  work in one conditional UPDATE (status ``reserved`` until a TTL).
+- ``release()`` puts a reserved device back in stock; ``expire()`` does it
+  for every reservation past its TTL (``expire_reservations`` job, every
+  15 minutes by default). Until then ``stock()`` already counts such
+  devices as available.
+- ``consume()`` assigns a device to its work (status ``assigned``), from a
+  reservation for that work or straight from stock.
+- ``auto_assign()`` reserves devices for all the works of a day with one
+  set-based pairing (works by appointment, devices by id).
+
+Every operation guards on the current status in its WHERE clause, so two
+requests never get the same device; none of them commits: the caller does,
+once, for the whole operation.
+"""
+import logging
+import os
+from collections import Counter
+from datetime import date, datetime, time, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, bindparam, delete, event, func, inspect, insert, or_, select, text, update
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.exc import StaleDataError
+
+from app.models.models import InventoryStock, Modem, ONT, Work
+from app.utils import changes, journal
+
+logger = logging.getLogger("app.utils.inventory")
+
+KINDS = {"ont": ONT, "modem": Modem}
+RESERVATION_TTL = timedelta(hours=float(os.getenv("INVENTORY_RESERVATION_TTL_HOURS") or 24))
+RESERVE_ATTEMPTS = 3
+# Statuses of a device that belongs to a work
+HELD = ("reserved", "assigned", "configured", "installed")
+
+StockKey = Tuple[str, str, str, str]  # kind, location, model, status
+
+
+def _table(kind: str):
+    try:
+        return KINDS[kind].__table__
+    except KeyError:
+        raise ValueError(f"Unknown device kind: {kind}")
+
+
+def _key(kind: str, location: Optional[str], model: Optional[str], status: Optional[str]) -> StockKey:
+    return kind, location or "", model or "", status or ""
+
+
+def _bump(conn: Connection, deltas: Counter) -> None:
+    """Add ``deltas`` to the stock counters (one upsert per key)."""
+    rows = [{"kind": k, "location": loc, "model": m, "status": st, "quantity": n}
+            for (k, loc, m, st), n in deltas.items() if n]
+    if not rows:
+        return
+    table = InventoryStock.__table__
+    dialect = conn.dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        stmt = dialect_insert(table)
+        conn.execute(stmt.on_conflict_do_update(index_elements=[table.c.kind, table.c.location, table.c.model, table.c.status],
+                                                set_={"quantity": table.c.quantity + stmt.excluded.quantity}), rows)
+        return
+    for row in rows:
+        match = and_(table.c.kind == row["kind"], table.c.location == row["location"],
+                     table.c.model == row["model"], table.c.status == row["status"])
+        if conn.execute(update(table).where(match).values(quantity=table.c.quantity + row["quantity"])).rowcount == 0:
+            conn.execute(insert(table), row)
+
+
+def count_inserted(db: Session, kind: str, rows: List[Dict[str, Any]]) -> None:
+    """Add devices written with Core INSERTs (bulk registration) to the stock counters."""
+    _bump(db.connection(), Counter(_key(kind, row.get("location"), row.get("model"), row.get("status")) for row in rows))
+
+
+def rebuild(conn: Connection) -> int:
+    """Recount ``inventory_stock`` from the device tables (``reindex`` job); returns the devices counted."""
+    conn.execute(delete(InventoryStock.__table__))
+    counts: Counter = Counter()
+    for kind in KINDS:
+        t = _table(kind)
+        for location, model, status, n in conn.execute(select(t.c.location, t.c.model, t.c.status, func.count())
+                                                       .group_by(t.c.location, t.c.model, t.c.status)):
+            counts[_key(kind, location, model, status)] += n
+    _bump(conn, counts)
+    return sum(counts.values())
+
+
+def ensure_schema(engine: Engine) -> None:
+    """Reservation column and stock index on existing device tables, counters on first run (startup)."""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for model in KINDS.values():
+            table = model.__table__
+            if not inspector.has_table(table.name):
+                continue
+            if "reserved_until" not in {c["name"] for c in inspector.get_columns(table.name)}:
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN reserved_until DATETIME"))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+        if conn.execute(select(InventoryStock.id).limit(1)).first() is None:
+            if rebuild(conn):
+                logger.info("Built inventory stock counters")
+
+
+def stock(db: Session, kind: Optional[str] = None, location: Optional[str] = None,
+          model: Optional[str] = None, now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+    """Devices per kind, location and model, with a count per status (lapsed reservations as available)."""
+    query = db.query(InventoryStock).filter(InventoryStock.quantity != 0)
+    if kind:
+        query = query.filter(InventoryStock.kind == kind)
+    if location is not None:
+        query = query.filter(InventoryStock.location == location)
+    if model is not None:
+        query = query.filter(InventoryStock.model == model)
+    grouped: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+    for row in query.order_by(InventoryStock.kind, InventoryStock.location, InventoryStock.model):
+        entry = grouped.setdefault((row.kind, row.location, row.model), {
+            "kind": row.kind, "location": row.location or None, "model": row.model or None, "available": 0, "reserved": 0})
+        entry[row.status or "unknown"] = row.quantity
+    for key, lapsed in _lapsed(db, kind, location, model, now or datetime.utcnow()).items():
+        entry = grouped.get(key)
+        if entry is not None:
+            entry["reserved"] -= lapsed
+            entry["available"] += lapsed
+    return list(grouped.values())
+
+
+def _lapsed(db: Session, kind: Optional[str], location: Optional[str], model: Optional[str],
+            now: datetime) -> Counter:
+    """Reservations past their TTL that ``expire()`` has not released yet, per (kind, location, model)."""
+    lapsed: Counter = Counter()
+    for name in ([kind] if kind else KINDS):
+        t = _table(name)
+        loc, mod = func.coalesce(t.c.location, ""), func.coalesce(t.c.model, "")
+        criteria = [t.c.status == "reserved", t.c.reserved_until < now]
+        if location is not None:
+            criteria.append(loc == location)
+        if model is not None:
+            criteria.append(mod == model)
+        for row_location, row_model, n in db.execute(select(loc, mod, func.count()).where(*criteria).group_by(loc, mod)):
+            lapsed[(name, row_location, row_model)] += n
+    return lapsed
+
+
+def reserve(db: Session, kind: str, work_id: int, model: Optional[str] = None, location: Optional[str] = None,
+            ttl: Optional[timedelta] = None, now: Optional[datetime] = None) -> Optional[Dict[str, Any]]:
+    """Reserve an available device for ``work_id``; None when the stock is empty."""
+    t = _table(kind)
+    now = now or datetime.utcnow()
+    expire(db, now)
+    until = now + (ttl or RESERVATION_TTL)
+    criteria = [t.c.status == "available"]
+    if model:
+        criteria.append(t.c.model == model)
+    if location:
+        criteria.append(t.c.location == location)
+    for _ in range(RESERVE_ATTEMPTS):
+        candidate = select(t.c.id).where(*criteria).order_by(t.c.id).limit(1).scalar_subquery()
+        row = db.execute(
+            update(t).where(t.c.id == candidate, t.c.status == "available")
+            .values(status="reserved", work_id=work_id, reserved_until=until, version=t.c.version + 1)
+            .returning(t.c.id, t.c.serial_number, t.c.location, t.c.model)
+        ).first()
+        if row is not None:
+            _bump(db.connection(), Counter({_key(kind, row.location, row.model, "available"): -1,
+                                            _key(kind, row.location, row.model, "reserved"): 1}))
+            changes.record(db, kind, [row.id])
+            journal.add(db, work_id, journal.EventKind.UPDATED, note=f"reserved {kind}:{row.serial_number}")
+            return {"kind": kind, "id": row.id, "serial_number": row.serial_number, "work_id": work_id,
+                    "reserved_until": until}
+        # lost the device to a concurrent request: try the next one, if any is left
+        if db.execute(select(t.c.id).where(*criteria).limit(1)).first() is None:
+            return None
+    return None
+
+
+def _release(db: Session, kind: str, criteria: list) -> int:
+    t = _table(kind)
+    rows = db.execute(
+        update(t).where(t.c.status == "reserved", *criteria)
+        .values(status="available", work_id=None, reserved_until=None, version=t.c.version + 1)
+        .returning(t.c.id, t.c.location, t.c.model)
+    ).all()
+    if rows:
+        deltas: Counter = Counter()
+        for row in rows:
+            deltas[_key(kind, row.location, row.model, "reserved")] -= 1
+            deltas[_key(kind, row.location, row.model, "available")] += 1
+        _bump(db.connection(), deltas)
+        changes.record(db, kind, [row.id for row in rows])
+    return len(rows)
+
+
+def release(db: Session, kind: str, device_id: int, work_id: Optional[int] = None) -> bool:
+    """Put a reserved device back in stock (only if reserved for ``work_id``, when given)."""
+    t = _table(kind)
+    criteria = [t.c.id == device_id]
+    if work_id is not None:
+        criteria.append(t.c.work_id == work_id)
+    return _release(db, kind, criteria) > 0
+
+
+def expire(db: Session, now: Optional[datetime] = None) -> int:
+    """Release every reservation past its TTL; returns how many."""
+    now = now or datetime.utcnow()
+    released = 0
+    for kind in KINDS:
+        t = _table(kind)
+        released += _release(db, kind, [t.c.reserved_until < now])
+    if released:
+        logger.info("Released %d expired device reservations", released)
+    return released
+
+
+def consume(db: Session, kind: str, device_id: int, work_id: int, expected_version: Optional[int] = None,
+            now: Optional[datetime] = None) -> bool:
+    """Assign the device to ``work_id`` if it is reserved for it or available; False otherwise.
+
+    With ``expected_version`` the device must also still be at that version,
+    else StaleDataError is raised (409), like an ORM write on a stale row.
+    Other reservations of the same kind for the work go back to stock.
+    """
+    t = _table(kind)
+    now = now or datetime.utcnow()
+    values = {"status": "assigned", "work_id": work_id, "reserved_until": None, "version": t.c.version + 1}
+    if "assigned_date" in t.c:
+        values["assigned_date"] = now
+    guard = [t.c.id == device_id]
+    if expected_version is not None:
+        guard.append(t.c.version == expected_version)
+    for previous, condition in (("reserved", and_(t.c.status == "reserved", t.c.work_id == work_id)),
+                                ("available", t.c.status == "available")):
+        row = db.execute(update(t).where(*guard, condition).values(**values).returning(t.c.location, t.c.model)).first()
+        if row is None:
+            continue
+        _bump(db.connection(), Counter({_key(kind, row.location, row.model, previous): -1,
+                                        _key(kind, row.location, row.model, "assigned"): 1}))
+        changes.record(db, kind, [device_id])
+        _release(db, kind, [t.c.work_id == work_id, t.c.id != device_id])
+        return True
+    if expected_version is not None:
+        current = db.execute(select(t.c.version).where(t.c.id == device_id)).scalar()
+        if current is not None and current != expected_version:
+            raise StaleDataError(f"{kind} {device_id} was modified by another request")
+    return False
+
+
+def auto_assign(db: Session, day: Optional[date] = None, location: Optional[str] = None,
+                ttl: Optional[timedelta] = None, now: Optional[datetime] = None) -> Dict[str, Any]:
+    """Reserve an ONT and a modem for every open work with an appointment on ``day`` (default tomorrow).
+
+    A work needs a device when its flag (``requires_ont``/``requires_modem``)
+    is set or it is an activation, and it holds none of that kind yet. Works
+    are paired with available devices (of ``location``, if given) by rank in
+    one query, then reserved with one executemany guarded on the status;
+    reservations last until the end of ``day`` or the TTL, whichever is later.
+    """
+    now = now or datetime.utcnow()
+    day = day or (date.today() + timedelta(days=1))
+    start = datetime.combine(day, time.min)
+    end = start + timedelta(days=1)
+    until = max(end, now + (ttl or RESERVATION_TTL))
+    expire(db, now)
+    result: Dict[str, Any] = {"day": day.isoformat()}
+    for kind, flag in (("ont", Work.requires_ont), ("modem", Work.requires_modem)):
+        t = _table(kind)
+        held = select(t.c.id).where(t.c.work_id == Work.id, t.c.status.in_(HELD)).exists()
+        needing = (select(Work.id, func.row_number().over(order_by=(Work.data_apertura, Work.id)).label("rn"))
+                   .where(Work.data_apertura >= start, Work.data_apertura < end,
+                          func.coalesce(Work.stato, "aperto").not_in(("chiuso", "sospeso")),
+                          or_(flag.is_(True), Work.tipo_lavoro == "attivazione"), ~held)
+                   .subquery())
+        wanted = db.execute(select(func.count()).select_from(needing)).scalar() or 0
+        pairs: List[Tuple[int, int]] = []
+        if wanted:
+            stock_criteria = [t.c.status == "available"]
+            if location:
+                stock_criteria.append(t.c.location == location)
+            devices = (select(t.c.id, func.row_number().over(order_by=t.c.id).label("rn"))
+                       .where(*stock_criteria).order_by(t.c.id).limit(wanted).subquery())
+            pairs = [(d, w) for d, w in db.execute(select(devices.c.id, needing.c.id)
+                                                   .join(needing, needing.c.rn == devices.c.rn))]
+        reserved = _reserve_pairs(db, kind, pairs, until) if pairs else []
+        result[kind] = {"needed": wanted, "reserved": len(reserved), "missing": wanted - len(reserved)}
+    return result
+
+
+def _reserve_pairs(db: Session, kind: str, pairs: List[Tuple[int, int]], until: datetime) -> List[Any]:
+    t = _table(kind)
+    db.execute(
+        update(t).where(t.c.id == bindparam("device"), t.c.status == "available")
+        .values(status="reserved", work_id=bindparam("target"), reserved_until=until, version=t.c.version + 1),
+        [{"device": device_id, "target": work_id} for device_id, work_id in pairs],
+    )
+    wanted = set(pairs)
+    # a concurrent writer may have taken some of the devices between the pairing and the update
+    rows = [row for row in db.execute(select(t.c.id, t.c.work_id, t.c.serial_number, t.c.location, t.c.model)
+                                      .where(t.c.id.in_([d for d, _ in pairs]), t.c.status == "reserved",
+                                             t.c.reserved_until == until))
+            if (row.id, row.work_id) in wanted]
+    deltas: Counter = Counter()
+    for row in rows:
+        deltas[_key(kind, row.location, row.model, "available")] -= 1
+        deltas[_key(kind, row.location, row.model, "reserved")] += 1
+        journal.add(db, row.work_id, journal.EventKind.UPDATED, note=f"reserved {kind}:{row.serial_number}")
+    _bump(db.connection(), deltas)
+    changes.record(db, kind, [row.id for row in rows])
+    return rows
+
+
+_STOCK_FIELDS = ("location", "model", "status")
+
+
+def _device_key(kind: str, obj, old: bool) -> StockKey:
+    state = inspect(obj)
+    values = []
+    for name in _STOCK_FIELDS:
+        history = state.attrs[name].history
+        if old and history.deleted:
+            values.append(history.deleted[0])
+        elif not old and history.added:
+            values.append(history.added[0])
+        else:
+            values.append(getattr(obj, name))
+    return _key(kind, *values)
+
+
+@event.listens_for(Session, "after_flush")
+def _count_flushed(session, flush_context):
+    deltas: Counter = Counter()
+    for objects, sign in ((session.new, 1), (session.deleted, -1), (session.dirty, 0)):
+        for obj in objects:
+            kind = "ont" if isinstance(obj, ONT) else "modem" if isinstance(obj, Modem) else None
+            if kind is None:
+                continue
+            if sign:
+                deltas[_device_key(kind, obj, old=sign < 0)] += sign
+                continue
+            before, after = _device_key(kind, obj, old=True), _device_key(kind, obj, old=False)
+            if before != after:
+                deltas[before] -= 1
+                deltas[after] += 1
+    if deltas:
+        _bump(session.connection(), deltas)
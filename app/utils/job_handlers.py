@@ -0,0 +1,154 @@
+"""Handlers of the built-in job types (registered on app.utils.jobs)."""
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from app.models.models import Job, Work
+from app.utils import archive, backup, changes, dispatch, fuzzy, geocode, idempotency, inventory, replication, search
+from app.utils.jobs import FINISHED, RETENTION_DAYS, handler
+
+
+@handler("sync")
+def sync_with_peer(ctx):
+    """Replicate works, ONTs and modems with the node configured by SYNC_PEER_URL."""
+    peer = replication.peer_from_env()
+    engine = replication.SyncEngine(ctx.session_factory, peer, policy=ctx.params.get("policy") or replication.CONFLICT_POLICY,
+                                    progress=lambda pct, msg: ctx.progress(min(pct, 99), msg))
+    stats = engine.run()
+    stats["message"] = f"Sync with {peer.name}: pulled {stats.get('pulled', 0)}, pushed {stats.get('pushed', 0)}"
+    return stats
+
+
+@handler("reindex")
+def sync_indexes(ctx):
+    """Resynchronize the derived indexes (full-text search, fuzzy match keys, work areas, stock counters) with the source tables."""
+    db = ctx.session_factory()
+    try:
+        ctx.progress(5, "Rebuilding full-text search index")
+        backend = search.rebuild(db)
+        db.commit()
+        ctx.progress(50, "Rebuilding fuzzy match keys")
+        fuzzy.rebuild(db)
+        db.commit()
+        ctx.progress(70, "Normalizing addresses")
+        geocode.rebuild(db)
+        db.commit()
+        ctx.progress(90, "Recounting inventory stock")
+        inventory.rebuild(db.connection())
+        db.commit()
+        works = db.query(func.count(Work.id)).scalar()
+    finally:
+        db.close()
+    return {"message": f"Indexes rebuilt for {works} works", "works": works, "search_backend": backend}
+
+
+@handler("backup")
+def backup_database(ctx):
+    """Back up the database into BACKUP_DIR and rotate the old copies."""
+    db = ctx.session_factory()
+    try:
+        engine = db.get_bind()
+    finally:
+        db.close()
+    # always BACKUP_DIR: params come from /jobs/create callers, who must not pick where files are written or removed
+    ctx.progress(0, "Creating backup...")
+    result = backup.create_backup(engine, backup.BACKUP_DIR, compression=ctx.params.get("compression"),
+                                  progress=lambda pct, msg: ctx.progress(min(pct, 95), msg))
+    ctx.progress(97, "Rotating old backups")
+    result["rotated"] = backup.rotate(backup.BACKUP_DIR, ctx.params.get("retention_days"))
+    result["message"] = f"Backup created: {result['path']}"
+    return result
+
+
+@handler("archive")
+def archive_closed_works(ctx):
+    """Move works closed more than ARCHIVE_AFTER_MONTHS months ago to the archive tables."""
+    months = ctx.params.get("months")
+    db = ctx.session_factory()
+    try:
+        result = archive.archive_closed(db, int(months) if months is not None else None,
+                                        progress=lambda pct, msg: ctx.progress(min(pct, 99), msg))
+    finally:
+        db.close()
+    result["message"] = f"Archived {result['archived']} closed works"
+    return result
+
+
+@handler("auto_assign")
+def auto_assign_devices(ctx):
+    """Release expired device reservations and reserve ONTs/modems for tomorrow's works."""
+    day = ctx.params.get("day")
+    db = ctx.session_factory()
+    try:
+        result = inventory.auto_assign(db, day=datetime.strptime(day, "%Y-%m-%d").date() if day else None,
+                                       location=ctx.params.get("location"))
+        db.commit()
+    finally:
+        db.close()
+    reserved = result["ont"]["reserved"] + result["modem"]["reserved"]
+    result["message"] = f"Reserved {reserved} devices for the works of {result['day']}"
+    return result
+
+
+@handler("expire_reservations")
+def expire_reservations(ctx):
+    """Put the devices whose reservation passed its TTL back in stock."""
+    db = ctx.session_factory()
+    try:
+        released = inventory.expire(db)
+        db.commit()
+    finally:
+        db.close()
+    return {"message": f"Released {released} expired reservations", "released": released}
+
+
+@handler("dispatch")
+def dispatch_works(ctx):
+    """Assign open works to technicians; scheduled runs dispatch tomorrow's appointments."""
+    day = ctx.params.get("day")
+    if day:
+        day = datetime.strptime(day, "%Y-%m-%d").date()
+    elif ctx.params.get("scheduled"):
+        day = datetime.now().date() + timedelta(days=1)
+    db = ctx.session_factory()
+    try:
+        ctx.progress(10, "Planning")
+        planned = dispatch.plan(db, day=day, team_id=ctx.params.get("team_id"),
+                                capacity=ctx.params.get("max_open_works"))
+        result = {"day": planned["day"], "works": planned["works"], "planned": len(planned["assigned"]),
+                  "unassigned": len(planned["unassigned"]), "elapsed_ms": planned["elapsed_ms"]}
+        if ctx.params.get("preview"):
+            result["plan"] = planned["assigned"]
+            result["message"] = f"Preview: {result['planned']} of {planned['works']} works would be assigned"
+            return result
+        ctx.progress(60, f"Assigning {result['planned']} works")
+        done = dispatch.apply(db, planned)
+        db.commit()
+        result["assigned"] = len(done)
+        if ctx.params.get("notify", True):
+            result["notified"] = dispatch.notify_technicians(db, done)
+    finally:
+        db.close()
+    result["message"] = f"Assigned {result['assigned']} of {planned['works']} works"
+    return result
+
+
+@handler("cleanup")
+def cleanup(ctx):
+    """Purge expired ingest idempotency keys, finished jobs and change log entries past their retention period."""
+    days = int(ctx.params.get("retention_days") or RETENTION_DAYS)
+    db = ctx.session_factory()
+    try:
+        keys = idempotency.purge_expired(db)
+        ctx.progress(50, f"Removed {keys} expired idempotency keys")
+        jobs = db.query(Job).filter(
+            Job.status.in_(FINISHED), Job.completed_at < datetime.utcnow() - timedelta(days=days)
+        ).delete(synchronize_session=False)
+        db.commit()  # progress() writes from its own session: do not hold the write lock across it
+        ctx.progress(75, f"Removed {jobs} old jobs")
+        entries = changes.prune(db, int(ctx.params.get("change_log_retention_days") or changes.RETENTION_DAYS))
+        db.commit()
+    finally:
+        db.close()
+    return {"message": f"Removed {keys} idempotency keys, {jobs} old jobs and {entries} change log entries",
+            "idempotency_keys": keys, "jobs": jobs, "change_log": entries}
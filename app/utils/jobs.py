@@ -0,0 +1,347 @@
+"""Persistent background jobs.
+
+Jobs live in the ``jobs`` table, so they survive restarts and every API
+process and worker sees the same queue. A worker takes a job with a
+*lease*: a conditional ``UPDATE`` that only succeeds for one worker, valid
+until ``lease_expires_at``. While the handler runs, a heartbeat thread
+renews the lease every ``HEARTBEAT_SECONDS`` (progress reports renew it
+too), so a long step without progress keeps its job; a job whose worker
+died is leased again once the lease expires.
+
+Scheduled jobs carry a ``schedule_key`` (job type and minute) with a
+unique index, so when several workers' schedulers fire in the same minute
+only one of them queues the job.
+
+Failures are retried with exponential backoff (``run_after``) until
+``max_attempts`` is reached. Handlers are registered with ``@handler`` and
+receive a ``JobContext``::
+
+    @handler("backup")
+    def _backup(ctx):
+        ctx.progress(50, "Copying pages")
+        return {"path": ...}   # stored in Job.result
+
+Workers run as ``python -m app.worker`` (deploy/worker.service); the
+Yggdrasil API can also host one in-process (``JOBS_EMBEDDED_WORKER``).
+"""
+import logging
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Optional
+
+from sqlalchemy import and_, inspect, or_, text, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.models.models import Job
+
+logger = logging.getLogger("app.utils.jobs")
+
+LEASE_SECONDS = int(os.getenv("JOBS_LEASE_SECONDS") or 300)
+# Well within the lease, so one missed beat does not lose the job
+HEARTBEAT_SECONDS = LEASE_SECONDS / 3
+RETRY_BASE_SECONDS = 30
+POLL_SECONDS = 2.0
+# Finished jobs older than this are removed by the cleanup job
+RETENTION_DAYS = int(os.getenv("JOBS_RETENTION_DAYS") or 30)
+FINISHED = ("completed", "failed")
+
+# Job types queued periodically by the workers (cron expressions); empty values are skipped
+SCHEDULES = {"backup": os.getenv("BACKUP_SCHEDULE") or "", "archive": os.getenv("ARCHIVE_SCHEDULE") or "",
+             "auto_assign": os.getenv("AUTO_ASSIGN_SCHEDULE") or "", "dispatch": os.getenv("DISPATCH_SCHEDULE") or "",
+             # set to an empty value to disable
+             "expire_reservations": os.getenv("INVENTORY_EXPIRE_SCHEDULE", "*/15 * * * *")}
+
+HANDLERS: Dict[str, Callable[["JobContext"], Any]] = {}
+
+
+def handler(job_type: str):
+    def register(fn):
+        HANDLERS[job_type] = fn
+        return fn
+    return register
+
+
+class JobContext:
+    """What a handler gets: its params, a session factory and ``progress()``."""
+
+    def __init__(self, job: Job, session_factory: Callable[[], Session], owner: str):
+        self.job_id = job.id
+        self.params: Dict[str, Any] = dict(job.params or {})
+        self.attempt = job.attempts
+        self.session_factory = session_factory
+        self.owner = owner
+
+    def progress(self, percent: int, message: Optional[str] = None) -> None:
+        """Record progress (own transaction, visible to /jobs/status at once) and renew the lease."""
+        db = self.session_factory()
+        try:
+            db.execute(
+                update(Job)
+                .where(Job.id == self.job_id, Job.lease_owner == self.owner)
+                .values(progress=max(0, min(100, int(percent))), message=message,
+                        lease_expires_at=datetime.utcnow() + timedelta(seconds=LEASE_SECONDS))
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    def renew_lease(self) -> bool:
+        """Push the lease expiry forward; False once another worker owns the job."""
+        db = self.session_factory()
+        try:
+            renewed = db.execute(
+                update(Job)
+                .where(Job.id == self.job_id, Job.lease_owner == self.owner)
+                .values(lease_expires_at=datetime.utcnow() + timedelta(seconds=LEASE_SECONDS))
+            ).rowcount
+            db.commit()
+            return bool(renewed)
+        finally:
+            db.close()
+
+
+def _heartbeat(ctx: JobContext, stop: threading.Event, interval: float) -> None:
+    while not stop.wait(interval):
+        try:
+            if not ctx.renew_lease():
+                logger.warning("Job %s: lease lost by %s", ctx.job_id, ctx.owner)
+                return
+        except Exception:
+            logger.exception("Job %s: lease renewal failed", ctx.job_id)
+
+
+def ensure_schema(engine: Engine) -> None:
+    """Add ``jobs.schedule_key`` and its unique index to databases created before them (startup)."""
+    inspector = inspect(engine)
+    if not inspector.has_table(Job.__tablename__):
+        return
+    with engine.begin() as conn:
+        if "schedule_key" not in {c["name"] for c in inspector.get_columns(Job.__tablename__)}:
+            conn.execute(text("ALTER TABLE jobs ADD COLUMN schedule_key VARCHAR"))
+            logger.info("Added schedule_key column to jobs")
+        next(i for i in Job.__table__.indexes if i.name == "ux_jobs_schedule_key").create(conn, checkfirst=True)
+
+
+def enqueue(db: Session, job_type: str, params: Optional[Dict[str, Any]] = None, *,
+            priority: int = 0, max_attempts: int = 3, schedule_key: Optional[str] = None) -> Job:
+    """Queue a job and commit; with an already used ``schedule_key`` the commit raises IntegrityError."""
+    job = Job(job_type=job_type, params=params or {}, priority=priority, max_attempts=max(1, max_attempts),
+              run_after=datetime.utcnow(), schedule_key=schedule_key)
+    if job_type not in HANDLERS:
+        job.status = "failed"
+        job.message = f"Unknown job type: {job_type}"
+        job.completed_at = datetime.utcnow()
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def lease(db: Session, owner: str, job_types: Optional[list] = None) -> Optional[Job]:
+    """Take the next runnable job for ``owner``, or None.
+
+    Candidates are pending jobs whose backoff has elapsed and running jobs
+    whose lease expired. The claim is an UPDATE guarded by the state read,
+    so when two workers race for the same row only one of them gets it.
+    """
+    now = datetime.utcnow()
+    runnable = or_(
+        and_(Job.status == "pending", Job.run_after <= now),
+        and_(Job.status == "running", Job.lease_expires_at < now),
+    )
+    query = db.query(Job.id, Job.status, Job.attempts).filter(runnable, Job.attempts < Job.max_attempts)
+    if job_types:
+        query = query.filter(Job.job_type.in_(job_types))
+    for job_id, status, attempts in query.order_by(Job.priority.desc(), Job.id).limit(10).all():
+        claimed = db.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == status, Job.attempts == attempts)
+            .values(status="running", lease_owner=owner, attempts=attempts + 1,
+                    lease_expires_at=now + timedelta(seconds=LEASE_SECONDS), started_at=now)
+        ).rowcount
+        db.commit()
+        if claimed:
+            return db.query(Job).filter(Job.id == job_id).one()
+    return None
+
+
+def fail_abandoned(db: Session) -> int:
+    """Mark as failed the jobs whose lease expired on their last allowed attempt."""
+    count = db.query(Job).filter(
+        Job.status == "running", Job.lease_expires_at < datetime.utcnow(), Job.attempts >= Job.max_attempts
+    ).update({"status": "failed", "message": "Worker lost (lease expired)", "completed_at": datetime.utcnow()},
+             synchronize_session=False)
+    db.commit()
+    return count
+
+
+def run_next(session_factory: Callable[[], Session], owner: str) -> Optional[int]:
+    """Lease and run one job. Returns its id, or None when the queue is empty."""
+    db = session_factory()
+    try:
+        fail_abandoned(db)
+        job = lease(db, owner)
+        if job is None:
+            return None
+        ctx = JobContext(job, session_factory, owner)
+        job_id, job_type = job.id, job.job_type
+    finally:
+        db.close()
+
+    logger.info("Job %s (%s) started by %s, attempt %d", job_id, job_type, owner, ctx.attempt)
+    beating = threading.Event()
+    threading.Thread(target=_heartbeat, args=(ctx, beating, HEARTBEAT_SECONDS), daemon=True,
+                     name=f"job-heartbeat-{job_id}").start()
+    try:
+        fn = HANDLERS.get(job_type)
+        if fn is None:
+            raise LookupError(f"No handler for job type {job_type!r}")
+        result = fn(ctx)
+    except Exception as e:
+        logger.exception("Job %s failed", job_id)
+        beating.set()
+        _finish_failed(session_factory, job_id, owner, e)
+    else:
+        beating.set()
+        _finish(session_factory, job_id, owner, status="completed", progress=100, result=result,
+                message=(result or {}).get("message") if isinstance(result, dict) else None, error=None)
+    return job_id
+
+
+def _finish_failed(session_factory, job_id: int, owner: str, error: Exception) -> None:
+    db = session_factory()
+    try:
+        job = db.query(Job).filter(Job.id == job_id).one()
+        message = f"{type(error).__name__}: {error}"
+        if job.attempts < job.max_attempts:
+            # back to the queue: 30s, 60s, 120s, ...
+            delay = RETRY_BASE_SECONDS * (2 ** (job.attempts - 1))
+            values = dict(status="pending", run_after=datetime.utcnow() + timedelta(seconds=delay),
+                          message=f"Attempt {job.attempts} failed, retrying in {delay}s", error=message)
+        else:
+            values = dict(status="failed", message=f"Failed after {job.attempts} attempt(s)", error=message,
+                          completed_at=datetime.utcnow())
+    finally:
+        db.close()
+    _finish(session_factory, job_id, owner, **values)
+
+
+def _finish(session_factory, job_id: int, owner: str, **values) -> None:
+    if values.get("status") == "completed":
+        values["completed_at"] = datetime.utcnow()
+    values.update(lease_owner=None, lease_expires_at=None)
+    db = session_factory()
+    try:
+        # a worker that lost its lease to another one does not overwrite the other's outcome
+        db.execute(update(Job).where(Job.id == job_id, Job.lease_owner == owner).values(**values))
+        db.commit()
+    finally:
+        db.close()
+
+
+def _cron_field(field: str, value: int, low: int, high: int) -> bool:
+    for part in field.split(","):
+        spec, _, step = part.partition("/")
+        if spec == "*":
+            start, end = low, high
+        elif "-" in spec:
+            start, end = (int(v) for v in spec.split("-", 1))
+        else:
+            start = end = int(spec)
+            if step:
+                end = high
+        if start <= value <= end and (value - start) % int(step or 1) == 0:
+            return True
+    return False
+
+
+def cron_matches(expr: str, when: datetime) -> bool:
+    """Whether the 5-field cron expression (minute hour day month weekday) matches ``when``."""
+    minute, hour, day, month, weekday = expr.split()
+    return (_cron_field(minute, when.minute, 0, 59) and _cron_field(hour, when.hour, 0, 23)
+            and _cron_field(day, when.day, 1, 31) and _cron_field(month, when.month, 1, 12)
+            and _cron_field(weekday, (when.weekday() + 1) % 7, 0, 6))  # cron: 0 = Sunday
+
+
+def enqueue_scheduled(db: Session, schedules: Dict[str, str], now: Optional[datetime] = None) -> list:
+    """Queue the job types whose cron expression matches this minute, once per minute across workers."""
+    now = (now or datetime.now()).replace(second=0, microsecond=0)
+    queued = []
+    for job_type, expr in schedules.items():
+        if not cron_matches(expr, now):
+            continue
+        slot = now.isoformat(timespec="minutes")
+        try:
+            queued.append(enqueue(db, job_type, {"scheduled": slot}, schedule_key=f"{job_type}@{slot}").id)
+        except IntegrityError:
+            # another worker's scheduler queued this slot first
+            db.rollback()
+    return queued
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class Worker:
+    """Runs jobs on ``concurrency`` threads until ``stop()`` is called.
+
+    ``schedules`` maps job types to cron expressions (e.g. ``{"backup": "0 2 * * *"}``);
+    matching jobs are queued by a scheduler thread.
+    """
+
+    def __init__(self, session_factory: Callable[[], Session], concurrency: int = 1, poll_seconds: float = POLL_SECONDS,
+                 schedules: Optional[Dict[str, str]] = None):
+        self.session_factory = session_factory
+        self.concurrency = max(1, concurrency)
+        self.poll_seconds = poll_seconds
+        self.schedules = {k: v for k, v in (schedules or {}).items() if v}
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self) -> "Worker":
+        for _ in range(self.concurrency):
+            thread = threading.Thread(target=self._loop, args=(worker_name(),), daemon=True, name="job-worker")
+            thread.start()
+            self._threads.append(thread)
+        if self.schedules:
+            thread = threading.Thread(target=self._schedule_loop, daemon=True, name="job-scheduler")
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _loop(self, owner: str) -> None:
+        while not self._stop.is_set():
+            try:
+                ran = run_next(self.session_factory, owner)
+            except Exception:
+                logger.exception("Job worker %s: queue error", owner)
+                ran = None
+            if ran is None:
+                self._stop.wait(self.poll_seconds)
+
+    def _schedule_loop(self) -> None:
+        while not self._stop.is_set():
+            db = self.session_factory()
+            try:
+                enqueue_scheduled(db, self.schedules)
+            except Exception:
+                logger.exception("Job scheduler error")
+            finally:
+                db.close()
+            # wake up early in the next minute
+            self._stop.wait(61 - datetime.now().second)
+
+
+# The job types: importing them registers the handlers
+from app.utils import job_handlers  # noqa: E402,F401
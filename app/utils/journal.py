@@ -0,0 +1,173 @@
+"""Work event journal (``work_journal``, ``GET /works/{id}/history``).
+
+An entry is a coded ``EventKind``, the technician behind it, the changed
+fields as ``{field: [old, new]}`` and an optional short note: no free-text
+sentences, so an entry costs a few bytes plus the values that changed.
+
+``add()`` does not write anything: entries are buffered on the session and
+inserted with one executemany when the transaction commits (and dropped if
+it rolls back), so a route that records several events pays one round-trip
+and never commits just to log. ``diff()`` builds the payload from the
+pending ORM changes, so call it before the flush. Deleting a work deletes
+its journal (and legacy ``work_events``) in the same flush.
+
+``ensure_migrated()`` moves the legacy ``work_events`` rows into the journal.
+"""
+import enum
+import logging
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, Optional, Union
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import delete, event, inspect, insert, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from app.models.models import Work, WorkEvent, WorkJournalEntry
+
+logger = logging.getLogger("app.utils.journal")
+
+_PENDING = "work_journal_pending"
+
+
+class EventKind(enum.IntEnum):
+    CREATED = 1
+    UPDATED = 2
+    STATUS_CHANGE = 3
+    CLOSED = 4
+    SUSPENDED = 5
+    ASSIGNED = 6
+    UNASSIGNED = 7
+    ACCEPTED = 8
+    REJECTED = 9
+    MERGED = 10
+    APPLIED_FROM_DOCUMENT = 11
+    MESSAGE = 12
+
+
+# work_events.event_type values written before the journal existed
+LEGACY_TYPES = {
+    "created": EventKind.CREATED, "created_manual": EventKind.CREATED, "updated": EventKind.UPDATED,
+    "status_change": EventKind.STATUS_CHANGE, "closed": EventKind.CLOSED, "suspended": EventKind.SUSPENDED,
+    "assigned": EventKind.ASSIGNED, "unassigned": EventKind.UNASSIGNED, "accepted": EventKind.ACCEPTED,
+    "rejected": EventKind.REJECTED, "merged": EventKind.MERGED,
+    "applied_from_document": EventKind.APPLIED_FROM_DOCUMENT, "gpt_message": EventKind.MESSAGE,
+}
+
+
+def status_kind(new_status: Optional[str]) -> EventKind:
+    if new_status == "chiuso":
+        return EventKind.CLOSED
+    if new_status == "sospeso":
+        return EventKind.SUSPENDED
+    return EventKind.STATUS_CHANGE
+
+
+def add(db: Session, work: Union[Work, int], kind: EventKind, diff: Optional[Dict[str, Any]] = None,
+        actor_id: Optional[int] = None, note: Optional[str] = None) -> None:
+    """Queue an entry for ``work`` (a Work, possibly not flushed yet, or an id); written at commit."""
+    db.info.setdefault(_PENDING, []).append((work, int(kind), datetime.now(), actor_id, diff or None, note))
+
+
+def diff(obj, fields: Optional[Iterable[str]] = None) -> Dict[str, list]:
+    """``{field: [old, new]}`` of the pending (unflushed) column changes of ``obj``."""
+    state = inspect(obj)
+    out = {}
+    for name in fields or [attr.key for attr in state.mapper.column_attrs]:
+        history = state.attrs[name].history
+        if not history.added:
+            continue
+        old = history.deleted[0] if history.deleted else None
+        new = history.added[0]
+        if old != new:
+            out[name] = jsonable_encoder([old, new])
+    return out
+
+
+@event.listens_for(Session, "before_commit")
+def _write_pending(session):
+    if not session.info.get(_PENDING):
+        return
+    # works created in this transaction need their ids; deleted ones drop their entries (_drop_deleted)
+    session.flush()
+    pending = session.info.pop(_PENDING, None)
+    if not pending:
+        return
+    rows = [{"work_id": work.id if isinstance(work, Work) else work, "kind": kind, "ts": ts,
+             "actor_id": actor_id, "diff": entry_diff, "note": note}
+            for work, kind, ts, actor_id, entry_diff, note in pending]
+    session.execute(insert(WorkJournalEntry.__table__), [r for r in rows if r["work_id"] is not None])
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _drop_pending(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop(_PENDING, None)
+
+
+@event.listens_for(Session, "before_flush")
+def _drop_deleted(session, flush_context, instances):
+    # the entries' foreign key would reject the works' DELETE: remove them first
+    ids = sorted(obj.id for obj in session.deleted if isinstance(obj, Work) and obj.id is not None)
+    if not ids:
+        return
+    conn = session.connection()
+    conn.execute(delete(WorkJournalEntry.__table__).where(WorkJournalEntry.work_id.in_(ids)))
+    conn.execute(delete(WorkEvent.__table__).where(WorkEvent.work_id.in_(ids)))
+    pending = session.info.get(_PENDING)
+    if pending:
+        gone = set(ids)
+        pending[:] = [entry for entry in pending
+                      if (entry[0].id if isinstance(entry[0], Work) else entry[0]) not in gone]
+
+
+def entry_out(kind: int, ts: Any, actor_id: Optional[int], entry_diff: Optional[dict], note: Optional[str]) -> Dict[str, Any]:
+    try:
+        name = EventKind(kind).name.lower()
+    except ValueError:
+        name = str(kind)
+    return {"ts": jsonable_encoder(ts), "kind": name, "actor_id": actor_id, "diff": entry_diff, "note": note}
+
+
+def history(db: Session, work_id: int, batch_size: int = 500) -> Iterator[Dict[str, Any]]:
+    """The journal of ``work_id`` in time order, read in batches (one range scan of ix_work_journal_work_ts)."""
+    stmt = (select(WorkJournalEntry.kind, WorkJournalEntry.ts, WorkJournalEntry.actor_id, WorkJournalEntry.diff, WorkJournalEntry.note)
+            .where(WorkJournalEntry.work_id == work_id)
+            .order_by(WorkJournalEntry.ts, WorkJournalEntry.id)
+            .execution_options(yield_per=batch_size))
+    for row in db.execute(stmt):
+        yield entry_out(*row)
+
+
+def archived_history(events: Optional[list]) -> Iterator[Dict[str, Any]]:
+    """The timeline stored on an archived work (journal rows, or work_events rows for older archives)."""
+    for row in events or []:
+        if "kind" in row:
+            yield entry_out(row["kind"], row["ts"], row.get("actor_id"), row.get("diff"), row.get("note"))
+        else:
+            kind = LEGACY_TYPES.get(row.get("event_type"), EventKind.UPDATED)
+            yield entry_out(kind, row.get("timestamp"), row.get("user_id"), None, row.get("description"))
+
+
+def ensure_migrated(engine: Engine, batch_size: int = 5000) -> int:
+    """Move the legacy ``work_events`` rows into ``work_journal`` (at startup); returns the rows moved.
+
+    Rows are copied and deleted in one transaction, so running it again, from
+    any service, only moves what some old process wrote in the meantime.
+    """
+    with engine.begin() as conn:
+        if conn.execute(select(WorkEvent.id).limit(1)).first() is None:
+            return 0
+        moved = 0
+        result = conn.execute(select(WorkEvent.work_id, WorkEvent.timestamp, WorkEvent.event_type, WorkEvent.user_id,
+                                     WorkEvent.description).where(WorkEvent.work_id.is_not(None)).order_by(WorkEvent.id))
+        for batch in result.partitions(batch_size):
+            conn.execute(insert(WorkJournalEntry.__table__), [
+                {"work_id": work_id, "ts": ts or datetime.now(), "kind": int(LEGACY_TYPES.get(event_type, EventKind.UPDATED)),
+                 "actor_id": user_id, "diff": None, "note": description}
+                for work_id, ts, event_type, user_id, description in batch
+            ])
+            moved += len(batch)
+        conn.execute(delete(WorkEvent.__table__))
+    logger.info("Moved %d legacy work events into the work journal", moved)
+    return moved
@@ -0,0 +1,108 @@
+"""Per-process fan-out hub behind ``GET /live/events`` (Server-Sent Events).
+
+Change entries recorded by ``app.utils.changes`` are published once their
+transaction commits; every open dashboard holds a small queue fed
+from the hub, so one commit costs one fan-out instead of N polls. Each
+worker process has its own hub: with several uvicorn workers a browser only
+sees the commits of its own worker plus what it catches up through
+``Last-Event-ID`` / ``GET /works/changes``.
+
+EventSource cannot send ``X-API-Key``, and the key must not travel in URLs
+(access logs, browser history): a client holding the key asks
+``POST /live/token`` for a short-lived signed token and opens the stream
+with ``?token=``. The token is only checked when the stream opens.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set
+
+from jose import JWTError, jwt
+
+from app.utils import changes
+from app.utils.auth import ALGORITHM, SECRET_KEY
+
+logger = logging.getLogger("app.utils.live")
+
+# Events buffered per subscriber before it is considered too slow and asked to reload
+QUEUE_SIZE = 1000
+HEARTBEAT_SECONDS = 15
+STREAM_TOKEN_SECONDS = int(os.getenv("LIVE_TOKEN_SECONDS") or 300)
+_STREAM_SCOPE = "live"
+
+
+def stream_token(seconds: int = STREAM_TOKEN_SECONDS) -> str:
+    """Signed token opening the full stream (every entity) within ``seconds``."""
+    return jwt.encode({"scope": _STREAM_SCOPE, "exp": int(time.time()) + seconds}, SECRET_KEY, algorithm=ALGORITHM)
+
+
+def valid_stream_token(token: str) -> bool:
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return False
+    # login tokens are signed with the same key: only stream tokens open the stream
+    return payload.get("scope") == _STREAM_SCOPE
+
+
+class Subscriber:
+    def __init__(self, loop: asyncio.AbstractEventLoop, entities: Optional[Set[str]] = None):
+        self.loop = loop
+        self.entities = entities
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    def _put(self, item: Dict[str, Any]) -> None:
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            # Drop the backlog and tell the client to resync from the change feed
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait({"type": "reset"})
+
+    def offer(self, item: Dict[str, Any]) -> None:
+        """Thread-safe enqueue; called from whichever thread committed."""
+        if self.entities is not None and item.get("entity") not in self.entities:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self._put, item)
+        except RuntimeError:
+            # Event loop already closed: the client is gone
+            pass
+
+
+class LiveHub:
+    def __init__(self):
+        self._subscribers: Set[Subscriber] = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, entities: Optional[Set[str]] = None) -> Subscriber:
+        subscriber = Subscriber(asyncio.get_running_loop(), entities)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, items: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            for item in items:
+                subscriber.offer(item)
+
+
+hub = LiveHub()
+
+
+@changes.on_commit
+def _publish_committed(entries: List[Dict[str, Any]]) -> None:
+    hub.publish([{"type": "change", **entry} for entry in entries])
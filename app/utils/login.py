@@ -0,0 +1,123 @@
+"""Login protection: bounded password verification and failed-login throttling.
+
+PBKDF2 verification costs tens of milliseconds of CPU by design. It runs on
+a small dedicated thread pool (hashlib releases the GIL while hashing) with
+a cap on queued requests, so a burst of logins cannot take every CPU away
+from the rest of the API; past the cap ``/auth/login`` answers 503.
+
+Failed attempts are counted per username and per client IP over a sliding
+window kept in memory (per process); over the limit the login answers 429
+with ``Retry-After`` before any hashing is done. Keys are kept in order of
+their last failure, so each failure also drops the keys whose window has
+passed, and at most ``LOGIN_THROTTLE_MAX_KEYS`` are tracked (oldest evicted).
+
+A successful verification also reports whether the stored hash uses
+outdated parameters (``PASSWORD_HASH_ROUNDS``), so the login can store the
+upgraded hash transparently.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Optional, Tuple
+
+from app.utils.auth import pwd_context
+
+HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS") or 2)
+# Verifications running or waiting; beyond this logins are refused with 503
+HASH_QUEUE_LIMIT = int(os.getenv("PASSWORD_HASH_QUEUE") or 32)
+HASH_TIMEOUT_SECONDS = 30
+LOGIN_WINDOW_SECONDS = int(os.getenv("LOGIN_WINDOW_SECONDS") or 900)
+LOGIN_MAX_FAILURES_PER_USER = int(os.getenv("LOGIN_MAX_FAILURES_PER_USER") or 5)
+LOGIN_MAX_FAILURES_PER_IP = int(os.getenv("LOGIN_MAX_FAILURES_PER_IP") or 20)
+# Usernames and IPs tracked at once: a spray of random names cannot grow memory past this
+LOGIN_THROTTLE_MAX_KEYS = int(os.getenv("LOGIN_THROTTLE_MAX_KEYS") or 100_000)
+
+
+class Busy(Exception):
+    """Too many password verifications are already queued."""
+
+
+class PasswordVerifier:
+    def __init__(self, workers: int = HASH_WORKERS, queue_limit: int = HASH_QUEUE_LIMIT):
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="pwhash")
+        self._slots = threading.BoundedSemaphore(max(1, queue_limit))
+
+    def verify(self, password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        """(valid, new hash when the stored one should be upgraded). Raises Busy when the queue is full."""
+        if not self._slots.acquire(blocking=False):
+            raise Busy()
+        try:
+            return self._pool.submit(pwd_context.verify_and_update, password, hashed).result(HASH_TIMEOUT_SECONDS)
+        finally:
+            self._slots.release()
+
+
+class LoginThrottle:
+    """Failed attempts per key in a sliding window."""
+
+    def __init__(self, window: float = LOGIN_WINDOW_SECONDS, max_keys: int = LOGIN_THROTTLE_MAX_KEYS):
+        self.window = window
+        self.max_keys = max(1, max_keys)
+        # least recently failed first
+        self._failures: "OrderedDict[str, Deque[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _recent(self, key: str, now: float) -> Deque[float]:
+        failures = self._failures.get(key)
+        if failures is None:
+            return deque()
+        while failures and failures[0] <= now - self.window:
+            failures.popleft()
+        if not failures:
+            del self._failures[key]
+        return failures
+
+    def retry_after(self, key: str, limit: int) -> Optional[int]:
+        """Seconds until ``key`` may try again, or None if it is under ``limit``."""
+        now = time.monotonic()
+        with self._lock:
+            failures = self._recent(key, now)
+            if len(failures) < limit:
+                return None
+            return max(1, int(failures[len(failures) - limit] + self.window - now) + 1)
+
+    def failed(self, key: str) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._failures.setdefault(key, deque()).append(now)
+            self._failures.move_to_end(key)
+            # front keys failed last before the window: all their failures have expired
+            while self._failures:
+                oldest, failures = next(iter(self._failures.items()))
+                if failures[-1] > now - self.window and len(self._failures) <= self.max_keys:
+                    break
+                del self._failures[oldest]
+
+    def reset(self, key: str) -> None:
+        with self._lock:
+            self._failures.pop(key, None)
+
+
+verifier = PasswordVerifier()
+throttle = LoginThrottle()
+
+
+def check_throttle(username: str, ip: Optional[str]) -> Optional[int]:
+    """Retry-After seconds if this username or IP failed too often recently."""
+    waits = [throttle.retry_after(f"user:{username.casefold()}", LOGIN_MAX_FAILURES_PER_USER)]
+    if ip:
+        waits.append(throttle.retry_after(f"ip:{ip}", LOGIN_MAX_FAILURES_PER_IP))
+    waits = [w for w in waits if w]
+    return max(waits) if waits else None
+
+
+def record_failure(username: str, ip: Optional[str]) -> None:
+    throttle.failed(f"user:{username.casefold()}")
+    if ip:
+        throttle.failed(f"ip:{ip}")
+
+
+def record_success(username: str) -> None:
+    throttle.reset(f"user:{username.casefold()}")
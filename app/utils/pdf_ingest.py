@@ -0,0 +1,308 @@
+"""Bulk ingestion of PDF schedules from disk (``scripts/ingest_pdfs.py``).
+
+Extraction and parsing are CPU bound and run in worker processes
+(``parse_file`` only touches the file it is given, never the database).
+The parent process writes the results in batches: the works of a batch go
+through the bulk ingest engine (``app.utils.ingest.WorkIngestor``), then
+the ``Document`` rows, their pages, the document/work links and the
+``processed_files`` ledger entries are committed together.
+
+The ledger is keyed by the SHA-256 of the file content, so an interrupted
+run resumes where it stopped and a file copied under another name is not
+ingested twice.
+"""
+import hashlib
+import logging
+import os
+import re
+from datetime import datetime
+from io import BytesIO
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import pdfplumber
+try:
+    import pytesseract
+except Exception:
+    pytesseract = None
+from sqlalchemy.orm import Session
+
+from app.models.models import Document, DocumentAppliedWork, ProcessedFile
+from app.utils import doc_pages
+from app.utils.ingest import WorkIngestor
+from app.utils.ocr import extract_wr_entries, extract_wr_fields, normalize_numero_wr
+
+logger = logging.getLogger("app.utils.pdf_ingest")
+
+DEFAULT_BATCH_SIZE = 50
+# Entry fields written to the Work columns; apply_document uses the same ones
+ENTRY_COLUMNS = ("operatore", "indirizzo", "nome_cliente", "tipo_lavoro")
+
+
+def extract_pages(content: bytes) -> Tuple[Optional[str], Optional[List[str]], bool]:
+    """Full text, per-page texts and whether OCR was used.
+
+    Pages without a text layer are OCR'd when pytesseract is installed. Content
+    pdfplumber cannot open is decoded as UTF-8 (pages is None in that case).
+    """
+    try:
+        with pdfplumber.open(BytesIO(content)) as pdf:
+            pages_text = [p.extract_text() or '' for p in pdf.pages]
+            text = '\n'.join(pages_text)
+            ocr_used = False
+            if not text.strip() and pytesseract:
+                ocr_pages = []
+                for p in pdf.pages:
+                    try:
+                        ocr_pages.append(pytesseract.image_to_string(p.to_image(resolution=200).original))
+                    except Exception:
+                        # best effort; keep the page empty so page numbers line up
+                        ocr_pages.append('')
+                if any(ocr_pages):
+                    text, pages_text, ocr_used = '\n'.join(ocr_pages), ocr_pages, True
+            return text, pages_text, ocr_used
+    except Exception:
+        try:
+            return content.decode('utf-8'), None, False
+        except Exception:
+            return None, None, False
+
+
+def parse_file(path: str) -> Dict[str, Any]:
+    """Read, hash and parse one PDF (runs in a worker process)."""
+    result: Dict[str, Any] = {"path": path, "filename": os.path.basename(path), "error": None}
+    try:
+        with open(path, 'rb') as fh:
+            content = fh.read()
+        stat = os.stat(path)
+        result.update(content=content, sha256=hashlib.sha256(content).hexdigest(), size=stat.st_size, mtime=stat.st_mtime)
+        text, pages_text, ocr_used = extract_pages(content)
+        pages = []
+        entries: List[Dict[str, Any]] = []
+        for page_no, ptext in enumerate(pages_text if pages_text is not None else [text or '']):
+            page_entries = [e for e in extract_wr_entries(ptext) if e]
+            pages.append((page_no, doc_pages.fingerprint(ptext), page_entries))
+            entries.extend(page_entries)
+        if not entries and text:
+            fallback = extract_wr_fields(text)
+            if fallback.get('numero_wr') or fallback.get('nome_cliente'):
+                entries.append(fallback)
+        result.update(text=text or '', pages=pages, entries=_dedupe(entries), ocr_used=ocr_used)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    return result
+
+
+def _dedupe(entries: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Normalize WR numbers and keep the first entry of each, like parse_document."""
+    seen = set()
+    out = []
+    for e in entries:
+        nr = normalize_numero_wr(e.get('numero_wr'))
+        if nr:
+            if nr in seen:
+                continue
+            seen.add(nr)
+            e = dict(e, numero_wr=nr)
+        out.append(e)
+    return out
+
+
+def entry_record(entry: Dict[str, Any], now: datetime) -> Optional[Dict[str, Any]]:
+    """Ingest engine record for a parsed entry; None when it has no WR number."""
+    numero_wr = normalize_numero_wr(entry.get('numero_wr'))
+    if not numero_wr:
+        return None
+    return {
+        "numero_wr": numero_wr,
+        "values": {k: entry.get(k) for k in ENTRY_COLUMNS if entry.get(k)},
+        "defaults": {"operatore": "unknown", "indirizzo": "unknown", "nome_cliente": "unknown",
+                     "tipo_lavoro": "attivazione", "stato": "aperto", "data_apertura": now},
+        "extra": entry.get('extra_fields') or {},
+    }
+
+
+def entry_confidence(entry: Dict[str, Any]) -> float:
+    """Rough 0..1 confidence that a parsed entry was read completely and correctly.
+
+    A WR number that normalizes to ``WR-<digits>`` weighs most (OCR misreads
+    leave letters in it), then customer name, address and a labelled match.
+    """
+    score = 0.0
+    numero_wr = normalize_numero_wr(entry.get('numero_wr'))
+    if numero_wr:
+        score += 0.5 if re.fullmatch(r"WR-\d{6,}", numero_wr) else 0.2
+    if entry.get('nome_cliente'):
+        score += 0.2
+    if entry.get('indirizzo'):
+        score += 0.2
+    if any(m.startswith('label:') for m in (entry.get('_parse_debug') or {}).get('methods', [])):
+        score += 0.1
+    return round(min(score, 1.0), 2)
+
+
+def iter_pdfs(paths: Iterable[str], recursive: bool = True) -> Iterator[str]:
+    for root in paths:
+        if os.path.isfile(root):
+            yield os.path.abspath(root)
+            continue
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if name.lower().endswith('.pdf'):
+                    yield os.path.abspath(os.path.join(dirpath, name))
+            if not recursive:
+                break
+
+
+def pending_files(db: Session, paths: Iterable[str], *, retry_failed: bool = False) -> List[str]:
+    """Files not in the ledger yet, skipping the ones already seen with the same path, size and mtime.
+
+    Files that changed (or were renamed) are returned; the content hash
+    decides whether they are really new once parsed.
+    """
+    paths = list(paths)
+    seen = set()
+    for chunk_start in range(0, len(paths), 500):
+        chunk = paths[chunk_start:chunk_start + 500]
+        query = db.query(ProcessedFile.path, ProcessedFile.size, ProcessedFile.mtime).filter(ProcessedFile.path.in_(chunk))
+        if retry_failed:
+            query = query.filter(ProcessedFile.status != "failed")
+        seen.update(tuple(row) for row in query)
+    out = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if (path, stat.st_size, stat.st_mtime) not in seen:
+            out.append(path)
+    return out
+
+
+class DocumentBatchWriter:
+    """Writes parsed files (``parse_file`` results) in batched transactions.
+
+    With ``min_confidence`` only entries scoring at least that much (see
+    ``entry_confidence``) are applied; the others stay on the document,
+    listed in ``parsed_data["pending_review"]``, for an operator to apply.
+    """
+
+    def __init__(self, db: Session, *, batch_size: int = DEFAULT_BATCH_SIZE, retry_failed: bool = False,
+                 min_confidence: Optional[float] = None,
+                 event_note: str = "pdf-archive"):
+        self.db = db
+        self.batch_size = max(1, batch_size)
+        self.retry_failed = retry_failed
+        self.min_confidence = min_confidence
+        self.event_note = event_note
+        self.stats = {"files": 0, "documents": 0, "duplicates": 0, "failed": 0, "entries": 0, "works": 0, "work_errors": 0}
+        self._batch: List[Dict[str, Any]] = []
+
+    def add(self, parsed: Dict[str, Any]) -> None:
+        self._batch.append(parsed)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+        self.stats["files"] += len(batch)
+        known = self._ledger([p["sha256"] for p in batch if p.get("sha256")])
+        fresh, duplicates, seen = [], [], set()
+        for parsed in batch:
+            digest = parsed.get("sha256")
+            status = known.get(digest, (None, None))[0]
+            if digest in seen or status in ("parsed", "duplicate") or (status == "failed" and not self.retry_failed):
+                # same content as a file already ingested (or failed) under another path
+                duplicates.append(parsed)
+                continue
+            if digest:
+                seen.add(digest)
+            fresh.append(parsed)
+
+        now = datetime.now()
+        ingestor = WorkIngestor(self.db, extra_mode="merge", event_note=self.event_note)
+        owners: List[int] = []
+        for position, parsed in enumerate(fresh):
+            for entry in parsed.get("entries") or ():
+                if self.min_confidence is not None:
+                    entry["_confidence"] = entry_confidence(entry)
+                    if entry["_confidence"] < self.min_confidence:
+                        continue
+                record = entry_record(entry, now)
+                if record is not None:
+                    ingestor.add(len(owners), record)
+                    owners.append(position)
+        summary = ingestor.finish()
+        work_ids: List[List[int]] = [[] for _ in fresh]
+        for result in summary["results"]:
+            if result["work_id"] and result["work_id"] not in work_ids[owners[result["index"]]]:
+                work_ids[owners[result["index"]]].append(result["work_id"])
+        self.stats["works"] += summary["success_count"]
+        self.stats["work_errors"] += summary["error_count"]
+
+        if self.retry_failed:
+            self.db.query(ProcessedFile).filter(
+                ProcessedFile.sha256.in_([p["sha256"] for p in fresh if p.get("sha256")]), ProcessedFile.status == "failed"
+            ).delete(synchronize_session=False)
+        documents = {}
+        for parsed, ids in zip(fresh, work_ids):
+            documents[parsed.get("sha256")] = self._write_file(parsed, ids, now)
+        for parsed in duplicates:
+            self.stats["duplicates"] += 1
+            document_id = documents.get(parsed["sha256"]) or known.get(parsed["sha256"], (None, None))[1]
+            self.db.add(ProcessedFile(sha256=parsed["sha256"], path=parsed["path"], size=parsed["size"], mtime=parsed["mtime"],
+                                      status="duplicate", document_id=document_id, processed_at=now))
+        self.db.commit()
+
+    def finish(self) -> Dict[str, int]:
+        self.flush()
+        return dict(self.stats)
+
+    def _ledger(self, digests: List[str]) -> Dict[str, Tuple[str, Optional[int]]]:
+        """Ledger status and document of each known hash (the ingested copy wins over duplicates)."""
+        known: Dict[str, Tuple[str, Optional[int]]] = {}
+        if digests:
+            rows = self.db.query(ProcessedFile.sha256, ProcessedFile.status, ProcessedFile.document_id).filter(ProcessedFile.sha256.in_(set(digests)))
+            for digest, status, document_id in rows:
+                if digest not in known or status == "parsed":
+                    known[digest] = (status, document_id)
+        return known
+
+    def _write_file(self, parsed: Dict[str, Any], work_ids: List[int], now: datetime) -> Optional[int]:
+        if parsed["error"]:
+            self.stats["failed"] += 1
+            logger.warning("Cannot ingest %s: %s", parsed["path"], parsed["error"])
+            if parsed.get("sha256"):
+                # unreadable files have no hash and are simply tried again next time
+                self.db.add(ProcessedFile(sha256=parsed["sha256"], path=parsed["path"], size=parsed["size"], mtime=parsed["mtime"],
+                                          status="failed", error=parsed["error"], processed_at=now))
+            return None
+        entry = ProcessedFile(sha256=parsed["sha256"], path=parsed["path"], size=parsed["size"], mtime=parsed["mtime"], processed_at=now)
+        entries = parsed["entries"]
+        doc = Document(
+            filename=parsed["filename"], mime="application/pdf", content=parsed["content"], uploaded_at=now, parsed=True,
+            parsed_data={
+                "entries": entries,
+                "raw_text": parsed["text"],
+                "parse_debug": {
+                    "methods": sorted({m for e in entries for m in (e.get("_parse_debug") or {}).get("methods", [])} | ({"ocr"} if parsed["ocr_used"] else set())),
+                    "candidates": sorted({c for e in entries for c in (e.get("_parse_debug") or {}).get("candidates", [])}),
+                    "source": parsed["path"],
+                },
+                "applied_work_ids": work_ids,
+            },
+            applied_work_id=work_ids[0] if work_ids else None,
+        )
+        if self.min_confidence is not None:
+            doc.parsed_data["pending_review"] = [i for i, e in enumerate(entries) if e["_confidence"] < self.min_confidence]
+        self.db.add(doc)
+        self.db.flush()
+        doc_pages.store(self.db, doc.id, parsed["pages"])
+        self.db.add_all(DocumentAppliedWork(document_id=doc.id, work_id=work_id, applied_at=now) for work_id in work_ids)
+        entry.status, entry.document_id, entry.entries = "parsed", doc.id, len(entries)
+        self.db.add(entry)
+        self.stats["documents"] += 1
+        self.stats["entries"] += len(entries)
+        return doc.id
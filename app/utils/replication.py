@@ -0,0 +1,519 @@
+"""Bidirectional replication of works, ONTs and modems with a remote node.
+
+Rows are matched across databases by natural key (``numero_wr``,
+``serial_number``); references are carried the same way (technicians by
+name, works by WR number), never by local id.
+
+The remote node is a plain server: ``/manual/sync/pull`` exports its
+``change_log`` deltas after a cursor (``export_changes``) and
+``/manual/sync/push`` applies a batch with a compare-and-set on the row
+hash (``apply_push``), rejecting rows that changed there in the meantime.
+The node running ``SyncEngine`` resolves every conflict:
+
+1. pull: remote batches are applied locally and the cursor is stored in
+   the same transaction, so an interrupted run resumes where it stopped;
+2. push: local changes after the push cursor (and rows left pending) are
+   sent with the hash of the last state both sides agreed on; rows the
+   remote rejects come back with its current state, are merged, and are
+   pushed again.
+
+Conflicts (both sides changed a row since the last agreed state, kept in
+``sync_rows``) are resolved per field (``merge``: fields changed on one
+side only are kept, fields changed on both go to the later writer) or per
+row (``lww``). Batches travel as gzip-compressed JSON.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import socket
+from collections import Counter
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import DateTime, event, func, inspect
+from sqlalchemy.orm import Session
+
+from app.models.models import ChangeLog, Modem, ONT, SyncPeer, SyncRow, SyncTombstone, Technician, Work
+from app.utils import changes
+
+logger = logging.getLogger("app.utils.replication")
+
+NODE_NAME = os.getenv("SYNC_NODE_NAME") or socket.gethostname()
+CONFLICT_POLICY = os.getenv("SYNC_CONFLICT_POLICY") or "merge"  # merge, lww
+BATCH_SIZE = int(os.getenv("SYNC_BATCH_SIZE") or 500)
+# Push rounds per run: a rejected row is merged and sent again at most this often
+MAX_PUSH_ROUNDS = 3
+
+# Apply order: works first, so ONT/modem references to them resolve
+MODELS = {"work": Work, "ont": ONT, "modem": Modem}
+KEY_FIELDS = {"work": "numero_wr", "ont": "serial_number", "modem": "serial_number"}
+_ENTITY_NAMES = {model: name for name, model in MODELS.items()}
+_ORDER = {name: i for i, name in enumerate(MODELS)}
+# updated_at and version are rewritten by every UPDATE: node-local bookkeeping, not replicated
+EXCLUDED = {"id", "updated_at", "version"}
+TECHNICIAN_REFS = {"tecnico_assegnato_id": "tecnico_assegnato", "tecnico_chiusura_id": "tecnico_chiusura"}
+_TECHNICIAN_COLUMNS = {ref: column for column, ref in TECHNICIAN_REFS.items()}
+DELETED = "deleted"  # state hash of a missing row
+
+
+@event.listens_for(Session, "before_flush")
+def _record_tombstones(session, flush_context, instances):
+    for obj in list(session.deleted):
+        entity = _ENTITY_NAMES.get(type(obj))
+        if entity is not None and obj.id is not None:
+            session.add(SyncTombstone(entity=entity, entity_id=obj.id, key=getattr(obj, KEY_FIELDS[entity])))
+
+
+# ---- payloads ----
+
+def encode_payload(payload: Dict[str, Any]) -> bytes:
+    return gzip.compress(json.dumps(jsonable_encoder(payload), separators=(",", ":")).encode("utf-8"), compresslevel=6)
+
+
+def decode_payload(body: bytes, content_encoding: Optional[str] = None) -> Dict[str, Any]:
+    if content_encoding and "gzip" in content_encoding.lower():
+        body = gzip.decompress(body)
+    return json.loads(body or b"{}")
+
+
+def state_hash(data: Optional[Dict[str, Any]]) -> str:
+    if data is None:
+        return DELETED
+    return hashlib.sha256(json.dumps(data, sort_keys=True, separators=(",", ":"), default=str).encode("utf-8")).hexdigest()
+
+
+# ---- portable rows ----
+
+class _Refs:
+    """Translates local foreign keys to natural references and back (cached per batch)."""
+
+    def __init__(self, db: Session):
+        self.db = db
+        self._technicians: Dict[int, Optional[List[str]]] = {}
+        self._technician_ids: Dict[Tuple[str, str], int] = {}
+        self._work_keys: Dict[int, Optional[str]] = {}
+
+    def technician_ref(self, technician_id: Optional[int]) -> Optional[List[str]]:
+        if technician_id is None:
+            return None
+        if technician_id not in self._technicians:
+            tech = self.db.query(Technician.nome, Technician.cognome).filter(Technician.id == technician_id).first()
+            self._technicians[technician_id] = [tech.nome or "", tech.cognome or ""] if tech else None
+        return self._technicians[technician_id]
+
+    def technician_id(self, ref: Optional[List[str]]) -> Optional[int]:
+        """Local technician with that name; created when this node does not know them yet."""
+        if not ref:
+            return None
+        nome, cognome = ref
+        lookup = (nome.casefold(), cognome.casefold())
+        if lookup not in self._technician_ids:
+            tech = self.db.query(Technician).filter(
+                func.lower(Technician.nome) == lookup[0], func.lower(Technician.cognome) == lookup[1]
+            ).order_by(Technician.id).first()
+            if tech is None:
+                tech = Technician(nome=nome, cognome=cognome)
+                self.db.add(tech)
+                self.db.flush()
+            self._technician_ids[lookup] = tech.id
+        return self._technician_ids[lookup]
+
+    def work_key(self, work_id: Optional[int]) -> Optional[str]:
+        if work_id is None:
+            return None
+        if work_id not in self._work_keys:
+            self._work_keys[work_id] = self.db.query(Work.numero_wr).filter(Work.id == work_id).scalar()
+        return self._work_keys[work_id]
+
+    def work_id(self, key: Optional[str]) -> Optional[int]:
+        if key is None:
+            return None
+        return self.db.query(Work.id).filter(Work.numero_wr == key).scalar()
+
+
+def portable(refs: _Refs, entity: str, obj) -> Dict[str, Any]:
+    """Column values of ``obj`` without local ids: the form exchanged and hashed."""
+    values = {}
+    for attr in inspect(obj).mapper.column_attrs:
+        if attr.key in EXCLUDED:
+            continue
+        value = getattr(obj, attr.key)
+        if attr.key in TECHNICIAN_REFS:
+            values[TECHNICIAN_REFS[attr.key]] = refs.technician_ref(value)
+        elif attr.key == "work_id":
+            values["work"] = refs.work_key(value)
+        else:
+            values[attr.key] = value
+    return jsonable_encoder(values)
+
+
+def _columns(refs: _Refs, entity: str, data: Dict[str, Any]) -> Dict[str, Any]:
+    columns = {c.key: c for c in MODELS[entity].__table__.columns}
+    values = {}
+    for key, value in data.items():
+        if key in _TECHNICIAN_COLUMNS:
+            values[_TECHNICIAN_COLUMNS[key]] = refs.technician_id(value)
+        elif key == "work" and entity != "work":
+            values["work_id"] = refs.work_id(value)
+        elif key in columns and key not in EXCLUDED:
+            if isinstance(value, str) and isinstance(columns[key].type, DateTime):
+                value = datetime.fromisoformat(value)
+            values[key] = value
+    return values
+
+
+def _find(db: Session, entity: str, key: str):
+    model = MODELS[entity]
+    return db.query(model).filter(getattr(model, KEY_FIELDS[entity]) == key).first()
+
+
+def _write(db: Session, refs: _Refs, entity: str, obj, data: Optional[Dict[str, Any]]) -> None:
+    if data is None:
+        if obj is not None:
+            db.delete(obj)
+    elif obj is None:
+        db.add(MODELS[entity](**_columns(refs, entity, data)))
+    else:
+        for column, value in _columns(refs, entity, data).items():
+            setattr(obj, column, value)
+    db.flush()
+
+
+def _local_time(db: Session, entity: str, obj, key: str) -> Optional[datetime]:
+    """When this node last wrote the row (or deleted it)."""
+    if obj is not None:
+        return db.query(func.max(ChangeLog.changed_at)).filter(
+            ChangeLog.entity == entity, ChangeLog.entity_id == obj.id
+        ).scalar()
+    return db.query(func.max(SyncTombstone.deleted_at)).filter(
+        SyncTombstone.entity == entity, SyncTombstone.key == key
+    ).scalar()
+
+
+def _remote_wins(remote_at: Optional[str], remote_node: str, local_at: Optional[datetime], local_node: str) -> bool:
+    if local_at is None:
+        return True
+    if not remote_at:
+        return False
+    remote = datetime.fromisoformat(remote_at)
+    if remote != local_at:
+        return remote > local_at
+    return remote_node > local_node  # same instant: a fixed, node-independent order
+
+
+def merge_fields(base: Dict[str, Any], local: Dict[str, Any], remote: Dict[str, Any], remote_wins: bool) -> Dict[str, Any]:
+    """Three-way merge: one-sided changes are kept, fields changed on both sides go to the winner."""
+    merged = dict(local)
+    for field in set(local) | set(remote):
+        mine, theirs, common = local.get(field), remote.get(field), base.get(field)
+        if mine == theirs:
+            continue
+        if mine == common or (theirs != common and remote_wins):
+            merged[field] = theirs
+    return merged
+
+
+# ---- server side ----
+
+def export_changes(db: Session, since: int = 0, limit: int = BATCH_SIZE) -> Dict[str, Any]:
+    """Changes of synced rows after ``since``, by natural key (the answer to /sync/pull)."""
+    feed = changes.fetch_changes(db, since, limit, entities=list(MODELS))
+    result = {"node": NODE_NAME, "since": since, "cursor": feed["cursor"], "has_more": feed["has_more"],
+              "reset": feed["reset"], "changes": []}
+    wanted: Dict[str, List[int]] = {}
+    for change in feed["changes"]:
+        wanted.setdefault(change["entity"], []).append(change["id"])
+    rows, tombstones, written = {}, {}, {}
+    for entity, ids in wanted.items():
+        model = MODELS[entity]
+        for obj in db.query(model).filter(model.id.in_(ids)):
+            rows[(entity, obj.id)] = obj
+        # the data sent is the row as it is now, so its time is the row's latest write, not the entry's
+        for entity_id, changed_at in db.query(ChangeLog.entity_id, func.max(ChangeLog.changed_at)).filter(
+            ChangeLog.entity == entity, ChangeLog.entity_id.in_(ids)
+        ).group_by(ChangeLog.entity_id):
+            written[(entity, entity_id)] = changed_at
+        for entity_id, key in db.query(SyncTombstone.entity_id, SyncTombstone.key).filter(
+            SyncTombstone.entity == entity, SyncTombstone.entity_id.in_(ids)
+        ).order_by(SyncTombstone.id):
+            tombstones[(entity, entity_id)] = key
+    refs = _Refs(db)
+    for change in feed["changes"]:
+        obj = rows.get((change["entity"], change["id"]))
+        if change["op"] == "upsert" and obj is not None:
+            data = portable(refs, change["entity"], obj)
+            key = data[KEY_FIELDS[change["entity"]]]
+        else:
+            data, key = None, tombstones.get((change["entity"], change["id"]))
+        if key is None:
+            continue  # deleted before tombstones were recorded, or a row without a natural key
+        changed_at = written.get((change["entity"], change["id"]))
+        result["changes"].append({"entity": change["entity"], "key": key, "op": "upsert" if data else "delete", "data": data,
+                                  "changed_at": jsonable_encoder(changed_at) if changed_at else change["changed_at"]})
+    return result
+
+
+def apply_push(db: Session, entries: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """Apply a pushed batch; a row is written only if it still has the state the sender based its change on."""
+    refs = _Refs(db)
+    accepted, rejected = [], []
+    for change in sorted(entries, key=lambda c: _ORDER[c["entity"]]):
+        entity, key = change["entity"], change["key"]
+        obj = _find(db, entity, key)
+        current = portable(refs, entity, obj) if obj is not None else None
+        current_hash, incoming = state_hash(current), change.get("data")
+        if current_hash in (change.get("base_hash"), state_hash(incoming)):
+            if current_hash != state_hash(incoming):
+                _write(db, refs, entity, obj, incoming)
+            accepted.append({"entity": entity, "key": key})
+        else:
+            rejected.append({"entity": entity, "key": key, "op": "upsert" if current else "delete", "data": current,
+                             "changed_at": jsonable_encoder(_local_time(db, entity, obj, key))})
+    db.commit()
+    return {"node": NODE_NAME, "accepted": accepted, "rejected": rejected}
+
+
+# ---- client side ----
+
+def _metas(db: Session, peer: str, entries: Iterable[Dict[str, Any]]) -> Dict[Tuple[str, str], SyncRow]:
+    keys: Dict[str, set] = {}
+    for change in entries:
+        keys.setdefault(change["entity"], set()).add(change["key"])
+    metas = {}
+    for entity, entity_keys in keys.items():
+        for meta in db.query(SyncRow).filter(SyncRow.peer == peer, SyncRow.entity == entity, SyncRow.key.in_(entity_keys)):
+            metas[(entity, meta.key)] = meta
+    return metas
+
+
+def _agree(db: Session, metas, peer: str, entity: str, key: str, data: Optional[Dict[str, Any]], pending: bool) -> None:
+    meta = metas.get((entity, key))
+    if meta is None:
+        meta = metas[(entity, key)] = SyncRow(peer=peer, entity=entity, key=key)
+        db.add(meta)
+    meta.base, meta.base_hash, meta.pending = data, state_hash(data), pending
+
+
+def apply_remote(db: Session, peer: str, entries: List[Dict[str, Any]], policy: str = CONFLICT_POLICY,
+                 remote_node: str = "") -> Counter:
+    """Apply remote row states locally, resolving conflicts against the last agreed state. Does not commit."""
+    stats: Counter = Counter()
+    refs = _Refs(db)
+    metas = _metas(db, peer, entries)
+    for change in sorted(entries, key=lambda c: _ORDER[c["entity"]]):
+        entity, key = change["entity"], change["key"]
+        incoming = change.get("data") if change["op"] == "upsert" else None
+        incoming_hash = state_hash(incoming)
+        meta = metas.get((entity, key))
+        if meta is not None and meta.base_hash == incoming_hash:
+            stats["skipped"] += 1  # nothing new on the remote (often the echo of our own push)
+            continue
+        obj = _find(db, entity, key)
+        local = portable(refs, entity, obj) if obj is not None else None
+        local_hash = state_hash(local)
+        if local_hash in (incoming_hash, meta.base_hash if meta else DELETED):
+            result = incoming  # unchanged here since the last agreement
+        else:
+            stats["conflicts"] += 1
+            remote_wins = _remote_wins(change.get("changed_at"), remote_node, _local_time(db, entity, obj, key), NODE_NAME)
+            if policy == "merge" and local is not None and incoming is not None:
+                result = merge_fields((meta.base if meta else None) or {}, local, incoming, remote_wins)
+            else:
+                result = incoming if remote_wins else local
+        if state_hash(result) != local_hash:
+            _write(db, refs, entity, obj, result)
+            stats["applied"] += 1
+        _agree(db, metas, peer, entity, key, incoming, pending=state_hash(result) != incoming_hash)
+    return stats
+
+
+def collect_push(db: Session, peer: str, since: int, limit: int = BATCH_SIZE) -> Tuple[List[Dict[str, Any]], int, bool]:
+    """Local changes after ``since`` plus rows left pending, minus those the peer already has."""
+    feed = export_changes(db, since, limit)
+    candidates = {(c["entity"], c["key"]): c for c in feed["changes"]}
+    refs = _Refs(db)
+    for meta in db.query(SyncRow).filter(SyncRow.peer == peer, SyncRow.pending.is_(True)):
+        if (meta.entity, meta.key) not in candidates:
+            obj = _find(db, meta.entity, meta.key)
+            data = portable(refs, meta.entity, obj) if obj is not None else None
+            candidates[(meta.entity, meta.key)] = {
+                "entity": meta.entity, "key": meta.key, "op": "upsert" if data else "delete", "data": data,
+                "changed_at": jsonable_encoder(_local_time(db, meta.entity, obj, meta.key)),
+            }
+    metas = _metas(db, peer, candidates.values())
+    items = []
+    for (entity, key), change in candidates.items():
+        meta = metas.get((entity, key))
+        base_hash = meta.base_hash if meta else DELETED
+        if state_hash(change["data"]) == base_hash:
+            if meta is not None:
+                meta.pending = False
+            continue
+        items.append(dict(change, base_hash=base_hash))
+    return items, feed["cursor"], feed["has_more"]
+
+
+class LocalPeer:
+    """A node served from a session factory in this process (two local SQLite files, tests).
+
+    Payloads go through the same gzip/JSON encoding as over HTTP.
+    """
+
+    def __init__(self, session_factory: Callable[[], Session], name: str = "local"):
+        self.session_factory = session_factory
+        self.name = name
+
+    def _call(self, fn, payload):
+        db = self.session_factory()
+        try:
+            result = fn(db, decode_payload(encode_payload(payload), "gzip"))
+        finally:
+            db.close()
+        result["node"] = self.name
+        return decode_payload(encode_payload(result), "gzip")
+
+    def pull(self, since: int, limit: int) -> Dict[str, Any]:
+        return self._call(lambda db, body: export_changes(db, body["since"], body["limit"]), {"since": since, "limit": limit})
+
+    def push(self, entries: List[Dict[str, Any]]) -> Dict[str, Any]:
+        return self._call(lambda db, body: apply_push(db, body["changes"]), {"node": NODE_NAME, "changes": entries})
+
+
+class HttpPeer:
+    """A node reached through its Yggdrasil API (``SYNC_PEER_URL``, e.g. http://[200:...]:6040/manual)."""
+
+    def __init__(self, url: str, api_key: str, timeout: float = 60.0):
+        import httpx
+        self.name = url.rstrip("/")
+        self.client = httpx.Client(base_url=self.name, timeout=timeout, headers={
+            "X-KEY": api_key, "Content-Type": "application/json", "Content-Encoding": "gzip", "Accept-Encoding": "gzip",
+        })
+
+    def _post(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        response = self.client.post(path, content=encode_payload(payload))
+        response.raise_for_status()
+        return response.json()
+
+    def pull(self, since: int, limit: int) -> Dict[str, Any]:
+        return self._post("/sync/pull", {"node": NODE_NAME, "since": since, "limit": limit})
+
+    def push(self, entries: List[Dict[str, Any]]) -> Dict[str, Any]:
+        return self._post("/sync/push", {"node": NODE_NAME, "changes": entries})
+
+
+class SyncEngine:
+    """Runs pull-then-push rounds against one peer; every batch commits with its cursor."""
+
+    def __init__(self, session_factory: Callable[[], Session], peer, *, policy: str = CONFLICT_POLICY,
+                 batch_size: int = BATCH_SIZE, progress: Optional[Callable[[int, str], None]] = None):
+        if policy not in ("merge", "lww"):
+            raise ValueError(f"Unknown conflict policy: {policy}")
+        self.session_factory = session_factory
+        self.peer = peer
+        self.policy = policy
+        self.batch_size = batch_size
+        self.progress = progress or (lambda pct, msg: None)
+
+    def run(self) -> Dict[str, int]:
+        stats: Counter = Counter()
+        try:
+            self._pull(stats)
+            self._push(stats)
+        except Exception as e:
+            self._update_state(last_error=f"{type(e).__name__}: {e}")
+            raise
+        self._update_state(last_error=None, last_sync_at=datetime.utcnow())
+        logger.info("Sync with %s done: %s", self.peer.name, dict(stats))
+        return dict(stats)
+
+    def _state(self, db: Session) -> SyncPeer:
+        state = db.query(SyncPeer).filter(SyncPeer.name == self.peer.name).first()
+        if state is None:
+            state = SyncPeer(name=self.peer.name, pull_cursor=0, push_cursor=0)
+            db.add(state)
+            db.flush()
+        return state
+
+    def _update_state(self, **values) -> None:
+        db = self.session_factory()
+        try:
+            state = self._state(db)
+            for key, value in values.items():
+                setattr(state, key, value)
+            db.commit()
+        finally:
+            db.close()
+
+    def _pull(self, stats: Counter) -> None:
+        reset_done = False
+        while True:
+            db = self.session_factory()
+            try:
+                state = self._state(db)
+                batch = self.peer.pull(state.pull_cursor, self.batch_size)
+                if batch.get("reset") and not reset_done:
+                    # the peer is behind our cursor (restored from a backup): start over, hashes skip what we have
+                    logger.warning("Peer %s reset its change feed; pulling from the start", self.peer.name)
+                    state.pull_cursor, reset_done = 0, True
+                    db.commit()
+                    continue
+                stats.update({f"pull_{k}": v for k, v in apply_remote(db, self.peer.name, batch["changes"], self.policy,
+                                                                     batch.get("node", "")).items()})
+                stats["pulled"] += len(batch["changes"])
+                state.pull_cursor = batch["cursor"]
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+            self.progress(40 if batch["has_more"] else 50, f"Pulled {stats['pulled']} changes")
+            if not batch["has_more"]:
+                return
+
+    def _push(self, stats: Counter) -> None:
+        rounds = 0
+        while True:
+            db = self.session_factory()
+            try:
+                state = self._state(db)
+                items, cursor, has_more = collect_push(db, self.peer.name, state.push_cursor, self.batch_size)
+                if items:
+                    response = self.peer.push(items)
+                    sent = {(i["entity"], i["key"]): i for i in items}
+                    metas = _metas(db, self.peer.name, items)
+                    for done in response["accepted"]:
+                        _agree(db, metas, self.peer.name, done["entity"], done["key"],
+                               sent[(done["entity"], done["key"])]["data"], pending=False)
+                    # rows changed on the peer meanwhile come back with its state: merge them now, push next round
+                    merged = apply_remote(db, self.peer.name, response["rejected"], self.policy, response.get("node", ""))
+                    stats.update({f"push_{k}": v for k, v in merged.items()})
+                    stats["pushed"] += len(response["accepted"])
+                    stats["rejected"] += len(response["rejected"])
+                state.push_cursor = cursor
+                db.commit()
+                pending = db.query(SyncRow.id).filter(SyncRow.peer == self.peer.name, SyncRow.pending.is_(True)).first()
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+            self.progress(90 if has_more else 100, f"Pushed {stats['pushed']} changes")
+            if has_more:
+                continue
+            rounds += 1
+            if pending is None or rounds >= MAX_PUSH_ROUNDS:
+                if pending is not None:
+                    stats["pending"] += 1
+                return
+
+
+def peer_from_env():
+    """The HttpPeer configured by SYNC_PEER_URL / SYNC_PEER_KEY."""
+    url = os.getenv("SYNC_PEER_URL")
+    if not url:
+        raise RuntimeError("SYNC_PEER_URL is not set: no replication peer configured")
+    return HttpPeer(url, os.getenv("SYNC_PEER_KEY") or os.getenv("YGG_API_KEY") or "")
@@ -0,0 +1,27 @@
+"""Database bootstrap shared by every entrypoint (API, worker, watcher, ingest script, Yggdrasil).
+
+There are no migrations: ``init_schema`` creates the missing tables, adds the
+columns and indexes introduced after a database was first created, and
+backfills the derived tables (search index, fuzzy keys, journal, work areas)
+when they are still empty. Every step is idempotent and cheap when there is
+nothing to do, so it runs at each start. Importing this module also
+registers the session hooks of those modules.
+"""
+from sqlalchemy.engine import Engine
+
+from app.models import models
+from app.utils import changes, concurrency, dispatch, fuzzy, geocode, inventory, jobs, journal, search
+
+
+def init_schema(engine: Engine) -> None:
+    models.Base.metadata.create_all(bind=engine)
+    changes.ensure_epoch(engine)
+    # columns and indexes first: the backfills below read them
+    concurrency.ensure_columns(engine)
+    dispatch.ensure_columns(engine)
+    inventory.ensure_schema(engine)
+    jobs.ensure_schema(engine)
+    journal.ensure_migrated(engine)
+    search.ensure_index(engine)
+    fuzzy.ensure_keys(engine)
+    geocode.ensure_index(engine)
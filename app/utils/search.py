@@ -0,0 +1,317 @@
+"""Full-text search over works and parsed documents.
+
+Two backends share one interface:
+
+* SQLite: an FTS5 virtual table ``search_fts`` (bm25 ranking, ``snippet()``
+  highlighting, prefix indexes so partial WR numbers and names match);
+* PostgreSQL: a ``search_documents`` table with a weighted ``tsvector``
+  column behind a GIN index (``ts_rank_cd`` / ``ts_headline``).
+
+Indexed per work: numero_wr, nome_cliente, indirizzo, note and the values of
+extra_fields; per document: filename and ``parsed_data['raw_text']``. Rows
+are keyed by ``id * 2`` (works) and ``id * 2 + 1`` (documents) so updates
+are primary-key deletes and inserts. The index is refreshed with
+INSERT ... SELECT from the source tables inside the writing transaction: ORM
+writes through a Session ``after_flush`` hook, Core bulk writes (the ingest
+engine) through ``reindex``.
+"""
+import html
+import logging
+import re
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+
+from sqlalchemy import bindparam, event, inspect as sa_inspect, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+
+from app.models.models import Document, Work
+
+logger = logging.getLogger("app.utils.search")
+
+KINDS = ("work", "document")
+MAX_TERMS = 8
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+# Private-use markers survive html.escape and are turned into <mark> afterwards
+_START, _STOP = "\ue000", "\ue001"
+
+_ready: Dict[str, str] = {}  # engine url -> backend name
+_ready_lock = threading.Lock()
+
+_SQLITE_DDL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+    ref, nome_cliente, indirizzo, note, extra, body,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3 4'
+)
+"""
+_SQLITE_SOURCES = {
+    "work": """
+        SELECT id * 2, numero_wr, nome_cliente, indirizzo, note,
+               (SELECT group_concat(value, ' ') FROM json_each(works.extra_fields)), NULL
+        FROM works WHERE {where}
+    """,
+    "document": """
+        SELECT id * 2 + 1, filename, NULL, NULL, NULL, NULL, json_extract(parsed_data, '$.raw_text')
+        FROM documents WHERE {where}
+    """,
+}
+
+_PG_DDL = (
+    """
+    CREATE TABLE IF NOT EXISTS search_documents (
+        id BIGINT PRIMARY KEY,
+        ref TEXT, nome_cliente TEXT, indirizzo TEXT, note TEXT, extra TEXT, body TEXT,
+        tsv TSVECTOR
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_search_documents_tsv ON search_documents USING GIN (tsv)",
+)
+_PG_TSV = """
+    setweight(to_tsvector('simple', coalesce(src.ref, '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce(src.nome_cliente, '')), 'B') ||
+    setweight(to_tsvector('simple', coalesce(src.indirizzo, '')), 'B') ||
+    setweight(to_tsvector('simple', concat_ws(' ', src.note, src.extra)), 'C') ||
+    setweight(to_tsvector('simple', coalesce(src.body, '')), 'D')
+"""
+_PG_SOURCES = {
+    "work": """
+        SELECT id * 2 AS id, numero_wr AS ref, nome_cliente, indirizzo, note,
+               CASE WHEN json_typeof(extra_fields) = 'object'
+                    THEN (SELECT string_agg(value, ' ') FROM json_each_text(works.extra_fields)) END AS extra,
+               NULL AS body
+        FROM works WHERE {where}
+    """,
+    "document": """
+        SELECT id * 2 + 1 AS id, filename AS ref, NULL AS nome_cliente, NULL AS indirizzo, NULL AS note,
+               NULL AS extra, parsed_data ->> 'raw_text' AS body
+        FROM documents WHERE {where}
+    """,
+}
+
+
+def _key(kind: str, ref_id: int) -> int:
+    return ref_id * 2 + (1 if kind == "document" else 0)
+
+
+def _backend_for(conn: Connection) -> str:
+    url = str(conn.engine.url)
+    backend = _ready.get(url)
+    if backend is None:
+        with _ready_lock:
+            backend = _ready.get(url) or _create(conn)
+            _ready[url] = backend
+    return backend
+
+
+def _create(conn: Connection) -> str:
+    dialect = conn.dialect.name
+    if dialect == "sqlite":
+        try:
+            conn.exec_driver_sql(_SQLITE_DDL)
+            return "fts5"
+        except Exception:
+            logger.warning("SQLite built without FTS5, falling back to LIKE search")
+            return "like"
+    if dialect == "postgresql":
+        for statement in _PG_DDL:
+            conn.exec_driver_sql(statement)
+        return "tsvector"
+    return "like"
+
+
+def ensure_index(engine: Engine) -> str:
+    """Create the index if needed and fill it when empty (startup). Returns the backend name."""
+    with engine.begin() as conn:
+        backend = _backend_for(conn)
+        if backend == "like":
+            return backend
+        table = "search_fts" if backend == "fts5" else "search_documents"
+        if conn.execute(text(f"SELECT 1 FROM {table} LIMIT 1")).first() is None:
+            for kind in KINDS:
+                _index(conn, backend, kind, None)
+    return backend
+
+
+def _index(conn: Connection, backend: str, kind: str, ids: Optional[List[int]]) -> None:
+    """(Re)write the index rows of ``ids`` (all rows when None) from the source tables."""
+    where = "id IN :ids" if ids is not None else "1 = 1"
+    params = {"ids": ids} if ids is not None else {}
+    if ids is not None:
+        _remove(conn, backend, kind, ids)
+    if backend == "fts5":
+        sql = "INSERT INTO search_fts (rowid, ref, nome_cliente, indirizzo, note, extra, body) " + _SQLITE_SOURCES[kind].format(where=where)
+    else:
+        sql = (
+            "INSERT INTO search_documents (id, ref, nome_cliente, indirizzo, note, extra, body, tsv) "
+            f"SELECT src.*, {_PG_TSV} FROM ({_PG_SOURCES[kind].format(where=where)}) AS src"
+        )
+    stmt = text(sql)
+    if ids is not None:
+        stmt = stmt.bindparams(bindparam("ids", expanding=True))
+    conn.execute(stmt, params)
+
+
+def _remove(conn: Connection, backend: str, kind: str, ids: List[int]) -> None:
+    table, column = ("search_fts", "rowid") if backend == "fts5" else ("search_documents", "id")
+    conn.execute(text(f"DELETE FROM {table} WHERE {column} IN :keys").bindparams(bindparam("keys", expanding=True)),
+                 {"keys": [_key(kind, i) for i in ids]})
+
+
+def rebuild(db: Session) -> str:
+    """Drop and rewrite the whole index from the source tables (``sync`` job). Returns the backend name."""
+    conn = db.connection()
+    backend = _backend_for(conn)
+    if backend != "like":
+        conn.execute(text("DELETE FROM search_fts" if backend == "fts5" else "DELETE FROM search_documents"))
+        for kind in KINDS:
+            _index(conn, backend, kind, None)
+    return backend
+
+
+def reindex(db: Session, kind: str, ids: Iterable[int]) -> None:
+    """Refresh the index for rows written outside the ORM unit of work (bulk Core statements)."""
+    ids = [i for i in ids if i is not None]
+    if not ids:
+        return
+    conn = db.connection()
+    backend = _backend_for(conn)
+    if backend != "like":
+        _index(conn, backend, kind, ids)
+
+
+@event.listens_for(Session, "after_flush")
+def _index_flushed(session, flush_context):
+    touched: Dict[str, set] = {"work": set(), "document": set()}
+    removed: Dict[str, set] = {"work": set(), "document": set()}
+    for objects, target, dirty in ((session.new, touched, False), (session.dirty, touched, True), (session.deleted, removed, False)):
+        for obj in objects:
+            kind = "work" if isinstance(obj, Work) else "document" if isinstance(obj, Document) else None
+            if kind is None or obj.id is None or (dirty and not _search_fields_changed(obj, kind)):
+                continue
+            target[kind].add(obj.id)
+    if not any(touched.values()) and not any(removed.values()):
+        return
+    conn = session.connection()
+    backend = _backend_for(conn)
+    if backend == "like":
+        return
+    for kind in KINDS:
+        if removed[kind]:
+            _remove(conn, backend, kind, sorted(removed[kind]))
+        if touched[kind]:
+            _index(conn, backend, kind, sorted(touched[kind]))
+
+
+_WORK_FIELDS = ("numero_wr", "nome_cliente", "indirizzo", "note", "extra_fields")
+_DOCUMENT_FIELDS = ("filename", "parsed_data")
+
+
+def _search_fields_changed(obj, kind: str) -> bool:
+    attrs = sa_inspect(obj).attrs
+    fields = _WORK_FIELDS if kind == "work" else _DOCUMENT_FIELDS
+    return any(attrs[name].history.has_changes() for name in fields)
+
+
+def _terms(query: str) -> List[str]:
+    return re.findall(r"\w+", query, re.UNICODE)[:MAX_TERMS]
+
+
+def _highlight(snippet: Optional[str]) -> Optional[str]:
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(_START, "<mark>").replace(_STOP, "</mark>")
+
+
+def search(db: Session, query: str, kind: Optional[str] = None, limit: int = DEFAULT_LIMIT) -> Dict[str, Any]:
+    """Ranked matches for ``query``; every term must match (prefix match)."""
+    terms = _terms(query)
+    if not terms:
+        return {"backend": None, "results": []}
+    conn = db.connection()
+    backend = _backend_for(conn)
+    if backend == "fts5":
+        hits = _search_fts5(conn, terms, kind, limit)
+    elif backend == "tsvector":
+        hits = _search_tsvector(conn, terms, kind, limit)
+    else:
+        hits = _search_like(db, terms, kind, limit)
+    return {"backend": backend, "results": _hydrate(db, hits)}
+
+
+def _kind_filter(column: str, kind: Optional[str]) -> str:
+    if kind == "work":
+        return f" AND {column} % 2 = 0"
+    if kind == "document":
+        return f" AND {column} % 2 = 1"
+    return ""
+
+
+def _search_fts5(conn: Connection, terms: List[str], kind: Optional[str], limit: int) -> List[Dict[str, Any]]:
+    match = " AND ".join('"{}"*'.format(t.replace('"', '""')) for t in terms)
+    rows = conn.execute(text(
+        "SELECT rowid, bm25(search_fts, 10.0, 5.0, 4.0, 1.0, 1.0, 0.5) AS score, "
+        f"snippet(search_fts, -1, '{_START}', '{_STOP}', '…', 12) AS snippet "
+        "FROM search_fts WHERE search_fts MATCH :match" + _kind_filter("rowid", kind) +
+        " ORDER BY score LIMIT :limit"
+    ), {"match": match, "limit": limit})
+    # bm25 is lower-is-better; flip it so every backend returns higher-is-better
+    return [{"key": r[0], "score": -r[1], "snippet": r[2]} for r in rows]
+
+
+def _search_tsvector(conn: Connection, terms: List[str], kind: Optional[str], limit: int) -> List[Dict[str, Any]]:
+    tsquery = " & ".join(f"{t}:*" for t in terms)
+    rows = conn.execute(text(
+        "SELECT hit.id, hit.score, ts_headline('simple', "
+        "concat_ws(' … ', s.ref, s.nome_cliente, s.indirizzo, s.note, s.extra, left(s.body, 5000)), hit.q, "
+        f"'StartSel={_START},StopSel={_STOP},MaxFragments=2,MaxWords=20,MinWords=5') "
+        "FROM (SELECT id, q, ts_rank_cd(tsv, q) AS score FROM search_documents, to_tsquery('simple', :q) AS q "
+        "WHERE tsv @@ q" + _kind_filter("id", kind) + " ORDER BY score DESC LIMIT :limit) AS hit "
+        "JOIN search_documents s ON s.id = hit.id ORDER BY hit.score DESC"
+    ), {"q": tsquery, "limit": limit})
+    return [{"key": r[0], "score": float(r[1]), "snippet": r[2]} for r in rows]
+
+
+def _search_like(db: Session, terms: List[str], kind: Optional[str], limit: int) -> List[Dict[str, Any]]:
+    """Unindexed fallback for databases without a full-text backend."""
+    from sqlalchemy import String, and_, cast, or_
+    hits = []
+    if kind in (None, "work"):
+        columns = (Work.numero_wr, Work.nome_cliente, Work.indirizzo, Work.note, cast(Work.extra_fields, String))
+        criteria = [or_(*[c.ilike(f"%{t}%") for c in columns]) for t in terms]
+        hits += [{"key": _key("work", i), "score": 0.0, "snippet": None} for (i,) in db.query(Work.id).filter(and_(*criteria)).limit(limit)]
+    if kind in (None, "document"):
+        columns = (Document.filename, cast(Document.parsed_data, String))
+        criteria = [or_(*[c.ilike(f"%{t}%") for c in columns]) for t in terms]
+        hits += [{"key": _key("document", i), "score": 0.0, "snippet": None} for (i,) in db.query(Document.id).filter(and_(*criteria)).limit(limit)]
+    return hits[:limit]
+
+
+def _hydrate(db: Session, hits: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    work_ids = [h["key"] // 2 for h in hits if h["key"] % 2 == 0]
+    doc_ids = [h["key"] // 2 for h in hits if h["key"] % 2 == 1]
+    works = {}
+    if work_ids:
+        works = {r.id: r for r in db.query(Work.id, Work.numero_wr, Work.nome_cliente, Work.indirizzo, Work.stato).filter(Work.id.in_(work_ids))}
+    docs = {}
+    if doc_ids:
+        docs = {r.id: r for r in db.query(Document.id, Document.filename, Document.uploaded_at).filter(Document.id.in_(doc_ids))}
+    results = []
+    for hit in hits:
+        ref_id = hit["key"] // 2
+        if hit["key"] % 2 == 0:
+            row = works.get(ref_id)
+            if row is None:
+                continue
+            result = {"kind": "work", "id": ref_id, "title": row.numero_wr,
+                      "subtitle": " - ".join(p for p in (row.nome_cliente, row.indirizzo) if p), "stato": row.stato}
+        else:
+            row = docs.get(ref_id)
+            if row is None:
+                continue
+            result = {"kind": "document", "id": ref_id, "title": row.filename, "subtitle": None, "stato": None}
+        result["score"] = round(hit["score"], 4)
+        result["snippet"] = _highlight(hit["snippet"])
+        results.append(result)
+    return results
@@ -1,11 +1,18 @@
 import os
+from functools import lru_cache
 from fastapi import Header, HTTPException
 
 
+@lru_cache(maxsize=None)
+def api_key() -> str | None:
+    """API_KEY from the environment, read once (on the first request, after .env is loaded)."""
+    return os.getenv("API_KEY")
+
+
 def verify_api_key(x_api_key: str | None = Header(None)):
-    api_key = os.getenv("API_KEY")
-    if not api_key:
+    key = api_key()
+    if not key:
         raise HTTPException(status_code=500, detail="API key not configured")
-    if x_api_key != api_key:
+    if x_api_key != key:
         raise HTTPException(status_code=403, detail="Invalid API Key")
     return True
@@ -34,3 +34,46 @@ def send_message_to_telegram(chat_id: Any, text: str, reply_markup: dict | None
     except Exception as e:
         logger.exception("Error sending telegram message: %s", e)
         return False
+
+
+def edit_message_text(chat_id: Any, message_id: int, text: str, reply_markup: dict | None = None) -> bool:
+    """Replace the text (and inline keyboard) of a message previously sent by the bot.
+
+    Returns True on success, False on failure.
+    """
+    token = os.getenv("TELEGRAM_BOT_TOKEN")
+    if not token:
+        logger.warning("TELEGRAM_BOT_TOKEN not set, skipping telegram message edit")
+        return False
+    if not httpx:
+        logger.warning("httpx not available, cannot edit telegram message")
+        return False
+    url = f"https://api.telegram.org/bot{token}/editMessageText"
+    payload = {"chat_id": int(chat_id), "message_id": int(message_id), "text": text}
+    if reply_markup is not None:
+        payload["reply_markup"] = reply_markup
+    try:
+        resp = httpx.post(url, json=payload, timeout=10.0)
+        resp.raise_for_status()
+        return True
+    except Exception as e:
+        logger.exception("Error editing telegram message: %s", e)
+        return False
+
+
+def answer_callback_query(callback_query_id: str, text: str | None = None) -> bool:
+    """Acknowledge an inline keyboard press so the client stops showing the loading spinner."""
+    token = os.getenv("TELEGRAM_BOT_TOKEN")
+    if not token or not httpx:
+        return False
+    url = f"https://api.telegram.org/bot{token}/answerCallbackQuery"
+    payload = {"callback_query_id": callback_query_id}
+    if text:
+        payload["text"] = text
+    try:
+        resp = httpx.post(url, json=payload, timeout=10.0)
+        resp.raise_for_status()
+        return True
+    except Exception as e:
+        logger.exception("Error answering telegram callback query: %s", e)
+        return False
@@ -0,0 +1,71 @@
+"""Unit of work for work mutations.
+
+A route collects everything one request changes — rows, journal entries,
+outbound notifications — and writes it with a single commit::
+
+    with UnitOfWork(db) as uow:
+        work.stato = "chiuso"
+        uow.event(work, journal.EventKind.CLOSED, journal.diff(work))
+        uow.notify(telegram_utils.send_message_to_telegram, chat_id, text)
+
+Leaving the block commits once (one fsync on SQLite) and only then runs the
+notifications, so nothing is announced for a write that did not happen; an
+exception rolls everything back and drops the notifications. A failing
+notification is logged, never raised: the data is already committed.
+"""
+import logging
+from functools import partial
+from typing import Any, Callable, List, Optional, Union
+
+from sqlalchemy.orm import Session
+
+from app.models.models import Work
+from app.utils import journal
+
+logger = logging.getLogger("app.utils.uow")
+
+
+class UnitOfWork:
+    def __init__(self, db: Session):
+        self.db = db
+        self._notifications: List[Callable[[], Any]] = []
+
+    def __enter__(self) -> "UnitOfWork":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        if exc_type is not None:
+            self.rollback()
+            return False
+        self.commit()
+        return False
+
+    def add(self, obj):
+        self.db.add(obj)
+        return obj
+
+    def event(self, work: Union[Work, int], kind: journal.EventKind, diff: Optional[dict] = None,
+              actor_id: Optional[int] = None, note: Optional[str] = None) -> None:
+        """Journal entry for ``work``, written by the same commit (take ``diff`` with ``journal.diff`` first)."""
+        journal.add(self.db, work, kind, diff, actor_id=actor_id, note=note)
+
+    def notify(self, fn: Callable, *args, **kwargs) -> None:
+        """Call ``fn(*args, **kwargs)`` once the transaction has committed."""
+        self._notifications.append(partial(fn, *args, **kwargs))
+
+    def commit(self) -> None:
+        try:
+            self.db.commit()
+        except Exception:
+            self.rollback()
+            raise
+        pending, self._notifications = self._notifications, []
+        for fn in pending:
+            try:
+                fn()
+            except Exception:
+                logger.exception("Notification after commit failed")
+
+    def rollback(self) -> None:
+        self._notifications = []
+        self.db.rollback()
@@ -0,0 +1,145 @@
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from sqlalchemy import event, func, inspect, or_
+from sqlalchemy.orm import Session
+
+from app.models.models import Work
+
+# Works in these states are hidden from /miei_lavori unless the technician asks for them
+CLOSED_STATES = ("chiuso",)
+PAGE_SIZE = 10
+CACHE_TTL_SECONDS = 300
+CALLBACK_PREFIX = "miei_lavori"
+# Telegram rejects messages longer than 4096 characters; keep a safety margin
+MAX_MESSAGE_CHARS = 4000
+MAX_LINE_CHARS = 300
+
+# tech_id -> {(page, include_closed): (expires_at, text, reply_markup)}
+_page_cache: Dict[int, Dict[Tuple[int, bool], Tuple[float, str, Optional[dict]]]] = {}
+_cache_lock = threading.Lock()
+# session.info key: technicians whose pages go stale when the transaction commits
+_STALE_KEY = "work_pages_stale_technicians"
+
+
+def parse_callback_data(data: str | None) -> Optional[Tuple[int, bool]]:
+    """Decode a ``miei_lavori:<page>:<scope>`` callback payload into (page, include_closed)."""
+    if not data or not data.startswith(CALLBACK_PREFIX + ":"):
+        return None
+    parts = data.split(":")
+    try:
+        page = int(parts[1])
+    except (IndexError, ValueError):
+        return None
+    include_closed = len(parts) > 2 and parts[2] == "all"
+    return max(page, 1), include_closed
+
+
+def _callback_data(page: int, include_closed: bool) -> str:
+    return f"{CALLBACK_PREFIX}:{page}:{'all' if include_closed else 'open'}"
+
+
+def _work_filter(tech_id: int, include_closed: bool):
+    criteria = [Work.tecnico_assegnato_id == tech_id]
+    if not include_closed:
+        # NULL stato counts as open; this stays a range scan on ix_works_tecnico_stato
+        criteria.append(or_(Work.stato.is_(None), Work.stato.notin_(CLOSED_STATES)))
+    return criteria
+
+
+def _render(db: Session, tech_id: int, page: int, include_closed: bool) -> Tuple[str, Optional[dict]]:
+    criteria = _work_filter(tech_id, include_closed)
+    total = db.query(func.count(Work.id)).filter(*criteria).scalar() or 0
+    if total == 0:
+        return ("Nessun lavoro assegnato" if include_closed else "Nessun lavoro aperto assegnato"), None
+    pages = (total + PAGE_SIZE - 1) // PAGE_SIZE
+    page = min(max(page, 1), pages)
+    rows = (
+        db.query(Work.numero_wr, Work.stato, Work.indirizzo)
+        .filter(*criteria)
+        .order_by(Work.data_apertura.is_(None), Work.data_apertura, Work.id)
+        .offset((page - 1) * PAGE_SIZE)
+        .limit(PAGE_SIZE)
+        .all()
+    )
+    title = "Tutti i tuoi lavori" if include_closed else "I tuoi lavori aperti"
+    lines = [f"{title} ({total}) - pagina {page}/{pages}"]
+    for numero_wr, stato, indirizzo in rows:
+        line = f"WR {numero_wr} - {stato} - {indirizzo}"
+        lines.append(line[:MAX_LINE_CHARS])
+    text = "\n".join(lines)[:MAX_MESSAGE_CHARS]
+
+    nav = []
+    if page > 1:
+        nav.append({"text": "◀️ Indietro", "callback_data": _callback_data(page - 1, include_closed)})
+    if page < pages:
+        nav.append({"text": "Avanti ▶️", "callback_data": _callback_data(page + 1, include_closed)})
+    toggle = {
+        "text": "Solo aperti" if include_closed else "Mostra anche chiusi",
+        "callback_data": _callback_data(1, not include_closed),
+    }
+    keyboard = [nav, [toggle]] if nav else [[toggle]]
+    return text, {"inline_keyboard": keyboard}
+
+
+def get_works_page(db: Session, tech_id: int, page: int = 1, include_closed: bool = False) -> Tuple[str, Optional[dict]]:
+    """Return the rendered (text, inline reply_markup) for a page of a technician's works.
+
+    Pages are cached per technician and dropped as soon as one of their works
+    changes state or assignee (see ``invalidate_technician``). Changes made
+    through a session are dropped when it commits, not at the flush: a page
+    rendered in between would otherwise cache the old rows again.
+    """
+    key = (max(page, 1), bool(include_closed))
+    now = time.monotonic()
+    with _cache_lock:
+        cached = _page_cache.get(tech_id, {}).get(key)
+    if cached and cached[0] > now:
+        return cached[1], cached[2]
+    text, markup = _render(db, tech_id, key[0], key[1])
+    with _cache_lock:
+        _page_cache.setdefault(tech_id, {})[key] = (now + CACHE_TTL_SECONDS, text, markup)
+    return text, markup
+
+
+def invalidate_technician(tech_id: Any) -> None:
+    if tech_id is None:
+        return
+    with _cache_lock:
+        _page_cache.pop(tech_id, None)
+
+
+def invalidate_on_commit(db: Session, tech_id: Any) -> None:
+    """Drop the technician's pages once ``db`` commits (writes not visible to other sessions yet)."""
+    if tech_id is not None:
+        db.info.setdefault(_STALE_KEY, set()).add(tech_id)
+
+
+def clear_cache() -> None:
+    with _cache_lock:
+        _page_cache.clear()
+
+
+@event.listens_for(Session, "after_flush")
+def _invalidate_on_work_change(session, flush_context):
+    """Mark the technicians whose works were created, deleted or modified; their pages go at commit."""
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, Work):
+            continue
+        invalidate_on_commit(session, obj.tecnico_assegnato_id)
+        # A reassignment must also refresh the previous technician's list
+        history = inspect(obj).attrs.tecnico_assegnato_id.history
+        for old_tech in history.deleted or ():
+            invalidate_on_commit(session, old_tech)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed(session):
+    for tech_id in session.info.pop(_STALE_KEY, ()):
+        invalidate_technician(tech_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_rolled_back(session):
+    session.info.pop(_STALE_KEY, None)
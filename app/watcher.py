@@ -0,0 +1,49 @@
+"""Drop-folder watcher service: ingests PDFs copied into WATCH_DIR (see app/utils/dropwatch.py).
+
+Run with ``python -m app.watcher``; deploy/watcher.service is the systemd unit.
+"""
+import logging
+import os
+import signal
+
+from dotenv import load_dotenv
+
+from app.database import SessionLocal, engine
+from app.utils import dropwatch
+from app.utils.schema import init_schema
+
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("app.watcher")
+
+
+def main():
+    directory = os.getenv("WATCH_DIR")
+    if not directory or not os.path.isdir(directory):
+        logger.error("WATCH_DIR must point to an existing directory (got %r)", directory)
+        raise SystemExit(1)
+    init_schema(engine)
+
+    watcher = dropwatch.DropFolderWatcher(
+        directory,
+        SessionLocal,
+        debounce=float(os.getenv("WATCH_DEBOUNCE_SECONDS", "2")),
+        min_confidence=float(os.getenv("WATCH_AUTO_APPLY_CONFIDENCE", "0.8")),
+        workers=int(os.getenv("WATCH_WORKERS", "2")),
+    )
+    stopping = []
+    # systemd stops the unit with SIGTERM: finish the files in flight, then exit
+    signal.signal(signal.SIGTERM, lambda *_: stopping.append(True))
+    try:
+        watcher.run(should_stop=lambda: bool(stopping))
+    except KeyboardInterrupt:
+        pass
+    logger.info("Watcher stopped: %s", watcher.stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""Background job worker: runs the jobs queued in the ``jobs`` table (see app/utils/jobs.py).
+
+Run with ``python -m app.worker [--concurrency N]``; deploy/worker.service is the systemd unit.
+Several workers (on one or more hosts) can share the queue: each job is leased by one of them.
+"""
+import argparse
+import logging
+import os
+import signal
+import threading
+
+from dotenv import load_dotenv
+
+from app.database import SessionLocal, engine
+from app.utils import jobs
+from app.utils.schema import init_schema
+
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("app.worker")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FTTH background job worker")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("JOBS_CONCURRENCY") or 2),
+                        help="jobs run at the same time by this process (default: JOBS_CONCURRENCY or 2)")
+    args = parser.parse_args()
+
+    init_schema(engine)
+    worker = jobs.Worker(SessionLocal, concurrency=args.concurrency, schedules=jobs.SCHEDULES).start()
+    logger.info("Job worker started (concurrency %d, types: %s)", args.concurrency, ", ".join(sorted(jobs.HANDLERS)))
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+    try:
+        stopped.wait()
+    except KeyboardInterrupt:
+        pass
+    # running jobs finish; anything interrupted is leased again after JOBS_LEASE_SECONDS
+    worker.stop()
+    logger.info("Job worker stopped")
+
+
+if __name__ == "__main__":
+    main()
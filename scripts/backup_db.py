@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Online backups of the FTTH database (app/utils/backup.py).
+
+The backup is taken while the API and the bot keep running: SQLite is copied with
+the online backup API and compressed (zstd if installed, gzip otherwise), Postgres
+is dumped with pg_dump. Scheduled backups run as "backup" jobs (BACKUP_SCHEDULE).
+
+Usage:
+  python3 scripts/backup_db.py create [--dir /opt/ftth/backups] [--compression gzip]
+  python3 scripts/backup_db.py list
+  python3 scripts/backup_db.py verify backups/ftth_20250101_020000.db.zst
+  python3 scripts/backup_db.py restore backups/ftth_20250101_020000.db.zst   # stop api/bot first
+  python3 scripts/backup_db.py rotate [--retention-days 30]
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', default=None, help='backup directory (default: BACKUP_DIR or ./backups)')
+    sub = parser.add_subparsers(dest='command', required=True)
+    create = sub.add_parser('create', help='take a backup now')
+    create.add_argument('--compression', choices=['zstd', 'gzip', 'none'], default=None)
+    create.add_argument('--no-rotate', action='store_true', help='do not delete expired backups afterwards')
+    sub.add_parser('list', help='list backups, newest first')
+    verify = sub.add_parser('verify', help='decompress a backup and run an integrity check')
+    verify.add_argument('path')
+    restore = sub.add_parser('restore', help='restore a backup into DATABASE_URL')
+    restore.add_argument('path')
+    restore.add_argument('--yes', action='store_true', help='do not ask for confirmation')
+    rotate = sub.add_parser('rotate', help='delete backups older than the retention period')
+    rotate.add_argument('--retention-days', type=int, default=None)
+    return parser.parse_args()
+
+
+def progress(pct, message):
+    print(f'\r{pct:3d}% {message}', end='', file=sys.stderr, flush=True)
+
+
+def main():
+    args = parse_args()
+    from app.database import engine
+    from app.utils import backup
+
+    if args.command == 'create':
+        result = backup.create_backup(engine, args.dir, progress=progress, compression=args.compression)
+        print(file=sys.stderr)
+        print(f"{result['path']}  {result['size']} bytes  sha256={result['sha256']}")
+        if not args.no_rotate:
+            for path in backup.rotate(args.dir):
+                print(f'removed {path}')
+    elif args.command == 'list':
+        for item in backup.list_backups(args.dir):
+            print(f"{item['created_at']:%Y-%m-%d %H:%M:%S}  {item['size']:>12}  {item['path']}")
+    elif args.command == 'verify':
+        result = backup.verify(args.path)
+        print(' '.join(f'{k}={v}' for k, v in result.items()))
+        return 0 if result['ok'] else 1
+    elif args.command == 'restore':
+        if not args.yes and input(f'Overwrite {engine.url.render_as_string(hide_password=True)} with {args.path}? [y/N] ').lower() != 'y':
+            return 1
+        result = backup.restore(args.path, engine, progress=progress)
+        print(file=sys.stderr)
+        print(f"restored {result['path']}")
+    elif args.command == 'rotate':
+        for path in backup.rotate(args.dir, args.retention_days):
+            print(f'removed {path}')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Bulk-ingest PDF schedules from disk (backfill of archived schedules).
+
+Walks the given files/directories, extracts and parses the PDFs in a pool of worker
+processes with the same parser as POST /documents/{id}/parse (app/utils/ocr.py), and
+writes Document and Work rows in batched transactions (app/utils/pdf_ingest.py).
+Every file is recorded in the processed_files ledger by content hash, so the command
+can be stopped and run again: files already ingested are skipped.
+
+Usage:
+  python3 scripts/ingest_pdfs.py /srv/archivio/2024 --workers 8
+  python3 scripts/ingest_pdfs.py /srv/drop --watch 30          # rescan every 30s
+  python3 scripts/ingest_pdfs.py /srv/archivio --retry-failed  # retry files that failed before
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='PDF files or directories to ingest')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2, help='parser processes (default: CPU count)')
+    parser.add_argument('--batch-size', type=int, default=50, help='files per database transaction (default 50)')
+    parser.add_argument('--no-recursive', action='store_true', help='do not descend into subdirectories')
+    parser.add_argument('--retry-failed', action='store_true', help='parse again files the ledger marks as failed')
+    parser.add_argument('--watch', type=float, default=None, metavar='SECONDS', help='keep running and rescan every SECONDS')
+    return parser.parse_args()
+
+
+class Progress:
+    """One status line every `interval` seconds: done/total, files/s, ETA."""
+
+    def __init__(self, total, interval=2.0):
+        self.total = total
+        self.done = 0
+        self.entries = 0
+        self.errors = 0
+        self.interval = interval
+        self.started = time.monotonic()
+        self._last = 0.0
+
+    def update(self, parsed, force=False):
+        if parsed is not None:
+            self.done += 1
+            self.entries += len(parsed.get('entries') or ())
+            self.errors += 1 if parsed.get('error') else 0
+        now = time.monotonic()
+        if not force and now - self._last < self.interval:
+            return
+        self._last = now
+        elapsed = max(now - self.started, 1e-6)
+        rate = self.done / elapsed
+        eta = (self.total - self.done) / rate if rate else 0
+        pct = 100.0 * self.done / self.total if self.total else 100.0
+        print(f'[{self.done:>{len(str(self.total))}}/{self.total}] {pct:5.1f}%  {rate:6.1f} files/s  '
+              f'{self.entries} entries  {self.errors} errors  ETA {int(eta // 60)}m{int(eta % 60):02d}s', file=sys.stderr, flush=True)
+
+
+def ingest(paths, args, pool):
+    from app.database import SessionLocal
+    from app.utils import pdf_ingest
+
+    db = SessionLocal()
+    try:
+        todo = pdf_ingest.pending_files(db, pdf_ingest.iter_pdfs(paths, recursive=not args.no_recursive), retry_failed=args.retry_failed)
+        if not todo:
+            return None
+        progress = Progress(len(todo))
+        writer = pdf_ingest.DocumentBatchWriter(db, batch_size=args.batch_size, retry_failed=args.retry_failed)
+        # Bounded window: parsed files (content + text) are not all kept in memory at once
+        window = max(2, args.workers * 2)
+        queue = iter(todo)
+        running = set()
+        while True:
+            while len(running) < window:
+                path = next(queue, None)
+                if path is None:
+                    break
+                running.add(pool.submit(pdf_ingest.parse_file, path))
+            if not running:
+                break
+            finished, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                parsed = future.result()
+                writer.add(parsed)
+                progress.update(parsed)
+        stats = writer.finish()
+        progress.update(None, force=True)
+        elapsed = time.monotonic() - progress.started
+        stats['seconds'] = round(elapsed, 1)
+        stats['files_per_second'] = round(progress.done / elapsed, 1) if elapsed else None
+        return stats
+    finally:
+        db.close()
+
+
+def main():
+    args = parse_args()
+    from app.database import engine
+    from app.utils.schema import init_schema
+    init_schema(engine)
+
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        while True:
+            stats = ingest(args.paths, args, pool)
+            if stats:
+                print(' '.join(f'{k}={v}' for k, v in stats.items()), flush=True)
+            elif args.watch is None:
+                print('Nothing to ingest: every file is already in the ledger.')
+            if args.watch is None:
+                break
+            time.sleep(args.watch)
+    return 0
+
+
+if __name__ == '__main__':
+    try:
+        raise SystemExit(main())
+    except KeyboardInterrupt:
+        # batches already committed stay in the ledger; the next run resumes from there
+        raise SystemExit(130)
@@ -671,3 +671,1351 @@ def test_debug_db_documents_handles_binary_content():
 
 
     
+
+
+def test_miei_lavori_paginated_with_callbacks(monkeypatch):
+    headers = {"X-API-Key": os.environ["API_KEY"]}
+    import app.utils.telegram as telegram_utils
+    from app.models.models import Work, Technician
+    from app.utils import work_pages
+    sent = []
+    edited = []
+    monkeypatch.setattr(telegram_utils, 'send_message_to_telegram', lambda chat_id, text, reply_markup=None: sent.append((chat_id, text, reply_markup)) or True)
+    monkeypatch.setattr(telegram_utils, 'edit_message_text', lambda chat_id, message_id, text, reply_markup=None: edited.append((chat_id, message_id, text, reply_markup)) or True)
+    monkeypatch.setattr(telegram_utils, 'answer_callback_query', lambda callback_query_id, text=None: True)
+
+    res = client.post('/teams/', json={'nome': 'PagingTeam'}, headers=headers)
+    team_id = res.json().get('id')
+    res = client.post('/technicians/', json={'nome': 'Page', 'cognome': 'Tech', 'telefono': '3330001112', 'squadra_id': team_id, 'telegram_id': '7777'}, headers=headers)
+    assert res.status_code == 200
+    tech_id = res.json().get('id')
+    import datetime
+    db = SessionLocal()
+    for i in range(12):
+        db.add(Work(numero_wr=f'PAGE{i:03d}', operatore='op', indirizzo=f'Via Page {i}', nome_cliente='C', tipo_lavoro='attivazione', stato='in_corso', tecnico_assegnato_id=tech_id, data_apertura=datetime.datetime(2025, 1, 1) + datetime.timedelta(hours=i)))
+    db.add(Work(numero_wr='PAGECLOSED', operatore='op', indirizzo='Via Chiusa', nome_cliente='C', tipo_lavoro='attivazione', stato='chiuso', tecnico_assegnato_id=tech_id, data_apertura=datetime.datetime(2024, 1, 1)))
+    db.commit()
+    db.close()
+
+    def message(text):
+        return {"update_id": 1, "message": {"message_id": 10, "from": {"id": 7777}, "chat": {"id": 7777}, "text": text}}
+
+    res = client.post('/telegram/webhook', json=message('/miei_lavori'))
+    assert res.status_code == 200
+    chat_id, text, markup = sent[-1]
+    assert 'pagina 1/2' in text and '(12)' in text
+    assert 'PAGECLOSED' not in text
+    next_button = markup['inline_keyboard'][0][-1]
+    assert next_button['callback_data'] == 'miei_lavori:2:open'
+
+    callback = {"update_id": 2, "callback_query": {"id": "cb1", "from": {"id": 7777}, "data": next_button['callback_data'], "message": {"message_id": 11, "chat": {"id": 7777}}}}
+    res = client.post('/telegram/webhook', json=callback)
+    assert res.status_code == 200 and res.json().get('page') == 2
+    assert edited[-1][1] == 11 and 'pagina 2/2' in edited[-1][2]
+    assert 'PAGE011' in edited[-1][2]
+
+    # Closing a work through the webhook must invalidate the cached pages
+    res = client.post('/telegram/webhook', json=message('/chiudi PAGE011'))
+    assert res.json().get('message') == 'Closed'
+    res = client.post('/telegram/webhook', json=message('/miei_lavori'))
+    assert '(11)' in sent[-1][1]
+    res = client.post('/telegram/webhook', json=message('/miei_lavori tutti'))
+    assert '(13)' in sent[-1][1]
+
+    # a page rendered between a change's flush and its commit is dropped at the commit
+    db = SessionLocal()
+    db.query(Work).filter(Work.numero_wr == 'PAGE010').one().stato = 'chiuso'
+    db.flush()
+    reader = SessionLocal()
+    assert '(11)' in work_pages.get_works_page(reader, tech_id)[0]
+    reader.close()
+    db.commit()
+    db.close()
+    reader = SessionLocal()
+    assert '(10)' in work_pages.get_works_page(reader, tech_id)[0]
+    reader.close()
+    work_pages.clear_cache()
+
+
+def test_bulk_ingest_json_and_ndjson_upserts():
+    headers = {"X-API-Key": os.environ["API_KEY"]}
+    res = client.post('/teams/', json={'nome': 'IngestTeam'}, headers=headers)
+    team_id = res.json().get('id')
+    res = client.post('/technicians/', json={'nome': 'Ingest', 'cognome': 'Rossi', 'telefono': '3331112223', 'squadra_id': team_id}, headers=headers)
+    tech_id = res.json().get('id')
+
+    works = [
+        {"numero_wr": "9100001", "stato": "aperto", "cliente": "Bulk A", "tecnico": "ingest  ROSSI", "telefono": "333"},
+        {"numero_wr": "9100002", "stato": "aperto", "cliente": "Bulk B", "data_creazione": "not-a-date"},
+        {"numero_wr": "9100003", "stato": "aperto", "indirizzo": "Via Bulk 3"},
+    ]
+    res = client.post('/works/ingest/bulk?chunk_size=2', json={"works": works}, headers=headers)
+    assert res.status_code == 200
+    data = res.json()
+    assert data['success_count'] == 2 and data['error_count'] == 1
+    assert [r['status'] for r in data['results']] == ['created', 'created']
+    assert data['results'][0]['numero_wr'] == 'WR-9100001'
+
+    # NDJSON stream updating an existing work and creating a new one; bad lines are reported per index
+    body = "\n".join([
+        json.dumps({"numero_wr": "WR-9100001", "stato": "chiuso", "email": "a@b.c"}),
+        "{not json",
+        json.dumps({"numero_wr": "9100004", "stato": "aperto", "cliente": "Bulk D"}),
+    ]) + "\n"
+    res = client.post('/works/ingest/bulk', content=body, headers={**headers, "Content-Type": "application/x-ndjson"})
+    assert res.status_code == 200
+    data = res.json()
+    assert data['success_count'] == 2 and data['error_count'] == 1
+    statuses = {r['numero_wr']: r['status'] for r in data['results']}
+    assert statuses == {'WR-9100001': 'updated', 'WR-9100004': 'created'}
+
+    from app.models.models import Work, WorkJournalEntry
+    from app.utils.journal import EventKind
+    db = SessionLocal()
+    w = db.query(Work).filter(Work.numero_wr == 'WR-9100001').first()
+    assert w.stato == 'chiuso' and w.nome_cliente == 'Bulk A' and w.operatore == 'Imported'
+    assert w.tecnico_assegnato_id == tech_id
+    assert w.extra_fields == {'telefono': '333', 'email': 'a@b.c'}
+    assert db.query(WorkJournalEntry).filter(WorkJournalEntry.work_id == w.id, WorkJournalEntry.kind == EventKind.CREATED).count() == 1
+    db.close()
+
+    res = client.post('/works/ingest/work', json={"numero_wr": "9100003", "stato": "sospeso"}, headers=headers)
+    assert res.status_code == 200
+    assert res.json()['message'] == 'Work WR-9100003 updated successfully'
+
+
+def test_ingest_idempotency_key_replays_and_rejects_reuse():
+    headers = {"X-API-Key": os.environ["API_KEY"], "Idempotency-Key": "idem-bulk-1"}
+    works = [{"numero_wr": "9200001", "stato": "aperto", "cliente": "Idem A", "telefono": "111"}]
+    res = client.post('/works/ingest/bulk', json={"works": works}, headers=headers)
+    assert res.status_code == 200
+    first = res.json()
+    assert first['results'][0]['status'] == 'created'
+
+    # Retry with the same key and payload: stored response, no second write
+    res = client.post('/works/ingest/bulk', json={"works": works}, headers=headers)
+    assert res.status_code == 200
+    assert res.json() == first
+
+    # Same key, different payload
+    res = client.post('/works/ingest/bulk', json={"works": [{"numero_wr": "9200002", "stato": "aperto"}]}, headers=headers)
+    assert res.status_code == 409
+
+    # Single-work ingest merges extra_fields instead of wiping them
+    single = {"numero_wr": "9200001", "stato": "aperto", "email": "idem@x.it"}
+    h = {"X-API-Key": os.environ["API_KEY"], "Idempotency-Key": "idem-work-1"}
+    res = client.post('/works/ingest/work', json=single, headers=h)
+    assert res.status_code == 200
+    assert client.post('/works/ingest/work', json=single, headers=h).json() == res.json()
+
+    from app.models.models import Work, WorkJournalEntry
+    from app.utils.journal import EventKind
+    db = SessionLocal()
+    w = db.query(Work).filter(Work.numero_wr == 'WR-9200001').first()
+    assert w.extra_fields == {'telefono': '111', 'email': 'idem@x.it'}
+    assert db.query(WorkJournalEntry).filter(WorkJournalEntry.work_id == w.id, WorkJournalEntry.kind == EventKind.CREATED).count() == 1
+    db.close()
+
+
+def test_works_change_feed_returns_deltas_since_cursor():
+    headers = {"X-API-Key": os.environ["API_KEY"]}
+    res = client.get('/works/changes', params={'since': 10 ** 9}, headers=headers)
+    assert res.status_code == 200 and res.json()['reset'] is True
+    cursor = res.json()['cursor']
+
+    res = client.post('/works/', json={'numero_wr': 'FEED-1', 'operatore': 'Op', 'indirizzo': 'Via Feed', 'nome_cliente': 'Feed', 'tipo_lavoro': 'attivazione', 'stato': 'aperto'}, headers=headers)
+    work_id = res.json()['id']
+    client.put(f'/works/{work_id}/status', json={'stato': 'in_corso'}, headers=headers)
+    client.post('/works/ingest/bulk', json={"works": [{"numero_wr": "9300001", "stato": "aperto"}]}, headers=headers)
+
+    res = client.get('/works/changes', params={'since': cursor, 'entities': 'work'}, headers=headers)
+    assert res.status_code == 200
+    data = res.json()
+    assert data['has_more'] is False and data['cursor'] > cursor
+    works = {c['data']['numero_wr']: c for c in data['changes']}
+    # Two writes on FEED-1 fold into one entry carrying the latest state
+    assert [c['id'] for c in data['changes']].count(work_id) == 1
+    assert works['FEED-1']['data']['stato'] == 'in_corso'
+    assert 'WR-9300001' in works
+
+    client.delete(f'/works/{work_id}', headers=headers)
+    data = client.get('/works/changes', params={'since': data['cursor']}, headers=headers).json()
+    assert [(c['entity'], c['id'], c['op']) for c in data['changes']] == [('work', work_id, 'delete')]
+    assert client.get('/works/changes', params={'since': data['cursor']}, headers=headers).json()['changes'] == []
+    assert client.get('/works/changes', params={'entities': 'bogus'}, headers=headers).status_code == 400
+
+
+def test_change_log_prune_keeps_unsent_entries_and_resets_older_cursors():
+    from datetime import datetime, timedelta
+    from app.models.models import ChangeLog, SyncPeer
+    from app.utils import changes
+
+    db = SessionLocal()
+    try:
+        seqs = [seq for (seq,) in db.query(ChangeLog.seq).order_by(ChangeLog.seq)]
+        assert len(seqs) >= 4
+        middle = seqs[len(seqs) // 2]
+        db.query(ChangeLog).filter(ChangeLog.seq < middle).update(
+            {ChangeLog.changed_at: datetime.utcnow() - timedelta(days=400)}, synchronize_session=False)
+        peer = SyncPeer(name='prune-test', pull_cursor=0, push_cursor=seqs[1])
+        db.add(peer)
+        db.commit()
+
+        # the peer has not received seqs[1] yet: only what is below it goes
+        assert changes.prune(db, retention_days=90) == 1
+        db.delete(peer)
+        db.commit()
+        assert changes.prune(db, retention_days=90) == seqs.index(middle) - 1
+        db.commit()
+        assert db.query(ChangeLog.seq).order_by(ChangeLog.seq).first() == (middle,)
+        assert changes.head(db) == seqs[-1]
+
+        # the entries below the oldest one left are gone: the client must refresh, the rest still comes along
+        feed = changes.fetch_changes(db, since=0)
+        assert feed['reset'] is True and feed['changes']
+        assert changes.fetch_changes(db, since=middle - 1)['reset'] is False
+        assert changes.fetch_changes(db, since=seqs[-1])['reset'] is False
+    finally:
+        db.close()
+
+
+def test_live_hub_pushes_only_committed_changes():
+    import asyncio
+    from app.models.models import Work
+    from app.utils.live import hub
+    headers = {"X-API-Key": os.environ["API_KEY"]}
+
+    async def scenario():
+        subscriber = hub.subscribe({"work"})
+        try:
+            db = SessionLocal()
+            db.add(Work(numero_wr='LIVE-ROLLBACK', stato='aperto'))
+            db.flush()
+            db.rollback()
+            db.close()
+            await asyncio.to_thread(client.post, '/onts/', json={'serial_number': 'LIVE-ONT', 'model': 'X'}, headers=headers)
+            res = await asyncio.to_thread(client.post, '/works/ingest/work', json={'numero_wr': '9400001', 'stato': 'aperto'}, headers=headers)
+            item = await asyncio.wait_for(subscriber.queue.get(), timeout=5)
+            assert item['type'] == 'change' and item['entity'] == 'work'
+            assert item['id'] == res.json()['work_id'] and item['seq'] > 0
+            # Nothing else: the rolled back work and the ONT (filtered out) are not pushed
+            assert subscriber.queue.empty()
+        finally:
+            hub.unsubscribe(subscriber)
+
+    asyncio.run(scenario())
+    assert client.get('/live/events', params={'entities': 'ont'}).status_code == 403
+
+
+def test_live_stream_token_replaces_the_api_key_in_the_url():
+    from app.utils import live
+    from app.utils.auth import create_access_token
+    headers = {"X-API-Key": os.environ["API_KEY"]}
+
+    assert client.post('/live/token').status_code == 403
+    res = client.post('/live/token', headers=headers)
+    assert res.status_code == 200 and res.json()['expires_in'] == live.STREAM_TOKEN_SECONDS
+    assert live.valid_stream_token(res.json()['token'])
+    # an expired stream token or a login token does not open the stream
+    assert not live.valid_stream_token(live.stream_token(seconds=-10))
+    assert not live.valid_stream_token(create_access_token({'sub': 'someone'}))
+    res = client.get('/live/events', params={'entities': 'ont', 'token': live.stream_token(seconds=-10)})
+    assert res.status_code == 403
+    # the key itself is not accepted in the query string any more
+    res = client.get('/live/events', params={'entities': 'ont', 'api_key': os.environ['API_KEY']})
+    assert res.status_code == 403
+
+
+def test_conditional_get_returns_304_until_data_changes():
+    headers = {"X-API-Key": os.environ["API_KEY"]}
+    res = client.get('/technicians/')
+    assert res.status_code == 200 and res.headers['ETag'].startswith('W/"')
+    assert 'no-cache' in res.headers['Cache-Control']
+    tag = res.headers['ETag']
+    res = client.get('/technicians/', headers={'If-None-Match': tag})
+    assert res.status_code == 304 and res.content == b''
+
+    # Unrelated writes keep the tag, writes to the table change it
+    client.post('/onts/', json={'serial_number': 'ETAG-ONT', 'model': 'X'}, headers=headers)
+    assert client.get('/technicians/', headers={'If-None-Match': tag}).status_code == 304
+    res = client.post('/teams/', json={'nome': 'EtagTeam'}, headers=headers)
+    client.post('/technicians/', json={'nome': 'Etag', 'cognome': 'Tech', 'telefono': '3330000000', 'squadra_id': res.json()['id']}, headers=headers)
+    res = client.get('/technicians/', headers={'If-None-Match': tag})
+    assert res.status_code == 200 and res.headers['ETag'] != tag
+
+    res = client.post('/works/ingest/work', json={'numero_wr': '9500001', 'stato': 'aperto'}, headers=headers)
+    work_id = res.json()['work_id']
+    tag = client.get(f'/works/{work_id}').headers['ETag']
+    client.post('/works/ingest/work', json={'numero_wr': '9500002', 'stato': 'aperto'}, headers=headers)
+    assert client.get(f'/works/{work_id}', headers={'If-None-Match': tag}).status_code == 304
+    client.put(f'/works/{work_id}/status', json={'stato': 'in_corso'}, headers=headers)
+    res = client.get(f'/works/{work_id}', headers={'If-None-Match': tag})
+    assert res.status_code == 200 and res.json()['stato'] == 'in_corso'
+    # Query parameters are part of the tag
+    assert client.get('/onts/?status=available', headers=headers).headers['ETag'] != client.get('/onts/', headers=headers).headers['ETag']
+
+
+def test_fast_list_serialization_matches_response_model(monkeypatch):
+    headers = {"X-API-Key": os.environ["API_KEY"]}
+    res = client.post('/teams/', json={'nome': 'FastTeam'}, headers=headers)
+    res = client.post('/technicians/', json={'nome': 'Fast', 'cognome': 'Path', 'telefono': '3334445556', 'squadra_id': res.json()['id']}, headers=headers)
+    client.post('/works/ingest/work', json={'numero_wr': '9600001', 'stato': 'aperto', 'tecnico': 'Fast Path', 'telefono': '1'}, headers=headers)
+    client.post('/onts/', json={'serial_number': 'FAST-ONT', 'model': 'X'}, headers=headers)
+
+    for path in ('/works/', '/onts/', '/modems/', '/sync/'):
+        monkeypatch.setenv('FAST_SERIALIZATION', '0')
+        slow = client.get(path, headers=headers)
+        monkeypatch.setenv('FAST_SERIALIZATION', '1')
+        fast = client.get(path, headers=headers)
+        assert fast.status_code == slow.status_code == 200
+        assert fast.json() == slow.json()
+        if path != '/sync/':
+            assert fast.headers['ETag'] == slow.headers['ETag']
+    work = next(w for w in client.get('/works/').json() if w['numero_wr'] == 'WR-9600001')
+    assert work['tecnico_assegnato']['squadra']['nome'] == 'FastTeam'
+
+
+def test_search_ranks_and_highlights_works_and_documents():
+    headers = {"X-API-Key": os.environ["API_KEY"]}
+    client.post('/works/ingest/bulk', json={"works": [
+        {"numero_wr": "9700001", "stato": "aperto", "cliente": "Zebedeo Quintavalle", "indirizzo": "Via Sgrò 7", "email": "zq@example.it"},
+        {"numero_wr": "9700002", "stato": "aperto", "cliente": "Altro Cliente", "note": "citofono Quintavalle <b>"},
+    ]}, headers=headers)
+    from app.models.models import Document
+    db = SessionLocal()
+    db.add(Document(filename='ordine_quintavalle.pdf', parsed=True, parsed_data={'raw_text': 'Appuntamento cliente Quintavalle via Sgro'}))
+    db.commit()
+    db.close()
+
+    res = client.get('/search/', params={'q': 'quintav'}, headers=headers)
+    assert res.status_code == 200
+    results = res.json()['results']
+    assert [r['kind'] for r in results].count('document') == 1
+    # Name match outranks a match in the notes
+    works = [r for r in results if r['kind'] == 'work']
+    assert [w['title'] for w in works] == ['WR-9700001', 'WR-9700002']
+    assert '<mark>Quintavalle</mark>' in works[0]['snippet']
+    assert '&lt;b&gt;' in works[1]['snippet']
+
+    # Accents are folded, extra_fields are indexed, kind filters
+    assert client.get('/search/', params={'q': 'sgro', 'kind': 'work'}, headers=headers).json()['results'][0]['title'] == 'WR-9700001'
+    assert client.get('/search/', params={'q': 'zq example'}, headers=headers).json()['results'][0]['title'] == 'WR-9700001'
+
+    # Kept up to date on ORM writes
+    work_id = works[0]['id']
+    client.put(f'/works/{work_id}', json={'nome_cliente': 'Rinominato Cliente'}, headers=headers)
+    assert all(r['id'] != work_id for r in client.get('/search/', params={'q': 'zebedeo'}, headers=headers).json()['results'])
+    assert client.get('/search/', params={'q': 'rinominato'}, headers=headers).json()['results'][0]['id'] == work_id
+    assert client.get('/search/', params={'q': 'x'}).status_code == 403
+
+
+def test_fuzzy_match_reuses_work_for_ocr_misread_wr():
+    headers = {"X-API-Key": os.environ["API_KEY"]}
+    res = client.post('/works/ingest/bulk', json={"works": [
+        {"numero_wr": "9800001234", "stato": "aperto", "cliente": "Ermenegildo Fabbrocini", "indirizzo": "Via Garibaldi 12, Lecce"},
+    ]}, headers=headers)
+    original_id = res.json()['results'][0]['work_id']
+    # A misread WR for the same customer is flagged, not silently accepted
+    res = client.post('/works/ingest/bulk', json={"works": [
+        {"numero_wr": "98000O1234", "stato": "aperto", "cliente": "Ermenegildo Fabbrocini", "indirizzo": "Via Garibaldi 12 Lecce"},
+    ]}, headers=headers)
+    result = res.json()['results'][0]
+    assert result['status'] == 'created'
+    assert result['possible_duplicates'][0]['work_id'] == original_id
+    assert result['possible_duplicates'][0]['signals']['wr'] == 1.0
+
+    from app.models.models import Document, DocumentAppliedWork
+    db = SessionLocal()
+    doc = Document(filename='ocr_fabbrocini.pdf', parsed=True, parsed_data={'entries': [
+        {'numero_wr': 'WR-98OOOQ1234', 'nome_cliente': 'Ermenegildo Fabbrocini', 'indirizzo': 'Via Garibaldi 12'},
+    ]})
+    db.add(doc)
+    db.commit()
+    doc_id = doc.id
+    db.close()
+    res = client.post(f'/documents/{doc_id}/apply', headers=headers)
+    assert res.status_code == 200
+    parse_debug = res.json()['parsed_data']['parse_debug']
+    assert parse_debug['applied_matches'][0]['reason'] == 'fuzzy'
+    applied = parse_debug['applied_matches'][0]['work_id']
+    assert applied in (original_id, result['work_id'])
+    db = SessionLocal()
+    assert db.query(DocumentAppliedWork).filter(DocumentAppliedWork.document_id == doc_id).count() == 1
+    db.close()
+
+
+def test_fuzzy_postings_of_a_common_key_are_capped_in_the_query(monkeypatch):
+    from app.models.models import Work
+    from app.utils import fuzzy
+
+    monkeypatch.setattr(fuzzy, 'MAX_BLOCK', 2)
+    db = SessionLocal()
+    try:
+        works = [Work(numero_wr=f'CAP-{i}', nome_cliente='Zebedeo Frequentissimo') for i in range(5)]
+        db.add_all(works)
+        db.commit()
+        ids = sorted(w.id for w in works)
+        found = fuzzy.find_matches(db, None, 'Zebedeo Frequentissimo', None)
+        # only the newest MAX_BLOCK postings of each key are read
+        assert sorted(c['work_id'] for c in found) == ids[-2:]
+    finally:
+        db.close()
+
+
+def _make_pdf(pages):
+    """Minimal text-only PDF, one page per string (lines split on newlines)."""
+    objs = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        lines = "".join(f"({line}) Tj 0 -14 Td " for line in text.split("\n"))
+        stream = f"BT /F1 11 Tf 50 750 Td {lines}ET"
+        objs.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objs.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents {len(objs)} 0 R >>")
+        kids.append(f"{len(objs)} 0 R")
+    objs[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+    out, offsets = "%PDF-1.4\n", []
+    for i, body in enumerate(objs, 1):
+        offsets.append(len(out))
+        out += f"{i} 0 obj\n{body}\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objs) + 1}\n0000000000 65535 f \n" + "".join(f"{o:010d} 00000 n \n" for o in offsets)
+    out += f"trailer\n<< /Size {len(objs) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n"
+    return out.encode("latin-1")
+
+
+def test_revised_document_parses_and_applies_only_changed_pages(monkeypatch):
+    headers = {"X-API-Key": os.environ["API_KEY"]}
+    pages = [
+        'Pratica: 1765000001\nCliente: Lucia Mondella\nIndirizzo: Via Manzoni 1',
+        'Pratica: 1765000002\nCliente: Renzo Tramaglino\nIndirizzo: Via Lecco 2',
+    ]
+    res = client.post('/documents/upload', files={"files": ("agenda.pdf", _make_pdf(pages), "application/pdf")}, headers=headers)
+    first_id = res.json()[0]['id']
+    client.post(f'/documents/{first_id}/parse', headers=headers)
+    assert len(client.post(f'/documents/{first_id}/apply', headers=headers).json()['parsed_data']['applied_work_ids']) == 2
+
+    import app.routes.documents as documents_routes
+    parsed_pages = []
+    original_extract = documents_routes.extract_wr_entries
+    monkeypatch.setattr(documents_routes, 'extract_wr_entries', lambda text: parsed_pages.append(text) or original_extract(text))
+    revised = pages + ['Pratica: 1765000003\nCliente: Fra Cristoforo\nIndirizzo: Piazza Pescarenico 3']
+    res = client.post('/documents/upload', files={"files": ("agenda (1).pdf", _make_pdf(revised), "application/pdf")}, headers=headers)
+    second_id = res.json()[0]['id']
+    parsed = client.post(f'/documents/{second_id}/parse', headers=headers).json()['parsed_data']
+    assert parsed['parse_debug']['revision'] == {'of': first_id, 'unchanged_pages': [0, 1], 'changed_pages': [2]}
+    assert len(parsed_pages) == 1 and 'Cristoforo' in parsed_pages[0]
+    assert len(parsed['entries']) == 3
+
+    applied = client.post(f'/documents/{second_id}/apply', headers=headers).json()['parsed_data']
+    assert len(applied['applied_work_ids']) == 1
+    assert [s['numero_wr'] for s in applied['parse_debug']['skipped_entries']] == ['WR-1765000001', 'WR-1765000002']
+    assert any(w['numero_wr'] == 'WR-1765000003' for w in client.get('/works/').json())
+
+
+def test_revision_of_a_partially_applied_document_writes_the_entries_left_out():
+    headers = {"X-API-Key": os.environ["API_KEY"]}
+    pages = [
+        'Pratica: 1765100001\nCliente: Agnese Mondella\nIndirizzo: Via Manzoni 11',
+        'Pratica: 1765100002\nCliente: Perpetua Abbondio\nIndirizzo: Via Lecco 12',
+    ]
+    res = client.post('/documents/upload', files={"files": ("agenda_parziale.pdf", _make_pdf(pages), "application/pdf")}, headers=headers)
+    first_id = res.json()[0]['id']
+    client.post(f'/documents/{first_id}/parse', headers=headers)
+    # only the first entry is applied
+    res = client.post(f'/documents/{first_id}/apply', params={'selected_indices': [0]}, headers=headers)
+    assert len(res.json()['parsed_data']['applied_work_ids']) == 1
+
+    revised = pages + ['Pratica: 1765100003\nCliente: Don Rodrigo\nIndirizzo: Palazzotto 13']
+    res = client.post('/documents/upload', files={"files": ("agenda_parziale (1).pdf", _make_pdf(revised), "application/pdf")}, headers=headers)
+    second_id = res.json()[0]['id']
+    parsed = client.post(f'/documents/{second_id}/parse', headers=headers).json()['parsed_data']
+    assert parsed['parse_debug']['revision']['of'] == first_id
+    applied = client.post(f'/documents/{second_id}/apply', headers=headers).json()['parsed_data']
+    assert [s['numero_wr'] for s in applied['parse_debug']['skipped_entries']] == ['WR-1765100001']
+    assert len(applied['applied_work_ids']) == 2
+    numeri = {w['numero_wr'] for w in client.get('/works/').json()}
+    assert {'WR-1765100002', 'WR-1765100003'} <= numeri
+
+
+def test_pdf_batch_ingest_writes_documents_and_resumes_from_ledger(tmp_path):
+    from app.models.models import Document, DocumentAppliedWork, ProcessedFile
+    from app.utils import pdf_ingest
+    for i in range(3):
+        (tmp_path / f'agenda_{i}.pdf').write_bytes(_make_pdf([f'Pratica: 17670000{i}{j}\nCliente: Cliente {i}{j}\nIndirizzo: Via Archivio {j}' for j in range(2)]))
+    (tmp_path / 'copia.pdf').write_bytes((tmp_path / 'agenda_0.pdf').read_bytes())
+
+    db = SessionLocal()
+    try:
+        todo = pdf_ingest.pending_files(db, pdf_ingest.iter_pdfs([str(tmp_path)]))
+        assert len(todo) == 4
+        writer = pdf_ingest.DocumentBatchWriter(db, batch_size=2)
+        for path in todo:
+            writer.add(pdf_ingest.parse_file(path))
+        stats = writer.finish()
+        assert stats['documents'] == 3 and stats['duplicates'] == 1 and stats['works'] == 6
+
+        doc = db.query(Document).filter(Document.filename == 'agenda_1.pdf').one()
+        assert [e['numero_wr'] for e in doc.parsed_data['entries']] == ['WR-1767000010', 'WR-1767000011']
+        assert db.query(DocumentAppliedWork).filter(DocumentAppliedWork.document_id == doc.id).count() == 2
+        copy = db.query(ProcessedFile).filter(ProcessedFile.path == str(tmp_path / 'copia.pdf')).one()
+        assert copy.status == 'duplicate'
+        # Second run: everything is in the ledger
+        assert pdf_ingest.pending_files(db, pdf_ingest.iter_pdfs([str(tmp_path)])) == []
+    finally:
+        db.close()
+    assert any(w['numero_wr'] == 'WR-1767000021' for w in client.get('/works/').json())
+
+
+def test_drop_folder_watcher_debounces_dedupes_and_auto_applies(tmp_path):
+    import time
+    from app.models.models import Document
+    from app.utils import dropwatch
+    watcher = dropwatch.DropFolderWatcher(str(tmp_path), SessionLocal, debounce=0.2, min_confidence=0.8, workers=0)
+    try:
+        content = _make_pdf([
+            'Pratica: 1768000001\nCliente: Gertrude Monza\nIndirizzo: Via Monza 1',
+            'WR: 17680OO002',  # OCR noise, no customer: left for review
+        ])
+        partial = tmp_path / 'arrivo.pdf'
+        partial.write_bytes(content[:100])
+        assert watcher.poll(timeout=0.05) == 0
+        partial.write_bytes(content)  # the copy completes
+        (tmp_path / 'arrivo_copia.pdf').write_bytes(content)
+        written, deadline = 0, time.monotonic() + 5
+        while written < 2 and time.monotonic() < deadline:
+            written += watcher.poll(timeout=0.05)
+        assert written == 2
+        assert watcher.stats['documents'] == 1 and watcher.stats['duplicates'] == 1
+    finally:
+        watcher.close()
+
+    db = SessionLocal()
+    doc = db.query(Document).filter(Document.filename.in_(['arrivo.pdf', 'arrivo_copia.pdf'])).one()
+    db.close()
+    assert doc.parsed_data['pending_review'] == [1]
+    assert len(doc.parsed_data['applied_work_ids']) == 1
+    numeri = [w['numero_wr'] for w in client.get('/works/').json()]
+    assert 'WR-1768000001' in numeri and not any('17680OO002' in n for n in numeri)
+
+
+def test_drop_folder_watcher_writes_the_files_in_flight_on_close(tmp_path):
+    from app.models.models import Document
+    from app.utils import dropwatch
+
+    watcher = dropwatch.DropFolderWatcher(str(tmp_path), SessionLocal, debounce=0, workers=1)
+    try:
+        (tmp_path / 'in_volo.pdf').write_bytes(_make_pdf(['Pratica: 1768100001\nCliente: Egidio Volo\nIndirizzo: Via Volo 1']))
+        watcher._touch(str(tmp_path / 'in_volo.pdf'))
+        watcher._start_ready()  # parsing started, SIGTERM arrives before the next poll
+        assert len(watcher._running) == 1
+    finally:
+        watcher.close()
+    assert watcher.stats['documents'] == 1
+    db = SessionLocal()
+    try:
+        assert db.query(Document).filter(Document.filename == 'in_volo.pdf').count() == 1
+    finally:
+        db.close()
+
+
+def test_job_queue_runs_retries_and_fails_jobs():
+    from datetime import datetime
+    from app.models.models import Job
+    from app.utils import jobs
+
+    calls = []
+
+    @jobs.handler('test_flaky')
+    def _flaky(ctx):
+        calls.append(ctx.attempt)
+        ctx.progress(40, 'halfway')
+        raise RuntimeError('boom')
+
+    db = SessionLocal()
+    try:
+        unknown = jobs.enqueue(db, 'nonexistent')
+        assert unknown.status == 'failed' and 'Unknown job type' in unknown.message
+        # higher priority first
+        cleanup = jobs.enqueue(db, 'cleanup')
+        sync = jobs.enqueue(db, 'reindex', priority=5)
+        flaky = jobs.enqueue(db, 'test_flaky', max_attempts=2)
+        sync_id, cleanup_id, flaky_id = sync.id, cleanup.id, flaky.id
+    finally:
+        db.close()
+
+    assert jobs.run_next(SessionLocal, 'w1') == sync_id
+    assert jobs.run_next(SessionLocal, 'w1') == cleanup_id
+    assert jobs.run_next(SessionLocal, 'w1') == flaky_id
+    assert jobs.run_next(SessionLocal, 'w1') is None  # flaky waits for its backoff
+
+    db = SessionLocal()
+    try:
+        done = db.query(Job).filter(Job.id == sync_id).one()
+        assert done.status == 'completed' and done.progress == 100 and done.result['works'] >= 0
+        assert db.query(Job).filter(Job.id == cleanup_id).one().status == 'completed'
+        retry = db.query(Job).filter(Job.id == flaky_id).one()
+        assert retry.status == 'pending' and retry.attempts == 1 and 'boom' in retry.error
+        assert retry.run_after > datetime.utcnow() and retry.lease_owner is None
+        retry.run_after = datetime.utcnow()
+        db.commit()
+    finally:
+        db.close()
+
+    assert jobs.run_next(SessionLocal, 'w2') == flaky_id
+    db = SessionLocal()
+    try:
+        failed = db.query(Job).filter(Job.id == flaky_id).one()
+        assert failed.status == 'failed' and failed.attempts == 2 and failed.completed_at
+    finally:
+        db.close()
+    assert calls == [1, 2]
+    jobs.HANDLERS.pop('test_flaky')
+
+
+def test_job_lease_is_renewed_while_the_handler_runs(monkeypatch):
+    import time
+    from app.models.models import Job
+    from app.utils import jobs
+
+    monkeypatch.setattr(jobs, 'HEARTBEAT_SECONDS', 0.05)
+    seen = []
+
+    @jobs.handler('test_slow')
+    def _slow(ctx):
+        # no progress() calls: only the heartbeat can move the lease
+        for _ in range(2):
+            db = ctx.session_factory()
+            try:
+                seen.append(db.query(Job.lease_expires_at).filter(Job.id == ctx.job_id).scalar())
+            finally:
+                db.close()
+            time.sleep(0.3)
+
+    db = SessionLocal()
+    try:
+        job_id = jobs.enqueue(db, 'test_slow').id
+    finally:
+        db.close()
+    try:
+        assert jobs.run_next(SessionLocal, 'w-slow') == job_id
+    finally:
+        jobs.HANDLERS.pop('test_slow')
+    assert seen[1] > seen[0]
+    db = SessionLocal()
+    try:
+        job = db.query(Job).filter(Job.id == job_id).one()
+        assert job.status == 'completed' and job.lease_owner is None
+    finally:
+        db.close()
+
+
+def test_backup_job_ignores_a_directory_from_the_caller(tmp_path, monkeypatch):
+    from app.models.models import Job
+    from app.utils import backup, jobs
+
+    monkeypatch.setattr(backup, 'BACKUP_DIR', str(tmp_path / 'backups'))
+    elsewhere = tmp_path / 'elsewhere'
+    db = SessionLocal()
+    try:
+        job_id = jobs.enqueue(db, 'backup', {'directory': str(elsewhere), 'compression': 'gzip'}).id
+    finally:
+        db.close()
+    assert jobs.run_next(SessionLocal, 'w-backup') == job_id
+    db = SessionLocal()
+    try:
+        job = db.query(Job).filter(Job.id == job_id).one()
+        assert job.status == 'completed'
+        assert os.path.dirname(job.result['path']) == str(tmp_path / 'backups')
+        db.delete(job)
+        db.commit()
+    finally:
+        db.close()
+    assert not elsewhere.exists()
+
+
+def test_online_backup_verify_restore_rotate_and_schedule(tmp_path):
+    from datetime import datetime
+    from sqlalchemy import create_engine, text
+    from app.database import engine
+    from app.models.models import Job
+    from app.utils import backup, jobs
+
+    steps = []
+    result = backup.create_backup(engine, str(tmp_path), progress=lambda pct, msg: steps.append(pct), compression='gzip')
+    # a single step: a concurrent writer cannot make the copy start over
+    assert result['path'].endswith('.db.gz') and steps == [100]
+    assert backup.verify(result['path'])['ok']
+
+    target = create_engine(f"sqlite:///{tmp_path / 'restored.db'}")
+    backup.restore(result['path'], target)
+    with target.connect() as conn:
+        assert conn.execute(text('SELECT COUNT(*) FROM works')).scalar() == len(client.get('/works/').json())
+        # the restored change sequence gets a new identity, so earlier ETags cannot match it
+        restored_epoch = conn.execute(text('SELECT epoch FROM db_epoch')).scalars().all()
+    with engine.connect() as conn:
+        assert restored_epoch != conn.execute(text('SELECT epoch FROM db_epoch')).scalars().all()
+    assert len(restored_epoch) == 1
+    target.dispose()
+
+    for stamp in ('20200101_020000', '20200102_020000'):
+        (tmp_path / f'ftth_{stamp}.db.gz').write_bytes(b'')
+    removed = backup.rotate(str(tmp_path), retention_days=30, keep_min=1)
+    assert sorted(os.path.basename(p) for p in removed) == ['ftth_20200101_020000.db.gz', 'ftth_20200102_020000.db.gz']
+    assert [b['path'] for b in backup.list_backups(str(tmp_path))] == [result['path']]
+
+    assert jobs.cron_matches('0 2 * * *', datetime(2025, 3, 4, 2, 0))
+    assert not jobs.cron_matches('0 2 * * 1-5', datetime(2025, 3, 2, 2, 0))  # Sunday
+    assert jobs.cron_matches('*/15 8-18 * * *', datetime(2025, 3, 4, 9, 45))
+    db = SessionLocal()
+    try:
+        now = datetime(2025, 3, 4, 2, 0, 30)
+        assert len(jobs.enqueue_scheduled(db, {'backup': '0 2 * * *'}, now)) == 1
+        assert jobs.enqueue_scheduled(db, {'backup': '0 2 * * *'}, now) == []  # once per slot
+        other = SessionLocal()  # a second worker's scheduler, same minute
+        try:
+            assert jobs.enqueue_scheduled(other, {'backup': '0 2 * * *'}, now) == []
+        finally:
+            other.close()
+        assert db.query(Job).filter(Job.job_type == 'backup').count() == 1
+        db.query(Job).filter(Job.job_type == 'backup').delete()
+        db.commit()
+    finally:
+        db.close()
+
+
+def test_replication_between_two_sqlite_files_merges_conflicts_and_resumes(tmp_path):
+    import time
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from app.models.models import SyncPeer, Work
+    from app.utils import replication
+    from app.utils.schema import init_schema
+
+    remote_engine = create_engine(f"sqlite:///{tmp_path / 'remote.db'}", connect_args={"check_same_thread": False})
+    init_schema(remote_engine)
+    Remote = sessionmaker(bind=remote_engine)
+
+    def works(factory, prefix='WR-REP-'):
+        db = factory()
+        try:
+            return {w.numero_wr: (w.nome_cliente, w.stato, w.note) for w in db.query(Work).filter(Work.numero_wr.like(prefix + '%'))}
+        finally:
+            db.close()
+
+    db = SessionLocal()
+    db.add(Work(numero_wr='WR-REP-1', nome_cliente='Locale', stato='aperto'))
+    db.add(Work(numero_wr='WR-REP-2', nome_cliente='Da cancellare', stato='aperto'))
+    db.commit()
+    db.close()
+    db = Remote()
+    db.add(Work(numero_wr='WR-REP-3', nome_cliente='Remoto', stato='aperto'))
+    db.commit()
+    db.close()
+
+    peer = replication.LocalPeer(Remote, name='remote-test')
+    stats = replication.SyncEngine(SessionLocal, peer, batch_size=2).run()
+    assert stats['pulled'] == 1 and stats['pushed'] >= 2
+    assert works(SessionLocal) == works(Remote) and len(works(Remote)) == 3
+
+    # Both sides edit WR-REP-1: different fields merge, the same field goes to the later writer
+    db = SessionLocal()
+    work = db.query(Work).filter(Work.numero_wr == 'WR-REP-1').one()
+    work.note, work.stato = 'nota locale', 'in_corso'
+    db.commit()
+    db.close()
+    time.sleep(0.01)
+    db = Remote()
+    work = db.query(Work).filter(Work.numero_wr == 'WR-REP-1').one()
+    work.nome_cliente, work.stato = 'Remoto bis', 'chiuso'
+    db.delete(db.query(Work).filter(Work.numero_wr == 'WR-REP-2').one())
+    db.commit()
+    db.close()
+
+    stats = replication.SyncEngine(SessionLocal, peer, batch_size=2).run()
+    assert stats['pull_conflicts'] == 1
+    assert works(SessionLocal) == works(Remote) == {
+        'WR-REP-1': ('Remoto bis', 'chiuso', 'nota locale'),
+        'WR-REP-3': ('Remoto', 'aperto', None),
+    }
+    # Nothing new: only the echoes of our own push come back, and are skipped
+    stats = replication.SyncEngine(SessionLocal, peer).run()
+    assert not stats.get('pull_applied') and not stats.get('pushed')
+    db = SessionLocal()
+    state = db.query(SyncPeer).filter(SyncPeer.name == 'remote-test').one()
+    assert state.pull_cursor > 0 and state.push_cursor > 0 and state.last_error is None
+    db.close()
+    remote_engine.dispose()
+
+
+def test_principal_cache_skips_user_lookup_and_drops_on_role_change():
+    from sqlalchemy import event as sa_event
+    from app.database import engine
+    from app.models.models import User
+    from app.utils.auth import principal_cache
+
+    res = client.post('/auth/login', json={'username': 'admin', 'password': 'adminpass'})
+    if res.status_code != 200:
+        client.post('/auth/register', json={'username': 'admin', 'password': 'adminpass', 'role': 'admin'})
+        res = client.post('/auth/login', json={'username': 'admin', 'password': 'adminpass'})
+    admin = {"Authorization": f"Bearer {res.json()['access_token']}"}
+    assert client.post('/auth/register', json={'username': 'cachetest', 'password': 'pw-cache', 'role': 'admin'},
+                       headers=admin).status_code == 200
+    token = client.post('/auth/login', json={'username': 'cachetest', 'password': 'pw-cache'}).json()['access_token']
+    headers = {"Authorization": f"Bearer {token}"}
+
+    user_queries = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if 'FROM users' in statement:
+            user_queries.append(statement)
+
+    sa_event.listen(engine, 'before_cursor_execute', count)
+    try:
+        assert client.post('/teams/', json={'nome': 'Cache Team 1'}, headers=headers).status_code == 200
+        first = len(user_queries)
+        assert client.post('/teams/', json={'nome': 'Cache Team 2'}, headers=headers).status_code == 200
+        assert len(user_queries) == first  # served from the cache
+
+        db = SessionLocal()
+        db.query(User).filter(User.username == 'cachetest').one().role = 'tecnico'
+        db.commit()
+        db.close()
+        assert client.post('/teams/', json={'nome': 'Cache Team 3'}, headers=headers).status_code == 403
+        assert len(user_queries) > first
+    finally:
+        sa_event.remove(engine, 'before_cursor_execute', count)
+        principal_cache.clear()
+
+
+def test_login_throttles_failures_and_rehashes_outdated_passwords():
+    from passlib.context import CryptContext
+    from app.models.models import User
+    from app.utils import login as login_guard
+
+    old_hash = CryptContext(schemes=['pbkdf2_sha256'], pbkdf2_sha256__default_rounds=1000).hash('vecchia')
+    db = SessionLocal()
+    db.add(User(username='rehash-me', hashed_password=old_hash, role='backoffice'))
+    db.commit()
+    db.close()
+    try:
+        res = client.post('/auth/login', json={'username': 'rehash-me', 'password': 'vecchia'})
+        assert res.status_code == 200
+        db = SessionLocal()
+        new_hash = db.query(User.hashed_password).filter(User.username == 'rehash-me').scalar()
+        db.close()
+        assert new_hash != old_hash and '$1000$' not in new_hash
+        assert client.post('/auth/login', json={'username': 'rehash-me', 'password': 'vecchia'}).status_code == 200
+
+        for _ in range(login_guard.LOGIN_MAX_FAILURES_PER_USER):
+            assert client.post('/auth/login', json={'username': 'rehash-me', 'password': 'sbagliata'}).status_code == 401
+        res = client.post('/auth/login', json={'username': 'rehash-me', 'password': 'vecchia'})
+        assert res.status_code == 429 and int(res.headers['Retry-After']) > 0
+    finally:
+        login_guard.throttle = login_guard.LoginThrottle()
+
+    busy = login_guard.PasswordVerifier(workers=1, queue_limit=1)
+    busy._slots.acquire()
+    with pytest.raises(login_guard.Busy):
+        busy.verify('x', new_hash)
+
+    # a spray of usernames keeps at most max_keys entries, and expired keys go on the next failure
+    bounded = login_guard.LoginThrottle(window=60, max_keys=3)
+    for i in range(10):
+        bounded.failed(f'user:spray{i}')
+    assert list(bounded._failures) == ['user:spray7', 'user:spray8', 'user:spray9']
+    bounded.window = 0
+    bounded.failed('user:last')
+    assert list(bounded._failures) == []
+
+
+def test_archive_moves_old_closed_works_and_keeps_lookups_and_stats():
+    from datetime import datetime, timedelta
+    from app.models.models import ArchivedWork, ONT, Technician, Work, WorkJournalEntry, WorkMatchKey
+    from app.utils import archive
+
+    db = SessionLocal()
+    tech = Technician(nome='Archivio', cognome='Tecnico', telefono='3330000000')
+    db.add(tech)
+    db.flush()
+    old_close = datetime.now() - timedelta(days=800)
+    old = Work(numero_wr='ARCH-OLD-1', operatore='ArchOp', nome_cliente='Cliente Vecchio', stato='chiuso',
+               data_apertura=old_close - timedelta(days=3), data_chiusura=old_close, tecnico_assegnato_id=tech.id)
+    recent = Work(numero_wr='ARCH-NEW-1', operatore='ArchOp', stato='chiuso', data_chiusura=datetime.now() - timedelta(days=1),
+                  tecnico_assegnato_id=tech.id)
+    db.add_all([old, recent])
+    db.flush()
+    db.add(WorkJournalEntry(work_id=old.id, ts=old_close, kind=4, note='chiuso'))
+    db.add(ONT(serial_number='ARCH-ONT-1', model='HG8245', status='installed', work_id=old.id))
+    db.commit()
+    old_id, recent_id, tech_id = old.id, recent.id, tech.id
+    db.close()
+
+    def operator_total():
+        return {r['operatore']: r['closed'] for r in client.get('/stats/closed_by_operator').json()}.get('ArchOp')
+
+    assert operator_total() == 2
+
+    db = SessionLocal()
+    result = archive.archive_closed(db, months=6)
+    assert result['archived'] >= 1
+    assert db.query(Work).filter(Work.id == old_id).first() is None
+    assert db.query(Work).filter(Work.id == recent_id).first() is not None
+    assert db.query(WorkJournalEntry).filter(WorkJournalEntry.work_id == old_id).count() == 0
+    assert db.query(WorkMatchKey).filter(WorkMatchKey.work_id == old_id).count() == 0
+    assert db.query(ONT).filter(ONT.serial_number == 'ARCH-ONT-1').one().work_id is None
+    archived = db.get(ArchivedWork, old_id)
+    assert archived.events[0]['note'] == 'chiuso'
+    assert archived.equipment['onts'][0]['serial_number'] == 'ARCH-ONT-1'
+    assert archive.archive_closed(db, months=6)['archived'] == 0
+    db.close()
+
+    res = client.get(f'/works/{old_id}')
+    assert res.status_code == 200
+    assert res.headers.get('X-Archived') == 'true'
+    assert res.json()['numero_wr'] == 'ARCH-OLD-1'
+    assert res.json()['tecnico_assegnato']['id'] == tech_id
+
+    # counts are unchanged: the archived work comes from the aggregates
+    assert operator_total() == 2
+    technicians = {r['tecnico']: r['closed'] for r in client.get('/stats/closed_by_technician').json()}
+    assert technicians['Archivio Tecnico'] == 2
+    days = {r['date']: r['closed'] for r in client.get('/stats/daily_closed').json()}
+    assert days[old_close.date().isoformat()] >= 1
+
+
+def test_work_journal_batches_diffs_and_streams_history():
+    import json as _json
+    from datetime import datetime
+    from sqlalchemy import event as sa_event
+    from app.database import engine
+    from app.models.models import Technician, Work, WorkEvent, WorkJournalEntry
+    from app.utils import journal
+
+    db = SessionLocal()
+    tech = Technician(nome='Journal', cognome='Tecnico', telefono='3331112222')
+    work = Work(numero_wr='JOURNAL-1', stato='aperto', nome_cliente='Prima')
+    db.add_all([tech, work])
+    db.commit()
+    work_id, tech_id = work.id, tech.id
+    db.close()
+
+    inserts = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('INSERT INTO work_journal'):
+            inserts.append(executemany)
+
+    sa_event.listen(engine, 'before_cursor_execute', count)
+    try:
+        res = client.put(f'/works/{work_id}', json={'stato': 'chiuso', 'tecnico_assegnato_id': tech_id, 'nome_cliente': 'Dopo'})
+    finally:
+        sa_event.remove(engine, 'before_cursor_execute', count)
+    assert res.status_code == 200
+    assert inserts == [True]  # three entries, one executemany
+
+    res = client.get(f'/works/{work_id}/history')
+    assert res.status_code == 200
+    assert res.headers['content-type'].startswith('application/x-ndjson')
+    entries = [_json.loads(line) for line in res.text.splitlines()]
+    assert [e['kind'] for e in entries] == ['closed', 'assigned', 'updated']
+    assert entries[0]['diff']['stato'] == ['aperto', 'chiuso']
+    assert entries[1]['diff'] == {'tecnico_assegnato_id': [None, tech_id]} and entries[1]['actor_id'] == tech_id
+    assert entries[2]['diff'] == {'nome_cliente': ['Prima', 'Dopo']}
+    assert client.get('/works/999999999/history').status_code == 404
+
+    # legacy free-text events are moved into the journal at startup
+    db = SessionLocal()
+    db.add(WorkEvent(work_id=work_id, timestamp=datetime(2020, 1, 1), event_type='created_manual', description='Created via manual entry'))
+    db.commit()
+    assert journal.ensure_migrated(engine) == 1
+    assert db.query(WorkEvent).count() == 0
+    legacy = db.query(WorkJournalEntry).filter(WorkJournalEntry.work_id == work_id).order_by(WorkJournalEntry.ts).first()
+    assert legacy.kind == journal.EventKind.CREATED and legacy.note == 'Created via manual entry'
+    db.close()
+    assert [_json.loads(line)['kind'] for line in client.get(f'/works/{work_id}/history').text.splitlines()][0] == 'created'
+
+
+def test_unit_of_work_commits_once_and_notifies_after_commit():
+    from sqlalchemy import event as sa_event
+    from app.database import engine
+    from app.models.models import Work, WorkJournalEntry
+    from app.utils import journal
+    from app.utils.uow import UnitOfWork
+
+    res = client.post('/auth/login', json={'username': 'admin', 'password': 'adminpass'})
+    if res.status_code != 200:
+        client.post('/auth/register', json={'username': 'admin', 'password': 'adminpass', 'role': 'admin'})
+        res = client.post('/auth/login', json={'username': 'admin', 'password': 'adminpass'})
+    admin = {"Authorization": f"Bearer {res.json()['access_token']}"}
+
+    db = SessionLocal()
+    work = Work(numero_wr='UOW-1', stato='aperto')
+    db.add(work)
+    db.commit()
+    work_id = work.id
+    db.close()
+
+    commits = []
+
+    def count(conn):
+        commits.append(conn)
+
+    sa_event.listen(engine, 'commit', count)
+    try:
+        assert client.put(f'/works/{work_id}/status', json={'stato': 'sospeso'}, headers=admin).status_code == 200
+    finally:
+        sa_event.remove(engine, 'commit', count)
+    assert len(commits) == 1  # status change and journal entry together
+
+    # notifications run after the commit, and only if it happened
+    seen = []
+
+    def notify(wr):
+        check = SessionLocal()
+        seen.append(check.query(Work.id).filter(Work.numero_wr == wr).first() is not None)
+        check.close()
+
+    db = SessionLocal()
+    with UnitOfWork(db) as uow:
+        created = uow.add(Work(numero_wr='UOW-2', stato='aperto'))
+        uow.event(created, journal.EventKind.CREATED, note='test')
+        uow.notify(notify, 'UOW-2')
+        assert seen == []
+    assert seen == [True]
+    assert db.query(WorkJournalEntry).filter(WorkJournalEntry.work_id == created.id).count() == 1
+
+    try:
+        with UnitOfWork(db) as uow:
+            uow.add(Work(numero_wr='UOW-3', stato='aperto'))
+            uow.event(work_id, journal.EventKind.UPDATED, note='lost')
+            uow.notify(notify, 'UOW-3')
+            raise RuntimeError('boom')
+    except RuntimeError:
+        pass
+    assert seen == [True]
+    assert db.query(Work).filter(Work.numero_wr == 'UOW-3').first() is None
+    assert db.query(WorkJournalEntry).filter(WorkJournalEntry.note == 'lost').count() == 0
+    db.close()
+
+
+def test_optimistic_concurrency_if_match_and_conflicting_writes():
+    from sqlalchemy import event as sa_event, update
+    from sqlalchemy.orm.exc import StaleDataError
+    from app.database import engine
+    from app.models.models import ONT, Work
+
+    headers = {"X-API-Key": os.environ["API_KEY"]}
+    db = SessionLocal()
+    work = Work(numero_wr='OCC-1', stato='aperto')
+    ont = ONT(serial_number='OCC-ONT-1', model='HG8245')
+    db.add_all([work, ont])
+    db.commit()
+    work_id, ont_id = work.id, ont.id
+    db.close()
+
+    assert client.get(f'/works/{work_id}').json()['version'] == 1
+    res = client.put(f'/works/{work_id}', json={'note': 'first'}, headers={'If-Match': '"1"'})
+    assert res.status_code == 200
+    assert res.headers['ETag'] == '"2"' and res.json()['version'] == 2
+    # a client still holding version 1 is refused before anything is written
+    res = client.put(f'/works/{work_id}', json={'note': 'stale'}, headers={'If-Match': '"1"'})
+    assert res.status_code == 412 and res.headers['ETag'] == '"2"'
+    assert client.get(f'/works/{work_id}').json()['note'] == 'first'
+
+    # a write based on a row read before someone else's commit matches nothing
+    db = SessionLocal()
+    stale = db.get(Work, work_id)
+    assert client.put(f'/works/{work_id}', json={'note': 'second'}).status_code == 200
+    stale.stato = 'chiuso'
+    with pytest.raises(StaleDataError):
+        db.commit()
+    db.rollback()
+    db.close()
+
+    # the ONT is taken by a concurrent request between this route's read and its UPDATE
+    fired = []
+
+    def race(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('UPDATE onts') and not fired:
+            fired.append(statement)
+            with engine.begin() as other:
+                other.execute(update(ONT.__table__).where(ONT.id == ont_id).values(version=ONT.version + 1))
+
+    sa_event.listen(engine, 'before_cursor_execute', race)
+    try:
+        res = client.put(f'/onts/{ont_id}/assign/{work_id}', headers=headers)
+    finally:
+        sa_event.remove(engine, 'before_cursor_execute', race)
+    assert fired and res.status_code == 409
+    current = client.get(f'/onts/{ont_id}', headers=headers).json()
+    assert current['status'] == 'available' and current['work_id'] is None
+
+    res = client.put(f'/onts/{ont_id}/assign/{work_id}', headers={**headers, 'If-Match': f'"{current["version"]}"'})
+    assert res.status_code == 200 and res.headers['ETag'] == f'"{current["version"] + 1}"'
+    assert client.put(f'/works/{work_id}/ont/{ont_id}', headers=headers).status_code == 400
+
+
+def test_get_etag_round_trips_as_if_match():
+    from app.models.models import Modem, ONT, Work
+
+    headers = {"X-API-Key": os.environ["API_KEY"]}
+    db = SessionLocal()
+    work = Work(numero_wr='OCC-GET-1', stato='aperto')
+    ont = ONT(serial_number='OCC-GET-ONT', model='HG8245')
+    modem = Modem(serial_number='OCC-GET-MDM', model='FRITZ', type='fiber')
+    db.add_all([work, ont, modem])
+    db.commit()
+    work_id, ont_id, modem_id = work.id, ont.id, modem.id
+    db.close()
+
+    # read, then write back with the ETag of the read
+    tag = client.get(f'/works/{work_id}').headers['ETag']
+    assert tag.startswith('"1.')
+    assert client.get(f'/works/{work_id}', headers={'If-None-Match': tag}).status_code == 304
+    res = client.put(f'/works/{work_id}', json={'note': 'from GET'}, headers={'If-Match': tag})
+    assert res.status_code == 200 and res.headers['ETag'] == '"2"'
+    assert client.put(f'/works/{work_id}', json={'note': 'stale'}, headers={'If-Match': tag}).status_code == 412
+    for path, body in ((f'/onts/{ont_id}', {'location': 'MAG-OCC'}), (f'/modems/{modem_id}', {'location': 'MAG-OCC'})):
+        tag = client.get(path, headers=headers).headers['ETag']
+        assert client.put(path, json=body, headers={**headers, 'If-Match': tag}).status_code == 200
+
+    # If-None-Match: * only matches a resource that exists
+    assert client.get(f'/works/{work_id}', headers={'If-None-Match': '*'}).status_code == 304
+    assert client.get('/works/987654321', headers={'If-None-Match': '*'}).status_code == 404
+    assert client.get('/onts/987654321', headers={**headers, 'If-None-Match': '*'}).status_code == 404
+
+
+def test_inventory_reserves_consumes_and_auto_assigns_with_stock_counters():
+    from datetime import date, datetime, timedelta
+    from app.models.models import InventoryStock, Modem, ONT, Work
+    from app.utils import inventory
+
+    headers = {"X-API-Key": os.environ["API_KEY"]}
+    db = SessionLocal()
+    onts = [ONT(serial_number=f'INV-ONT-{i}', model='F601', location='MAG-INV') for i in range(3)]
+    modem = Modem(serial_number='INV-MDM-1', model='FRITZ', type='fiber', location='MAG-INV')
+    day = date(2031, 5, 5)
+    activation = Work(numero_wr='INV-1', stato='aperto', tipo_lavoro='attivazione', data_apertura=datetime(2031, 5, 5, 9))
+    repair = Work(numero_wr='INV-2', stato='aperto', tipo_lavoro='guasto', data_apertura=datetime(2031, 5, 5, 11))
+    closed = Work(numero_wr='INV-3', stato='chiuso', tipo_lavoro='attivazione', data_apertura=datetime(2031, 5, 5, 12))
+    db.add_all(onts + [modem, activation, repair, closed])
+    db.commit()
+    ont_ids = [o.id for o in onts]
+    work_id, repair_id = activation.id, repair.id
+    db.close()
+
+    def ont_stock():
+        rows = client.get('/inventory/stock?kind=ont&location=MAG-INV', headers=headers).json()
+        assert len(rows) == 1 and rows[0]['model'] == 'F601'
+        return rows[0]
+
+    assert ont_stock()['available'] == 3
+
+    # only the open activation needs devices; a second run finds nothing left to do
+    res = client.post(f'/inventory/auto-assign?day={day}&location=MAG-INV', headers=headers).json()
+    assert res['ont'] == {'needed': 1, 'reserved': 1, 'missing': 0}
+    assert res['modem'] == {'needed': 1, 'reserved': 1, 'missing': 0}
+    assert ont_stock()['available'] == 2 and ont_stock()['reserved'] == 1
+    assert client.post(f'/inventory/auto-assign?day={day}&location=MAG-INV', headers=headers).json()['ont']['needed'] == 0
+    db = SessionLocal()
+    reserved_id = db.query(ONT.id).filter(ONT.work_id == work_id, ONT.status == 'reserved').scalar()
+    db.close()
+    assert reserved_id == ont_ids[0]
+
+    res = client.post('/inventory/reserve', json={'kind': 'ont', 'work_id': repair_id, 'model': 'F601', 'location': 'MAG-INV'}, headers=headers)
+    assert res.status_code == 200 and res.json()['id'] == ont_ids[1]
+
+    # a device reserved for another work cannot be taken; the work's own reservation is consumed
+    assert client.put(f'/onts/{ont_ids[1]}/assign/{work_id}', headers=headers).status_code == 400
+    assert client.put(f'/works/{work_id}/ont/{reserved_id}', headers=headers).status_code == 200
+    stock = ont_stock()
+    assert (stock['available'], stock['reserved'], stock['assigned']) == (1, 1, 1)
+
+    assert client.post(f'/inventory/ont/{ont_ids[1]}/release?work_id={work_id}', headers=headers).status_code == 409
+    assert client.post(f'/inventory/ont/{ont_ids[1]}/release', headers=headers).status_code == 200
+    assert ont_stock()['reserved'] == 0
+
+    # reservations past their TTL go back to stock; ORM writes keep the counters in step too
+    db = SessionLocal()
+    assert inventory.reserve(db, 'ont', repair_id, location='MAG-INV', ttl=timedelta(minutes=5))['id'] == ont_ids[1]
+    # stock reads count a lapsed reservation as available before expire() runs
+    later = datetime.utcnow() + timedelta(minutes=10)
+    (lapsed,) = inventory.stock(db, kind='ont', location='MAG-INV', now=later)
+    assert (lapsed['available'], lapsed['reserved']) == (2, 0)
+    assert inventory.expire(db, now=later) == 1
+    db.commit()
+    db.close()
+    assert client.put(f'/onts/{reserved_id}/return', headers=headers).status_code == 200
+    assert ont_stock()['available'] == 3
+    db = SessionLocal()
+    counters = {(s.kind, s.location, s.model, s.status): s.quantity for s in db.query(InventoryStock) if s.quantity}
+    inventory.rebuild(db.connection())
+    recount = {(s.kind, s.location, s.model, s.status): s.quantity for s in db.query(InventoryStock) if s.quantity}
+    db.rollback()
+    db.close()
+    assert counters == recount
+
+
+def test_bulk_device_registration_from_csv_and_ndjson():
+    headers = {"X-API-Key": os.environ["API_KEY"]}
+    scan = b"SN-BULK-1\nSN-BULK-2\r\nSN-BULK-1\n\nSN-BULK-3"
+    res = client.post('/onts/bulk?model=F601&location=MAG-BULK&chunk_size=2', content=scan,
+                      headers={**headers, 'Content-Type': 'text/csv'})
+    assert res.status_code == 200
+    body = res.json()
+    assert (body['received'], body['created'], body['duplicate'], body['exists']) == (4, 3, 1, 0)
+    assert [r['status'] for r in body['results']] == ['created', 'created', 'duplicate', 'created']
+    stock = client.get('/inventory/stock?kind=ont&location=MAG-BULK', headers=headers).json()
+    assert stock[0]['available'] == 3 and stock[0]['model'] == 'F601'
+
+    # the same delivery sent again registers nothing; a header row maps the columns
+    res = client.post('/onts/bulk', content=b"seriale;model;location\nSN-BULK-2;F601;MAG-BULK\nSN-BULK-4;G2425;MAG-BULK\n",
+                      headers={**headers, 'Content-Type': 'text/csv'}).json()
+    assert [(r['serial_number'], r['status']) for r in res['results']] == [('SN-BULK-2', 'exists'), ('SN-BULK-4', 'created')]
+    assert client.get(f"/onts/{res['results'][1]['id']}", headers=headers).json()['model'] == 'G2425'
+
+    lines = [json.dumps({'serial_number': 'MD-BULK-1', 'sync_method': 'pppoe'}), json.dumps('MD-BULK-2'),
+             json.dumps({'model': 'no serial'}), '{broken']
+    res = client.post('/modems/bulk?model=FRITZ&type=fiber', content='\n'.join(lines).encode(),
+                      headers={**headers, 'Content-Type': 'application/x-ndjson'}).json()
+    assert [r['status'] for r in res['results']] == ['created', 'created', 'error', 'error']
+    modem = client.get(f"/modems/{res['results'][0]['id']}", headers=headers).json()
+    assert (modem['type'], modem['sync_method'], modem['status']) == ('fiber', 'pppoe', 'available')
+
+
+def test_dispatch_balances_load_by_skills_and_locality_with_preview():
+    from datetime import date, datetime
+    from app.models.models import Team, Technician, Work
+    from app.utils import dispatch
+
+    assert dispatch.locality('Via Roma 1, 20121 Milano (MI)') == '20121'
+    assert dispatch.locality('Via Po 3, Torino (TO)') == 'torino'
+
+    headers = {"X-API-Key": os.environ["API_KEY"]}
+    db = SessionLocal()
+    team = Team(nome='Squadra Dispatch')
+    db.add(team)
+    db.flush()
+    anyone = Technician(nome='Ada', cognome='Generalista', telefono='3330000001', squadra_id=team.id)
+    fixer = Technician(nome='Bruno', cognome='Guasti', telefono='3330000002', squadra_id=team.id, competenze=['guasto'])
+    installer = Technician(nome='Carla', cognome='Attivazioni', telefono='3330000003', squadra_id=team.id, competenze=['attivazione'])
+    db.add_all([anyone, fixer, installer])
+    works = [Work(numero_wr=f'DSP-A{i}', stato='aperto', tipo_lavoro='attivazione', indirizzo=f'Via Roma {i}, 20121 Milano',
+                  data_apertura=datetime(2031, 6, 6, 8 + i)) for i in range(4)]
+    works += [Work(numero_wr=f'DSP-G{i}', stato='aperto', tipo_lavoro='guasto', indirizzo=f'Via Po {i}, Torino',
+                   data_apertura=datetime(2031, 6, 6, 13 + i)) for i in range(2)]
+    works.append(Work(numero_wr='DSP-M0', stato='aperto', tipo_lavoro='manutenzione', indirizzo='Corso Francia 9, Torino',
+                      data_apertura=datetime(2031, 6, 6, 16)))
+    db.add_all(works)
+    db.commit()
+    techs = {t.id: t.competenze for t in (anyone, fixer, installer)}
+    team_id, work_ids = team.id, [w.id for w in works]
+    db.close()
+    day = date(2031, 6, 6)
+
+    # preview: a complete plan that respects skills, nothing written
+    res = client.post(f'/dispatch?preview=true&day={day}&team_id={team_id}', headers=headers)
+    assert res.status_code == 200
+    planned = res.json()
+    assert planned['preview'] is True and planned['works'] == 7 and len(planned['assigned']) == 7
+    for entry in planned['assigned']:
+        skills = techs[entry['technician_id']]
+        assert skills is None or entry['tipo_lavoro'] in skills
+    assert {e['technician_id'] for e in planned['assigned'] if e['numero_wr'] == 'DSP-M0'} == {anyone.id}
+    # the two repairs share a locality and go to the same technician
+    assert len({e['technician_id'] for e in planned['assigned'] if e['tipo_lavoro'] == 'guasto'}) == 1
+    db = SessionLocal()
+    assert db.query(Work).filter(Work.id.in_(work_ids), Work.tecnico_assegnato_id.isnot(None)).count() == 0
+    db.close()
+
+    # with a cap of 2 open works each, one of the seven works is left over
+    res = client.post(f'/dispatch?day={day}&team_id={team_id}&max_open_works=2', headers=headers).json()
+    assert res['preview'] is False and len(res['assigned']) == 6
+    assert res['unassigned'] == [{'work_id': res['unassigned'][0]['work_id'], 'numero_wr': res['unassigned'][0]['numero_wr'],
+                                  'reason': 'all technicians at capacity'}]
+    assert all(t['open_after'] == 2 for t in res['technicians'])
+    db = SessionLocal()
+    rows = db.query(Work).filter(Work.id.in_(work_ids), Work.tecnico_assegnato_id.isnot(None)).all()
+    assert len(rows) == 6 and all(w.stato == 'in_corso' and w.version == 2 for w in rows)
+    db.close()
+    history = [json.loads(line) for line in client.get(f'/works/{rows[0].id}/history').text.splitlines()]
+    assert [(e['kind'], e['note']) for e in history if e['kind'] == 'assigned'] == [('assigned', 'dispatch')]
+
+    # the technicians are full: a second run assigns nothing
+    res = client.post(f'/dispatch?day={day}&team_id={team_id}&max_open_works=2', headers=headers).json()
+    assert res['works'] == 1 and res['assigned'] == []
+
+
+def test_address_normalization_cache_and_area_index(tmp_path, monkeypatch):
+    from app.models.models import AddressCache, Work, WorkLocation
+    from app.utils import geocode
+
+    headers = {"X-API-Key": os.environ["API_KEY"]}
+    res = client.get('/areas/normalize', params={'address': 'p.zza della Loggia, 5/b - 39991 Brescia BS'}, headers=headers).json()
+    assert (res['street_type'], res['street'], res['civico'], res['cap'], res['comune'], res['provincia']) == \
+        ('Piazza', 'della Loggia', '5/B', '39991', 'Brescia', 'BS')
+    assert res['canonical'] == 'Piazza della Loggia 5/B, 39991 Brescia (BS)' and res['area'] == '39991'
+
+    db = SessionLocal()
+    works = [Work(numero_wr='GEO-1', stato='aperto', indirizzo='Via Roma 1, 39991 Brescia (BS)'),
+             Work(numero_wr='GEO-2', stato='aperto', indirizzo='via  ROMA 1 , 39991 brescia (bs)'),
+             Work(numero_wr='GEO-3', stato='chiuso', indirizzo='C.so Zanardelli 3, 39991 Brescia'),
+             Work(numero_wr='GEO-4', stato='aperto', indirizzo='Viale Venezia 10, Lumezzane Geo')]
+    db.add_all(works)
+    db.commit()
+    ids = [w.id for w in works]
+    # the same address written differently is parsed and stored once
+    locations = {l.work_id: l for l in db.query(WorkLocation).filter(WorkLocation.work_id.in_(ids))}
+    assert locations[ids[0]].address_id == locations[ids[1]].address_id
+    assert db.query(AddressCache).filter(AddressCache.id == locations[ids[0]].address_id).one().canonical == 'Via Roma 1, 39991 Brescia (BS)'
+    assert locations[ids[3]].area == 'lumezzane geo'
+    works[3].indirizzo = 'Viale Venezia 10, 39991 Brescia'
+    db.commit()
+    assert db.query(WorkLocation.area).filter(WorkLocation.work_id == ids[3]).scalar() == '39991'
+    db.close()
+
+    areas = client.get('/areas', params={'comune': 'brescia'}, headers=headers).json()
+    assert [(a['area'], a['works']) for a in areas] == [('39991', 3)]
+    areas = client.get('/areas', params={'comune': 'brescia', 'open_only': 'false'}, headers=headers).json()
+    assert (areas[0]['works'], areas[0]['open']) == (4, 3)
+    listed = client.get('/areas/works', params={'cap': '39991'}, headers=headers).json()
+    assert sorted(w['numero_wr'] for w in listed) == ['GEO-1', 'GEO-2', 'GEO-4']
+    assert client.get('/areas/works', headers=headers).status_code == 400
+
+    # a local gazetteer completes the CAP of a comune and gives the coordinates
+    gazetteer = tmp_path / 'cap.csv'
+    gazetteer.write_text('cap;comune;provincia;lat;lon\n39992;Geoborgo;GB;45,5;10,2\n')
+    monkeypatch.setattr(geocode, 'GAZETTEER_PATH', str(gazetteer))
+    monkeypatch.setattr(geocode, '_gazetteer', None)
+    res = geocode.normalize('Via Verdi 2, Geoborgo')
+    assert (res['cap'], res['provincia'], res['lat'], res['lon'], res['area']) == ('39992', 'GB', 45.5, 10.2, '39992')
+
+
+def test_deleting_a_work_removes_its_index_and_journal_rows_first(tmp_path):
+    from sqlalchemy import create_engine, event, func
+    from sqlalchemy.orm import sessionmaker
+    from app.models.models import Work, WorkJournalEntry, WorkLocation, WorkMatchKey
+    from app.utils import journal
+    from app.utils.schema import init_schema
+
+    # enforce the foreign keys like PostgreSQL does
+    fk_engine = create_engine(f"sqlite:///{tmp_path / 'fk.db'}")
+    event.listen(fk_engine, 'connect', lambda conn, record: conn.execute('PRAGMA foreign_keys=ON'))
+    init_schema(fk_engine)
+    db = sessionmaker(bind=fk_engine)()
+    try:
+        work = Work(numero_wr='WR-FK-1', nome_cliente='Mario Rossi', indirizzo='Via Roma 1, 25121 Brescia')
+        db.add(work)
+        journal.add(db, work, journal.EventKind.CREATED)
+        db.commit()
+        work_id = work.id
+        assert db.query(WorkLocation).filter(WorkLocation.work_id == work_id).count() == 1
+        assert db.query(WorkMatchKey).filter(WorkMatchKey.work_id == work_id).count() > 0
+        journal.add(db, work_id, journal.EventKind.UPDATED, note='pending when deleted')
+        db.delete(work)
+        db.commit()
+        for model in (WorkLocation, WorkMatchKey, WorkJournalEntry):
+            assert db.query(func.count()).select_from(model).filter(model.work_id == work_id).scalar() == 0
+    finally:
+        db.close()
+        fk_engine.dispose()
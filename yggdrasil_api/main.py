@@ -36,7 +36,18 @@ os.environ["DATABASE_URL"] = DATABASE_URL
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print(f"🚀 Yggdrasil API starting on [{YGGDRASIL_HOST}]:{YGGDRASIL_PORT}")
+    from app.database import SessionLocal, engine
+    from app.utils.jobs import SCHEDULES, Worker
+    from app.utils.schema import init_schema
+    init_schema(engine)
+    # Runs queued jobs in this process; set JOBS_EMBEDDED_WORKER=0 when app.worker runs as a service
+    worker = None
+    if os.getenv("JOBS_EMBEDDED_WORKER", "1").lower() in ("1", "true", "yes"):
+        worker = Worker(SessionLocal, concurrency=int(os.getenv("JOBS_CONCURRENCY") or 2),
+                        schedules=SCHEDULES).start()
     yield
+    if worker:
+        worker.stop(timeout=5)
     print("🛑 Yggdrasil API shutting down")
 
 # Create app
@@ -2,8 +2,8 @@
 Ingest Router - For receiving data from external sources
 """
 
-from fastapi import APIRouter, Depends, HTTPException, Header
-from pydantic import BaseModel
+from fastapi import APIRouter, Depends, HTTPException, Header, Query, Request
+from pydantic import BaseModel, ValidationError
 from typing import Optional, List, Dict, Any
 from datetime import datetime
 import sys
@@ -13,9 +13,9 @@ import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 
 from app.database import SessionLocal, engine
-from app.models.models import Work, Technician
+from app.utils.ingest import WorkIngestor, DEFAULT_CHUNK_SIZE, run_bulk_ingest
+from app.utils import idempotency
 from sqlalchemy.orm import Session
-from sqlalchemy.exc import IntegrityError
 
 router = APIRouter()
 
@@ -56,164 +56,137 @@ async def verify_key(x_key: str = Header(..., alias="X-KEY")):
     return x_key
 
 
+# ============ Helpers ============
+
+def _to_record(work: WorkIngest, source: str) -> dict:
+    """Map a Yggdrasil WorkIngest onto a shared ingest engine record"""
+    extra = dict(work.extra_fields or {})
+    if work.telefono_cliente:
+        extra['telefono'] = work.telefono_cliente
+    return {
+        "numero_wr": work.numero_wr,
+        "values": {
+            "nome_cliente": work.nome_cliente,
+            "indirizzo": work.indirizzo,
+            "operatore": work.operatore,
+            "tipo_lavoro": work.tipo_lavoro,
+            "note": work.note,
+        },
+        # Only used when the work is created
+        "defaults": {"stato": "aperto", "data_apertura": datetime.now()},
+        "defaults_extra": {
+            "telefono": work.telefono_cliente,
+            "source": source,
+            "data_appuntamento": work.data_appuntamento,
+        },
+        "extra": extra,
+    }
+
+
+def _feed(ingestor: WorkIngestor, index: int, item: Any, source: str):
+    numero_wr = item.get("numero_wr") if isinstance(item, dict) else getattr(item, "numero_wr", None)
+    try:
+        work = item if isinstance(item, WorkIngest) else WorkIngest.model_validate(item)
+        ingestor.add(index, _to_record(work, source))
+    except (ValidationError, ValueError) as e:
+        ingestor.add_error(index, numero_wr, str(e))
+
+
+def _response(summary: dict, source: str) -> IngestResponse:
+    errors = [f"{e['numero_wr']}: {e['error']}" for e in summary["errors"]]
+    return IngestResponse(
+        ok=len(errors) == 0,
+        message=f"Bulk ingest from {source}: {summary['success_count']} processed, {len(errors)} errors",
+        received=summary["received"],
+        processed=summary["success_count"],
+        errors=errors
+    )
+
+
 # ============ Endpoints ============
 
 @router.post("/work", response_model=IngestResponse, dependencies=[Depends(verify_key)])
-async def ingest_single_work(work: WorkIngest):
-    """Ingest a single work order"""
+async def ingest_single_work(work: WorkIngest, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    """Ingest a single work order.
+
+    Retries with the same ``Idempotency-Key`` and payload get the original
+    response back without re-running the upsert.
+    """
     db: Session = SessionLocal()
     try:
-        # Check if work already exists
-        existing_work = db.query(Work).filter(Work.numero_wr == work.numero_wr).first()
-        
-        if existing_work:
-            # Update existing work
-            if work.nome_cliente:
-                existing_work.nome_cliente = work.nome_cliente
-            if work.telefono_cliente:
-                # Store phone in extra_fields if not already there
-                if not existing_work.extra_fields:
-                    existing_work.extra_fields = {}
-                existing_work.extra_fields['telefono'] = work.telefono_cliente
-            if work.indirizzo:
-                existing_work.indirizzo = work.indirizzo
-            if work.operatore:
-                existing_work.operatore = work.operatore
-            if work.tipo_lavoro:
-                existing_work.tipo_lavoro = work.tipo_lavoro
-            if work.note:
-                existing_work.note = work.note
-            if work.extra_fields:
-                if not existing_work.extra_fields:
-                    existing_work.extra_fields = {}
-                existing_work.extra_fields.update(work.extra_fields)
-            
-            db.commit()
-            message = f"Work {work.numero_wr} updated"
-        else:
-            # Create new work
-            new_work = Work(
-                numero_wr=work.numero_wr,
-                nome_cliente=work.nome_cliente,
-                indirizzo=work.indirizzo,
-                operatore=work.operatore,
-                tipo_lavoro=work.tipo_lavoro,
-                note=work.note,
-                stato="aperto",
-                data_apertura=datetime.now(),
-                extra_fields={
-                    "telefono": work.telefono_cliente,
-                    "source": "yggdrasil",
-                    "data_appuntamento": work.data_appuntamento,
-                    **(work.extra_fields or {})
-                }
+        digest = None
+        if idempotency_key:
+            digest = idempotency.payload_hash(work.model_dump(mode="json"))
+            cached = idempotency.claim(db, "ygg.ingest.work", idempotency_key, digest)
+            if cached is not None:
+                return cached
+        ingestor = WorkIngestor(db, extra_mode="merge", event_note="yggdrasil")
+        _feed(ingestor, 0, work, "yggdrasil")
+        summary = ingestor.finish()
+        if summary["errors"]:
+            if idempotency_key:
+                idempotency.release(db, "ygg.ingest.work", idempotency_key)
+            return IngestResponse(
+                ok=False,
+                message=f"Work {work.numero_wr} could not be ingested",
+                received=1,
+                processed=0,
+                errors=[e["error"] for e in summary["errors"]]
             )
-            db.add(new_work)
-            db.commit()
-            message = f"Work {work.numero_wr} created"
-        
-        return IngestResponse(
+        result = summary["results"][0]
+        response = IngestResponse(
             ok=True,
-            message=message,
+            message=f"Work {result['numero_wr']} {result['status']}",
             received=1,
             processed=1
         )
-    except IntegrityError as e:
-        db.rollback()
-        return IngestResponse(
-            ok=False,
-            message=f"Work {work.numero_wr} already exists or constraint violation",
-            received=1,
-            processed=0,
-            errors=[str(e)]
-        )
-    except Exception as e:
-        db.rollback()
-        return IngestResponse(
-            ok=False,
-            message=str(e),
-            received=1,
-            processed=0,
-            errors=[str(e)]
-        )
+        if idempotency_key:
+            idempotency.complete(db, "ygg.ingest.work", idempotency_key, digest, response.model_dump())
+        return response
     finally:
         db.close()
 
 
-@router.post("/bulk", response_model=IngestResponse, dependencies=[Depends(verify_key)])
-async def ingest_bulk_works(request: BulkIngestRequest):
-    """Ingest multiple work orders at once"""
+@router.post("/bulk", response_model=IngestResponse, dependencies=[Depends(verify_key)], openapi_extra={
+    "requestBody": {
+        "content": {
+            "application/json": {"schema": {"type": "object", "properties": {"works": {"type": "array", "items": {"type": "object"}}, "source": {"type": "string"}}}},
+            "application/x-ndjson": {"schema": {"type": "string", "description": "One WorkIngest JSON object per line"}},
+        },
+        "required": True,
+    }
+})
+async def ingest_bulk_works(request: Request, source: Optional[str] = None, chunk_size: int = Query(DEFAULT_CHUNK_SIZE, ge=1, le=5000)):
+    """Ingest multiple work orders at once.
+
+    Accepts ``{"works": [...], "source": "..."}`` JSON or an NDJSON stream
+    (``Content-Type: application/x-ndjson``); for NDJSON the source is taken
+    from the ``source`` query parameter. An ``Idempotency-Key`` header makes
+    retries safe.
+    """
     db: Session = SessionLocal()
-    errors = []
-    processed = 0
-    
+    context = {"source": source or "yggdrasil"}
+
+    def parse_json(body):
+        try:
+            payload = BulkIngestRequest.model_validate(body)
+        except ValidationError as e:
+            raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
+        context["source"] = source or payload.source or "yggdrasil"
+        return list(enumerate(payload.works))
+
+    def feed_batch(ingestor, batch):
+        for index, item in batch:
+            _feed(ingestor, index, item, context["source"])
+
     try:
-        for work in request.works:
-            try:
-                # Check if work already exists
-                existing_work = db.query(Work).filter(Work.numero_wr == work.numero_wr).first()
-                
-                if existing_work:
-                    # Update existing work
-                    if work.nome_cliente:
-                        existing_work.nome_cliente = work.nome_cliente
-                    if work.telefono_cliente:
-                        if not existing_work.extra_fields:
-                            existing_work.extra_fields = {}
-                        existing_work.extra_fields['telefono'] = work.telefono_cliente
-                    if work.indirizzo:
-                        existing_work.indirizzo = work.indirizzo
-                    if work.operatore:
-                        existing_work.operatore = work.operatore
-                    if work.tipo_lavoro:
-                        existing_work.tipo_lavoro = work.tipo_lavoro
-                    if work.note:
-                        existing_work.note = work.note
-                    if work.extra_fields:
-                        if not existing_work.extra_fields:
-                            existing_work.extra_fields = {}
-                        existing_work.extra_fields.update(work.extra_fields)
-                else:
-                    # Create new work
-                    new_work = Work(
-                        numero_wr=work.numero_wr,
-                        nome_cliente=work.nome_cliente,
-                        indirizzo=work.indirizzo,
-                        operatore=work.operatore,
-                        tipo_lavoro=work.tipo_lavoro,
-                        note=work.note,
-                        stato="aperto",
-                        data_apertura=datetime.now(),
-                        extra_fields={
-                            "telefono": work.telefono_cliente,
-                            "source": request.source or "yggdrasil",
-                            "data_appuntamento": work.data_appuntamento,
-                            **(work.extra_fields or {})
-                        }
-                    )
-                    db.add(new_work)
-                
-                processed += 1
-            except Exception as e:
-                errors.append(f"{work.numero_wr}: {str(e)}")
-        
-        db.commit()
-        
-        return IngestResponse(
-            ok=len(errors) == 0,
-            message=f"Bulk ingest from {request.source}: {processed} processed, {len(errors)} errors",
-            received=len(request.works),
-            processed=processed,
-            errors=errors
-        )
-    except Exception as e:
-        db.rollback()
-        return IngestResponse(
-            ok=False,
-            message=f"Bulk ingest failed: {str(e)}",
-            received=len(request.works),
-            processed=processed,
-            errors=[str(e)] + errors
+        ingestor = WorkIngestor(db, extra_mode="merge", chunk_size=chunk_size, event_note="yggdrasil-bulk")
+        return await run_bulk_ingest(
+            request, db, ingestor,
+            scope="ygg.ingest.bulk",
+            parse_json=parse_json,
+            feed_batch=feed_batch,
+            build_response=lambda summary: _response(summary, context["source"]).model_dump(),
         )
     finally:
         db.close()
@@ -1,20 +1,35 @@
 """
 Jobs Router - For managing background jobs and sync tasks
+
+Jobs are stored in the shared database (app/utils/jobs.py): they survive restarts
+and are run by the worker processes (python -m app.worker) or by the worker
+embedded in this API (JOBS_EMBEDDED_WORKER).
 """
 
-from fastapi import APIRouter, Depends, HTTPException, Header, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, Header
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
-from datetime import datetime
-import asyncio
+import re
+import sys
+import os
+
+# Add parent directory to path to import from main app
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from app.database import SessionLocal
+from app.models.models import Job
+from app.utils import jobs as job_queue
+from sqlalchemy.orm import Session
 
 router = APIRouter()
 
 # ============ Schemas ============
 
 class JobCreate(BaseModel):
-    job_type: str  # sync, backup, cleanup, etc.
+    job_type: str  # sync, reindex, backup, archive, cleanup
     params: Optional[Dict[str, Any]] = {}
+    priority: int = 0  # higher runs first
+    max_attempts: int = 3
 
 
 class JobStatus(BaseModel):
@@ -25,16 +40,15 @@ class JobStatus(BaseModel):
     message: Optional[str] = None
     created_at: str
     completed_at: Optional[str] = None
-
-
-# In-memory job storage (use Redis in production)
-jobs_store: Dict[str, JobStatus] = {}
-job_counter = 0
+    attempts: int = 0
+    max_attempts: int = 3
+    priority: int = 0
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
 
 
 # ============ Auth Dependency ============
 
-import os
 API_KEY = os.getenv("YGG_API_KEY", "your-secure-yggdrasil-key-here")
 
 async def verify_key(x_key: str = Header(..., alias="X-KEY")):
@@ -43,94 +57,82 @@ async def verify_key(x_key: str = Header(..., alias="X-KEY")):
     return x_key
 
 
-# ============ Background Tasks ============
-
-async def run_sync_job(job_id: str):
-    """Simulate a sync job"""
-    jobs_store[job_id].status = "running"
-    
-    for i in range(1, 101, 10):
-        await asyncio.sleep(0.5)  # Simulate work
-        jobs_store[job_id].progress = i
-        jobs_store[job_id].message = f"Syncing... {i}%"
-    
-    jobs_store[job_id].status = "completed"
-    jobs_store[job_id].progress = 100
-    jobs_store[job_id].completed_at = datetime.now().isoformat()
-    jobs_store[job_id].message = "Sync completed successfully"
-
-
-async def run_backup_job(job_id: str):
-    """Simulate a backup job"""
-    jobs_store[job_id].status = "running"
-    jobs_store[job_id].message = "Creating backup..."
-    
-    await asyncio.sleep(2)
-    
-    jobs_store[job_id].status = "completed"
-    jobs_store[job_id].progress = 100
-    jobs_store[job_id].completed_at = datetime.now().isoformat()
-    jobs_store[job_id].message = "Backup created"
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
 
 
-# ============ Endpoints ============
+# ============ Helpers ============
 
-@router.post("/create", dependencies=[Depends(verify_key)])
-async def create_job(job: JobCreate, background_tasks: BackgroundTasks):
-    """Create a new background job"""
-    global job_counter
-    job_counter += 1
-    job_id = f"job_{job_counter}_{datetime.now().strftime('%H%M%S')}"
-    
-    job_status = JobStatus(
-        job_id=job_id,
+def _job_id(job: Job) -> str:
+    return f"job_{job.id}"
+
+
+def _parse_job_id(job_id: str) -> Optional[int]:
+    # "job_12", "12" and the old in-memory ids "job_12_153012"
+    match = re.fullmatch(r"(?:job_)?(\d+)(?:_\d+)?", job_id)
+    return int(match.group(1)) if match else None
+
+
+def _to_status(job: Job) -> JobStatus:
+    return JobStatus(
+        job_id=_job_id(job),
         job_type=job.job_type,
-        status="pending",
-        progress=0,
-        created_at=datetime.now().isoformat()
+        status=job.status,
+        progress=job.progress or 0,
+        message=job.message,
+        created_at=job.created_at.isoformat() if job.created_at else "",
+        completed_at=job.completed_at.isoformat() if job.completed_at else None,
+        attempts=job.attempts or 0,
+        max_attempts=job.max_attempts,
+        priority=job.priority or 0,
+        result=job.result,
+        error=job.error,
     )
-    jobs_store[job_id] = job_status
-    
-    # Schedule background task
-    if job.job_type == "sync":
-        background_tasks.add_task(run_sync_job, job_id)
-    elif job.job_type == "backup":
-        background_tasks.add_task(run_backup_job, job_id)
-    else:
-        jobs_store[job_id].status = "failed"
-        jobs_store[job_id].message = f"Unknown job type: {job.job_type}"
-    
-    return {"ok": True, "job_id": job_id, "status": "pending"}
+
+
+# ============ Endpoints ============
+
+@router.post("/create", dependencies=[Depends(verify_key)])
+def create_job(job: JobCreate, db: Session = Depends(get_db)):
+    """Queue a new background job (unknown types are recorded as failed)"""
+    row = job_queue.enqueue(db, job.job_type, job.params, priority=job.priority, max_attempts=job.max_attempts)
+    return {"ok": True, "job_id": _job_id(row), "status": row.status}
 
 
 @router.get("/status/{job_id}", dependencies=[Depends(verify_key)])
-async def get_job_status(job_id: str):
+def get_job_status(job_id: str, db: Session = Depends(get_db)):
     """Get status of a specific job"""
-    if job_id not in jobs_store:
+    pk = _parse_job_id(job_id)
+    job = db.query(Job).filter(Job.id == pk).first() if pk is not None else None
+    if not job:
         raise HTTPException(status_code=404, detail="Job not found")
-    
-    return jobs_store[job_id]
+
+    return _to_status(job)
 
 
 @router.get("/list", dependencies=[Depends(verify_key)])
-async def list_jobs(status: Optional[str] = None):
-    """List all jobs, optionally filtered by status"""
-    jobs = list(jobs_store.values())
-    
+def list_jobs(status: Optional[str] = None, limit: int = 100, db: Session = Depends(get_db)):
+    """List jobs (newest first), optionally filtered by status"""
+    query = db.query(Job)
     if status:
-        jobs = [j for j in jobs if j.status == status]
-    
+        query = query.filter(Job.status == status)
+    total = query.count()
+    jobs = [_to_status(j) for j in query.order_by(Job.id.desc()).limit(max(1, min(limit, 1000))).all()]
+
     return {
         "jobs": jobs,
-        "total": len(jobs)
+        "total": total
     }
 
 
 @router.delete("/clear", dependencies=[Depends(verify_key)])
-async def clear_completed_jobs():
+def clear_completed_jobs(db: Session = Depends(get_db)):
     """Clear completed and failed jobs from the list"""
-    to_remove = [jid for jid, j in jobs_store.items() if j.status in ["completed", "failed"]]
-    for jid in to_remove:
-        del jobs_store[jid]
-    
-    return {"ok": True, "cleared": len(to_remove)}
+    cleared = db.query(Job).filter(Job.status.in_(job_queue.FINISHED)).delete(synchronize_session=False)
+    db.commit()
+
+    return {"ok": True, "cleared": cleared}
@@ -2,10 +2,22 @@
 Manual Router - For manual data entry and management
 """
 
-from fastapi import APIRouter, Depends, HTTPException, Header
+from fastapi import APIRouter, Depends, HTTPException, Header, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
 from typing import Optional, List, Dict, Any
 from datetime import datetime
+import sys
+import os
+
+# Add parent directory to path to import from main app
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from app.database import SessionLocal
+from app.utils import replication
+from sqlalchemy.orm import Session
 
 router = APIRouter()
 
@@ -132,22 +144,37 @@ async def list_technicians():
 
 
 # ============ Sync Endpoints ============
+# Server side of the replication protocol (app/utils/replication.py): the node
+# running the sync engine pulls our deltas and pushes its own. Bodies are JSON,
+# gzip-compressed when sent with Content-Encoding: gzip.
+
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
 
 @router.post("/sync/push", dependencies=[Depends(verify_key)])
-async def push_to_remote():
-    """Push local changes to remote server"""
-    return {
-        "ok": True,
-        "message": "Push initiated",
-        "timestamp": datetime.now().isoformat()
-    }
+async def push_to_remote(request: Request, db: Session = Depends(get_db)):
+    """Apply a batch of changes pushed by a peer (rows changed here meanwhile are rejected with their state)"""
+    body = replication.decode_payload(await request.body(), request.headers.get("content-encoding"))
+    result = await run_in_threadpool(replication.apply_push, db, body.get("changes") or [])
+    return _payload_response(request, result)
 
 
 @router.post("/sync/pull", dependencies=[Depends(verify_key)])
-async def pull_from_remote():
-    """Pull changes from remote server"""
-    return {
-        "ok": True,
-        "message": "Pull initiated",
-        "timestamp": datetime.now().isoformat()
-    }
+async def pull_from_remote(request: Request, db: Session = Depends(get_db)):
+    """Changes recorded here after the peer's cursor, by natural key"""
+    body = replication.decode_payload(await request.body(), request.headers.get("content-encoding"))
+    limit = max(1, min(int(body.get("limit") or replication.BATCH_SIZE), 5000))
+    result = await run_in_threadpool(replication.export_changes, db, int(body.get("since") or 0), limit)
+    return _payload_response(request, result)
+
+
+def _payload_response(request: Request, result: dict) -> Response:
+    if "gzip" in (request.headers.get("accept-encoding") or ""):
+        return Response(replication.encode_payload(result), media_type="application/json",
+                        headers={"Content-Encoding": "gzip"})
+    return JSONResponse(jsonable_encoder(result))